@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+设备数据采集服务
+周期性读取所有设备的属性值并写入历史数据，由事件引擎计算事件状态，
+数值属性送入流式异常检测器评分，并把属性值变化、事件状态跳变和异常状态变化推送到实时推送中心。
+"""
+
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+from models import db, Device, DeviceType, DeviceProperty, DevicePropertyBinding, PropertyHistory, EventHistory
+from models import DerivedSeriesPoint, DeviceEvent
+from event_engine import event_engine, evaluate_expression, to_number
+from ingest_filter import exception_filter, deadband_config
+from anomaly import anomaly_detector
+from root_cause import latest_event_states
+
+logger = logging.getLogger(__name__)
+
+# 数据来源，与设备监控页面的标签一致
+SOURCE_REGISTER = 'register'
+SOURCE_CALCULATION = 'calculation'
+SOURCE_SIMULATION = 'simulation'
+
+
+def simulate_value(prop):
+    """为未绑定的属性生成模拟值"""
+    if prop.data_type not in ('int', 'float'):
+        return None
+    if prop.min_value is not None and prop.max_value is not None:
+        return round(random.uniform(prop.min_value, prop.max_value), 2)
+    return round(random.uniform(0, 100), 2)
+
+
+class AcquisitionService:
+    """
+    设备数据采集服务
+    read_point_values 为读取Modbus点位当前值的函数，返回 {point_id: value}
+    diagnosis 为诊断任务队列，事件跳变为触发状态时提交决策树诊断
+    """
+    
+    def __init__(self, app, read_point_values, hub, interval=10.0, diagnosis=None):
+        self.app = app
+        self.read_point_values = read_point_values
+        self.hub = hub
+        self.interval = interval
+        self.diagnosis = diagnosis
+        self.running = False
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.latest_values = {}  # device_id → {property_id: 属性消息}
+        self.event_states = {}  # (device_id, event_id) → 事件消息
+    
+    def start(self):
+        """启动采集线程"""
+        if self.running:
+            return
+        with self.app.app_context():
+            self.load_event_states()
+        self.running = True
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("设备数据采集线程已启动")
+    
+    def stop(self):
+        """停止采集线程"""
+        self.running = False
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        logger.info("设备数据采集线程已停止")
+    
+    def load_event_states(self):
+        """
+        以事件历史中每个设备事件的最后一条状态作为初始状态，
+        服务重启后只有真正发生跳变的事件才写入历史和提交诊断
+        """
+        rows = db.session.execute(
+            latest_event_states()
+            .add_columns(Device.name.label('device_name'), DeviceEvent.identifier,
+                         DeviceEvent.name.label('event_name'), DeviceEvent.level)
+            .join(Device, Device.id == EventHistory.device_id)
+            .join(DeviceEvent, DeviceEvent.id == EventHistory.event_id)
+        ).all()
+        states = {
+            (row.device_id, row.event_id): {
+                'device_id': row.device_id,
+                'device_name': row.device_name,
+                'event_id': row.event_id,
+                'identifier': row.identifier,
+                'name': row.event_name,
+                'level': row.level,
+                'status': row.status,
+                'timestamp': row.timestamp.isoformat() if row.timestamp else None
+            }
+            for row in rows
+        }
+        with self._lock:
+            self.event_states = states
+    
+    def _worker(self):
+        while self.running:
+            started = time.time()
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"设备数据采集出错: {e}")
+                import traceback
+                traceback.print_exc()
+            self._stop_event.wait(max(0.0, self.interval - (time.time() - started)))
+    
+    def run_once(self, now=None):
+        """执行一轮采集：读取属性值 → 写入历史 → 计算事件状态"""
+        now = now or datetime.utcnow()
+        with self.app.app_context():
+            try:
+                point_values = self.read_point_values() or {}
+                
+                properties_by_type = {}
+                for prop in DeviceProperty.query.all():
+                    properties_by_type.setdefault(prop.device_type_id, []).append(prop)
+                devices_by_type = {}
+                for device in Device.query.all():
+                    devices_by_type.setdefault(device.type, []).append(device)
+                bindings = {
+                    (device_id, property_id): (modbus_point_id, expression)
+                    for device_id, property_id, modbus_point_id, expression in db.session.query(
+                        DevicePropertyBinding.device_id,
+                        DevicePropertyBinding.property_id,
+                        DevicePropertyBinding.modbus_point_id,
+                        DevicePropertyBinding.calculation_expression
+                    ).all()
+                }
+                
+                history_rows = []
+                samples = []
+                pending_events = []
+                for device_type in DeviceType.query.all():
+                    devices = devices_by_type.get(device_type.name)
+                    if not devices:
+                        continue
+                    properties = properties_by_type.get(device_type.id, [])
+                    device_values = {
+                        device.id: self._acquire_device(device, properties, bindings, point_values, now, history_rows, samples)
+                        for device in devices
+                    }
+                    pending_events.append((device_type.id, devices, device_values))
+                
+                if history_rows:
+                    db.session.execute(PropertyHistory.__table__.insert(), history_rows)
+                    db.session.flush()
+                
+                event_rows = []
+                triggered = []
+                for device_type_id, devices, device_values in pending_events:
+                    if not event_engine.get_program(device_type_id).events:
+                        continue
+                    results = event_engine.evaluate_devices(device_type_id, device_values, now)
+                    for device in devices:
+                        changed = self._update_event_states(device, results[device.id], now, event_rows)
+                        triggered.extend(
+                            (device_type_id, device.id, result, device_values[device.id])
+                            for result in changed if result['triggered']
+                        )
+                
+                if event_rows:
+                    db.session.execute(EventHistory.__table__.insert(), event_rows)
+                
+                anomaly_messages = []
+                if samples:
+                    keys = [(device_id, prop.id) for device_id, prop, _ in samples]
+                    changed = anomaly_detector.update(keys, [value for _, _, value in samples], now)
+                    if changed:
+                        sampled = {(device_id, prop.id): prop for device_id, prop, _ in samples}
+                        anomaly_messages = [
+                            self._anomaly_message(device_id, sampled[(device_id, property_id)], score, anomalous, now)
+                            for device_id, property_id, score, anomalous in changed
+                        ]
+                    score_rows = anomaly_detector.persist_rows(now)
+                    if score_rows:
+                        db.session.execute(DerivedSeriesPoint.__table__.insert(), score_rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            
+            for message in anomaly_messages:
+                self.hub.publish(f'device:{message["device_id"]}', f'anomaly:{message["property_id"]}', 'anomaly', message)
+            
+            # 事件历史提交后再提交诊断任务，队列已满时直接丢弃，不阻塞采集
+            if self.diagnosis is not None:
+                for device_type_id, device_id, result, values in triggered:
+                    self.diagnosis.submit(device_type_id, device_id, result['event_id'], result['identifier'], values, now)
+    
+    def _acquire_device(self, device, properties, bindings, point_values, now, history_rows, samples):
+        """读取单台设备的全部属性值，返回 {属性标识符: 值}；数值属性的采样追加到 samples 供异常检测"""
+        values = {}
+        calculated = []
+        acquired = []
+        for prop in properties:
+            modbus_point_id, expression = bindings.get((device.id, prop.id), (None, None))
+            if modbus_point_id:
+                value, source = point_values.get(modbus_point_id), SOURCE_REGISTER
+            elif expression:
+                calculated.append((prop, expression))
+                continue
+            else:
+                value, source = simulate_value(prop), SOURCE_SIMULATION
+            if value is not None:
+                values[prop.identifier] = value
+            acquired.append((prop, value, source))
+        
+        # 计算属性只引用非计算属性，避免循环依赖（与前端一致）
+        numeric_values = {identifier: to_number(value) for identifier, value in values.items()}
+        for prop, expression in calculated:
+            try:
+                result = evaluate_expression(expression, numeric_values)
+                value = round(float(result), 2)
+            except Exception as e:
+                logger.warning(f"设备 {device.id} 属性 {prop.identifier} 计算失败: {e}")
+                value = None
+            if value is not None:
+                values[prop.identifier] = value
+            acquired.append((prop, value, SOURCE_CALCULATION))
+        
+        for prop, value, source in acquired:
+            if value is None:
+                continue
+            # 例外报告：只有超出死区、旋转门转折点或心跳到期的采样才写入历史
+            for timestamp, stored_value in exception_filter.offer(device.id, prop.id, deadband_config(prop), str(value), now):
+                history_rows.append({
+                    'device_id': device.id,
+                    'property_id': prop.id,
+                    'value': stored_value,
+                    'timestamp': timestamp
+                })
+            self._publish_property(device, prop, value, source, now)
+            if prop.data_type in ('int', 'float'):
+                number = to_number(value)
+                if isinstance(number, float):
+                    samples.append((device.id, prop, number))
+        return values
+    
+    def _publish_property(self, device, prop, value, source, now):
+        """记录最新属性值，只有值或来源变化时才推送"""
+        message = {
+            'device_id': device.id,
+            'property_id': prop.id,
+            'identifier': prop.identifier,
+            'value': value,
+            'source': source,
+            'timestamp': now.isoformat()
+        }
+        with self._lock:
+            device_values = self.latest_values.setdefault(device.id, {})
+            previous = device_values.get(prop.id)
+            device_values[prop.id] = message
+        if previous is None or previous['value'] != value or previous['source'] != source:
+            self.hub.publish(f'device:{device.id}', f'property:{prop.id}', 'property', message)
+    
+    @staticmethod
+    def _anomaly_message(device_id, prop, score, anomalous, now):
+        """属性异常状态变化的推送消息"""
+        return {
+            'device_id': device_id,
+            'property_id': prop.id,
+            'identifier': prop.identifier,
+            'name': prop.name,
+            'score': round(score, 3),
+            'status': 'anomalous' if anomalous else 'normal',
+            'timestamp': now.isoformat()
+        }
+    
+    def _update_event_states(self, device, results, now, event_rows):
+        """比较事件状态，状态跳变时写入事件历史并推送，返回发生跳变的事件结果"""
+        changed = []
+        for result in results:
+            status = 'triggered' if result['triggered'] else 'normal'
+            key = (device.id, result['event_id'])
+            with self._lock:
+                previous = self.event_states.get(key)
+                if previous is not None and previous['status'] == status:
+                    continue
+                message = {
+                    'device_id': device.id,
+                    'device_name': device.name,
+                    'event_id': result['event_id'],
+                    'identifier': result['identifier'],
+                    'name': result['name'],
+                    'level': result['level'],
+                    'status': status,
+                    'timestamp': now.isoformat()
+                }
+                self.event_states[key] = message
+            event_rows.append({
+                'device_id': device.id,
+                'event_id': result['event_id'],
+                'status': status,
+                'timestamp': now
+            })
+            stream_key = f'event:{device.id}:{result["event_id"]}'
+            self.hub.publish(f'device:{device.id}', stream_key, 'event', message)
+            self.hub.publish('alarms', stream_key, 'event', message)
+            changed.append(result)
+        return changed
+    
+    def current_values(self, device_ids):
+        """返回设备最近一轮采集的属性值 {device_id: {属性标识符: 值}}"""
+        with self._lock:
+            return {
+                device_id: {m['identifier']: m['value'] for m in self.latest_values.get(device_id, {}).values()}
+                for device_id in device_ids
+            }
+    
+    def device_snapshot(self, device_id):
+        """设备的当前状态快照 [(键, 事件名, 消息)]"""
+        with self._lock:
+            properties = list(self.latest_values.get(device_id, {}).values())
+            events = [m for (d, _), m in self.event_states.items() if d == device_id]
+        return (
+            [(f'property:{message["property_id"]}', 'property', message) for message in properties] +
+            [(f'event:{device_id}:{message["event_id"]}', 'event', message) for message in events]
+        )
+    
+    def prime_device(self, device_id):
+        """返回设备订阅的快照推送函数"""
+        def prime(subscriber):
+            for key, event, message in self.device_snapshot(device_id):
+                subscriber.push(key, event, message)
+        return prime
+    
+    def active_alarms(self):
+        """当前处于触发状态的事件 [{device_id, event_id}]"""
+        with self._lock:
+            return [
+                {'device_id': m['device_id'], 'event_id': m['event_id']}
+                for m in self.event_states.values() if m['status'] == 'triggered'
+            ]
+    
+    def alarm_snapshot(self):
+        """当前处于触发状态的全部事件 [(键, 事件名, 消息)]"""
+        with self._lock:
+            events = [m for m in self.event_states.values() if m['status'] == 'triggered']
+        return [(f'event:{message["device_id"]}:{message["event_id"]}', 'event', message) for message in events]
+    
+    def prime_alarms(self, subscriber):
+        """推送当前处于触发状态的全部事件"""
+        for key, event, message in self.alarm_snapshot():
+            subscriber.push(key, event, message)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+数据分析结果缓存
+缓存键是（分析方法与参数、点位、各点位的清洗配置、时间范围、算法版本）的哈希，
+缓存项保存结果、可合并的中间统计量以及数据截止时间前各点位历史数据的指纹。
+再次运行时：指纹不变直接返回缓存结果；只在截止时间之后有新数据、且清洗流水线逐采样独立时，
+只处理新增的尾部数据并与中间统计量合并；其余情况全量重新计算。
+"""
+
+import hashlib
+import json
+from datetime import datetime
+
+from models import db, AnalysisResultCache, DataAnalysisProject, DataAnalysisResult
+from timeseries import point_fingerprint, parse_utc_time
+from analysis_engine import (
+    ANALYSIS_VERSION, AnalysisError, PointLoader, analyze, extend_instance, instance_indexes, parse_json_field, summarize
+)
+
+
+def cache_key(instance, selected_points, loader, start=None, end=None):
+    """分析实例在给定时间范围内的内容哈希（end 为空表示截止到当前）"""
+    indexes = instance_indexes(instance, selected_points)
+    content = {
+        'version': ANALYSIS_VERSION,
+        'method': instance.get('method'),
+        'degree': instance.get('polynomialDegree', 2) if instance.get('method') == 'trend' else None,
+        'points': [[selected_points[i].get('deviceId'), selected_points[i].get('id')] for i in indexes],
+        'pipelines': [loader.pipeline_config(i) for i in indexes],
+        'start': start.isoformat() if start else None,
+        'end': end.isoformat() if end else None
+    }
+    text = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _fingerprints(instance, selected_points, start, end):
+    """返回 (各点位的 [行数, 最大ID] JSON 文本, 范围内最新的采样时间)"""
+    fingerprints, latest = [], None
+    for i in instance_indexes(instance, selected_points):
+        count, max_id, timestamp = point_fingerprint(selected_points[i]['deviceId'], selected_points[i]['id'], start, end)
+        fingerprints.append([count, max_id])
+        if timestamp is not None and (latest is None or timestamp > latest):
+            latest = timestamp
+    return json.dumps(fingerprints), latest
+
+
+def run_cached(instance, selected_points, loader, start=None, end=None, project_id=None, refresh=False):
+    """
+    带缓存执行分析实例
+    返回 (结果字典, 缓存状态, 缓存项)，缓存状态为 cached（直接命中）、incremental（合并新增数据）
+    或 computed（全量计算）；refresh 为 True 时忽略已有缓存
+    结果覆盖到范围内最新的采样时间，之后写入的数据在下次运行时作为新增尾部处理
+    """
+    key = cache_key(instance, selected_points, loader, start, end)
+    fingerprint, as_of = _fingerprints(instance, selected_points, start, end)
+    if as_of is None:
+        as_of = end or datetime.utcnow()
+    
+    entry = AnalysisResultCache.query.filter_by(cache_key=key).first()
+    status = 'computed'
+    if entry is not None and not refresh:
+        if entry.fingerprint == fingerprint:
+            entry.hits += 1
+            return json.loads(entry.result), 'cached', entry
+        # 上次截止时间之前的数据没有变化时，只处理之后的新增数据
+        indexes = instance_indexes(instance, selected_points)
+        if as_of > entry.as_of and all(loader.stateless(i) for i in indexes) and \
+                _fingerprints(instance, selected_points, start, entry.as_of)[0] == entry.fingerprint:
+            result, state = extend_instance(instance, selected_points, json.loads(entry.state), as_of, loader)
+            status = 'incremental'
+    if status == 'computed':
+        result, state = analyze(instance, selected_points, start, as_of, loader)
+    
+    if entry is None:
+        entry = AnalysisResultCache(cache_key=key, hits=0)
+        db.session.add(entry)
+    entry.project_id = project_id
+    entry.instance_id = str(instance.get('id')) if instance.get('id') is not None else None
+    entry.as_of = as_of
+    entry.fingerprint = fingerprint
+    entry.state = json.dumps(state)
+    entry.result = json.dumps(result, ensure_ascii=False)
+    entry.result_id = None
+    return result, status, entry
+
+
+def select_instances(project, options):
+    """
+    按运行选项确定点位、清洗配置和要执行的分析实例
+    选项中可带上页面上尚未保存的配置，否则使用项目中保存的配置
+    """
+    selected_points = parse_json_field(options.get('selected_points', project.selected_points), [])
+    instances = parse_json_field(options.get('analysis_instances', project.analysis_instances), [])
+    instance_ids = options.get('instance_ids')
+    if instance_ids is not None:
+        run_instances = [instance for instance in instances if instance.get('id') in instance_ids]
+    else:
+        run_instances = instances
+    return selected_points, instances, run_instances
+
+
+def run_project_analysis(project_id, options, progress=None):
+    """
+    执行数据分析项目的分析实例并保存分析结果，返回各实例的执行结果列表
+    progress(已完成数, 总数, 说明) 用于报告进度
+    """
+    project = db.session.get(DataAnalysisProject, project_id)
+    if project is None:
+        raise AnalysisError('项目不存在')
+    selected_points, instances, run_instances = select_instances(project, options)
+    if not run_instances:
+        raise AnalysisError('没有可执行的分析实例')
+    cleaning_instances = parse_json_field(options.get('data_cleaning_instances', project.data_cleaning_instances), [])
+    feature_instances = parse_json_field(options.get('feature_extraction_instances', project.feature_extraction_instances), [])
+    start = parse_utc_time(options.get('start_time'))
+    end = parse_utc_time(options.get('end_time'))
+    
+    outcomes = []
+    loader = PointLoader(selected_points, cleaning_instances, feature_instances)
+    refresh = bool(options.get('refresh'))
+    for position, instance in enumerate(run_instances):
+        if progress is not None:
+            progress(position, len(run_instances), f"执行分析实例 {instance.get('id')}")
+        try:
+            result, cache_status, cache_entry = run_cached(
+                instance, selected_points, loader, start, end, project_id, refresh
+            )
+        except AnalysisError as e:
+            outcomes.append({
+                'instance_id': instance.get('id'),
+                'success': False,
+                'message': str(e)
+            })
+            continue
+        
+        instance['result'] = result
+        # 缓存直接命中时复用已保存的分析结果记录
+        if cache_status != 'cached' or cache_entry.result_id is None:
+            points = [selected_points[dp['index']] for dp in instance.get('dataPoints') or []]
+            analysis_result = DataAnalysisResult(
+                project_id=project_id,
+                name=f"{instance.get('method')}-{instance.get('id')}",
+                data_points=json.dumps(points, ensure_ascii=False),
+                chart_data='',
+                statistics=json.dumps(result, ensure_ascii=False),
+                analysis_result=summarize(result)
+            )
+            db.session.add(analysis_result)
+            db.session.flush()
+            cache_entry.result_id = analysis_result.id
+        outcomes.append({
+            'instance_id': instance.get('id'),
+            'success': True,
+            'result_id': cache_entry.result_id,
+            'cache': cache_status,
+            'result': result
+        })
+    
+    # 使用项目中保存的分析实例时，把结果写回项目
+    if 'analysis_instances' not in options:
+        project.analysis_instances = json.dumps(instances, ensure_ascii=False)
+    db.session.commit()
+    return outcomes
+
+
+def clear_project_cache(project_id):
+    """删除项目的全部缓存结果"""
+    AnalysisResultCache.query.filter_by(project_id=project_id).delete()
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+"""
+数据分析引擎
+读取数据分析项目的选中点位和分析实例配置，按全分辨率加载历史数据，
+经过项目配置的数据清洗流水线后，用 NumPy 计算描述性统计、线性/多项式趋势和相关性矩阵。
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from timeseries import load_point_series, iter_point_chunks, align_series
+from cleaning import CleaningError, applicable_instances, build_pipeline
+
+
+# 趋势判定阈值（每个采样的斜率），与前端趋势分析一致
+TREND_SLOPE_THRESHOLD = 0.1
+
+# 分析算法版本，计算方法变化时递增，使缓存的分析结果失效
+ANALYSIS_VERSION = 1
+
+# 描述性统计中间状态的直方图桶数
+HISTOGRAM_BINS = 1024
+
+
+class AnalysisError(ValueError):
+    """分析配置或数据不满足要求"""
+
+
+def parse_json_field(text, default):
+    """解析项目中以 JSON 文本保存的字段"""
+    if not text:
+        return default
+    if isinstance(text, (list, dict)):
+        return text
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return default
+
+
+class PointLoader:
+    """
+    点位序列加载器，loader(index, start, end) 加载第 index 个选中点位的序列
+    点位配置了清洗或特征提取时分块流过清洗流水线，否则直接加载；
+    同一次运行中多个分析实例引用同一点位时只加载一次
+    """
+    
+    def __init__(self, selected_points, cleaning_instances=None, feature_instances=None):
+        self.selected_points = selected_points
+        self.cleaning_instances = cleaning_instances or []
+        self.feature_instances = feature_instances or []
+        self._pipelines = {}
+        self._cache = {}
+    
+    def pipeline(self, index):
+        if index not in self._pipelines:
+            try:
+                self._pipelines[index] = build_pipeline(self.cleaning_instances, self.feature_instances, index)
+            except CleaningError as e:
+                raise AnalysisError(f'数据清洗配置错误: {e}')
+        return self._pipelines[index]
+    
+    def pipeline_config(self, index):
+        """作用于该点位的清洗和特征提取配置（用于缓存键）"""
+        try:
+            instances = applicable_instances(self.cleaning_instances, self.feature_instances, index)
+        except CleaningError as e:
+            raise AnalysisError(f'数据清洗配置错误: {e}')
+        return [[kind, instance.get('type'), instance.get('config') or {}] for kind, instance in instances]
+    
+    def stateless(self, index):
+        """该点位的流水线是否可以只处理新增数据"""
+        return self.pipeline(index).stateless
+    
+    def __call__(self, index, start=None, end=None):
+        key = (index, start, end)
+        if key not in self._cache:
+            point = self.selected_points[index]
+            pipeline = self.pipeline(index)
+            if pipeline:
+                self._cache[key] = pipeline.collect(lambda: iter_point_chunks(point['deviceId'], point['id'], start, end))
+            else:
+                self._cache[key] = load_point_series(point['deviceId'], point['id'], start, end)
+        return self._cache[key]
+
+
+def to_seconds(times):
+    """datetime64 时间戳转为相对第一个采样的秒数"""
+    if times.size == 0:
+        return np.empty(0, dtype=np.float64)
+    return (times - times[0]).astype('timedelta64[us]').astype(np.float64) / 1e6
+
+
+def descriptive_stats(values):
+    """描述性统计"""
+    if values.size == 0:
+        raise AnalysisError('没有有效的数值数据进行分析')
+    q25, q50, q75 = np.quantile(values, [0.25, 0.5, 0.75])
+    return {
+        'count': int(values.size),
+        'minValue': round(float(values.min()), 4),
+        'maxValue': round(float(values.max()), 4),
+        'mean': round(float(values.mean()), 4),
+        'variance': round(float(values.var()), 4),
+        'std': round(float(values.std()), 4),
+        'q25': round(float(q25), 4),
+        'q50': round(float(q50), 4),
+        'q75': round(float(q75), 4)
+    }
+
+
+def trend_analysis(times, values, degree=2):
+    """
+    线性趋势（按采样序号和按时间两种斜率）及多项式拟合
+    多项式以小时为自变量，返回从高次到低次的系数
+    """
+    if values.size < 2:
+        raise AnalysisError('数据点不足，无法进行趋势分析')
+    index = np.arange(values.size, dtype=np.float64)
+    slope, intercept = np.polyfit(index, values, 1)
+    hours = to_seconds(times) / 3600.0
+    slope_per_hour = 0.0
+    if hours[-1] > 0:
+        slope_per_hour = float(np.polyfit(hours, values, 1)[0])
+    
+    trend_type = '无明显趋势'
+    if slope > TREND_SLOPE_THRESHOLD:
+        trend_type = '上升趋势'
+    elif slope < -TREND_SLOPE_THRESHOLD:
+        trend_type = '下降趋势'
+    
+    result = {
+        'slope': round(float(slope), 6),
+        'intercept': round(float(intercept), 6),
+        'slopePerHour': round(slope_per_hour, 6),
+        'type': trend_type,
+        'rSquared': round(_r_squared(values, slope * index + intercept), 6)
+    }
+    degree = max(1, min(int(degree), values.size - 1))
+    if degree > 1 and hours[-1] > 0:
+        coefficients = np.polyfit(hours, values, degree)
+        result['polynomial'] = {
+            'degree': degree,
+            'coefficients': [round(float(c), 8) for c in coefficients],
+            'rSquared': round(_r_squared(values, np.polyval(coefficients, hours)), 6)
+        }
+    return result
+
+
+def _r_squared(values, fitted):
+    total = float(((values - values.mean()) ** 2).sum())
+    if total == 0:
+        return 1.0
+    return 1.0 - float(((values - fitted) ** 2).sum()) / total
+
+
+def _aligned_matrix(series):
+    """线性插值到各序列时间戳的并集上，只保留所有序列都有值的时刻（即公共时间段）"""
+    if len(series) < 2:
+        raise AnalysisError('相关性分析需要至少两个数据点')
+    for times, _ in series:
+        if times.size < 2:
+            raise AnalysisError('数据点不足，无法进行相关性分析')
+    aligned = align_series(series, method='linear')
+    matrix = aligned.values[:, aligned.mask.all(axis=0)]
+    if matrix.shape[1] < 2:
+        raise AnalysisError('数据点之间没有足够的重叠采样')
+    return matrix
+
+
+def correlation_analysis(series, matrix=None):
+    """时间对齐后的协方差矩阵和相关系数矩阵"""
+    if matrix is None:
+        matrix = _aligned_matrix(series)
+    covariance = np.cov(matrix, bias=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.corrcoef(matrix)
+    correlation = np.nan_to_num(correlation)
+    return {
+        'alignedSamples': int(matrix.shape[1]),
+        'covarianceMatrix': [[round(float(x), 4) for x in row] for row in covariance],
+        'correlationMatrix': [[round(float(x), 4) for x in row] for row in correlation]
+    }
+
+
+def _point_name(point):
+    return f"{point.get('deviceName', '')} - {point.get('name', '')}"
+
+
+def instance_indexes(instance, selected_points):
+    """校验分析实例，返回其引用的选中点位下标列表"""
+    method = instance.get('method')
+    if instance.get('type') != 'descriptive' or method not in ('descriptive', 'trend', 'correlation'):
+        raise AnalysisError('此分析类型的分析方法待定义')
+    
+    indexes = []
+    for data_point in instance.get('dataPoints') or []:
+        index = data_point.get('index')
+        if not isinstance(index, int) or not 0 <= index < len(selected_points):
+            raise AnalysisError('数据点不存在')
+        indexes.append(index)
+    if not indexes:
+        raise AnalysisError('请至少选择一个数据点')
+    return indexes
+
+
+def run_instance(instance, selected_points, start=None, end=None, loader=None):
+    """
+    执行单个分析实例，返回与前端 instance.result 结构一致的结果字典
+    loader(index, start, end) 用于加载第 index 个选中点位的序列，默认不做清洗
+    """
+    return analyze(instance, selected_points, start, end, loader)[0]
+
+
+def analyze(instance, selected_points, start=None, end=None, loader=None):
+    """执行单个分析实例，返回 (结果字典, 可合并的中间状态)，中间状态用于之后只处理新增数据"""
+    indexes = instance_indexes(instance, selected_points)
+    loader = loader or PointLoader(selected_points)
+    method = instance['method']
+    
+    series = [loader(index, start, end) for index in indexes]
+    if method == 'descriptive':
+        times, values = series[0]
+        result = {'type': 'descriptive', 'stats': descriptive_stats(values)}
+        state = descriptive_state(values)
+    elif method == 'trend':
+        times, values = series[0]
+        degree = instance.get('polynomialDegree', 2)
+        result = {'type': 'trend', 'trend': trend_analysis(times, values, degree)}
+        state = trend_state(times, values, degree)
+    else:
+        matrix = _aligned_matrix(series)
+        result = correlation_analysis(series, matrix)
+        result['type'] = 'correlation'
+        result['dataPointNames'] = [_point_name(selected_points[index]) for index in indexes]
+        state = correlation_state(series, matrix)
+    
+    if end is not None:
+        state['until'] = _to_micros(end)
+    else:
+        state['until'] = max((int(_to_micros(times[-1])) for times, _ in series if times.size), default=0)
+    return result, state
+
+
+def extend_instance(instance, selected_points, state, end, loader=None):
+    """
+    只加载中间状态截止时间之后、end 之前的新增数据，与中间状态合并
+    返回 (结果字典, 新的中间状态)；点位的清洗流水线必须是逐采样独立的
+    """
+    indexes = instance_indexes(instance, selected_points)
+    loader = loader or PointLoader(selected_points)
+    method = instance['method']
+    state = dict(state)
+    after = _from_micros(state['until'] + 1)
+    
+    if method == 'descriptive':
+        _, values = loader(indexes[0], after, end)
+        if values.size:
+            state = merge_descriptive_states(state, descriptive_state(values))
+        result = {'type': 'descriptive', 'stats': descriptive_from_state(state)}
+    elif method == 'trend':
+        times, values = loader(indexes[0], after, end)
+        if values.size:
+            state = accumulate_trend_state(state, times, values)
+        result = {'type': 'trend', 'trend': trend_from_state(state)}
+    else:
+        # 相关性需要从公共时间段的终点之后重新对齐
+        after = _from_micros(state['boundary'] + 1)
+        state = extend_correlation_state(state, [loader(index, after, end) for index in indexes])
+        result = correlation_from_state(state)
+        result['type'] = 'correlation'
+        result['dataPointNames'] = [_point_name(selected_points[index]) for index in indexes]
+    
+    state['until'] = max(state['until'], _to_micros(end))
+    return result, state
+
+
+def _to_micros(value):
+    """datetime / datetime64 转为 int64 微秒"""
+    return int(np.datetime64(value, 'us').astype(np.int64))
+
+
+def _from_micros(value):
+    return datetime(1970, 1, 1) + timedelta(microseconds=int(value))
+
+
+# 可合并的中间统计量
+# 描述性统计：样本数、均值、离差平方和、极值及覆盖 [min, max] 的等宽直方图（合并后分位数由直方图插值，
+# 误差不超过一个桶宽）；趋势：按采样序号和按小时的回归充分统计量；相关性：对齐采样的一阶和与交叉积
+
+
+def _histogram(values, low, high):
+    counts, _ = np.histogram(values, bins=HISTOGRAM_BINS, range=(low, high if high > low else low + 1.0))
+    return counts
+
+
+def descriptive_state(values):
+    if values.size == 0:
+        raise AnalysisError('没有有效的数值数据进行分析')
+    low, high = float(values.min()), float(values.max())
+    mean = float(values.mean())
+    return {
+        'count': int(values.size),
+        'mean': mean,
+        'm2': float(((values - mean) ** 2).sum()),
+        'min': low,
+        'max': high,
+        'histogram': _histogram(values, low, high).tolist()
+    }
+
+
+def merge_descriptive_states(left, right):
+    """按 Chan 并行算法合并均值和方差，直方图按桶中心重新分桶到合并后的值域"""
+    count = left['count'] + right['count']
+    delta = right['mean'] - left['mean']
+    low, high = min(left['min'], right['min']), max(left['max'], right['max'])
+    histogram = np.zeros(HISTOGRAM_BINS)
+    for part in (left, right):
+        part_high = part['max'] if part['max'] > part['min'] else part['min'] + 1.0
+        width = (part_high - part['min']) / HISTOGRAM_BINS
+        centers = part['min'] + (np.arange(HISTOGRAM_BINS) + 0.5) * width
+        centers = np.clip(centers, part['min'], part['max'])
+        histogram += np.histogram(centers, bins=HISTOGRAM_BINS, range=(low, high if high > low else low + 1.0),
+                                  weights=np.asarray(part['histogram'], dtype=np.float64))[0]
+    merged = dict(left)
+    merged.update({
+        'count': count,
+        'mean': left['mean'] + delta * right['count'] / count,
+        'm2': left['m2'] + right['m2'] + delta * delta * left['count'] * right['count'] / count,
+        'min': low,
+        'max': high,
+        'histogram': histogram.tolist()
+    })
+    return merged
+
+
+def _histogram_quantiles(state, quantiles):
+    counts = np.asarray(state['histogram'], dtype=np.float64)
+    low, high = state['min'], state['max']
+    if high <= low:
+        return [low] * len(quantiles)
+    edges = np.linspace(low, high, HISTOGRAM_BINS + 1)
+    cumulative = np.cumsum(counts)
+    targets = np.asarray(quantiles) * cumulative[-1]
+    bins = np.minimum(np.searchsorted(cumulative, targets), HISTOGRAM_BINS - 1)
+    before = cumulative[bins] - counts[bins]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(counts[bins] > 0, (targets - before) / counts[bins], 0.0)
+    return np.clip(edges[bins] + fraction * (edges[bins + 1] - edges[bins]), low, high).tolist()
+
+
+def descriptive_from_state(state):
+    """由中间状态生成描述性统计"""
+    variance = state['m2'] / state['count']
+    q25, q50, q75 = _histogram_quantiles(state, [0.25, 0.5, 0.75])
+    return {
+        'count': int(state['count']),
+        'minValue': round(state['min'], 4),
+        'maxValue': round(state['max'], 4),
+        'mean': round(state['mean'], 4),
+        'variance': round(variance, 4),
+        'std': round(float(np.sqrt(variance)), 4),
+        'q25': round(q25, 4),
+        'q50': round(q50, 4),
+        'q75': round(q75, 4)
+    }
+
+
+def trend_state(times, values, degree=2):
+    """以第一个采样的时刻为小时原点、第一个采样值为偏移，累加回归所需的各阶和"""
+    if values.size == 0:
+        raise AnalysisError('数据点不足，无法进行趋势分析')
+    degree = max(1, int(degree))
+    state = {
+        'degree': degree,
+        'origin': _to_micros(times[0]),
+        'shift': float(values[0]),
+        'count': 0,
+        'index_sums': [0.0, 0.0, 0.0],  # Σi, Σi², Σi·y
+        'value_sums': [0.0, 0.0],  # Σy, Σy²
+        'hour_powers': [0.0] * (2 * degree + 1),  # Σh^k, k = 0..2d
+        'hour_moments': [0.0] * (degree + 1),  # Σh^k·y, k = 0..d
+        'last_hours': 0.0
+    }
+    return accumulate_trend_state(state, times, values)
+
+
+def accumulate_trend_state(state, times, values):
+    """把一段后续采样累加到趋势中间状态"""
+    state = dict(state)
+    degree = state['degree']
+    index = state['count'] + np.arange(values.size, dtype=np.float64)
+    y = values - state['shift']
+    hours = (np.asarray(times, dtype='datetime64[us]').astype(np.int64) - state['origin']) / 3.6e9
+    powers = hours[np.newaxis, :] ** np.arange(2 * degree + 1)[:, np.newaxis]
+    
+    state['count'] += int(values.size)
+    state['index_sums'] = (np.asarray(state['index_sums']) + [index.sum(), (index * index).sum(), (index * y).sum()]).tolist()
+    state['value_sums'] = (np.asarray(state['value_sums']) + [y.sum(), (y * y).sum()]).tolist()
+    state['hour_powers'] = (np.asarray(state['hour_powers']) + powers.sum(axis=1)).tolist()
+    state['hour_moments'] = (np.asarray(state['hour_moments']) + (powers[:degree + 1] * y).sum(axis=1)).tolist()
+    state['last_hours'] = float(hours[-1])
+    return state
+
+
+def _solve_polynomial(state, degree):
+    """由正规方程求以小时为自变量的多项式系数（从低次到高次，对应偏移后的数值），返回 (系数, 残差平方和)"""
+    powers = np.asarray(state['hour_powers'])
+    gram = powers[np.add.outer(np.arange(degree + 1), np.arange(degree + 1))]
+    moments = np.asarray(state['hour_moments'][:degree + 1])
+    # 按对角线缩放改善条件数
+    scale = 1.0 / np.sqrt(np.diag(gram))
+    solution = np.linalg.lstsq(gram * np.outer(scale, scale), moments * scale, rcond=None)[0]
+    coefficients = solution * scale
+    sse = state['value_sums'][1] - 2 * coefficients @ moments + coefficients @ gram @ coefficients
+    return coefficients, max(float(sse), 0.0)
+
+
+def trend_from_state(state):
+    """由中间状态生成趋势分析结果"""
+    n = state['count']
+    if n < 2:
+        raise AnalysisError('数据点不足，无法进行趋势分析')
+    si, sii, siy = state['index_sums']
+    sy, syy = state['value_sums']
+    slope = (n * siy - si * sy) / (n * sii - si * si)
+    intercept = (sy - slope * si) / n
+    sst = syy - sy * sy / n
+    sse = syy - 2 * intercept * sy - 2 * slope * siy + n * intercept * intercept + 2 * intercept * slope * si + slope * slope * sii
+    
+    slope_per_hour = 0.0
+    if state['last_hours'] > 0:
+        slope_per_hour = float(_solve_polynomial(state, 1)[0][1])
+    
+    trend_type = '无明显趋势'
+    if slope > TREND_SLOPE_THRESHOLD:
+        trend_type = '上升趋势'
+    elif slope < -TREND_SLOPE_THRESHOLD:
+        trend_type = '下降趋势'
+    
+    result = {
+        'slope': round(float(slope), 6),
+        'intercept': round(float(intercept + state['shift']), 6),
+        'slopePerHour': round(slope_per_hour, 6),
+        'type': trend_type,
+        'rSquared': round(1.0 - max(sse, 0.0) / sst if sst > 0 else 1.0, 6)
+    }
+    degree = max(1, min(state['degree'], n - 1))
+    if degree > 1 and state['last_hours'] > 0:
+        coefficients, poly_sse = _solve_polynomial(state, degree)
+        coefficients[0] += state['shift']
+        result['polynomial'] = {
+            'degree': degree,
+            'coefficients': [round(float(c), 8) for c in coefficients[::-1]],
+            'rSquared': round(1.0 - poly_sse / sst if sst > 0 else 1.0, 6)
+        }
+    return result
+
+
+def _last_at_or_before(times, values, boundary):
+    """序列中不晚于 boundary 的最后一个采样 [微秒, 值]"""
+    micros = np.asarray(times, dtype='datetime64[us]').astype(np.int64)
+    position = int(np.searchsorted(micros, boundary, side='right')) - 1
+    return [int(micros[position]), float(values[position])]
+
+
+def _accumulate_correlation(state, matrix):
+    centered = matrix - np.asarray(state['shift'])[:, np.newaxis]
+    state['count'] += int(matrix.shape[1])
+    state['sums'] = (np.asarray(state['sums']) + centered.sum(axis=1)).tolist()
+    state['products'] = (np.asarray(state['products']) + centered @ centered.T).tolist()
+
+
+def _correlation_boundary(state, series):
+    """公共时间段的终点及各序列在该时刻之前的最后一个采样（后续对齐的起点）"""
+    state['boundary'] = min(_to_micros(times[-1]) for times, _ in series)
+    state['anchors'] = [_last_at_or_before(times, values, state['boundary']) for times, values in series]
+
+
+def correlation_state(series, matrix=None):
+    if matrix is None:
+        matrix = _aligned_matrix(series)
+    state = {'count': 0, 'shift': matrix[:, 0].tolist(), 'sums': [0.0] * len(series),
+             'products': [[0.0] * len(series) for _ in series]}
+    _accumulate_correlation(state, matrix)
+    _correlation_boundary(state, series)
+    return state
+
+
+def extend_correlation_state(state, tails):
+    """
+    tails 为各序列在公共时间段终点之后的新增采样
+    终点之前的网格时刻在上次计算时已经确定，只对齐终点之后的网格时刻
+    """
+    state = dict(state)
+    series = []
+    for (anchor_time, anchor_value), (times, values) in zip(state['anchors'], tails):
+        series.append((
+            np.concatenate([np.array([anchor_time], dtype='datetime64[us]'), np.asarray(times, dtype='datetime64[us]')]),
+            np.concatenate([[anchor_value], values])
+        ))
+    aligned = align_series(series, method='linear')
+    keep = (aligned.grid.astype(np.int64) > state['boundary']) & aligned.mask.all(axis=0)
+    if keep.any():
+        _accumulate_correlation(state, aligned.values[:, keep])
+    _correlation_boundary(state, series)
+    return state
+
+
+def correlation_from_state(state):
+    """由中间状态生成协方差矩阵和相关系数矩阵"""
+    n = state['count']
+    mean = np.asarray(state['sums']) / n
+    covariance = np.asarray(state['products']) / n - np.outer(mean, mean)
+    deviation = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.clip(covariance / np.outer(deviation, deviation), -1.0, 1.0)
+    correlation = np.nan_to_num(correlation)
+    return {
+        'alignedSamples': int(n),
+        'covarianceMatrix': [[round(float(x), 4) for x in row] for row in covariance],
+        'correlationMatrix': [[round(float(x), 4) for x in row] for row in correlation]
+    }
+
+
+def summarize(result):
+    """生成保存到分析结果中的文字说明"""
+    if result['type'] == 'descriptive':
+        stats = result['stats']
+        return f"样本数 {stats['count']}，均值 {stats['mean']}，方差 {stats['variance']}，范围 {stats['minValue']} ~ {stats['maxValue']}"
+    if result['type'] == 'trend':
+        trend = result['trend']
+        return f"{trend['type']}，斜率 {trend['slope']}（每小时 {trend['slopePerHour']}），R² {trend['rSquared']}"
+    return f"对齐采样数 {result['alignedSamples']}，相关系数矩阵 {result['correlationMatrix']}"
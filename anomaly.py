@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+流式异常检测
+采集服务每轮把所有数值属性的采样送入检测器，按三种方法计算异常分数：
+- robust: 最近 ROBUST_WINDOW 个采样的中位数和 MAD 构成的稳健 z 分数
+- ewma: 指数加权均值和方差的控制图 z 分数
+- seasonal: 同一时段（默认一天中的同一小时）历史基线的 z 分数
+综合分数取各方法 z 分数绝对值的最大值，达到 ANOMALY_THRESHOLD 即判定为异常。
+各方法的尺度不小于序列已观测到的最小非零变化量（分辨率）：整数寄存器、0/1 标志等量化信号的 MAD 常为 0，
+相邻量化值之间的一次变化不应判定为异常。
+所有序列的状态保存在按槽位索引的 NumPy 数组中（而不是每个序列一个 Python 对象），
+每轮对全部序列整体向量化计算。每个序列在 PERSIST_INTERVAL 内的最大分数作为派生序列
+anomaly_score 写入，数据库写入量与采集频率无关。
+"""
+
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+# 稳健 z 分数的滑动窗口长度（采样数）
+ROBUST_WINDOW = 60
+# 各方法开始给出分数前需要的最少采样数
+MIN_SAMPLES = 10
+# EWMA 平滑系数
+EWMA_ALPHA = 0.05
+# 季节基线：时段长度（秒）和一个周期内的时段数（默认一天 24 小时）
+SEASON_BUCKET_SECONDS = 3600
+SEASON_BUCKETS = 24
+# 时段结束时并入季节基线的权重（按周期的指数加权）
+SEASON_ALPHA = 0.3
+# 综合分数达到该值判定为异常
+ANOMALY_THRESHOLD = 4.0
+# 异常分数写入派生序列的间隔（秒）
+PERSIST_INTERVAL = 60.0
+# 派生序列名称
+SCORE_SERIES = 'anomaly_score'
+
+# MAD 换算为标准差的系数
+MAD_SCALE = 1.4826
+# 尺度下限（相对值和绝对值），避免常数序列的分数无穷大；已观测到分辨率的序列以分辨率为下限
+RELATIVE_SCALE_FLOOR = 1e-3
+ABSOLUTE_SCALE_FLOOR = 1e-9
+
+INITIAL_CAPACITY = 1024
+
+
+def _scale_floor(center, resolution):
+    # 分辨率为 NaN（尚未观测到变化）时只用相对下限
+    return np.fmax(RELATIVE_SCALE_FLOOR * np.abs(center) + ABSOLUTE_SCALE_FLOOR, resolution)
+
+
+def _grow(array, capacity, fill):
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class AnomalyDetector:
+    """按 (device_id, property_id) 分配槽位的流式异常检测器，状态为按槽位索引的数组"""
+    
+    # 数组字段 → 填充值，第二维由 _shape 给出
+    _FIELDS = {
+        'window': np.nan,  # 稳健 z 分数的环形缓冲区 [槽位, ROBUST_WINDOW]
+        'filled': 0,  # 缓冲区中的采样数
+        'position': 0,  # 下一个写入位置
+        'ewma_mean': 0.0,
+        'ewma_var': 0.0,
+        'ewma_count': 0,
+        'season_mean': 0.0,  # 季节基线 [槽位, SEASON_BUCKETS]
+        'season_var': 0.0,
+        'season_count': 0,  # 已并入基线的周期数
+        'bucket_n': 0,  # 当前时段内的采样统计
+        'bucket_mean': 0.0,
+        'bucket_m2': 0.0,
+        'robust_z': np.nan,  # 最近一次的各方法分数
+        'ewma_z': np.nan,
+        'seasonal_z': np.nan,
+        'score': 0.0,
+        'anomalous': False,
+        'last_value': np.nan,  # 最近一次采样值
+        'resolution': np.nan,  # 相邻采样之间最小的非零变化量
+        'updated_at': np.nan,  # 最近一次采样时间（epoch 秒）
+        'pending': np.nan  # 上次写入以来的最大分数
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}  # (device_id, property_id) → 槽位
+        self._keys = []  # 槽位 → (device_id, property_id)
+        self._device_slots = {}  # device_id → [槽位]
+        self._bucket = None  # 当前季节时段编号
+        self._last_persist = None
+        self._capacity = 0
+        self._allocate(INITIAL_CAPACITY)
+    
+    @staticmethod
+    def _shape(name, capacity):
+        if name == 'window':
+            return (capacity, ROBUST_WINDOW)
+        if name.startswith('season_'):
+            return (capacity, SEASON_BUCKETS)
+        return (capacity,)
+    
+    def _allocate(self, capacity):
+        for name, fill in self._FIELDS.items():
+            dtype = np.bool_ if isinstance(fill, bool) else (np.int32 if isinstance(fill, int) else np.float64)
+            if self._capacity == 0:
+                setattr(self, name, np.full(self._shape(name, capacity), fill, dtype=dtype))
+            else:
+                setattr(self, name, _grow(getattr(self, name), capacity, fill))
+        self._capacity = capacity
+    
+    def _slot_indexes(self, keys):
+        """查找（必要时分配）槽位"""
+        slots = np.empty(len(keys), dtype=np.intp)
+        for position, key in enumerate(keys):
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = len(self._keys)
+                self._slots[key] = slot
+                self._keys.append(key)
+                self._device_slots.setdefault(key[0], []).append(slot)
+            slots[position] = slot
+        if len(self._keys) > self._capacity:
+            capacity = self._capacity
+            while capacity < len(self._keys):
+                capacity *= 2
+            self._allocate(capacity)
+        return slots
+    
+    def reset(self):
+        with self._lock:
+            self._slots.clear()
+            self._keys.clear()
+            self._device_slots.clear()
+            self._bucket = None
+            self._last_persist = None
+            self._capacity = 0
+            self._allocate(INITIAL_CAPACITY)
+    
+    def update(self, keys, values, now):
+        """
+        提交一轮采样：keys 为 [(device_id, property_id)]，values 为对应的数值
+        返回异常状态发生变化的序列 [(device_id, property_id, 分数, 是否异常)]
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = np.isfinite(values)
+        if not valid.all():
+            keys = [key for key, ok in zip(keys, valid) if ok]
+            values = values[valid]
+        if not keys:
+            return []
+        # 采集时间为 UTC 的 naive datetime
+        epoch = now.replace(tzinfo=timezone.utc).timestamp() if isinstance(now, datetime) else float(now)
+        with self._lock:
+            slots = self._slot_indexes(keys)
+            self._advance_season(epoch)
+            
+            resolution = self.resolution[slots]
+            robust = self._robust_scores(slots, values, resolution)
+            ewma = self._ewma_scores(slots, values, resolution)
+            seasonal = self._seasonal_scores(slots, values, resolution)
+            # 分辨率在评分之后更新，第一次跳变本身仍按原尺度评分
+            step = np.abs(values - self.last_value[slots])
+            self.resolution[slots] = np.fmin(resolution, np.where(step > 0, step, np.nan))
+            self.last_value[slots] = values
+            
+            components = np.abs(np.stack([robust, ewma, seasonal]))
+            finite = np.isfinite(components)
+            score = np.where(finite, components, 0.0).max(axis=0)
+            anomalous = score >= ANOMALY_THRESHOLD
+            
+            changed = np.flatnonzero(anomalous != self.anomalous[slots])
+            self.robust_z[slots] = robust
+            self.ewma_z[slots] = ewma
+            self.seasonal_z[slots] = seasonal
+            self.score[slots] = score
+            self.anomalous[slots] = anomalous
+            self.updated_at[slots] = epoch
+            self.pending[slots] = np.fmax(self.pending[slots], score)
+            return [
+                (self._keys[slots[i]][0], self._keys[slots[i]][1], float(score[i]), bool(anomalous[i]))
+                for i in changed
+            ]
+    
+    def _robust_scores(self, slots, values, resolution):
+        """以加入新采样之前的窗口计算中位数和 MAD，再把新采样写入环形缓冲区"""
+        rows = self.window[slots]
+        filled = self.filled[slots]
+        scores = np.full(len(slots), np.nan)
+        ready = filled >= MIN_SAMPLES
+        if ready.any():
+            full = filled == ROBUST_WINDOW
+            # 缓冲区已满的序列没有 NaN，可以走更快的 np.median
+            for mask, median in ((ready & full, np.median), (ready & ~full, np.nanmedian)):
+                if not mask.any():
+                    continue
+                window = rows[mask]
+                center = median(window, axis=1)
+                mad = median(np.abs(window - center[:, None]), axis=1)
+                scale = np.maximum(MAD_SCALE * mad, _scale_floor(center, resolution[mask]))
+                scores[mask] = (values[mask] - center) / scale
+        
+        positions = self.position[slots]
+        self.window[slots, positions] = values
+        self.position[slots] = (positions + 1) % ROBUST_WINDOW
+        self.filled[slots] = np.minimum(filled + 1, ROBUST_WINDOW)
+        return scores
+    
+    def _ewma_scores(self, slots, values, resolution):
+        """以更新之前的指数加权均值和方差计算分数，再更新状态"""
+        mean = self.ewma_mean[slots]
+        var = self.ewma_var[slots]
+        count = self.ewma_count[slots]
+        first = count == 0
+        mean = np.where(first, values, mean)
+        
+        deviation = values - mean
+        scale = np.maximum(np.sqrt(var), _scale_floor(mean, resolution))
+        scores = np.where(count >= MIN_SAMPLES, deviation / scale, np.nan)
+        
+        self.ewma_mean[slots] = mean + EWMA_ALPHA * deviation
+        self.ewma_var[slots] = (1.0 - EWMA_ALPHA) * (var + EWMA_ALPHA * deviation * deviation)
+        self.ewma_count[slots] = count + 1
+        return scores
+    
+    def _advance_season(self, epoch):
+        """进入新的时段时，把上一时段的统计并入季节基线（全部槽位一次完成）"""
+        bucket = int(epoch // SEASON_BUCKET_SECONDS)
+        if self._bucket is None:
+            self._bucket = bucket
+            return
+        if bucket == self._bucket:
+            return
+        column = self._bucket % SEASON_BUCKETS
+        self._bucket = bucket
+        
+        size = len(self._keys)
+        n = self.bucket_n[:size]
+        has = n > 0
+        if has.any():
+            mean = self.bucket_mean[:size]
+            var = np.where(n > 1, self.bucket_m2[:size] / np.maximum(n - 1, 1), 0.0)
+            old_mean = self.season_mean[:size, column]
+            old_var = self.season_var[:size, column]
+            first = self.season_count[:size, column] == 0
+            alpha = np.where(first, 1.0, SEASON_ALPHA)
+            delta = mean - old_mean
+            new_mean = old_mean + alpha * delta
+            new_var = (1.0 - alpha) * old_var + alpha * var + alpha * (1.0 - alpha) * delta * delta
+            self.season_mean[:size, column] = np.where(has, new_mean, old_mean)
+            self.season_var[:size, column] = np.where(has, new_var, old_var)
+            self.season_count[:size, column] += has
+        self.bucket_n[:size] = 0
+        self.bucket_mean[:size] = 0.0
+        self.bucket_m2[:size] = 0.0
+    
+    def _seasonal_scores(self, slots, values, resolution):
+        """以同一时段的历史基线计算分数，并累计当前时段的均值和方差（Welford）"""
+        column = self._bucket % SEASON_BUCKETS
+        mean = self.season_mean[slots, column]
+        var = self.season_var[slots, column]
+        ready = self.season_count[slots, column] > 0
+        scale = np.maximum(np.sqrt(var), _scale_floor(mean, resolution))
+        scores = np.where(ready, (values - mean) / scale, np.nan)
+        
+        n = self.bucket_n[slots] + 1
+        current = self.bucket_mean[slots]
+        delta = values - current
+        current = current + delta / n
+        self.bucket_n[slots] = n
+        self.bucket_mean[slots] = current
+        self.bucket_m2[slots] += delta * (values - current)
+        return scores
+    
+    def persist_rows(self, now):
+        """
+        到达写入间隔时返回派生序列行（每个序列一行，值为间隔内的最大分数）并清空累计，
+        否则返回空列表
+        """
+        with self._lock:
+            if self._last_persist is None:
+                self._last_persist = now
+                return []
+            if (now - self._last_persist).total_seconds() < PERSIST_INTERVAL:
+                return []
+            self._last_persist = now
+            size = len(self._keys)
+            pending = self.pending[:size]
+            slots = np.flatnonzero(np.isfinite(pending))
+            rows = [
+                {
+                    'device_id': self._keys[slot][0],
+                    'property_id': self._keys[slot][1],
+                    'name': SCORE_SERIES,
+                    'timestamp': now,
+                    'value': value
+                }
+                for slot, value in zip(slots.tolist(), pending[slots].tolist())
+            ]
+            pending[:] = np.nan
+            return rows
+    
+    def _describe(self, slot):
+        def number(value):
+            value = float(value)
+            return value if np.isfinite(value) else None
+        
+        updated_at = self.updated_at[slot]
+        return {
+            'device_id': self._keys[slot][0],
+            'property_id': self._keys[slot][1],
+            'score': float(self.score[slot]),
+            'anomalous': bool(self.anomalous[slot]),
+            'robust_z': number(self.robust_z[slot]),
+            'ewma_z': number(self.ewma_z[slot]),
+            'seasonal_z': number(self.seasonal_z[slot]),
+            'samples': int(self.ewma_count[slot]),
+            'timestamp': datetime.utcfromtimestamp(updated_at).isoformat() if np.isfinite(updated_at) else None
+        }
+    
+    def device_scores(self, device_id):
+        """单台设备各属性的当前异常分数"""
+        with self._lock:
+            return [self._describe(slot) for slot in self._device_slots.get(device_id, [])]
+    
+    def active(self):
+        """当前处于异常状态的全部序列，按分数从高到低排列"""
+        with self._lock:
+            slots = np.flatnonzero(self.anomalous[:len(self._keys)])
+            slots = slots[np.argsort(-self.score[slots])]
+            return [self._describe(slot) for slot in slots.tolist()]
+    
+    def status(self):
+        with self._lock:
+            size = len(self._keys)
+            return {
+                'series': size,
+                'anomalous': int(self.anomalous[:size].sum()),
+                'threshold': ANOMALY_THRESHOLD
+            }
+
+
+# 全局检测器实例，由采集服务提供数据
+anomaly_detector = AnomalyDetector()
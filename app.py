@@ -1,24 +1,47 @@
 #!/usr/bin/env python3
-from flask import Flask, jsonify, render_template, request, redirect, url_for
+from flask import Flask, jsonify, render_template, request, redirect, url_for, Response, stream_with_context
 import random
 import time
 import os
-import threading
 from pymodbus.client import ModbusTcpClient
 from pymodbus.exceptions import ModbusException
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 import uuid
+import json
 
 # 导入模型
 from models import db, DeviceType, DeviceProperty, DeviceEvent, DeviceMethod, Device, ModbusPoint, DevicePropertyBinding, ServerConfig
 
 # 添加新的模型导入
-from models import PropertyHistory, EventHistory, DataAnalysisProject, DataAnalysisResult
-from models import DecisionTree, DecisionTreeNode, KnowledgeGraph, KnowledgeGraphNode, KnowledgeGraphEdge
-
-# 导入Modbus服务器类
-from modbus_server_db import DatabaseModbusServer
+from models import PropertyHistory, EventHistory, DataAnalysisProject, DataAnalysisResult, AnalysisResultCache
+from models import Job, DerivedSeriesPoint, DegradationModel, KpiDefinition, DecisionTree, DecisionTreeNode, DiagnosisRecord, KnowledgeGraph, KnowledgeGraphNode, KnowledgeGraphEdge
+
+# 导入事件条件引擎
+from event_engine import event_engine
+from decision_engine import decision_engine, tree_etag, load_tree_document
+from decision_backtest import DEFAULT_STEP as BACKTEST_STEP, MAX_INTERVALS as BACKTEST_MAX_INTERVALS, BacktestError, backtest_tree
+from decision_tree_ops import TreeEditError, flatten_document, save_tree, delete_subtree, move_subtree, copy_subtree, delete_tree_nodes
+
+# 导入决策树诊断队列和实时推送中心
+from diagnosis import DiagnosisPipeline
+from jobs import JobManager, RemoteJobManager, JobParamsError, check_generic_job, apply_backfilled_history
+from analysis_engine import AnalysisError
+from analysis_cache import run_project_analysis, select_instances, clear_project_cache
+from features import FeatureError, extract_point_features
+from correlation import CorrelationError, run_correlation, limit_result
+from graph_index import GraphQueryError, MAX_RESULT_NODES, graph_index
+from graph_bulk import FORMATS as GRAPH_FORMATS, BulkImportError, parse_jsonl, parse_columnar, import_graph, export_jsonl, export_columnar
+from graph_properties import index_entity, unindex_entities, unindex_graph, property_filters, matching_ids
+from root_cause import load_active_alarms, resolve_alarms, root_cause_ranker
+from degradation import MODEL_TYPES, DIRECTIONS, refresh_models, reset_model, model_curve
+from kpi import KpiError, compile_kpi, period_result, monthly_report, clear_cache as clear_kpi_cache
+from timeseries import parse_utc_time
+from stream_hub import stream_hub, sse_stream
+from ingest_filter import deadband_config, DEADBAND_MODES
+from runtime import create_runtime, default_address, default_key_path, parse_address
+from value_table import DEFAULT_CAPACITY as DEFAULT_TABLE_CAPACITY, QUALITY_GOOD, default_table_name
+from serialization import SerializationError, request_options, json_response, time_text, format_epoch, rows_payload, columns_payload
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
@@ -31,6 +54,17 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'static', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 限制文件大小为16MB
 
+# 运行时部署模式：local 为单进程（Modbus模拟器、数据采集在Web进程内运行）；
+# remote 为多进程，运行时由 runtime_service.py 启动的服务进程持有，任意数量的Web工作进程经本地IPC访问
+app.config['RUNTIME_MODE'] = os.environ.get('RUNTIME_MODE', 'local')
+app.config['RUNTIME_ADDRESS'] = parse_address(os.environ.get('RUNTIME_ADDRESS') or default_address(basedir))
+# IPC 认证密钥：未设置 RUNTIME_AUTHKEY 时服务进程在密钥文件中生成随机密钥（权限 0600），工作进程读取同一文件
+app.config['RUNTIME_AUTHKEY'] = os.environ.get('RUNTIME_AUTHKEY', '').encode() or None
+app.config['RUNTIME_AUTHKEY_FILE'] = os.environ.get('RUNTIME_AUTHKEY_FILE') or default_key_path(app.config['RUNTIME_ADDRESS'], basedir)
+# 点位最新值共享内存表的名称和容量（点位数）
+app.config['RUNTIME_VALUE_TABLE'] = os.environ.get('RUNTIME_VALUE_TABLE') or default_table_name(basedir)
+app.config['RUNTIME_VALUE_CAPACITY'] = int(os.environ.get('RUNTIME_VALUE_CAPACITY', DEFAULT_TABLE_CAPACITY))
+
 # 确保上传文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -503,6 +537,8 @@ def api_delete_device_type(id):
         
         db.session.delete(device_type)
         db.session.commit()
+        event_engine.invalidate(id)
+        decision_engine.invalidate()
         
         return jsonify({
             'success': True,
@@ -553,6 +589,12 @@ def api_create_device_property():
                 'message': '缺少必要参数'
             }), 400
         
+        if data.get('deadband_mode') and data['deadband_mode'] not in DEADBAND_MODES:
+            return jsonify({
+                'success': False,
+                'message': '不支持的死区模式'
+            }), 400
+        
         # 检查设备类型是否存在
         device_type = DeviceType.query.get(device_type_id)
         if not device_type:
@@ -581,11 +623,16 @@ def api_create_device_property():
             read_write_flag=data.get('read_write_flag', 'rw'),
             min_value=data.get('min_value'),
             max_value=data.get('max_value'),
+            deadband_mode=data.get('deadband_mode') or None,
+            deadband_value=data.get('deadband_value'),
+            max_silence=data.get('max_silence'),
             device_type_id=device_type_id
         )
         
         db.session.add(property)
         db.session.commit()
+        event_engine.invalidate(property.device_type_id)
+        decision_engine.invalidate()
         
         return jsonify({
             'success': True,
@@ -621,6 +668,17 @@ def api_update_device_property(id):
         property.min_value = data.get('min_value', property.min_value)
         property.max_value = data.get('max_value', property.max_value)
         
+        # 更新死区（例外报告）配置
+        if 'deadband_mode' in data:
+            if data['deadband_mode'] and data['deadband_mode'] not in DEADBAND_MODES:
+                return jsonify({
+                    'success': False,
+                    'message': '不支持的死区模式'
+                }), 400
+            property.deadband_mode = data['deadband_mode'] or None
+        property.deadband_value = data.get('deadband_value', property.deadband_value)
+        property.max_silence = data.get('max_silence', property.max_silence)
+        
         # 如果改变了标识符，需要检查重复
         if 'identifier' in data and data['identifier'] != property.identifier:
             existing = DeviceProperty.query.filter(
@@ -635,6 +693,9 @@ def api_update_device_property(id):
                 }), 400
         
         db.session.commit()
+        event_engine.invalidate(property.device_type_id)
+        decision_engine.invalidate()
+        runtime.reset_exception_filter(property_id=id)
         
         return jsonify({
             'success': True,
@@ -659,8 +720,11 @@ def api_delete_device_property(id):
                 'message': '属性不存在'
             }), 404
         
+        device_type_id = property.device_type_id
         db.session.delete(property)
         db.session.commit()
+        event_engine.invalidate(device_type_id)
+        decision_engine.invalidate()
         
         return jsonify({
             'success': True,
@@ -740,6 +804,7 @@ def api_create_device_event():
         
         db.session.add(event)
         db.session.commit()
+        event_engine.invalidate(event.device_type_id)
         
         return jsonify({
             'success': True,
@@ -786,6 +851,7 @@ def api_update_device_event(id):
                 }), 400
         
         db.session.commit()
+        event_engine.invalidate(event.device_type_id)
         
         return jsonify({
             'success': True,
@@ -938,6 +1004,7 @@ def api_update_decision_tree(id):
         tree.device_type_id = data.get('device_type_id', tree.device_type_id)
         
         db.session.commit()
+        decision_engine.invalidate(id)
         
         return jsonify({
             'success': True,
@@ -963,25 +1030,16 @@ def api_delete_decision_tree(id):
                 'message': '决策树不存在'
             }), 404
             
-        # 先删除所有相关的节点，需要特殊处理循环依赖
-        nodes = DecisionTreeNode.query.filter_by(tree_id=id).all()
-        
-        # 先清除所有节点的外键引用
-        for node in nodes:
-            node.parent_id = None
-            node.yes_child_id = None
-            node.no_child_id = None
-        
-        # 提交外键更新
-        db.session.flush()
-        
-        # 再删除所有节点
-        for node in nodes:
-            db.session.delete(node)
+        # 删除所有相关的节点（先清除节点间的循环引用）
+        delete_tree_nodes(id)
             
+        # 删除诊断记录
+        DiagnosisRecord.query.filter_by(tree_id=id).delete()
+        
         # 最后删除决策树本身
         db.session.delete(tree)
         db.session.commit()
+        decision_engine.invalidate(id)
         
         return jsonify({
             'success': True,
@@ -995,6 +1053,201 @@ def api_delete_decision_tree(id):
         }), 500
 
 
+@app.route('/api/decision-trees/<int:id>/evaluate', methods=['POST'])
+def api_evaluate_decision_tree(id):
+    """对单台或一批设备求值决策树（当前值或指定时刻的历史值）"""
+    try:
+        tree = DecisionTree.query.get(id)
+        if not tree:
+            return jsonify({
+                'success': False,
+                'message': '决策树不存在'
+            }), 404
+        
+        data = request.get_json(silent=True) or {}
+        try:
+            single_device_id = int(data['device_id']) if data.get('device_id') is not None else None
+            if single_device_id is not None:
+                device_ids = [single_device_id]
+            elif data.get('device_ids') is not None:
+                if not isinstance(data['device_ids'], list):
+                    raise ValueError(data['device_ids'])
+                device_ids = [int(device_id) for device_id in data['device_ids']]
+            else:
+                device_ids = None
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': '设备ID无效'
+            }), 400
+        
+        # 未指定设备时诊断决策树关联设备类型下的全部设备
+        if device_ids is not None:
+            devices = Device.query.filter(Device.id.in_(device_ids)).all()
+        elif tree.device_type:
+            devices = Device.query.filter_by(type=tree.device_type.name).all()
+        else:
+            return jsonify({
+                'success': False,
+                'message': '决策树未关联设备类型，请指定要诊断的设备'
+            }), 400
+        
+        if device_ids is not None and not devices:
+            return jsonify({
+                'success': False,
+                'message': '设备不存在'
+            }), 404
+        
+        # timestamp 指定时按该时刻之前的最新历史值求值，否则按当前值求值
+        at = None
+        timestamp = data.get('timestamp')
+        if timestamp:
+            try:
+                at = parse_utc_time(timestamp)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': '时间格式不正确'
+                }), 400
+        
+        # 单台设备直接传 {属性标识符: 值}，批量时传 {设备ID: {属性标识符: 值}}
+        values = data.get('values') or {}
+        try:
+            if not isinstance(values, dict):
+                raise ValueError(values)
+            if single_device_id is not None:
+                supplied = {single_device_id: values}
+            else:
+                supplied = {int(device_id): device_values for device_id, device_values in values.items()}
+                if not all(isinstance(device_values, dict) for device_values in supplied.values()):
+                    raise ValueError(values)
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': '属性值格式不正确'
+            }), 400
+        
+        live = {}
+        if at is None:
+            live = runtime.current_values([device.id for device in devices])
+        device_values = {}
+        for device in devices:
+            device_values[device.id] = dict(live.get(device.id) or {})
+            device_values[device.id].update(supplied.get(device.id) or {})
+        
+        if data.get('background'):
+            job = get_job_manager().submit('decision_tree_batch', {
+                'tree_id': id,
+                'device_values': device_values,
+                'timestamp': at.isoformat() if at else None,
+                'save': bool(data.get('save'))
+            })
+            return jsonify({
+                'success': True,
+                'message': '批量诊断任务已提交',
+                'data': job.to_dict()
+            }), 202
+        
+        results = decision_engine.evaluate_devices(id, device_values, at)
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'tree_id': id,
+                'timestamp': (at or datetime.utcnow()).isoformat(),
+                'results': [
+                    dict(device_id=device.id, device_name=device.name, **results[device.id])
+                    for device in devices
+                ]
+            }
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/decision-trees/<int:id>/backtest', methods=['POST'])
+def api_backtest_decision_tree(id):
+    """
+    在历史数据上回测决策树：按 step 秒的网格统计 [start_time, end_time] 内各设备每个叶子的命中次数和时间段
+    未指定设备时回测决策树关联设备类型下的全部设备，background 为真时作为后台任务执行
+    """
+    try:
+        tree = DecisionTree.query.get(id)
+        if not tree:
+            return jsonify({
+                'success': False,
+                'message': '决策树不存在'
+            }), 404
+        
+        data = request.get_json(silent=True) or {}
+        single_device_id = data.get('device_id')
+        device_ids = [single_device_id] if single_device_id is not None else data.get('device_ids')
+        if device_ids is not None:
+            devices = Device.query.filter(Device.id.in_(device_ids)).all()
+        elif tree.device_type:
+            devices = Device.query.filter_by(type=tree.device_type.name).all()
+        else:
+            return jsonify({
+                'success': False,
+                'message': '决策树未关联设备类型，请指定要回测的设备'
+            }), 400
+        if not devices:
+            return jsonify({
+                'success': False,
+                'message': '设备不存在'
+            }), 404
+        
+        try:
+            start = _parse_request_time(data.get('start_time'))
+            end = _parse_request_time(data.get('end_time'))
+            step = int(data.get('step') or BACKTEST_STEP)
+            max_intervals = int(data.get('max_intervals', BACKTEST_MAX_INTERVALS))
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': '时间或步长格式不正确'
+            }), 400
+        if start is None:
+            return jsonify({
+                'success': False,
+                'message': '请指定回测开始时间 start_time'
+            }), 400
+        
+        device_ids = [device.id for device in devices]
+        if data.get('background'):
+            job = get_job_manager().submit('decision_tree_backtest', {
+                'tree_id': id,
+                'device_ids': device_ids,
+                'start_time': start.isoformat(),
+                'end_time': end.isoformat() if end else None,
+                'step': step,
+                'max_intervals': max_intervals
+            })
+            return jsonify({
+                'success': True,
+                'message': '回测任务已提交',
+                'data': job.to_dict()
+            }), 202
+        
+        return jsonify({
+            'success': True,
+            'data': backtest_tree(id, device_ids, start, end, step, max_intervals)
+        })
+    except BacktestError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
 # 决策树节点 API 接口
 @app.route('/api/decision-trees/<int:tree_id>/nodes', methods=['GET'])
 def api_get_decision_tree_nodes(tree_id):
@@ -1019,6 +1272,97 @@ def api_get_decision_tree_nodes(tree_id):
         }), 500
 
 
+@app.route('/api/decision-trees/<int:tree_id>/full', methods=['GET'])
+def api_get_decision_tree_full(tree_id):
+    """
+    一次获取整棵决策树（嵌套结构），响应带 ETag，
+    If-None-Match 命中时只做一次聚合查询并返回 304
+    """
+    try:
+        tree = DecisionTree.query.get(tree_id)
+        if not tree:
+            return jsonify({
+                'success': False,
+                'message': '决策树不存在'
+            }), 404
+        
+        etag = tree_etag(tree)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = jsonify({
+                'success': True,
+                'data': load_tree_document(tree)
+            })
+        response.set_etag(etag)
+        # 浏览器缓存响应，但每次使用前先向服务器验证
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/decision-trees/<int:tree_id>/full', methods=['PUT'])
+def api_save_decision_tree_full(tree_id):
+    """
+    批量保存整棵决策树：与已存储的节点比对后，新建、更新、删除在一个事务中批量执行
+    请求体为 /full 返回的嵌套结构 {"root": {...}, "detached": [...]}，或节点列表 {"nodes": [...]}（新节点使用临时 id）；
+    带 If-Match 时，树已被他人修改则返回 412
+    """
+    try:
+        tree = DecisionTree.query.get(tree_id)
+        if not tree:
+            return jsonify({
+                'success': False,
+                'message': '决策树不存在'
+            }), 404
+        
+        if request.if_match and not request.if_match.contains(tree_etag(tree)):
+            return jsonify({
+                'success': False,
+                'message': '决策树已被修改，请重新加载后再保存'
+            }), 412
+        
+        data = request.get_json() or {}
+        if isinstance(data.get('nodes'), list):
+            nodes = data['nodes']
+        elif 'root' in data and (data['root'] is None or isinstance(data['root'], dict)):
+            nodes = flatten_document(data['root'], data.get('detached'))
+        else:
+            return jsonify({
+                'success': False,
+                'message': '请求体需包含 root 或 nodes'
+            }), 400
+        
+        result = save_tree(tree_id, nodes)
+        db.session.commit()
+        decision_engine.invalidate(tree_id)
+        
+        db.session.refresh(tree)
+        response = jsonify({
+            'success': True,
+            'message': '决策树保存成功',
+            'data': result
+        })
+        response.set_etag(tree_etag(tree))
+        return response
+    except TreeEditError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
 @app.route('/api/decision-tree-nodes', methods=['POST'])
 def api_create_decision_tree_node():
     """创建决策树节点"""
@@ -1088,6 +1432,7 @@ def api_create_decision_tree_node():
                 db.session.add(parent_node)
         
         db.session.commit()
+        decision_engine.invalidate(tree_id)
         
         return jsonify({
             'success': True,
@@ -1122,6 +1467,7 @@ def api_update_decision_tree_node(id):
         node.no_child_id = data.get('no_child_id', node.no_child_id)
         
         db.session.commit()
+        decision_engine.invalidate(node.tree_id)
         
         return jsonify({
             'success': True,
@@ -1134,13 +1480,111 @@ def api_update_decision_tree_node(id):
             'success': False,
             'message': str(e)
         }), 500
-        db.session.delete(node)
+
+
+@app.route('/api/decision-tree-nodes/<int:id>', methods=['DELETE'])
+def api_delete_decision_tree_node(id):
+    """删除决策树节点及其全部子节点"""
+    try:
+        if not DecisionTreeNode.query.get(id):
+            return jsonify({
+                'success': False,
+                'message': '节点不存在'
+            }), 404
+        
+        tree_id, deleted = delete_subtree(id)
         db.session.commit()
+        decision_engine.invalidate(tree_id)
         
         return jsonify({
             'success': True,
-            'message': '节点删除成功'
+            'message': f'节点删除成功，共删除 {deleted} 个节点',
+            'data': {'deleted': deleted}
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+def _subtree_target(data):
+    """子树移动、复制的目标父节点和分支"""
+    parent_id = data.get('parent_id')
+    if parent_id is None:
+        raise TreeEditError('缺少目标父节点 parent_id')
+    try:
+        parent_id = int(parent_id)
+    except (TypeError, ValueError):
+        raise TreeEditError('parent_id 必须为整数')
+    return parent_id, data.get('branch_type')
+
+
+@app.route('/api/decision-tree-nodes/<int:id>/move', methods=['POST'])
+def api_move_decision_tree_node(id):
+    """把节点及其子树移动到另一个父节点下（可跨决策树）"""
+    try:
+        if not DecisionTreeNode.query.get(id):
+            return jsonify({
+                'success': False,
+                'message': '节点不存在'
+            }), 404
+        
+        parent_id, branch = _subtree_target(request.get_json() or {})
+        source_tree, target_tree = move_subtree(id, parent_id, branch)
+        db.session.commit()
+        decision_engine.invalidate(source_tree)
+        decision_engine.invalidate(target_tree)
+        
+        return jsonify({
+            'success': True,
+            'message': '节点移动成功',
+            'data': DecisionTreeNode.query.get(id).to_dict()
         })
+    except TreeEditError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/decision-tree-nodes/<int:id>/copy', methods=['POST'])
+def api_copy_decision_tree_node(id):
+    """复制节点及其子树到另一个父节点下（可跨决策树）"""
+    try:
+        if not DecisionTreeNode.query.get(id):
+            return jsonify({
+                'success': False,
+                'message': '节点不存在'
+            }), 404
+        
+        parent_id, branch = _subtree_target(request.get_json() or {})
+        tree_id, root_id, copied = copy_subtree(id, parent_id, branch)
+        db.session.commit()
+        decision_engine.invalidate(tree_id)
+        
+        return jsonify({
+            'success': True,
+            'message': f'节点复制成功，共复制 {copied} 个节点',
+            'data': {
+                'root': DecisionTreeNode.query.get(root_id).to_dict(),
+                'copied': copied
+            }
+        })
+    except TreeEditError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({
@@ -1264,8 +1708,10 @@ def api_delete_knowledge_graph(id):
                 'message': '知识图谱不存在'
             }), 404
             
+        unindex_graph(id)
         db.session.delete(graph)
         db.session.commit()
+        graph_index.invalidate(id)
         
         return jsonify({
             'success': True,
@@ -1291,7 +1737,12 @@ def api_get_knowledge_graph_nodes(graph_id):
                 'message': '知识图谱不存在'
             }), 404
         
-        nodes = KnowledgeGraphNode.query.filter_by(graph_id=graph_id).all()
+        # ?prop.键=值 通过属性索引过滤
+        query = KnowledgeGraphNode.query.filter_by(graph_id=graph_id)
+        filters = property_filters(request.args)
+        if filters:
+            query = query.filter(KnowledgeGraphNode.id.in_(matching_ids(graph_id, 'node', filters)))
+        nodes = query.all()
         return jsonify({
             'success': True,
             'data': [node.to_dict() for node in nodes]
@@ -1335,7 +1786,10 @@ def api_create_knowledge_graph_node():
         )
         
         db.session.add(node)
+        db.session.flush()
+        index_entity(node.graph_id, 'node', node.id, node.properties)
         db.session.commit()
+        graph_index.invalidate(node.graph_id)
         
         return jsonify({
             'success': True,
@@ -1365,8 +1819,10 @@ def api_update_knowledge_graph_node(id):
         node.name = data.get('name', node.name)
         node.node_type = data.get('node_type', node.node_type)
         node.properties = data.get('properties', node.properties)
+        index_entity(node.graph_id, 'node', node.id, node.properties)
         
         db.session.commit()
+        graph_index.invalidate(node.graph_id)
         
         return jsonify({
             'success': True,
@@ -1392,8 +1848,11 @@ def api_delete_knowledge_graph_node(id):
                 'message': '节点不存在'
             }), 404
             
+        graph_id = node.graph_id
+        unindex_entities('node', [node.id])
         db.session.delete(node)
         db.session.commit()
+        graph_index.invalidate(graph_id)
         
         return jsonify({
             'success': True,
@@ -1419,7 +1878,12 @@ def api_get_knowledge_graph_edges(graph_id):
                 'message': '知识图谱不存在'
             }), 404
         
-        edges = KnowledgeGraphEdge.query.filter_by(graph_id=graph_id).all()
+        # ?prop.键=值 通过属性索引过滤
+        query = KnowledgeGraphEdge.query.filter_by(graph_id=graph_id)
+        filters = property_filters(request.args)
+        if filters:
+            query = query.filter(KnowledgeGraphEdge.id.in_(matching_ids(graph_id, 'edge', filters)))
+        edges = query.all()
         return jsonify({
             'success': True,
             'data': [edge.to_dict() for edge in edges]
@@ -1474,7 +1938,10 @@ def api_create_knowledge_graph_edge():
         )
         
         db.session.add(edge)
+        db.session.flush()
+        index_entity(edge.graph_id, 'edge', edge.id, edge.properties)
         db.session.commit()
+        graph_index.invalidate(edge.graph_id)
         
         return jsonify({
             'success': True,
@@ -1503,8 +1970,10 @@ def api_update_knowledge_graph_edge(id):
         data = request.get_json()
         edge.relation_type = data.get('relation_type', edge.relation_type)
         edge.properties = data.get('properties', edge.properties)
+        index_entity(edge.graph_id, 'edge', edge.id, edge.properties)
         
         db.session.commit()
+        graph_index.invalidate(edge.graph_id)
         
         return jsonify({
             'success': True,
@@ -1530,8 +1999,11 @@ def api_delete_knowledge_graph_edge(id):
                 'message': '边不存在'
             }), 404
             
+        graph_id = edge.graph_id
+        unindex_entities('edge', [edge.id])
         db.session.delete(edge)
         db.session.commit()
+        graph_index.invalidate(graph_id)
         
         return jsonify({
             'success': True,
@@ -1545,24 +2017,57 @@ def api_delete_knowledge_graph_edge(id):
         }), 500
 
 
-@app.route('/api/device-events/<int:id>', methods=['DELETE'])
-def api_delete_device_event(id):
-    """删除设备事件"""
+# 知识图谱批量导入导出 API 接口
+def _graph_format():
+    """批量接口的数据格式：format 参数优先，其次按请求的 Content-Type 判断，默认 columnar"""
+    data_format = request.args.get('format')
+    if data_format is None:
+        content_type = request.content_type or ''
+        data_format = 'jsonl' if 'ndjson' in content_type or 'jsonl' in content_type else 'columnar'
+    if data_format not in GRAPH_FORMATS:
+        raise BulkImportError(f'不支持的格式: {data_format}，可选 jsonl、columnar')
+    return data_format
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/import', methods=['POST'])
+def api_import_knowledge_graph(graph_id):
+    """
+    批量导入节点和边（单个事务）
+    参数：format（jsonl/columnar）、replace（true 时先清空图谱）、return_ids（默认true，返回临时 id 映射）
+    """
     try:
-        event = DeviceEvent.query.get(id)
-        if not event:
+        graph = KnowledgeGraph.query.get(graph_id)
+        if not graph:
             return jsonify({
                 'success': False,
-                'message': '事件不存在'
+                'message': '知识图谱不存在'
             }), 404
         
-        db.session.delete(event)
+        if _graph_format() == 'jsonl':
+            nodes, edges = parse_jsonl(request.get_data().splitlines())
+        else:
+            nodes, edges = parse_columnar(request.get_json(force=True, silent=True))
+        result = import_graph(
+            graph_id, nodes, edges,
+            replace=request.args.get('replace', 'false').lower() == 'true'
+        )
         db.session.commit()
+        graph_index.invalidate(graph_id)
         
+        if request.args.get('return_ids', 'true').lower() == 'false':
+            result.pop('id_map')
         return jsonify({
             'success': True,
-            'message': '事件删除成功'
+            'message': f"导入成功：新建节点 {result['nodes_created']} 个、边 {result['edges_created']} 条，"
+                       f"更新节点 {result['nodes_updated']} 个、边 {result['edges_updated']} 条",
+            'data': result
         })
+    except BulkImportError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({
@@ -1570,19 +2075,283 @@ def api_delete_device_event(id):
             'message': str(e)
         }), 500
 
-@app.route('/api/device-types/<int:device_type_id>/methods', methods=['GET'])
-def api_get_device_methods(device_type_id):
-    """获取设备类型的所有方法"""
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/export', methods=['GET'])
+def api_export_knowledge_graph(graph_id):
+    """流式导出知识图谱的节点和边，参数：format（jsonl/columnar，默认jsonl）"""
     try:
-        device_type = DeviceType.query.get(device_type_id)
-        if not device_type:
+        graph = KnowledgeGraph.query.get(graph_id)
+        if not graph:
             return jsonify({
                 'success': False,
-                'message': '设备类型不存在'
+                'message': '知识图谱不存在'
             }), 404
         
-        methods = DeviceMethod.query.filter_by(device_type_id=device_type_id).all()
-        return jsonify({
+        data_format = request.args.get('format', 'jsonl')
+        if data_format not in GRAPH_FORMATS:
+            return jsonify({
+                'success': False,
+                'message': f'不支持的格式: {data_format}，可选 jsonl、columnar'
+            }), 400
+        if data_format == 'jsonl':
+            generator, mimetype, extension = export_jsonl(graph_id), 'application/x-ndjson', 'jsonl'
+        else:
+            generator, mimetype, extension = export_columnar(graph_id), 'application/json', 'json'
+        return Response(stream_with_context(generator), mimetype=mimetype, headers={
+            'Content-Disposition': f'attachment; filename=knowledge_graph_{graph_id}.{extension}'
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+# 知识图谱遍历 API 接口
+def _graph_query_args():
+    """解析遍历查询的公共参数：direction、relations（逗号分隔）、max_depth"""
+    relations = request.args.get('relations')
+    if relations is not None:
+        relations = [r.strip() for r in relations.split(',') if r.strip()]
+    max_depth = request.args.get('max_depth', type=int)
+    if max_depth is not None and max_depth < 0:
+        raise GraphQueryError('max_depth 不能为负数')
+    return relations, max_depth
+
+
+def _graph_index_or_404(graph_id):
+    index = graph_index.get(graph_id)
+    if index is None:
+        return None, (jsonify({
+            'success': False,
+            'message': '知识图谱不存在'
+        }), 404)
+    return index, None
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/index', methods=['GET'])
+def api_get_knowledge_graph_index(graph_id):
+    """获取知识图谱邻接索引概况（节点数、边数、关系类型）"""
+    try:
+        index, error = _graph_index_or_404(graph_id)
+        if error:
+            return error
+        return jsonify({
+            'success': True,
+            'data': index.stats()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/neighborhood', methods=['GET'])
+def api_get_knowledge_graph_neighborhood(graph_id):
+    """
+    获取节点的 k 跳邻域
+    参数：node_id、hops（默认1）、direction（out/in/both，默认both）、relations、limit
+    """
+    try:
+        index, error = _graph_index_or_404(graph_id)
+        if error:
+            return error
+        relations, _ = _graph_query_args()
+        result = index.neighborhood(
+            request.args.get('node_id'),
+            hops=request.args.get('hops', 1, type=int),
+            direction=request.args.get('direction', 'both'),
+            relations=relations,
+            limit=min(request.args.get('limit', MAX_RESULT_NODES, type=int), MAX_RESULT_NODES)
+        )
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+    except GraphQueryError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/shortest-path', methods=['GET'])
+def api_get_knowledge_graph_shortest_path(graph_id):
+    """
+    获取两节点间的最短路径
+    参数：from_node_id、to_node_id、direction（默认out）、relations、max_depth
+    """
+    try:
+        index, error = _graph_index_or_404(graph_id)
+        if error:
+            return error
+        relations, max_depth = _graph_query_args()
+        result = index.shortest_path(
+            request.args.get('from_node_id'),
+            request.args.get('to_node_id'),
+            direction=request.args.get('direction', 'out'),
+            relations=relations,
+            max_depth=max_depth
+        )
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+    except GraphQueryError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/reachable', methods=['GET'])
+def api_get_knowledge_graph_reachable(graph_id):
+    """
+    获取沿指定关系可到达的节点（故障传播范围）
+    参数：node_id（可逗号分隔多个）、relations、direction（默认out）、max_depth、limit
+    """
+    try:
+        index, error = _graph_index_or_404(graph_id)
+        if error:
+            return error
+        relations, max_depth = _graph_query_args()
+        node_ids = [n for n in request.args.get('node_id', '').split(',') if n.strip()]
+        result = index.reachable(
+            node_ids,
+            relations=relations,
+            direction=request.args.get('direction', 'out'),
+            max_depth=max_depth,
+            limit=min(request.args.get('limit', MAX_RESULT_NODES, type=int), MAX_RESULT_NODES)
+        )
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+    except GraphQueryError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+def _current_alarms():
+    """当前触发的事件：采集服务运行时取其内存中的事件状态，否则取事件历史中每个设备事件的最新状态"""
+    alarms = runtime.active_alarms()
+    return alarms if alarms is not None else load_active_alarms()
+
+
+@app.route('/api/knowledge-graphs/<int:graph_id>/root-causes', methods=['GET', 'POST'])
+def api_get_knowledge_graph_root_causes(graph_id):
+    """
+    根据告警对候选根因排序（个性化 PageRank）
+    POST 请求体可指定 alarms（[{device_id, event_id}]）或 device_ids，缺省使用当前触发的事件；
+    参数：direction（默认in，从现象走向原因）、relations、damping、top_k、node_types、
+    exclude_alarm_nodes（默认true）
+    """
+    try:
+        index, error = _graph_index_or_404(graph_id)
+        if error:
+            return error
+        data = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+        params = dict(request.args)
+        params.update(data)
+        
+        def as_list(value):
+            if value is None or isinstance(value, list):
+                return value
+            return [v.strip() for v in str(value).split(',') if v.strip()]
+        
+        if data.get('alarms') is not None:
+            alarms = data['alarms']
+        elif data.get('device_ids') is not None:
+            alarms = [{'device_id': device_id} for device_id in data['device_ids']]
+        else:
+            alarms = _current_alarms()
+        exclude = params.get('exclude_alarm_nodes', True)
+        if isinstance(exclude, str):
+            exclude = exclude.lower() not in ('0', 'false', 'no')
+        result = root_cause_ranker.rank(
+            index,
+            resolve_alarms(alarms),
+            direction=params.get('direction', 'in'),
+            relations=as_list(params.get('relations')),
+            damping=float(params.get('damping', 0.85)),
+            top_k=min(int(params.get('top_k', 20)), MAX_RESULT_NODES),
+            node_types=as_list(params.get('node_types')),
+            exclude_alarm_nodes=bool(exclude)
+        )
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+    except (GraphQueryError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/device-events/<int:id>', methods=['DELETE'])
+def api_delete_device_event(id):
+    """删除设备事件"""
+    try:
+        event = DeviceEvent.query.get(id)
+        if not event:
+            return jsonify({
+                'success': False,
+                'message': '事件不存在'
+            }), 404
+        
+        device_type_id = event.device_type_id
+        db.session.delete(event)
+        db.session.commit()
+        event_engine.invalidate(device_type_id)
+        
+        return jsonify({
+            'success': True,
+            'message': '事件删除成功'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/device-types/<int:device_type_id>/methods', methods=['GET'])
+def api_get_device_methods(device_type_id):
+    """获取设备类型的所有方法"""
+    try:
+        device_type = DeviceType.query.get(device_type_id)
+        if not device_type:
+            return jsonify({
+                'success': False,
+                'message': '设备类型不存在'
+            }), 404
+        
+        methods = DeviceMethod.query.filter_by(device_type_id=device_type_id).all()
+        return jsonify({
             'success': True,
             'data': [method.to_dict() for method in methods]
         })
@@ -1976,41 +2745,217 @@ def device_property_binding():
 
 @app.route('/predictive-maintenance')
 def predictive_maintenance():
-    return '<h1>预测性维护模块</h1><p>基于数据分析预测设备维护需求。</p>'
+    """预测性维护页面（劣化趋势和剩余寿命）"""
+    return render_template('predictive_maintenance.html')
 
 @app.route('/performance-analysis')
 def performance_analysis():
-    return '<h1>性能分析与优化模块</h1><p>分析系统性能并提供优化建议。</p>'
+    """性能分析页面（KPI 定义和统计报表）"""
+    return render_template('performance_analysis.html')
 
 
-@app.route('/api/property-history', methods=['POST'])
-def api_save_property_history():
-    """保存设备属性历史数据"""
+# 预测性维护API
+@app.route('/api/predictive-maintenance/models', methods=['GET'])
+def api_get_degradation_models():
+    """获取劣化模型及剩余寿命预测，按剩余寿命从短到长排列"""
     try:
-        data = request.get_json()
-        device_id = data.get('device_id')
+        query = DegradationModel.query
+        device_id = request.args.get('device_id', type=int)
+        if device_id:
+            query = query.filter_by(device_id=device_id)
+        models = query.all()
+        
+        devices = {device.id: device for device in Device.query.filter(
+            Device.id.in_({model.device_id for model in models})
+        ).all()} if models else {}
+        properties = {prop.id: prop for prop in DeviceProperty.query.filter(
+            DeviceProperty.id.in_({model.property_id for model in models})
+        ).all()} if models else {}
+        data = []
+        for model in sorted(models, key=lambda m: (m.rul_hours is None, m.rul_hours or 0, m.id)):
+            item = model.to_dict()
+            device = devices.get(model.device_id)
+            prop = properties.get(model.property_id)
+            item['device_name'] = device.name if device else None
+            item['property_name'] = prop.name if prop else None
+            item['unit'] = prop.unit if prop else None
+            data.append(item)
+        return jsonify({
+            'success': True,
+            'data': data
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/predictive-maintenance/models', methods=['POST'])
+def api_create_degradation_models():
+    """为一组设备（或某类型的全部设备）的健康指标创建劣化模型，已存在的相同模型被跳过"""
+    try:
+        data = request.get_json(silent=True) or {}
         property_id = data.get('property_id')
-        value = data.get('value')
+        model_type = data.get('model_type', 'linear')
+        direction = data.get('direction') or None
+        series = (data.get('series') or '').strip() or None
+        threshold = data.get('threshold')
+        threshold = float(threshold) if threshold not in (None, '') else None
+        
+        prop = DeviceProperty.query.get(property_id) if property_id else None
+        if not prop:
+            return jsonify({
+                'success': False,
+                'message': '属性不存在'
+            }), 400
+        if model_type not in MODEL_TYPES:
+            return jsonify({
+                'success': False,
+                'message': f'不支持的模型类型: {model_type}'
+            }), 400
+        if direction is not None and direction not in DIRECTIONS:
+            return jsonify({
+                'success': False,
+                'message': f'不支持的失效方向: {direction}'
+            }), 400
         
-        if not all([device_id, property_id, value is not None]):
+        device_type = DeviceType.query.get(prop.device_type_id)
+        devices = Device.query.filter_by(type=device_type.name).all() if device_type else []
+        if data.get('device_ids'):
+            device_ids = {int(device_id) for device_id in data['device_ids']}
+            devices = [device for device in devices if device.id in device_ids]
+        if not devices:
             return jsonify({
                 'success': False,
-                'message': '缺少必要参数'
+                'message': '没有属于该属性所在设备类型的设备'
             }), 400
         
-        # 创建历史记录
-        history = PropertyHistory(
-            device_id=device_id,
-            property_id=property_id,
-            value=str(value)
-        )
+        existing = {
+            model.device_id for model in DegradationModel.query.filter_by(
+                property_id=prop.id, series=series, model_type=model_type
+            ).all()
+        }
+        created = []
+        for device in devices:
+            if device.id in existing:
+                continue
+            model = DegradationModel(
+                device_id=device.id,
+                property_id=prop.id,
+                series=series,
+                model_type=model_type,
+                threshold=threshold,
+                direction=direction
+            )
+            db.session.add(model)
+            created.append(model)
+        db.session.commit()
         
-        db.session.add(history)
+        return jsonify({
+            'success': True,
+            'message': f'已创建 {len(created)} 个劣化模型',
+            'data': [model.to_dict() for model in created]
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/predictive-maintenance/models/<int:id>', methods=['DELETE'])
+def api_delete_degradation_model(id):
+    """删除劣化模型"""
+    try:
+        model = DegradationModel.query.get(id)
+        if not model:
+            return jsonify({
+                'success': False,
+                'message': '劣化模型不存在'
+            }), 404
+        
+        db.session.delete(model)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': '劣化模型删除成功'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/predictive-maintenance/models/<int:id>/reset', methods=['POST'])
+def api_reset_degradation_model(id):
+    """清除劣化模型的拟合状态，下次刷新时从头拟合"""
+    try:
+        model = DegradationModel.query.get(id)
+        if not model:
+            return jsonify({
+                'success': False,
+                'message': '劣化模型不存在'
+            }), 404
+        
+        reset_model(model)
         db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': '拟合状态已清除',
+            'data': model.to_dict()
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/predictive-maintenance/models/<int:id>/curve', methods=['GET'])
+def api_get_degradation_curve(id):
+    """获取劣化模型的小时观测值和拟合趋势（外推到预测失效时刻）"""
+    try:
+        model = DegradationModel.query.get(id)
+        if not model:
+            return jsonify({
+                'success': False,
+                'message': '劣化模型不存在'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'data': model_curve(model)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/predictive-maintenance/refresh', methods=['POST'])
+def api_refresh_degradation_models():
+    """增量刷新全部劣化模型（并入新结束的时段），可作为后台任务执行"""
+    try:
+        data = request.get_json(silent=True) or {}
+        if data.get('background'):
+            job = get_job_manager().submit('degradation_refresh', {})
+            return jsonify({
+                'success': True,
+                'message': '刷新任务已提交',
+                'data': job.to_dict()
+            }), 202
         
+        summary = refresh_models()
         return jsonify({
             'success': True,
-            'message': '历史数据保存成功'
+            'message': f"已刷新 {summary['models']} 个劣化模型",
+            'data': summary
         })
     except Exception as e:
         db.session.rollback()
@@ -2020,36 +2965,627 @@ def api_save_property_history():
         }), 500
 
 
-@app.route('/api/property-history/<int:device_id>/<int:property_id>', methods=['GET'])
-def api_get_property_history(device_id, property_id):
-    """获取设备属性历史数据"""
+@app.route('/api/rollups/backfill', methods=['POST'])
+def api_backfill_rollups():
+    """作为后台任务回填属性和事件历史的小时汇总（full 为真时重算全部历史）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        job = get_job_manager().submit('rollup_backfill', {
+            'full': bool(data.get('full')),
+            'points': data.get('points')
+        })
+        return jsonify({
+            'success': True,
+            'message': '汇总任务已提交',
+            'data': job.to_dict()
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+# 性能分析API
+def _kpi_from_request(kpi, data):
+    """用请求数据更新 KPI 定义的字段"""
+    for field in ('name', 'identifier', 'description', 'unit', 'expression'):
+        if field in data:
+            value = data.get(field)
+            setattr(kpi, field, value.strip() if isinstance(value, str) else value)
+    if 'device_type_id' in data:
+        kpi.device_type_id = data.get('device_type_id') or None
+    if 'inputs' in data:
+        inputs = data.get('inputs')
+        kpi.inputs = inputs if isinstance(inputs, str) else json.dumps(inputs or {}, ensure_ascii=False)
+
+
+@app.route('/api/performance/kpis', methods=['GET'])
+def api_get_kpis():
+    """获取全部 KPI 定义"""
+    try:
+        kpis = KpiDefinition.query.order_by(KpiDefinition.id).all()
+        device_types = {device_type.id: device_type.name for device_type in DeviceType.query.all()}
+        data = []
+        for kpi in kpis:
+            item = kpi.to_dict()
+            item['device_type_name'] = device_types.get(kpi.device_type_id)
+            data.append(item)
+        return jsonify({
+            'success': True,
+            'data': data
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/kpis', methods=['POST'])
+def api_create_kpi():
+    """创建 KPI 定义"""
+    try:
+        data = request.get_json(silent=True) or {}
+        kpi = KpiDefinition()
+        _kpi_from_request(kpi, data)
+        if not kpi.name or not kpi.identifier:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 名称和标识符不能为空'
+            }), 400
+        if KpiDefinition.query.filter_by(identifier=kpi.identifier).first():
+            return jsonify({
+                'success': False,
+                'message': 'KPI 标识符已存在'
+            }), 400
+        compile_kpi(kpi)
+        
+        db.session.add(kpi)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': 'KPI 创建成功',
+            'data': kpi.to_dict()
+        })
+    except KpiError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/kpis/<int:id>', methods=['PUT'])
+def api_update_kpi(id):
+    """更新 KPI 定义并清除其周期结果缓存"""
+    try:
+        kpi = KpiDefinition.query.get(id)
+        if not kpi:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 不存在'
+            }), 404
+        
+        data = request.get_json(silent=True) or {}
+        _kpi_from_request(kpi, data)
+        if not kpi.name or not kpi.identifier:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 名称和标识符不能为空'
+            }), 400
+        if KpiDefinition.query.filter(KpiDefinition.identifier == kpi.identifier, KpiDefinition.id != id).first():
+            return jsonify({
+                'success': False,
+                'message': 'KPI 标识符已存在'
+            }), 400
+        compile_kpi(kpi)
+        
+        db.session.commit()
+        clear_kpi_cache(id)
+        return jsonify({
+            'success': True,
+            'message': 'KPI 更新成功',
+            'data': kpi.to_dict()
+        })
+    except KpiError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/kpis/<int:id>', methods=['DELETE'])
+def api_delete_kpi(id):
+    """删除 KPI 定义及其周期结果缓存"""
+    try:
+        kpi = KpiDefinition.query.get(id)
+        if not kpi:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 不存在'
+            }), 404
+        
+        clear_kpi_cache(id)
+        db.session.delete(kpi)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': 'KPI 删除成功'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/kpis/<int:id>/values', methods=['GET'])
+def api_get_kpi_values(id):
+    """计算统计周期内各设备、各设备类型和全部设备的 KPI（默认为本月至今），refresh=0 时不刷新汇总表"""
+    try:
+        kpi = KpiDefinition.query.get(id)
+        if not kpi:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 不存在'
+            }), 404
+        
+        now = datetime.utcnow()
+        start = _parse_request_time(request.args.get('start_time')) or now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = _parse_request_time(request.args.get('end_time')) or now
+        return jsonify({
+            'success': True,
+            'data': period_result(kpi, start, end, now, refresh=request.args.get('refresh', '1') not in ('0', 'false'))
+        })
+    except (KpiError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/kpis/<int:id>/report', methods=['GET'])
+def api_get_kpi_report(id):
+    """KPI 月度报表：从 month（YYYY-MM）起 months 个月的全部设备和各设备类型 KPI 及环比变化，refresh=0 时不刷新汇总表"""
+    try:
+        kpi = KpiDefinition.query.get(id)
+        if not kpi:
+            return jsonify({
+                'success': False,
+                'message': 'KPI 不存在'
+            }), 404
+        
+        now = datetime.utcnow()
+        months = request.args.get('months', 6, type=int)
+        month = request.args.get('month')
+        if not month:
+            # 默认截止到本月
+            index = now.year * 12 + now.month - months
+            month = f'{index // 12:04d}-{index % 12 + 1:02d}'
+        return jsonify({
+            'success': True,
+            'data': monthly_report(kpi, month, months, now, request.args.get('refresh', '1') not in ('0', 'false'))
+        })
+    except KpiError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/performance/cache', methods=['DELETE'])
+def api_clear_kpi_cache():
+    """清除 KPI 周期结果缓存（补录历史数据后使用），可按 kpi_id 只清除一个 KPI"""
+    try:
+        deleted = clear_kpi_cache(request.args.get('kpi_id', type=int))
+        return jsonify({
+            'success': True,
+            'message': f'已清除 {deleted} 条缓存结果'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/property-history', methods=['POST'])
+def api_save_property_history():
+    """保存设备属性历史数据"""
+    try:
+        data = request.get_json()
+        device_id = data.get('device_id')
+        property_id = data.get('property_id')
+        value = data.get('value')
+        
+        if not all([device_id, property_id, value is not None]):
+            return jsonify({
+                'success': False,
+                'message': '缺少必要参数'
+            }), 400
+        
+        # 按属性的死区配置过滤，未超出死区的采样不存储
+        property = DeviceProperty.query.get(property_id)
+        config = deadband_config(property) if property else None
+        rows = runtime.filter_sample(device_id, property_id, config, str(value), datetime.utcnow())
+        
+        # 创建历史记录
+        for timestamp, row_value in rows:
+            history = PropertyHistory(
+                device_id=device_id,
+                property_id=property_id,
+                value=row_value,
+                timestamp=timestamp
+            )
+            db.session.add(history)
+        db.session.commit()
+        
+        # 例外报告可能补发较早的保持值，早于已汇总时段时重算汇总
+        if rows:
+            apply_backfilled_history({(device_id, property_id): min(timestamp for timestamp, _ in rows)})
+        
+        return jsonify({
+            'success': True,
+            'message': '历史数据保存成功',
+            'stored': len(rows)
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/property-history/<int:device_id>/<int:property_id>', methods=['GET'])
+def api_get_property_history(device_id, property_id):
+    """
+    获取设备属性历史数据（按时间倒序）
+    format=columns 时返回列式结构 {t, v, id}，time=ms 时时间戳为 Unix 毫秒
+    """
+    try:
+        # 获取查询参数
+        limit = request.args.get('limit', type=int, default=100)
+        offset = request.args.get('offset', type=int, default=0)
+        start_time = request.args.get('start_time')
+        end_time = request.args.get('end_time')
+        shape, time_format = request_options(request.args)
+        
+        # 构建查询：只选取返回的列，按元组取出
+        table = PropertyHistory.__table__
+        if shape == 'columns':
+            names = ['id', 'value', 'timestamp']
+        else:
+            names = ['id', 'device_id', 'property_id', 'value', 'timestamp']
+        columns = [time_text(table.c[name]).label(name) if name == 'timestamp' else table.c[name] for name in names]
+        query = db.select(*columns).where(
+            table.c.device_id == device_id,
+            table.c.property_id == property_id
+        )
+        
+        # 添加时间范围过滤
+        if start_time:
+            start_datetime = parse_utc_time(start_time)
+            query = query.where(table.c.timestamp >= start_datetime)
+        if end_time:
+            end_datetime = parse_utc_time(end_time)
+            query = query.where(table.c.timestamp <= end_datetime)
+        
+        # 执行查询
+        rows = db.session.execute(query.order_by(table.c.timestamp.desc()).limit(limit).offset(offset)).all()
+        
+        if shape == 'columns':
+            data = columns_payload(names, rows, 'timestamp', 'value', time_format)
+        else:
+            data = rows_payload(names, rows, 'timestamp', time_format)
+        return json_response({
+            'success': True,
+            'data': data
+        })
+    except SerializationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/event-history', methods=['POST'])
+def api_save_event_history():
+    """保存设备事件历史数据"""
+    try:
+        data = request.get_json()
+        device_id = data.get('device_id')
+        event_id = data.get('event_id')
+        status = data.get('status')
+        
+        if not all([device_id, event_id, status]):
+            return jsonify({
+                'success': False,
+                'message': '缺少必要参数'
+            }), 400
+        
+        # 创建历史记录
+        history = EventHistory(
+            device_id=device_id,
+            event_id=event_id,
+            status=status
+        )
+        
+        db.session.add(history)
+        db.session.commit()
+        
+        # 事件触发时提交决策树诊断，属性值按触发时刻之前的最新历史值
+        if status == 'triggered':
+            event = DeviceEvent.query.get(event_id)
+            if event:
+                runtime.submit_diagnosis(event.device_type_id, device_id, event.id, event.identifier, {}, history.timestamp)
+        
+        return jsonify({
+            'success': True,
+            'message': '事件历史数据保存成功'
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/event-history/<int:device_id>/<int:event_id>', methods=['GET'])
+def api_get_event_history(device_id, event_id):
+    """
+    获取设备事件历史数据（按时间倒序）
+    format=columns 时返回列式结构 {t, v（事件状态）, id}，time=ms 时时间戳为 Unix 毫秒
+    """
+    try:
+        # 获取查询参数
+        limit = request.args.get('limit', type=int, default=100)
+        offset = request.args.get('offset', type=int, default=0)
+        start_time = request.args.get('start_time')
+        end_time = request.args.get('end_time')
+        shape, time_format = request_options(request.args)
+        
+        # 构建查询：只选取返回的列，按元组取出
+        table = EventHistory.__table__
+        if shape == 'columns':
+            names = ['id', 'status', 'timestamp']
+        else:
+            names = ['id', 'device_id', 'event_id', 'status', 'timestamp']
+        columns = [time_text(table.c[name]).label(name) if name == 'timestamp' else table.c[name] for name in names]
+        query = db.select(*columns).where(
+            table.c.device_id == device_id,
+            table.c.event_id == event_id
+        )
+        
+        # 添加时间范围过滤
+        if start_time:
+            start_datetime = parse_utc_time(start_time)
+            query = query.where(table.c.timestamp >= start_datetime)
+        if end_time:
+            end_datetime = parse_utc_time(end_time)
+            query = query.where(table.c.timestamp <= end_datetime)
+        
+        # 执行查询
+        rows = db.session.execute(query.order_by(table.c.timestamp.desc()).limit(limit).offset(offset)).all()
+        
+        if shape == 'columns':
+            data = columns_payload(names, rows, 'timestamp', 'status', time_format, numeric=False)
+        else:
+            data = rows_payload(names, rows, 'timestamp', time_format)
+        return json_response({
+            'success': True,
+            'data': data
+        })
+    except SerializationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/devices/<int:device_id>/diagnoses', methods=['GET'])
+def api_get_device_diagnoses(device_id):
+    """获取设备的决策树诊断记录"""
+    try:
+        # 获取查询参数
+        limit = request.args.get('limit', type=int, default=100)
+        offset = request.args.get('offset', type=int, default=0)
+        tree_id = request.args.get('tree_id', type=int)
+        start_time = request.args.get('start_time')
+        end_time = request.args.get('end_time')
+        
+        # 构建查询
+        query = DiagnosisRecord.query.filter_by(device_id=device_id)
+        if tree_id:
+            query = query.filter_by(tree_id=tree_id)
+        
+        # 添加时间范围过滤
+        if start_time:
+            start_datetime = parse_utc_time(start_time)
+            query = query.filter(DiagnosisRecord.timestamp >= start_datetime)
+        if end_time:
+            end_datetime = parse_utc_time(end_time)
+            query = query.filter(DiagnosisRecord.timestamp <= end_datetime)
+        
+        # 执行查询
+        records = query.order_by(DiagnosisRecord.timestamp.desc()).limit(limit).offset(offset).all()
+        
+        return jsonify({
+            'success': True,
+            'data': [record.to_dict() for record in records]
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/diagnosis/status', methods=['GET'])
+def api_get_diagnosis_status():
+    """获取诊断队列状态"""
+    return jsonify({
+        'success': True,
+        'data': runtime.diagnosis_status()
+    })
+
+
+# 后台任务API
+@app.route('/api/jobs', methods=['GET'])
+def api_get_jobs():
+    """获取后台任务列表（不含任务结果）"""
+    try:
+        query = Job.query
+        status = request.args.get('status')
+        if status:
+            query = query.filter_by(status=status)
+        job_type = request.args.get('job_type')
+        if job_type:
+            query = query.filter_by(job_type=job_type)
+        limit = request.args.get('limit', 50, type=int)
+        jobs = query.order_by(Job.id.desc()).limit(limit).all()
+        data = []
+        for job in jobs:
+            item = job.to_dict()
+            item.pop('result')
+            data.append(item)
+        return jsonify({
+            'success': True,
+            'data': data,
+            'pool': job_manager.status()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+    """提交后台任务"""
+    try:
+        data = request.get_json(silent=True) or {}
+        job_type = data.get('job_type')
+        params = data.get('params') or {}
+        check_generic_job(job_type, params)
+        job = get_job_manager().submit(job_type, params)
+        return jsonify({
+            'success': True,
+            'message': '任务已提交',
+            'data': job.to_dict()
+        }), 202
+    except JobParamsError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/jobs/<int:id>', methods=['GET'])
+def api_get_job(id):
+    """获取后台任务的状态、进度和结果"""
+    job = Job.query.get(id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': '任务不存在'
+        }), 404
+    return jsonify({
+        'success': True,
+        'data': job.to_dict()
+    })
+
+
+@app.route('/api/jobs/<int:id>/cancel', methods=['POST'])
+def api_cancel_job(id):
+    """取消后台任务"""
+    try:
+        job = job_manager.cancel(id)
+        if not job:
+            return jsonify({
+                'success': False,
+                'message': '任务不存在'
+            }), 404
+        return jsonify({
+            'success': True,
+            'message': {'cancelled': '任务已取消', 'succeeded': '任务已完成', 'failed': '任务已失败'}.get(job.status, '已请求取消任务'),
+            'data': job.to_dict()
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/devices/<int:device_id>/event-status', methods=['GET', 'POST'])
+def api_get_device_event_status(device_id):
+    """计算设备所有事件的当前触发状态"""
     try:
-        # 获取查询参数
-        limit = request.args.get('limit', type=int, default=100)
-        offset = request.args.get('offset', type=int, default=0)
-        start_time = request.args.get('start_time')
-        end_time = request.args.get('end_time')
-        
-        # 构建查询
-        query = PropertyHistory.query.filter_by(
-            device_id=device_id, 
-            property_id=property_id
-        )
-        
-        # 添加时间范围过滤
-        if start_time:
-            start_datetime = datetime.fromisoformat(start_time.replace('Z', '+00:00')) if 'Z' in start_time else datetime.fromisoformat(start_time)
-            query = query.filter(PropertyHistory.timestamp >= start_datetime)
-        if end_time:
-            end_datetime = datetime.fromisoformat(end_time.replace('Z', '+00:00')) if 'Z' in end_time else datetime.fromisoformat(end_time)
-            query = query.filter(PropertyHistory.timestamp <= end_datetime)
+        device = Device.query.get(device_id)
+        if not device:
+            return jsonify({
+                'success': False,
+                'message': '设备不存在'
+            }), 404
         
-        # 执行查询
-        histories = query.order_by(PropertyHistory.timestamp.desc()).limit(limit).offset(offset).all()
+        # 前端可提交已读取的属性当前值 {标识符: 值}，未提交的属性使用最新历史值
+        data = request.get_json(silent=True) or {}
+        values = data.get('values') or {}
         
         return jsonify({
             'success': True,
-            'data': [history.to_dict() for history in histories]
+            'data': event_engine.evaluate_device(device, values)
         })
     except Exception as e:
         return jsonify({
@@ -2058,73 +3594,53 @@ def api_get_property_history(device_id, property_id):
         }), 500
 
 
-@app.route('/api/event-history', methods=['POST'])
-def api_save_event_history():
-    """保存设备事件历史数据"""
+
+def _with_property_labels(scores):
+    """为异常分数补充属性标识符和名称"""
+    property_ids = {item['property_id'] for item in scores}
+    labels = {
+        prop.id: (prop.identifier, prop.name)
+        for prop in DeviceProperty.query.filter(DeviceProperty.id.in_(property_ids)).all()
+    } if property_ids else {}
+    for item in scores:
+        item['identifier'], item['name'] = labels.get(item['property_id'], (None, None))
+    return scores
+
+
+@app.route('/api/devices/<int:device_id>/anomalies', methods=['GET'])
+def api_get_device_anomalies(device_id):
+    """获取设备各数值属性的当前异常分数（历史分数见派生序列 anomaly_score）"""
     try:
-        data = request.get_json()
-        device_id = data.get('device_id')
-        event_id = data.get('event_id')
-        status = data.get('status')
-        
-        if not all([device_id, event_id, status]):
+        device = Device.query.get(device_id)
+        if not device:
             return jsonify({
                 'success': False,
-                'message': '缺少必要参数'
-            }), 400
-        
-        # 创建历史记录
-        history = EventHistory(
-            device_id=device_id,
-            event_id=event_id,
-            status=status
-        )
-        
-        db.session.add(history)
-        db.session.commit()
+                'message': '设备不存在'
+            }), 404
         
+        scores = runtime.anomaly_scores(device_id)
+        if request.args.get('anomalous_only', '').lower() in ('1', 'true'):
+            scores = [item for item in scores if item['anomalous']]
         return jsonify({
             'success': True,
-            'message': '事件历史数据保存成功'
+            'data': _with_property_labels(scores)
         })
     except Exception as e:
-        db.session.rollback()
         return jsonify({
             'success': False,
             'message': str(e)
         }), 500
 
 
-@app.route('/api/event-history/<int:device_id>/<int:event_id>', methods=['GET'])
-def api_get_event_history(device_id, event_id):
-    """获取设备事件历史数据"""
+@app.route('/api/anomalies', methods=['GET'])
+def api_get_anomalies():
+    """获取当前处于异常状态的全部属性，按分数从高到低排列"""
     try:
-        # 获取查询参数
         limit = request.args.get('limit', type=int, default=100)
-        offset = request.args.get('offset', type=int, default=0)
-        start_time = request.args.get('start_time')
-        end_time = request.args.get('end_time')
-        
-        # 构建查询
-        query = EventHistory.query.filter_by(
-            device_id=device_id, 
-            event_id=event_id
-        )
-        
-        # 添加时间范围过滤
-        if start_time:
-            start_datetime = datetime.fromisoformat(start_time.replace('Z', '+00:00')) if 'Z' in start_time else datetime.fromisoformat(start_time)
-            query = query.filter(EventHistory.timestamp >= start_datetime)
-        if end_time:
-            end_datetime = datetime.fromisoformat(end_time.replace('Z', '+00:00')) if 'Z' in end_time else datetime.fromisoformat(end_time)
-            query = query.filter(EventHistory.timestamp <= end_datetime)
-        
-        # 执行查询
-        histories = query.order_by(EventHistory.timestamp.desc()).limit(limit).offset(offset).all()
-        
         return jsonify({
             'success': True,
-            'data': [history.to_dict() for history in histories]
+            'data': _with_property_labels(runtime.anomaly_active()[:limit]),
+            'status': runtime.anomaly_status()
         })
     except Exception as e:
         return jsonify({
@@ -2132,7 +3648,6 @@ def api_get_event_history(device_id, event_id):
             'message': str(e)
         }), 500
 
-
 # 数据分析项目管理API
 @app.route('/api/data-analysis-projects', methods=['GET'])
 def api_get_data_analysis_projects():
@@ -2220,6 +3735,10 @@ def api_update_data_analysis_project(id):
             project.selected_points = data['selected_points']
         if 'analysis_instances' in data:
             project.analysis_instances = data['analysis_instances']
+        if 'data_cleaning_instances' in data:
+            project.data_cleaning_instances = data['data_cleaning_instances']
+        if 'feature_extraction_instances' in data:
+            project.feature_extraction_instances = data['feature_extraction_instances']
         if 'conclusion' in data:
             project.conclusion = data['conclusion']
         
@@ -2249,6 +3768,8 @@ def api_delete_data_analysis_project(id):
                 'message': '项目不存在'
             }), 404
             
+        clear_project_cache(id)
+        DataAnalysisResult.query.filter_by(project_id=id).delete()
         db.session.delete(project)
         db.session.commit()
         
@@ -2264,6 +3785,55 @@ def api_delete_data_analysis_project(id):
         }), 500
 
 
+@app.route('/api/data-analysis-projects/<int:id>/run', methods=['POST'])
+def api_run_data_analysis_project(id):
+    """在服务器端执行数据分析项目的分析实例并保存分析结果，background 为真时作为后台任务提交"""
+    try:
+        project = DataAnalysisProject.query.get(id)
+        if not project:
+            return jsonify({
+                'success': False,
+                'message': '项目不存在'
+            }), 404
+        
+        data = request.get_json(silent=True) or {}
+        _, _, run_instances = select_instances(project, data)
+        if not run_instances:
+            return jsonify({
+                'success': False,
+                'message': '没有可执行的分析实例'
+            }), 400
+        
+        if data.get('background'):
+            options = {key: value for key, value in data.items() if key != 'background'}
+            job = get_job_manager().submit('analysis_run', {'project_id': id, 'options': options})
+            return jsonify({
+                'success': True,
+                'message': '分析任务已提交',
+                'data': job.to_dict()
+            }), 202
+        
+        outcomes = run_project_analysis(id, data)
+        
+        return jsonify({
+            'success': True,
+            'message': '分析执行完成',
+            'data': outcomes
+        })
+    except AnalysisError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
 # 数据分析结果API
 @app.route('/api/data-analysis-results', methods=['POST'])
 def api_create_data_analysis_result():
@@ -2345,6 +3915,8 @@ def api_delete_data_analysis_result(id):
                 'message': '分析结果不存在'
             }), 404
             
+        # 缓存的结果保留，下次命中时重新生成分析结果记录
+        AnalysisResultCache.query.filter_by(result_id=id).update({'result_id': None})
         db.session.delete(result)
         db.session.commit()
         
@@ -2409,6 +3981,219 @@ def upload_excel():
         }), 500
 
 
+@app.route('/api/property-history/import', methods=['POST'])
+def api_import_property_history():
+    """将已上传的 Excel 文件作为后台任务导入属性历史数据"""
+    try:
+        data = request.get_json(silent=True) or {}
+        filename = os.path.basename(data.get('filename') or '')
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if not filename or not os.path.isfile(file_path):
+            return jsonify({
+                'success': False,
+                'message': '上传的文件不存在'
+            }), 404
+        
+        job = get_job_manager().submit('history_import', {'filepath': file_path})
+        return jsonify({
+            'success': True,
+            'message': '导入任务已提交',
+            'data': job.to_dict()
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+
+def _parse_request_time(text):
+    """请求中的时间参数转为 naive UTC（带时区偏移的先换算）"""
+    return parse_utc_time(text)
+
+
+@app.route('/api/derived-series/extract', methods=['POST'])
+def api_extract_derived_series():
+    """提取点位的状态监测特征（RMS、峭度、频带能量等）并保存为派生序列"""
+    try:
+        data = request.get_json(silent=True) or {}
+        device_id = data.get('device_id')
+        property_id = data.get('property_id')
+        if not device_id or not property_id:
+            return jsonify({
+                'success': False,
+                'message': '缺少设备ID或属性ID'
+            }), 400
+        
+        config = {key: data.get(key) for key in ('window', 'step', 'features', 'bands', 'sample_interval') if key in data}
+        if data.get('background'):
+            job = get_job_manager().submit('feature_extraction', {
+                'device_id': int(device_id),
+                'property_id': int(property_id),
+                'config': config,
+                'start_time': data.get('start_time'),
+                'end_time': data.get('end_time')
+            })
+            return jsonify({
+                'success': True,
+                'message': '特征提取任务已提交',
+                'data': job.to_dict()
+            }), 202
+        
+        summary = extract_point_features(
+            int(device_id), int(property_id), config,
+            _parse_request_time(data.get('start_time')), _parse_request_time(data.get('end_time'))
+        )
+        return jsonify({
+            'success': True,
+            'message': f"特征提取完成，共 {summary['windows']} 个窗口",
+            'data': summary
+        })
+    except FeatureError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+
+@app.route('/api/derived-series/<int:device_id>/<int:property_id>', methods=['GET'])
+def api_get_derived_series(device_id, property_id):
+    """获取派生序列：不指定 name 时列出该点位已有的派生序列，指定 name 时返回序列数据"""
+    try:
+        name = request.args.get('name')
+        if not name:
+            rows = db.session.query(
+                DerivedSeriesPoint.name,
+                db.func.count(DerivedSeriesPoint.id),
+                db.func.min(DerivedSeriesPoint.timestamp),
+                db.func.max(DerivedSeriesPoint.timestamp)
+            ).filter_by(device_id=device_id, property_id=property_id).group_by(DerivedSeriesPoint.name).all()
+            return jsonify({
+                'success': True,
+                'data': [{
+                    'name': series_name,
+                    'count': count,
+                    'start': start.isoformat() if start else None,
+                    'end': end.isoformat() if end else None
+                } for series_name, count, start, end in rows]
+            })
+        
+        limit = request.args.get('limit', type=int, default=1000)
+        shape, time_format = request_options(request.args)
+        table = DerivedSeriesPoint.__table__
+        if shape == 'columns':
+            names = ['id', 'value', 'timestamp']
+        else:
+            names = ['id', 'device_id', 'property_id', 'name', 'value', 'timestamp']
+        columns = [time_text(table.c[column]).label(column) if column == 'timestamp' else table.c[column] for column in names]
+        query = db.select(*columns).where(
+            table.c.device_id == device_id,
+            table.c.property_id == property_id,
+            table.c.name == name
+        )
+        start_time = _parse_request_time(request.args.get('start_time'))
+        end_time = _parse_request_time(request.args.get('end_time'))
+        if start_time:
+            query = query.where(table.c.timestamp >= start_time)
+        if end_time:
+            query = query.where(table.c.timestamp <= end_time)
+        rows = db.session.execute(query.order_by(table.c.timestamp.desc()).limit(limit)).all()
+        rows.reverse()
+        if shape == 'columns':
+            data = columns_payload(names, rows, 'timestamp', 'value', time_format)
+        else:
+            data = rows_payload(names, rows, 'timestamp', time_format)
+        return json_response({
+            'success': True,
+            'data': data
+        })
+    except SerializationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/correlation/fleet', methods=['POST'])
+def api_fleet_correlation():
+    """
+    多点位（最多上千个）的相关系数矩阵和滞后相关，返回相关性最强的序列对和目标点位的滞后排名
+    点位由 points 指定，或由 device_type_id（可选 property_ids）展开为该类型全部设备的数值属性
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        points = data.get('points') or []
+        if not points and data.get('device_type_id'):
+            device_type = DeviceType.query.get(data['device_type_id'])
+            if not device_type:
+                return jsonify({
+                    'success': False,
+                    'message': '设备类型不存在'
+                }), 400
+            property_ids = {int(property_id) for property_id in data.get('property_ids') or []}
+            properties = [
+                prop for prop in DeviceProperty.query.filter_by(device_type_id=device_type.id).all()
+                if prop.data_type in ('int', 'float') and (not property_ids or prop.id in property_ids)
+            ]
+            devices = Device.query.filter_by(type=device_type.name).order_by(Device.id).all()
+            points = [[device.id, prop.id] for device in devices for prop in properties]
+        
+        start_time = _parse_request_time(data.get('start_time'))
+        end_time = _parse_request_time(data.get('end_time'))
+        top_k = data.get('top_k', 20)
+        if data.get('background'):
+            job = get_job_manager().submit('fleet_correlation', {
+                'points': points,
+                'start_time': start_time.isoformat() if start_time else None,
+                'end_time': end_time.isoformat() if end_time else None,
+                'step': data.get('step'),
+                'max_lag': data.get('max_lag'),
+                'target': data.get('target'),
+                'top_k': top_k,
+                'refresh': bool(data.get('refresh'))
+            })
+            return jsonify({
+                'success': True,
+                'message': '相关性分析任务已提交',
+                'data': job.to_dict()
+            }), 202
+        
+        result, status, correlation = run_correlation(
+            points, start_time, end_time, data.get('step'), data.get('max_lag'), data.get('target'),
+            bool(data.get('refresh'))
+        )
+        result = limit_result(result, correlation, top_k, bool(data.get('include_matrix')))
+        result['cache_status'] = status
+        return jsonify({
+            'success': True,
+            'data': result
+        })
+    except CorrelationError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
 # 数据分析模块路由
 @app.route('/data-analysis')
 def data_analysis_list():
@@ -2428,56 +4213,14 @@ def data_analysis_project(project_id):
 
 
 
-# 添加全局变量来存储Modbus服务器实例
-modbus_server_instance = None
-modbus_server_thread = None
-
-
-# 定义一个用于Modbus服务器的数据库会话函数
-def modbus_db_session(get_config=False, save_config=None):
-    """为Modbus服务器提供数据库会话的函数"""
-    if get_config:
-        # 获取配置
-        return ServerConfig.query.all()
-    elif save_config:
-        # 保存配置
-        config = ServerConfig.query.filter_by(key=save_config['key']).first()
-        if config:
-            config.value = save_config['value']
-            config.updated_at = datetime.utcnow()
-        else:
-            config = ServerConfig(
-                key=save_config['key'],
-                value=save_config['value'],
-                description='Modbus服务器更新间隔（秒）'
-            )
-            db.session.add(config)
-        db.session.commit()
-        return True
-    else:
-        # 获取激活的Modbus点位
-        return ModbusPoint.query.filter_by(is_active=True).all()
-
-
 # Modbus服务器API端点
 @app.route('/api/modbus-server/status', methods=['GET'])
 def api_modbus_server_status():
     """获取Modbus服务器状态"""
     try:
-        global modbus_server_instance
-        host = "localhost"
-        port = 5020
-        
-        # 检查服务器是否在运行
-        running = modbus_server_instance is not None and modbus_server_instance.running
-        
         return jsonify({
             'success': True,
-            'data': {
-                'running': running,
-                'host': host,
-                'port': port
-            }
+            'data': runtime.modbus_status()
         })
     except Exception as e:
         return jsonify({
@@ -2488,26 +4231,14 @@ def api_modbus_server_status():
 
 @app.route('/api/modbus-server/start', methods=['POST'])
 def api_modbus_server_start():
-    """启动Modbus服务器"""
-    global modbus_server_instance, modbus_server_thread
-    
+    """启动Modbus服务器（同时启动设备数据采集）"""
     try:
-        if modbus_server_instance is not None and modbus_server_instance.running:
+        if not runtime.start_modbus():
             return jsonify({
                 'success': False,
                 'message': '服务器已在运行中'
             }), 400
         
-        # 创建服务器实例，传递数据库会话函数
-        modbus_server_instance = DatabaseModbusServer(modbus_db_session)
-        
-        # 在单独线程中启动服务器
-        modbus_server_thread = threading.Thread(target=modbus_server_instance.start_server)
-        modbus_server_thread.daemon = True
-        modbus_server_thread.start()
-        
-        time.sleep(1)  # 等待服务器启动
-        
         return jsonify({
             'success': True,
             'message': 'Modbus服务器启动成功'
@@ -2522,20 +4253,13 @@ def api_modbus_server_start():
 @app.route('/api/modbus-server/stop', methods=['POST'])
 def api_modbus_server_stop():
     """停止Modbus服务器"""
-    global modbus_server_instance, modbus_server_thread
-    
     try:
-        if modbus_server_instance is None or not modbus_server_instance.running:
+        if not runtime.stop_modbus():
             return jsonify({
                 'success': False,
                 'message': '服务器未在运行'
             }), 400
         
-        # 停止服务器
-        modbus_server_instance.stop_simulation()
-        modbus_server_instance = None
-        modbus_server_thread = None
-        
         return jsonify({
             'success': True,
             'message': 'Modbus服务器已停止'
@@ -2551,19 +4275,10 @@ def api_modbus_server_stop():
 def api_modbus_server_get_update_interval():
     """获取更新间隔"""
     try:
-        interval = 2.0  # 默认值
-        if modbus_server_instance:
-            interval = modbus_server_instance.update_interval
-        else:
-            # 从数据库获取
-            config = ServerConfig.query.filter_by(key='modbus_update_interval').first()
-            if config:
-                interval = float(config.value)
-        
         return jsonify({
             'success': True,
             'data': {
-                'interval': interval
+                'interval': runtime.modbus_interval()
             }
         })
     except Exception as e:
@@ -2602,8 +4317,7 @@ def api_modbus_server_set_update_interval():
         db.session.commit()
         
         # 如果服务器正在运行，更新其间隔
-        if modbus_server_instance:
-            modbus_server_instance.set_update_interval(interval)
+        runtime.set_modbus_interval(interval)
         
         return jsonify({
             'success': True,
@@ -2637,30 +4351,64 @@ def api_get_modbus_points():
         }), 500
 
 
+# 点位名称缓存 (值表实例, 布局版本) → {point_id: 名称}，点位配置变化时值表重新布局，缓存随之失效
+_point_names = {'cache': (None, {})}
+
+
+def _modbus_point_names(snapshot):
+    key = (snapshot.instance, snapshot.layout)
+    cached_key, names = _point_names['cache']
+    if cached_key != key:
+        names = dict(db.session.query(ModbusPoint.id, ModbusPoint.name).all())
+        _point_names['cache'] = (key, names)
+    return names
+
+
 @app.route('/api/modbus-points/values', methods=['GET'])
 def api_get_modbus_point_values():
-    """获取所有Modbus点位的当前值"""
+    """
+    获取所有Modbus点位的当前值（从点位最新值表复制快照，不经过运行时进程）
+    format=columns 时返回列式结构 {id, name, t, v}，time=ms 时时间戳为 Unix 毫秒
+    """
     try:
-        global modbus_server_instance
-        if modbus_server_instance is not None:
-            values = modbus_server_instance.get_point_values()
-            return jsonify({
-                'success': True,
-                'data': values
-            })
+        shape, time_format = request_options(request.args)
+        table = runtime.value_table()
+        snapshot = table.snapshot() if table is not None else None
+        if snapshot is not None and snapshot.active:
+            names = _modbus_point_names(snapshot)
+            ids = snapshot.ids.tolist()
+            # 无效值在值表中为 NaN，编码为 null；其时间戳同样置空
+            snapshot.timestamps[snapshot.quality != QUALITY_GOOD] = float('nan')
+            values = snapshot.values.tolist()
+            times = format_epoch(snapshot.timestamps, time_format)
+            if shape == 'columns':
+                data = {'id': ids, 'name': [names.get(point_id) for point_id in ids], 't': times, 'v': values}
+            else:
+                data = {
+                    point_id: {'value': value, 'name': names.get(point_id), 'timestamp': timestamp}
+                    for point_id, value, timestamp in zip(ids, values, times)
+                }
         else:
             # 服务器未运行，返回空值
-            points = ModbusPoint.query.all()
-            values = {}
-            for point in points:
-                values[point.id] = {
-                    'value': 'N/A',
-                    'name': point.name
+            points = db.session.query(ModbusPoint.id, ModbusPoint.name).all()
+            if shape == 'columns':
+                data = {
+                    'id': [point_id for point_id, _ in points],
+                    'name': [name for _, name in points],
+                    't': [None] * len(points),
+                    'v': [None] * len(points)
                 }
-            return jsonify({
-                'success': True,
-                'data': values
-            })
+            else:
+                data = {point_id: {'value': 'N/A', 'name': name} for point_id, name in points}
+        return json_response({
+            'success': True,
+            'data': data
+        })
+    except SerializationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -2689,9 +4437,7 @@ def api_create_modbus_point():
         db.session.commit()
         
         # 如果服务器正在运行，重新加载点位
-        if modbus_server_instance:
-            # 传递数据库会话函数来重新加载点位
-            modbus_server_instance.load_points_from_db()
+        runtime.reload_modbus_points()
         
         return jsonify({
             'success': True,
@@ -2732,9 +4478,7 @@ def api_update_modbus_point(point_id):
         db.session.commit()
         
         # 如果服务器正在运行，重新加载点位
-        if modbus_server_instance:
-            # 传递数据库会话函数来重新加载点位
-            modbus_server_instance.load_points_from_db()
+        runtime.reload_modbus_points()
         
         return jsonify({
             'success': True,
@@ -2764,9 +4508,7 @@ def api_delete_modbus_point(point_id):
         db.session.commit()
         
         # 如果服务器正在运行，重新加载点位
-        if modbus_server_instance:
-            # 传递数据库会话函数来重新加载点位
-            modbus_server_instance.load_points_from_db()
+        runtime.reload_modbus_points()
         
         return jsonify({
             'success': True,
@@ -2780,6 +4522,80 @@ def api_delete_modbus_point(point_id):
         }), 500
 
 
+# 决策树诊断工作线程（由运行时持有，采集服务和事件历史接口经运行时提交诊断任务）
+diagnosis_pipeline = DiagnosisPipeline(app)
+
+# 运行时：Modbus模拟器、设备数据采集和告警状态（单进程部署时在本进程内，多进程部署时在运行时服务进程中）
+runtime = create_runtime(app, stream_hub, diagnosis_pipeline, read_modbus_value)
+
+
+@app.before_request
+def start_runtime():
+    """多进程部署时，工作进程处理第一个请求前连接运行时服务的推送通道"""
+    runtime.start()
+
+
+# 多进程部署时进程池只在运行时服务进程中运行，Web 工作进程经 IPC 提交任务
+job_manager = RemoteJobManager(runtime) if runtime.remote else JobManager(app)
+if not runtime.remote:
+    runtime.jobs = job_manager
+
+
+def get_job_manager():
+    """获取（必要时启动）后台任务进程池"""
+    if not job_manager.started:
+        job_manager.start()
+    return job_manager
+
+
+def sse_response(generator):
+    """构造SSE响应"""
+    return Response(generator, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def prime_snapshot(snapshot):
+    """
+    订阅的快照推送函数：snapshot() 返回当前状态 [(键, 事件名, 数据)]
+    快照在连接建立和队列溢出后推送，此时不在请求上下文中，只读取运行时的内存状态
+    """
+    def prime(subscriber):
+        for key, event, data in snapshot():
+            subscriber.push(key, event, data)
+    return prime
+
+
+# 实时推送API端点（Server-Sent Events）
+@app.route('/api/stream/alarms', methods=['GET'])
+def api_stream_alarms():
+    """推送所有设备的事件状态跳变"""
+    subscriber = stream_hub.subscribe(['alarms'])
+    return sse_response(sse_stream(stream_hub, subscriber, prime_snapshot(runtime.alarm_snapshot)))
+
+
+@app.route('/api/stream/devices/<int:device_id>', methods=['GET'])
+def api_stream_device(device_id):
+    """推送单台设备的属性值变化和事件状态跳变"""
+    device = Device.query.get(device_id)
+    if not device:
+        return jsonify({
+            'success': False,
+            'message': '设备不存在'
+        }), 404
+    
+    subscriber = stream_hub.subscribe([f'device:{device_id}'])
+    return sse_response(sse_stream(stream_hub, subscriber, prime_snapshot(lambda: runtime.device_snapshot(device_id))))
+
+
+@app.route('/api/stream/modbus', methods=['GET'])
+def api_stream_modbus():
+    """推送Modbus服务器状态和点位值变化"""
+    subscriber = stream_hub.subscribe(['modbus'])
+    return sse_response(sse_stream(stream_hub, subscriber, prime_snapshot(runtime.modbus_snapshot)))
+
+
 if __name__ == '__main__':
     app.run(debug=True)
 
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+数据清洗流水线
+与数据分析页面相同的清洗 / 特征提取实例配置，在服务器端组合为一串流式处理阶段：
+上下限剔除、方差（σ）异常点剔除、线性/二次插值、滑动平均与指数平滑、代数变换。
+序列按固定大小分块流过各阶段，跨块需要的状态（窗口尾部、平滑值、待插值区段）由各阶段保存，
+因此任意长度的序列都只占用与块大小相当的内存。被剔除的采样以 NaN 占位，插值阶段据此填补，
+流水线输出时丢弃仍为 NaN 的采样。
+"""
+
+import ast
+import math
+
+import numpy as np
+
+from event_engine import ConditionError, parse_condition, compile_tree
+
+
+class CleaningError(ValueError):
+    """清洗配置不合法"""
+
+
+def _number(value):
+    """页面配置中的数值可能是字符串或空值"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise CleaningError(f'配置值不是数字: {value}')
+
+
+_EMPTY = (np.empty(0, dtype='datetime64[us]'), np.empty(0, dtype=np.float64))
+
+
+class Stage:
+    """
+    流水线阶段
+    process 处理一个块并返回 (times, values)，可以暂存部分采样到后续块再输出；
+    flush 在序列结束时输出暂存的采样；需要全局统计量的阶段设置 needs_fit，
+    由流水线先把上游结果流过 fit 计算统计量；逐采样独立处理、与前后采样无关的阶段设置 stateless，
+    这样的流水线可以只处理新增的数据
+    """
+    
+    needs_fit = False
+    stateless = False
+    
+    def reset(self):
+        """清除跨块状态（拟合得到的统计量保留）"""
+    
+    def fit(self, chunks):
+        """根据上游输出的全部块计算统计量"""
+    
+    def process(self, times, values):
+        return times, values
+    
+    def flush(self):
+        return _EMPTY
+
+
+class LimitStage(Stage):
+    """基于上下限的剔除"""
+    
+    stateless = True
+    
+    def __init__(self, lower=None, upper=None):
+        self.lower = lower
+        self.upper = upper
+    
+    def process(self, times, values):
+        values = values.copy()
+        with np.errstate(invalid='ignore'):
+            if self.lower is not None:
+                values[values < self.lower] = np.nan
+            if self.upper is not None:
+                values[values > self.upper] = np.nan
+        return times, values
+
+
+class SigmaStage(Stage):
+    """基于方差的异常点剔除：偏离均值超过 threshold 倍标准差的采样被剔除"""
+    
+    needs_fit = True
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.mean = None
+        self.std = None
+    
+    def fit(self, chunks):
+        # 分块计算后按 Chan 并行算法合并均值和方差
+        count, mean, m2 = 0, 0.0, 0.0
+        for _, values in chunks:
+            values = values[~np.isnan(values)]
+            if values.size == 0:
+                continue
+            chunk_mean = float(values.mean())
+            chunk_m2 = float(((values - chunk_mean) ** 2).sum())
+            total = count + values.size
+            delta = chunk_mean - mean
+            mean += delta * values.size / total
+            m2 += chunk_m2 + delta * delta * count * values.size / total
+            count = total
+        self.mean = mean if count else None
+        self.std = math.sqrt(m2 / count) if count else None
+    
+    def process(self, times, values):
+        if self.mean is None:
+            return times, values
+        values = values.copy()
+        with np.errstate(invalid='ignore'):
+            values[np.abs(values - self.mean) > self.std * self.threshold] = np.nan
+        return times, values
+
+
+def _seconds(times, origin):
+    return (times - origin).astype('timedelta64[us]').astype(np.float64) / 1e6
+
+
+class InterpolationStage(Stage):
+    """
+    插值填补被剔除的采样（NaN）
+    linear 使用两侧最近的有效采样；quadratic 使用左侧两个和右侧一个有效采样的二次曲线，
+    左侧不足两个有效采样时退化为线性。序列开头没有左侧采样的缺口不填补；
+    块末尾的缺口暂存，等到后续块出现右侧采样再输出
+    """
+    
+    def __init__(self, kind='linear'):
+        if kind not in ('linear', 'quadratic'):
+            raise CleaningError(f'不支持的插值方式: {kind}')
+        self.kind = kind
+        self.reset()
+    
+    def reset(self):
+        self._carry = _EMPTY  # 最近两个已输出的原始有效采样
+        self._pending = _EMPTY  # 等待右侧有效采样的缺口
+    
+    def process(self, times, values):
+        carry_times, carry_values = self._carry
+        pending_times, pending_values = self._pending
+        all_times = np.concatenate([carry_times, pending_times, times])
+        all_values = np.concatenate([carry_values, pending_values, values])
+        skip = carry_times.size
+        
+        valid = ~np.isnan(all_values)
+        valid_index = np.flatnonzero(valid)
+        new_valid = valid_index[valid_index >= skip]
+        if new_valid.size == 0:
+            # 没有新的有效采样，整段继续等待
+            self._pending = (all_times[skip:], all_values[skip:])
+            return _EMPTY
+        
+        end = new_valid[-1] + 1
+        out_times, out_values = all_times[:end], all_values[:end].copy()
+        gaps = np.flatnonzero(~valid[:end])
+        if gaps.size and valid_index.size:
+            positions = np.searchsorted(valid_index, gaps)
+            has_left = positions > 0
+            gaps, positions = gaps[has_left], positions[has_left]
+            right = valid_index[positions]
+            left = valid_index[positions - 1]
+            origin = out_times[0]
+            x = _seconds(out_times[gaps], origin)
+            x1, y1 = _seconds(out_times[left], origin), out_values[left]
+            x2, y2 = _seconds(out_times[right], origin), out_values[right]
+            filled = y1 + (y2 - y1) * (x - x1) / (x2 - x1)
+            if self.kind == 'quadratic':
+                has_second = positions > 1
+                second = valid_index[np.maximum(positions - 2, 0)]
+                x0, y0 = _seconds(out_times[second], origin), out_values[second]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    quadratic = (
+                        y0 * (x - x1) * (x - x2) / ((x0 - x1) * (x0 - x2))
+                        + y1 * (x - x0) * (x - x2) / ((x1 - x0) * (x1 - x2))
+                        + y2 * (x - x0) * (x - x1) / ((x2 - x0) * (x2 - x1))
+                    )
+                filled = np.where(has_second & np.isfinite(quadratic), quadratic, filled)
+            out_values[gaps] = filled
+        
+        self._pending = (all_times[end:], all_values[end:])
+        # 只有原始有效采样参与后续插值
+        keep = valid_index[valid_index < end][-2:]
+        self._carry = (all_times[keep], all_values[keep])
+        return out_times[skip:], out_values[skip:]
+    
+    def flush(self):
+        # 序列末尾的缺口没有右侧采样，保持剔除状态
+        pending_times, pending_values = self._pending
+        self._pending = _EMPTY
+        return pending_times, pending_values
+
+
+class MovingAverageStage(Stage):
+    """滑动平均（按采样个数的窗口），序列开头窗口未满时取已有采样的平均"""
+    
+    def __init__(self, window):
+        self.window = max(1, int(window))
+        self.reset()
+    
+    def reset(self):
+        self._tail = np.empty(0, dtype=np.float64)
+        self._seen = 0
+    
+    def process(self, times, values):
+        valid = ~np.isnan(values)
+        current = values[valid]
+        if current.size == 0:
+            return times, values
+        extended = np.concatenate([self._tail, current])
+        sums = np.concatenate([[0.0], np.cumsum(extended)])
+        ends = np.arange(self._tail.size + 1, extended.size + 1)
+        starts = np.maximum(ends - self.window, 0)
+        counts = np.minimum(self._seen + np.arange(1, current.size + 1), self.window)
+        starts = np.maximum(starts, ends - counts)
+        result = values.copy()
+        result[valid] = (sums[ends] - sums[starts]) / (ends - starts)
+        self._tail = extended[-(self.window - 1):] if self.window > 1 else np.empty(0)
+        self._seen += current.size
+        return times, result
+
+
+class ExponentialSmoothingStage(Stage):
+    """
+    指数平滑 y[n] = a·x[n] + (1-a)·y[n-1]
+    块内分段用幂次展开向量化，段长保证 (1-a)^-段长 不溢出
+    """
+    
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise CleaningError('平滑因子必须在 0 到 1 之间')
+        self.alpha = alpha
+        decay = 1.0 - alpha
+        self._block = 4096 if decay == 0 else max(1, min(4096, int(300 / -math.log(decay))))
+        self.reset()
+    
+    def reset(self):
+        self._last = None
+    
+    def process(self, times, values):
+        valid = ~np.isnan(values)
+        current = values[valid]
+        if current.size == 0:
+            return times, values
+        smoothed = np.empty_like(current)
+        decay = 1.0 - self.alpha
+        start = 0
+        last = self._last
+        if last is None:
+            last = current[0]
+        while start < current.size:
+            block = current[start:start + self._block]
+            if decay == 0:
+                smoothed[start:start + block.size] = block
+            else:
+                powers = decay ** np.arange(1, block.size + 1)
+                accumulated = np.cumsum(block * self.alpha / powers)
+                smoothed[start:start + block.size] = powers * (last + accumulated)
+            last = smoothed[start + block.size - 1]
+            start += block.size
+        self._last = last
+        result = values.copy()
+        result[valid] = smoothed
+        return times, result
+
+
+def _check_arithmetic(tree):
+    kind = tree[0]
+    if kind in ('bool', 'cmp', 'agg'):
+        raise CleaningError('代数变换表达式只支持四则运算')
+    if kind == 'unary':
+        if tree[1] is ast.Not:
+            raise CleaningError('代数变换表达式只支持四则运算')
+        _check_arithmetic(tree[2])
+    elif kind == 'bin':
+        _check_arithmetic(tree[2])
+        _check_arithmetic(tree[3])
+
+
+class TransformStage(Stage):
+    """
+    代数变换：表达式中 x（或 value）表示当前采样值，t 表示相对序列起点的秒数，
+    aliases 中的名称（如 point1）也指向当前采样值
+    """
+    
+    def __init__(self, expression, aliases=()):
+        try:
+            condition = parse_condition(expression)
+        except ConditionError as e:
+            raise CleaningError(str(e))
+        _check_arithmetic(condition.tree)
+        allowed = {'x', 'value', 't'} | set(aliases)
+        unknown = condition.variables - allowed
+        if unknown:
+            raise CleaningError(f'表达式引用了无法解析的变量: {", ".join(sorted(unknown))}')
+        self.expression = expression
+        self.aliases = tuple(aliases)
+        self.stateless = 't' not in condition.variables
+        self._evaluate = compile_tree(condition.tree, {})
+        self.reset()
+    
+    def reset(self):
+        self._origin = None
+    
+    def process(self, times, values):
+        if times.size == 0:
+            return times, values
+        if self._origin is None:
+            self._origin = times[0]
+        variables = {'x': values, 'value': values, 't': _seconds(times, self._origin)}
+        for alias in self.aliases:
+            variables[alias] = values
+        with np.errstate(all='ignore'):
+            result = self._evaluate(variables, ())
+        return times, np.broadcast_to(np.asarray(result, dtype=np.float64), values.shape).copy()
+
+
+class Pipeline:
+    """由多个阶段组成的流式清洗流水线"""
+    
+    def __init__(self, stages):
+        self.stages = list(stages)
+    
+    def __bool__(self):
+        return bool(self.stages)
+    
+    @property
+    def stateless(self):
+        """各阶段都与前后采样无关时，新增数据可以单独处理"""
+        return all(stage.stateless for stage in self.stages)
+    
+    def _run(self, source, stages):
+        for stage in stages:
+            stage.reset()
+        for times, values in source():
+            for stage in stages:
+                times, values = stage.process(times, values)
+            if times.size:
+                yield times, values
+        # 各阶段按顺序输出暂存的采样，并继续流过下游阶段
+        for index, stage in enumerate(stages):
+            times, values = stage.flush()
+            for downstream in stages[index + 1:]:
+                times, values = downstream.process(times, values)
+            if times.size:
+                yield times, values
+    
+    def stream(self, source):
+        """
+        source() 返回 (times, values) 块的迭代器，需要可重复调用（拟合阶段会重新读取上游）
+        逐块产出清洗后的有效采样
+        """
+        for index, stage in enumerate(self.stages):
+            if stage.needs_fit:
+                stage.fit(self._run(source, self.stages[:index]))
+        for times, values in self._run(source, self.stages):
+            valid = ~np.isnan(values)
+            if valid.any():
+                yield times[valid], values[valid]
+    
+    def collect(self, source):
+        """运行流水线并拼接为完整序列"""
+        chunks = list(self.stream(source))
+        if not chunks:
+            return _EMPTY
+        return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+
+def cleaning_stage(instance):
+    """数据清洗实例 → 流水线阶段"""
+    config = instance.get('config') or {}
+    kind = instance.get('type', 'limit')
+    if kind == 'limit':
+        lower, upper = _number(config.get('lowerLimit')), _number(config.get('upperLimit'))
+        return LimitStage(lower, upper) if lower is not None or upper is not None else None
+    if kind == 'variance':
+        threshold = _number(config.get('varianceThreshold'))
+        return SigmaStage(threshold) if threshold is not None else None
+    if kind == 'interpolation':
+        return InterpolationStage(config.get('interpolationType') or 'linear')
+    if kind in ('filter', 'moving_average'):
+        window = _number(config.get('windowSize'))
+        return MovingAverageStage(window) if window else None
+    if kind == 'smoothing':
+        return smoothing_stage(config)
+    if kind in ('transform', 'algebraic'):
+        expression = (config.get('expression') or '').strip()
+        return TransformStage(expression) if expression else None
+    raise CleaningError(f'不支持的清洗类型: {kind}')
+
+
+def smoothing_stage(config):
+    """平滑配置：指定 windowSize 时为滑动平均，否则按 smoothingFactor 指数平滑"""
+    window = _number(config.get('windowSize'))
+    if window:
+        return MovingAverageStage(window)
+    alpha = _number(config.get('smoothingFactor'))
+    return ExponentialSmoothingStage(alpha) if alpha else None
+
+
+def applicable_instances(cleaning_instances, feature_instances, point_index):
+    """
+    返回作用于第 point_index 个点位的实例列表 [(类别, 实例)]，类别为 cleaning 或 feature
+    清洗实例按 targetType（all / specific + targetPointIndex）选择点位，勾选使用清洗后数据时生效；
+    特征提取实例勾选使用提取后数据时追加在清洗实例之后，代数表达式中的 point{n} 为第 n 个点位
+    """
+    selected = []
+    for instance in cleaning_instances or []:
+        if not instance.get('useCleanedData'):
+            continue
+        if instance.get('targetType') == 'specific':
+            target = instance.get('targetPointIndex')
+            if target is None or int(target) != point_index:
+                continue
+        selected.append(('cleaning', instance))
+    
+    alias = f'point{point_index + 1}'
+    for instance in feature_instances or []:
+        if not instance.get('useExtractedData') or instance.get('type') not in ('smoothing', 'algebraic'):
+            continue
+        if instance.get('type') == 'algebraic':
+            expression = ((instance.get('config') or {}).get('expression') or '').strip()
+            if not expression:
+                continue
+            try:
+                variables = parse_condition(expression).variables
+            except ConditionError as e:
+                raise CleaningError(str(e))
+            # 引用其他点位的表达式不属于单个点位的流水线
+            if variables - {'x', 'value', 't', alias}:
+                continue
+        selected.append(('feature', instance))
+    return selected
+
+
+def build_pipeline(cleaning_instances, feature_instances, point_index):
+    """按页面配置为第 point_index 个点位组合流水线"""
+    alias = f'point{point_index + 1}'
+    stages = []
+    for kind, instance in applicable_instances(cleaning_instances, feature_instances, point_index):
+        config = instance.get('config') or {}
+        if kind == 'cleaning':
+            stage = cleaning_stage(instance)
+        elif instance.get('type') == 'smoothing':
+            stage = smoothing_stage(config)
+        else:
+            stage = TransformStage(config['expression'].strip(), (alias,))
+        if stage is not None:
+            stages.append(stage)
+    return Pipeline(stages)
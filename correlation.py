@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+大规模相关性和滞后相关分析
+把多达上千个点位按时间桶均值对齐到等间隔网格上，计算完整的相关系数矩阵和指定滞后范围内的互相关。
+相关系数矩阵按缺失值成对统计（只用两条序列都有值的时刻），由分块矩阵乘法一次得到所有序列对的
+重叠计数、总和、平方和与乘积和，只计算上三角的块；互相关用补零的 rFFT 计算，一次得到全部滞后。
+结果按（点位集合、时间范围、步长、滞后范围、目标点位）的内容哈希缓存，各点位历史数据的指纹不变时直接返回。
+"""
+
+import base64
+import hashlib
+import json
+import math
+from datetime import datetime
+
+import numpy as np
+
+from models import db, AnalysisResultCache, Device, DeviceProperty
+from timeseries import load_point_series, align_series, point_fingerprint
+
+
+# 算法版本，修改计算方式时递增使旧缓存失效
+CORRELATION_VERSION = 1
+
+# 单次分析的点位数上限
+MAX_SERIES = 1000
+# 未指定步长时网格的目标时刻数，以及网格时刻数上限
+DEFAULT_SAMPLES = 2048
+MAX_SAMPLES = 20000
+# 矩阵乘法和 FFT 每块处理的序列数
+BLOCK_SIZE = 256
+# 计算相关系数需要的最少重叠时刻数
+MIN_OVERLAP = 3
+# 缓存和返回的最大排名条数
+TOP_K_LIMIT = 100
+# 空桶按线性插值填补的最大间隔（步长的倍数），更长的缺口保留为缺失
+FILL_STEPS = 3
+
+# 缓存项的分析实例标识
+CACHE_INSTANCE = 'fleet_correlation'
+
+
+class CorrelationError(ValueError):
+    """相关性分析参数不合法"""
+
+
+def correlation_matrix(values, mask, block=BLOCK_SIZE):
+    """
+    成对完整的 Pearson 相关系数矩阵 [序列, 序列]
+    values 为 [序列, 时刻] 矩阵，mask 为有效值标记；重叠不足或方差为零的序列对为 NaN
+    返回 (相关系数矩阵, 重叠时刻数矩阵)
+    """
+    count = len(values)
+    if mask.all():
+        return _complete_correlation(values, block)
+    valid = mask.astype(np.float64)
+    # 先减去各序列的均值，降低平方和相减时的舍入误差
+    with np.errstate(invalid='ignore'):
+        shift = np.nanmean(np.where(mask, values, np.nan), axis=1)
+    centered = np.where(mask, values - np.nan_to_num(shift)[:, np.newaxis], 0.0)
+    squares = centered * centered
+    
+    correlation = np.full((count, count), np.nan)
+    overlap = np.zeros((count, count), dtype=np.int64)
+    for i0 in range(0, count, block):
+        i1 = min(i0 + block, count)
+        for j0 in range(i0, count, block):
+            j1 = min(j0 + block, count)
+            n = valid[i0:i1] @ valid[j0:j1].T
+            sx = centered[i0:i1] @ valid[j0:j1].T
+            sy = valid[i0:i1] @ centered[j0:j1].T
+            sxx = squares[i0:i1] @ valid[j0:j1].T
+            syy = valid[i0:i1] @ squares[j0:j1].T
+            sxy = centered[i0:i1] @ centered[j0:j1].T
+            with np.errstate(invalid='ignore', divide='ignore'):
+                covariance = sxy - sx * sy / n
+                vx = sxx - sx * sx / n
+                vy = syy - sy * sy / n
+                r = covariance / np.sqrt(vx * vy)
+            r = np.where((n >= MIN_OVERLAP) & (vx > 0) & (vy > 0), np.clip(r, -1.0, 1.0), np.nan)
+            correlation[i0:i1, j0:j1] = r
+            correlation[j0:j1, i0:i1] = r.T
+            overlap[i0:i1, j0:j1] = np.rint(n)
+            overlap[j0:j1, i0:i1] = np.rint(n).T
+    return correlation, overlap
+
+
+def _complete_correlation(values, block):
+    """没有缺失值时，标准化后的分块矩阵乘积即为相关系数矩阵"""
+    count, samples = values.shape
+    centered = values - values.mean(axis=1, keepdims=True)
+    deviation = np.sqrt((centered * centered).mean(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        standardized = centered / np.where(deviation > 0, deviation, np.nan)[:, np.newaxis]
+    correlation = np.empty((count, count))
+    for i0 in range(0, count, block):
+        i1 = min(i0 + block, count)
+        for j0 in range(i0, count, block):
+            j1 = min(j0 + block, count)
+            r = np.clip(standardized[i0:i1] @ standardized[j0:j1].T / samples, -1.0, 1.0)
+            correlation[i0:i1, j0:j1] = r
+            correlation[j0:j1, i0:i1] = r.T
+    return correlation, np.full((count, count), samples, dtype=np.int64)
+
+
+def standardize(values, mask):
+    """各序列按有效值标准化为均值 0、标准差 1，缺失值记为 0"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        masked = np.where(mask, values, np.nan)
+        mean = np.nanmean(masked, axis=1, keepdims=True)
+        deviation = np.nanstd(masked, axis=1, keepdims=True)
+        standardized = (masked - mean) / np.where(deviation > 0, deviation, np.nan)
+    return np.nan_to_num(standardized)
+
+
+def fft_size(samples, max_lag):
+    """补零后的 FFT 长度（2 的幂），保证滞后范围内没有循环相关的回绕"""
+    return 1 << int(math.ceil(math.log2(max(2, samples + max_lag))))
+
+
+class LagScanner:
+    """
+    基于 rFFT 的互相关：c[k] = Σ a[t]·b[t+k] / 重叠时刻数，序列按全长标准化
+    k > 0 表示 b 的变化滞后于 a，k < 0 表示 b 领先于 a
+    """
+    
+    def __init__(self, values, mask, max_lag):
+        self.standardized = standardize(values, mask)
+        self.valid = mask.astype(np.float64)
+        self.max_lag = max_lag
+        self.size = fft_size(values.shape[1], max_lag)
+        self.lags = np.arange(-max_lag, max_lag + 1)
+        self._columns = self.lags % self.size
+        self._spectra = {}
+    
+    def spectra(self, rows):
+        """指定序列（及其有效值标记）的频谱，已计算过的序列复用"""
+        missing = [row for row in rows if row not in self._spectra]
+        for offset in range(0, len(missing), BLOCK_SIZE):
+            block = missing[offset:offset + BLOCK_SIZE]
+            values = np.fft.rfft(self.standardized[block], self.size, axis=1)
+            valid = np.fft.rfft(self.valid[block], self.size, axis=1)
+            for index, row in enumerate(block):
+                self._spectra[row] = (values[index], valid[index])
+        return [self._spectra[row] for row in rows]
+    
+    def scan(self, anchor, rows):
+        """序列 anchor 与 rows 中各序列在全部滞后上的相关系数 [len(rows), 2·max_lag+1]"""
+        (anchor_values, anchor_valid), = self.spectra([anchor])
+        result = np.empty((len(rows), self.lags.size))
+        for offset in range(0, len(rows), BLOCK_SIZE):
+            block = self.spectra(rows[offset:offset + BLOCK_SIZE])
+            values = np.array([item[0] for item in block])
+            valid = np.array([item[1] for item in block])
+            products = np.fft.irfft(np.conj(anchor_values) * values, self.size, axis=1)[:, self._columns]
+            counts = np.rint(np.fft.irfft(np.conj(anchor_valid) * valid, self.size, axis=1)[:, self._columns])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[offset:offset + len(block)] = np.where(
+                    counts >= MIN_OVERLAP, np.clip(products / counts, -1.0, 1.0), np.nan
+                )
+        return result
+    
+    def best(self, correlations):
+        """每行绝对值最大的相关系数所在的滞后，返回 (滞后数组, 相关系数数组)，整行缺失时为 (0, NaN)"""
+        magnitude = np.where(np.isnan(correlations), -1.0, np.abs(correlations))
+        columns = np.argmax(magnitude, axis=1)
+        rows = np.arange(len(correlations))
+        return self.lags[columns], correlations[rows, columns]
+
+
+def _number(value, digits=4):
+    value = float(value)
+    return round(value, digits) if np.isfinite(value) else None
+
+
+def top_pairs(correlation, limit=TOP_K_LIMIT):
+    """相关系数绝对值最大的序列对（上三角，不含对角线）[(i, j)]"""
+    rows, columns = np.triu_indices(len(correlation), k=1)
+    values = correlation[rows, columns]
+    finite = np.isfinite(values)
+    rows, columns, values = rows[finite], columns[finite], values[finite]
+    if values.size > limit:
+        selected = np.argpartition(-np.abs(values), limit - 1)[:limit]
+        rows, columns, values = rows[selected], columns[selected], values[selected]
+    order = np.argsort(-np.abs(values), kind='stable')
+    return list(zip(rows[order].tolist(), columns[order].tolist()))
+
+
+def encode_matrix(matrix):
+    """相关系数矩阵压缩为 float32 的 base64 文本（缓存用）"""
+    return base64.b64encode(np.ascontiguousarray(matrix, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def decode_matrix(text, size):
+    return np.frombuffer(base64.b64decode(text), dtype=np.float32).reshape(size, size).astype(np.float64)
+
+
+def analyze_correlation(values, mask, step, max_lag=0, target=None, progress=None):
+    """
+    对已对齐的矩阵计算相关系数矩阵、排名靠前的序列对及其最佳滞后，以及目标序列对全部序列的滞后扫描
+    返回 (结果字典, 相关系数矩阵)
+    """
+    correlation, overlap = correlation_matrix(values, mask)
+    if progress is not None:
+        progress(1, 3, '相关系数矩阵计算完成')
+    
+    scanner = LagScanner(values, mask, max_lag) if max_lag > 0 else None
+    pairs = top_pairs(correlation)
+    pair_lags, pair_lag_r = np.zeros(len(pairs), dtype=np.int64), np.full(len(pairs), np.nan)
+    if scanner is not None:
+        for anchor in sorted({i for i, _ in pairs}):
+            indexes = [k for k, (i, _) in enumerate(pairs) if i == anchor]
+            lags, best = scanner.best(scanner.scan(anchor, [pairs[k][1] for k in indexes]))
+            pair_lags[indexes], pair_lag_r[indexes] = lags, best
+    if progress is not None:
+        progress(2, 3, '序列对滞后相关计算完成')
+    
+    result = {
+        'samples': int(values.shape[1]),
+        'step': step,
+        'max_lag': max_lag,
+        'pairs': [
+            {
+                'a': i,
+                'b': j,
+                'r': _number(correlation[i, j]),
+                'overlap': int(overlap[i, j]),
+                'lag': int(lag),
+                'lag_seconds': float(lag * step),
+                'lag_r': _number(lag_r) if scanner is not None else _number(correlation[i, j])
+            }
+            for (i, j), lag, lag_r in zip(pairs, pair_lags.tolist(), pair_lag_r.tolist())
+        ],
+        'target': target,
+        'target_lags': []
+    }
+    
+    if target is not None:
+        others = [index for index in range(len(values)) if index != target]
+        if scanner is not None:
+            lags, best = scanner.best(scanner.scan(target, others))
+        else:
+            lags, best = np.zeros(len(others), dtype=np.int64), correlation[target, others]
+        magnitude = np.where(np.isnan(best), -1.0, np.abs(best))
+        order = np.argsort(-magnitude, kind='stable')[:TOP_K_LIMIT]
+        result['target_lags'] = [
+            {
+                'index': others[k],
+                'r': _number(correlation[target, others[k]]),
+                'lag': int(lags[k]),
+                'lag_seconds': float(lags[k] * step),
+                'lag_r': _number(best[k])
+            }
+            for k in order.tolist() if np.isfinite(best[k])
+        ]
+    if progress is not None:
+        progress(3, 3, '相关性分析完成')
+    return result, correlation
+
+
+def _point_info(points):
+    devices = {device.id: device.name for device in Device.query.filter(
+        Device.id.in_({device_id for device_id, _ in points})
+    ).all()}
+    properties = {prop.id: prop for prop in DeviceProperty.query.filter(
+        DeviceProperty.id.in_({property_id for _, property_id in points})
+    ).all()}
+    return [
+        {
+            'device_id': device_id,
+            'property_id': property_id,
+            'device_name': devices.get(device_id),
+            'property_name': properties[property_id].name if property_id in properties else None,
+            'unit': properties[property_id].unit if property_id in properties else None
+        }
+        for device_id, property_id in points
+    ]
+
+
+def _parse_point(point):
+    """点位 {device_id, property_id} 或 [device_id, property_id] 转为元组"""
+    if isinstance(point, dict):
+        point = (point.get('device_id'), point.get('property_id'))
+    try:
+        return int(point[0]), int(point[1])
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise CorrelationError(f'点位格式错误: {point}')
+
+
+def normalize_points(points, target=None):
+    """点位列表去重并校验数量；目标点位不在列表中时放在最前，返回 (点位列表, 目标下标)"""
+    normalized = list(dict.fromkeys(_parse_point(point) for point in points or []))
+    target_index = None
+    if target is not None:
+        target = _parse_point(target)
+        if target not in normalized:
+            normalized.insert(0, target)
+        target_index = normalized.index(target)
+    if len(normalized) < 2:
+        raise CorrelationError('相关性分析需要至少两个点位')
+    if len(normalized) > MAX_SERIES:
+        raise CorrelationError(f'点位数超过上限 {MAX_SERIES}')
+    return normalized, target_index
+
+
+def cache_key(points, start, end, step, max_lag, target):
+    content = {
+        'version': CORRELATION_VERSION,
+        'points': [list(point) for point in points],
+        'start': start.isoformat() if start else None,
+        'end': end.isoformat() if end else None,
+        'step': step,
+        'max_lag': max_lag,
+        'target': target
+    }
+    text = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _fingerprints(points, start, end):
+    """各点位的 [行数, 最大ID] JSON 文本及范围内最新的采样时间"""
+    fingerprints, latest = [], None
+    for device_id, property_id in points:
+        count, max_id, timestamp = point_fingerprint(device_id, property_id, start, end)
+        fingerprints.append([count, max_id])
+        if timestamp is not None and (latest is None or timestamp > latest):
+            latest = timestamp
+    return json.dumps(fingerprints), latest
+
+
+def _choose_step(series, start, end):
+    """
+    网格范围及默认步长（整秒）：网格约有 DEFAULT_SAMPLES 个时刻，且不小于各点位采样间隔的中位数
+    （步长小于采样间隔时大部分时间桶为空）
+    """
+    non_empty = [times for times, _ in series if times.size]
+    if not non_empty:
+        raise CorrelationError('所选点位在时间范围内没有数据')
+    first = np.datetime64(start, 'us') if start else min(times[0] for times in non_empty)
+    last = np.datetime64(end, 'us') if end else max(times[-1] for times in non_empty)
+    span = (last - first).astype('timedelta64[us]').astype(np.int64) / 1e6
+    intervals = [np.median(np.diff(times.astype(np.int64))) / 1e6 for times in non_empty if times.size > 1]
+    interval = float(np.median(intervals)) if intervals else 0.0
+    return first, last, max(1, int(math.ceil(max(span / DEFAULT_SAMPLES, interval))))
+
+
+def run_correlation(points, start=None, end=None, step=None, max_lag=0, target=None, refresh=False, progress=None):
+    """
+    带缓存的大规模相关性分析
+    points 为 [(device_id, property_id)] 或 [{device_id, property_id}]，step 为网格步长（秒，为空时自动选择），
+    max_lag 为滞后范围（网格步数），target 为目标点位（其滞后扫描覆盖全部点位）
+    返回 (结果字典, 缓存状态 cached / computed, 相关系数矩阵)
+    """
+    points, target_index = normalize_points(points, target)
+    step = int(step) if step else None
+    max_lag = int(max_lag or 0)
+    if step is not None and step < 1:
+        raise CorrelationError('步长至少为 1 秒')
+    if max_lag < 0:
+        raise CorrelationError('滞后范围不能为负数')
+    
+    key = cache_key(points, start, end, step, max_lag, target_index)
+    fingerprint, latest = _fingerprints(points, start, end)
+    entry = AnalysisResultCache.query.filter_by(cache_key=key).first()
+    if entry is not None and not refresh and entry.fingerprint == fingerprint:
+        entry.hits += 1
+        db.session.commit()
+        return json.loads(entry.result), 'cached', decode_matrix(json.loads(entry.state)['matrix'], len(points))
+    
+    series = []
+    for index, (device_id, property_id) in enumerate(points):
+        series.append(load_point_series(device_id, property_id, start, end))
+        if progress is not None and (index + 1) % 50 == 0:
+            progress(index + 1, len(points), f'已加载 {index + 1} / {len(points)} 个点位')
+    first, last, auto_step = _choose_step(series, start, end)
+    step = step or auto_step
+    span = (last - first).astype('timedelta64[us]').astype(np.int64) / 1e6
+    if span / step + 1 > MAX_SAMPLES:
+        raise CorrelationError(f'网格时刻数超过上限 {MAX_SAMPLES}，请增大步长或缩短时间范围')
+    if max_lag >= span / step:
+        raise CorrelationError('滞后范围必须小于网格时刻数')
+    
+    aligned = align_series(
+        series, first.astype(datetime), last.astype(datetime), step, 'linear', step * FILL_STEPS, 'mean'
+    )
+    result, correlation = analyze_correlation(aligned.values, aligned.mask, step, max_lag, target_index, progress)
+    result.update({
+        'points': _point_info(points),
+        'start': str(aligned.grid[0]) if aligned.grid.size else None,
+        'end': str(aligned.grid[-1]) if aligned.grid.size else None,
+        'valid_samples': aligned.mask.sum(axis=1).tolist()
+    })
+    
+    if entry is None:
+        entry = AnalysisResultCache(cache_key=key, hits=0)
+        db.session.add(entry)
+    entry.project_id = None
+    entry.instance_id = CACHE_INSTANCE
+    entry.as_of = latest or end or datetime.utcnow()
+    entry.fingerprint = fingerprint
+    entry.state = json.dumps({'matrix': encode_matrix(correlation)})
+    entry.result = json.dumps(result, ensure_ascii=False)
+    entry.result_id = None
+    db.session.commit()
+    return result, 'computed', correlation
+
+
+def limit_result(result, correlation, top_k=20, include_matrix=False):
+    """按 top_k 截取排名并按需附带完整矩阵（保留 4 位小数，缺失为 None）"""
+    top_k = max(1, min(int(top_k), TOP_K_LIMIT))
+    limited = dict(result)
+    limited['pairs'] = result['pairs'][:top_k]
+    limited['target_lags'] = result['target_lags'][:top_k]
+    if include_matrix:
+        limited['matrix'] = [
+            [round(value, 4) if value == value else None for value in row]
+            for row in correlation.tolist()
+        ]
+    return limited
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+决策树历史回测
+在 [start, end] 上按固定步长生成时间网格，每台设备的属性历史按前值保持对齐为列，
+时间窗口聚合用前缀和 / 稀疏表在整条网格上一次算出；
+编译后决策树的每个条件对整条网格求一次布尔掩码，再用数组下标把所有时刻同时沿树逐层下推到叶子，
+不逐时刻遍历决策树。返回每台设备各叶子的命中次数、持续时长和命中时间段。
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from models import db, Device
+from decision_engine import NO_NODE, decision_engine
+from event_engine import ConditionError, parse_condition, compile_vector, load_latest_snapshot, to_number
+from timeseries import load_point_series, resample
+
+
+DEFAULT_STEP = 60
+
+# 单台设备的网格时刻数上限（一年按 30 秒步长约 105 万）
+MAX_GRID_POINTS = 2000000
+
+# 每台设备返回的命中时间段数上限
+MAX_INTERVALS = 1000
+
+# 批量求窗口中位数时一次复制的采样数上限
+MEDIAN_CHUNK = 1 << 22
+
+
+class BacktestError(ValueError):
+    """回测参数错误"""
+
+
+def _micros(value):
+    return int(np.datetime64(value, 'us').astype(np.int64))
+
+
+def _datetime(micros):
+    return np.datetime64(int(micros), 'us').astype(datetime).isoformat()
+
+
+class WindowAggregator:
+    """
+    一条原始采样序列上的滑动窗口聚合：窗口为 [t - window, t] 内的采样，
+    求和、均值、方差用前缀和，最大、最小值用稀疏表，每个网格时刻 O(1)；
+    中位数对不同的窗口按采样数分组，在滑动窗口视图上批量计算
+    """
+    
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+        self._prefix = None
+        self._tables = {}
+    
+    def bounds(self, grid, window):
+        return (np.searchsorted(self.times, grid - window, side='left'),
+                np.searchsorted(self.times, grid, side='right'))
+    
+    def prefix(self):
+        if self._prefix is None:
+            # 减去均值再累加，减小方差计算的相消误差
+            center = float(self.values.mean()) if self.values.size else 0.0
+            shifted = self.values - center
+            self._prefix = (np.r_[0.0, np.cumsum(shifted)], np.r_[0.0, np.cumsum(shifted * shifted)], center)
+        return self._prefix
+    
+    def table(self, ufunc, levels):
+        """稀疏表：第 k 层为从每个位置起 2^k 个采样的最大（最小）值"""
+        tables = self._tables.setdefault(ufunc, [self.values])
+        while len(tables) < levels:
+            previous, width = tables[-1], 1 << (len(tables) - 1)
+            tables.append(ufunc(previous[:-width], previous[width:]) if previous.size > width else previous[:0])
+        return tables
+    
+    def extreme(self, ufunc, lo, hi, filled):
+        counts = hi - lo
+        levels = int(counts.max()).bit_length() if counts.size else 0
+        tables = self.table(ufunc, levels)
+        for level in range(levels):
+            rows = np.flatnonzero((counts >= (1 << level)) & (counts < (1 << (level + 1))))
+            if rows.size:
+                table = tables[level]
+                filled[rows] = ufunc(table[lo[rows]], table[hi[rows] - (1 << level)])
+        return filled
+    
+    def median(self, lo, hi, filled):
+        rows = np.flatnonzero(hi > lo)
+        if not rows.size:
+            return filled
+        # 网格步长小于采样间隔时相邻时刻的窗口相同，每个不同的窗口只算一次
+        keys, first, inverse = np.unique(
+            lo[rows].astype(np.int64) * (self.values.size + 1) + hi[rows], return_index=True, return_inverse=True
+        )
+        starts = lo[rows[first]]
+        counts = hi[rows[first]] - starts
+        medians = np.empty(keys.size)
+        order = np.argsort(counts, kind='stable')
+        sizes, offsets = np.unique(counts[order], return_index=True)
+        offsets = np.r_[offsets, order.size]
+        for size, begin, end in zip(sizes.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+            windows = np.lib.stride_tricks.sliding_window_view(self.values, size)
+            step = max(1, MEDIAN_CHUNK // size)
+            for chunk in range(begin, end, step):
+                group = order[chunk:min(chunk + step, end)]
+                medians[group] = np.median(windows[starts[group]], axis=1)
+        filled[rows] = medians[inverse.ravel()]
+        return filled
+    
+    def __call__(self, function, grid, window, held):
+        """
+        网格各时刻的聚合值；窗口内没有采样时按当前（保持的）值计算，当前值也没有时为 0，与实时求值一致
+        """
+        lo, hi = self.bounds(grid, window)
+        counts = hi - lo
+        empty = counts == 0
+        result = np.zeros(grid.size)
+        if function in ('sum', 'avg', 'variance'):
+            sums, squares, center = self.prefix()
+            total = sums[hi] - sums[lo]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = total / counts
+                if function == 'sum':
+                    result = total + center * counts
+                elif function == 'avg':
+                    result = mean + center
+                else:
+                    result = np.maximum((squares[hi] - squares[lo]) / counts - mean * mean, 0.0)
+        elif function in ('max', 'min'):
+            result = self.extreme(np.maximum if function == 'max' else np.minimum, lo, hi, result)
+        else:
+            result = self.median(lo, hi, result)
+        if empty.any():
+            held_value = np.where(np.isfinite(held), held, 0.0)
+            if function in ('sum', 'avg', 'max', 'min', 'median'):
+                result[empty] = held_value[empty]
+            else:
+                result[empty] = 0.0
+        return result
+
+
+def condition_masks(compiled, columns, valid_columns, aggregates, size):
+    """
+    对整条网格求各条件的布尔掩码
+    返回 (掩码矩阵 [条件, 时刻], 可求值标记矩阵, {条件下标: 错误信息})；
+    条件引用的属性在某时刻还没有历史值时，该时刻不可求值
+    """
+    slots = {key: index for index, key in enumerate(compiled.aggregates)}
+    masks = np.zeros((len(compiled.conditions), size), dtype=bool)
+    valid = np.zeros((len(compiled.conditions), size), dtype=bool)
+    errors = {}
+    for index, text in enumerate(compiled.condition_texts):
+        try:
+            condition = parse_condition(text)
+            evaluate = compile_vector(condition.tree, slots)
+            masks[index] = np.broadcast_to(np.asarray(evaluate(columns, aggregates), dtype=bool), size)
+        except ConditionError as e:
+            errors[index] = str(e)
+            continue
+        valid[index] = True
+        for name in condition.variables:
+            valid[index] &= valid_columns[name]
+    return masks, valid, errors
+
+
+def route(compiled, masks, valid, size):
+    """
+    所有时刻同时沿决策树下推：每一步按各时刻所在节点取条件掩码，用数组下标选择是 / 否分支
+    返回 (到达的叶子节点下标数组, 停止节点下标数组)，未到达叶子的时刻叶子下标为 -1
+    """
+    condition_index = np.asarray(compiled.condition_index, dtype=np.int64)
+    yes_index = np.asarray(compiled.yes_index, dtype=np.int64)
+    no_index = np.asarray(compiled.no_index, dtype=np.int64)
+    is_leaf = np.array([node_type == 'leaf' for node_type in compiled.node_types], dtype=bool)
+    has_error = np.zeros(len(compiled.node_ids), dtype=bool)
+    has_error[list(compiled.errors)] = True
+    
+    leaves = np.full(size, NO_NODE, dtype=np.int64)
+    stopped = np.full(size, NO_NODE, dtype=np.int64)
+    if not compiled.node_ids:
+        return leaves, stopped
+    rows = np.arange(size)
+    current = np.zeros(size, dtype=np.int64)
+    for _ in range(len(compiled.node_ids) + 1):
+        if not rows.size:
+            break
+        reached = is_leaf[current] & ~has_error[current]
+        leaves[rows[reached]] = current[reached]
+        condition = condition_index[current]
+        has_condition = condition != NO_NODE
+        checked = np.flatnonzero(has_condition)
+        blocked = has_error[current]
+        blocked[checked] |= ~valid[condition[checked], rows[checked]]
+        matched = np.zeros(rows.size, dtype=bool)
+        matched[checked] = masks[condition[checked], rows[checked]]
+        following = np.where(
+            has_condition,
+            np.where(matched, yes_index[current], no_index[current]),
+            np.where(yes_index[current] != NO_NODE, yes_index[current], no_index[current])
+        )
+        done = reached | blocked | (following == NO_NODE)
+        stopped[rows[done & ~reached]] = current[done & ~reached]
+        rows, current = rows[~done], following[~done]
+    # 超过节点数仍未停止说明存在循环引用
+    stopped[rows] = current
+    return leaves, stopped
+
+
+def leaf_intervals(leaves, grid, step, limit):
+    """连续命中同一叶子的时刻合并为时间段 [(叶子下标, 起始时刻, 结束时刻)]，结束时刻为最后一个时刻加一个步长"""
+    if not leaves.size:
+        return [], False
+    change = np.flatnonzero(leaves[1:] != leaves[:-1]) + 1
+    starts = np.r_[0, change]
+    ends = np.r_[change, leaves.size]
+    hits = leaves[starts] != NO_NODE
+    starts, ends = starts[hits], ends[hits]
+    truncated = starts.size > limit
+    starts, ends = starts[:limit], ends[:limit]
+    return list(zip(leaves[starts].tolist(), grid[starts].tolist(), (grid[ends - 1] + step).tolist())), truncated
+
+
+class DeviceHistory:
+    """
+    一台设备在回测范围内的原始采样（从 since 起，since 为开始时刻减去最长聚合窗口），以及对齐到网格的属性列
+    initial 为 since 之前的最新值，放在序列开头作为网格起始处保持的值
+    """
+    
+    def __init__(self, device_id, compiled, grid, since, initial):
+        self.columns = {}
+        self.valid = {}
+        self.aggregators = {}
+        until = np.datetime64(int(grid[-1]), 'us').astype(datetime)
+        for identifier, property_id in compiled.property_ids.items():
+            times, values = load_point_series(
+                device_id, property_id, np.datetime64(since, 'us').astype(datetime), until
+            )
+            times = times.astype(np.int64)
+            value = to_number(initial.get(property_id))
+            if isinstance(value, float) and np.isfinite(value):
+                times, values = np.r_[since - 1, times], np.r_[value, values]
+            column, mask = resample(times, values, grid, 'previous')
+            self.columns[identifier], self.valid[identifier] = column, mask
+            self.aggregators[identifier] = WindowAggregator(times, values)
+    
+    def aggregates(self, keys, grid):
+        return [
+            self.aggregators[key.property](key.function, grid, key.window * 1000000, self.columns[key.property])
+            for key in keys
+        ]
+
+
+def backtest_tree(tree_id, device_ids, start, end=None, step=DEFAULT_STEP, max_intervals=MAX_INTERVALS,
+                  progress=None):
+    """
+    在历史数据上回测决策树：对每台设备统计 [start, end] 内每个网格时刻会命中的叶子
+    返回各设备的叶子命中次数、时长（秒）、命中时间段，以及全部设备的汇总；决策树不存在时返回 None
+    """
+    compiled = decision_engine.get_tree(tree_id)
+    if compiled is None:
+        return None
+    end = end or datetime.utcnow()
+    step = int(step or DEFAULT_STEP)
+    if step < 1:
+        raise BacktestError('步长至少为 1 秒')
+    if end <= start:
+        raise BacktestError('结束时间必须晚于开始时间')
+    step_us = step * 1000000
+    grid = np.arange(_micros(start), _micros(end) + 1, step_us, dtype=np.int64)
+    if grid.size > MAX_GRID_POINTS:
+        raise BacktestError(f'网格时刻数超过上限 {MAX_GRID_POINTS}，请增大步长或缩短时间范围')
+    max_window = max((key.window for key in compiled.aggregates), default=0) * 1000000
+    since = int(grid[0]) - max_window
+    
+    device_ids = list(device_ids)
+    names = dict(db.session.query(Device.id, Device.name).filter(Device.id.in_(device_ids)).all()) if device_ids else {}
+    snapshot = load_latest_snapshot(
+        device_ids, compiled.property_ids.values(), np.datetime64(since - 1, 'us').astype(datetime)
+    )
+    leaf_nodes = [i for i, node_type in enumerate(compiled.node_types) if node_type == 'leaf']
+    totals = np.zeros(len(compiled.node_ids), dtype=np.int64)
+    results = []
+    for position, device_id in enumerate(device_ids):
+        if progress is not None:
+            progress(position, len(device_ids), f'已回测 {position} / {len(device_ids)} 台设备')
+        history = DeviceHistory(device_id, compiled, grid, since, snapshot.get(device_id, {}))
+        aggregates = history.aggregates(compiled.aggregates, grid)
+        masks, valid, errors = condition_masks(compiled, history.columns, history.valid, aggregates, grid.size)
+        leaves, stopped = route(compiled, masks, valid, grid.size)
+        
+        counts = np.bincount(leaves[leaves != NO_NODE], minlength=len(compiled.node_ids))
+        totals += counts
+        unresolved = np.bincount(stopped[stopped != NO_NODE], minlength=len(compiled.node_ids))
+        intervals, truncated = leaf_intervals(leaves, grid, step_us, max_intervals)
+        results.append({
+            'device_id': device_id,
+            'device_name': names.get(device_id),
+            'leaf_hits': [
+                {
+                    'leaf_node_id': compiled.node_ids[i],
+                    'leaf_name': compiled.node_names[i],
+                    'result': compiled.results[i],
+                    'count': int(counts[i]),
+                    'duration_seconds': int(counts[i]) * step
+                }
+                for i in leaf_nodes
+            ],
+            'unresolved': int(unresolved.sum()),
+            'unresolved_nodes': {
+                str(compiled.node_ids[i]): int(unresolved[i]) for i in np.flatnonzero(unresolved).tolist()
+            },
+            'condition_errors': {compiled.condition_texts[i]: message for i, message in errors.items()},
+            'intervals': [
+                {
+                    'leaf_node_id': compiled.node_ids[leaf],
+                    'start': _datetime(first),
+                    'end': _datetime(last)
+                }
+                for leaf, first, last in intervals
+            ],
+            'intervals_truncated': truncated
+        })
+    return {
+        'tree_id': tree_id,
+        'start': _datetime(grid[0]),
+        'end': _datetime(grid[-1]),
+        'step': step,
+        'samples': int(grid.size),
+        'totals': [
+            {
+                'leaf_node_id': compiled.node_ids[i],
+                'leaf_name': compiled.node_names[i],
+                'result': compiled.results[i],
+                'count': int(totals[i]),
+                'duration_seconds': int(totals[i]) * step
+            }
+            for i in leaf_nodes
+        ],
+        'devices': results
+    }
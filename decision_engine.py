@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+决策树编译与批量求值
+一次查询读取整棵决策树，编译为扁平的并行数组（条件下标、是分支下标、否分支下标），
+判定条件复用事件引擎的语法树编译器，同一棵树上相同的聚合只计算一次。
+"""
+
+import hashlib
+import re
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from models import db, DecisionTree, DecisionTreeNode, DeviceProperty
+from event_engine import (
+    ConditionError, parse_condition, compile_tree, register_aggregates, compute_aggregates,
+    load_window_history, fill_missing_values
+)
+
+
+# 节点没有对应分支时的下标
+NO_NODE = -1
+
+
+class CompiledDecisionTree:
+    """
+    扁平化的决策树
+    第 i 个节点：condition_index[i] 为条件下标（-1 表示无条件），
+    yes_index[i] / no_index[i] 为分支节点下标（-1 表示无分支）
+    """
+    
+    def __init__(self, tree, nodes, properties):
+        self.tree_id = tree.id
+        self.name = tree.name
+        self.device_type_id = tree.device_type_id
+        self.property_ids = {p.identifier: p.id for p in properties}
+        self.node_ids = []
+        self.node_names = []
+        self.node_types = []
+        self.results = []
+        self.decision_inputs = []
+        self.condition_index = []
+        self.yes_index = []
+        self.no_index = []
+        self.conditions = []  # 条件下标 → 编译后的求值函数
+        self.condition_texts = []
+        self.errors = {}  # 节点下标 → 编译错误
+        self.aggregates = []  # 槽位下标 → AggregateKey
+        self.windows = {}  # property_id → 最长时间窗口（秒）
+        self._compile(nodes)
+    
+    def _compile(self, nodes):
+        by_id = {node.id: node for node in nodes}
+        children = {}
+        for node in sorted(nodes, key=lambda n: n.id):
+            if node.parent_id is not None:
+                children.setdefault(node.parent_id, []).append(node.id)
+        roots = [node for node in nodes if node.node_type == 'root']
+        if not roots:
+            roots = [node for node in nodes if node.parent_id is None]
+        if not roots:
+            return
+        
+        index_of = {}
+        order = []
+        
+        def visit(node_id):
+            if node_id is None or node_id not in by_id:
+                return NO_NODE
+            if node_id not in index_of:
+                index_of[node_id] = len(order)
+                order.append(node_id)
+            return index_of[node_id]
+        
+        slots = {}
+        compiled = {}  # 条件文本 → 条件下标
+        visit(min(roots, key=lambda n: n.id).id)
+        position = 0
+        # 广度优先编号，子节点下标在遍历时分配，环路引用只会指向已编号的节点
+        while position < len(order):
+            node = by_id[order[position]]
+            self.node_ids.append(node.id)
+            self.node_names.append(node.name)
+            self.node_types.append(node.node_type)
+            self.results.append(node.result)
+            self.decision_inputs.append(node.decision_input)
+            
+            condition_index = NO_NODE
+            text = (node.condition or '').strip() if node.node_type != 'leaf' else ''
+            if text:
+                try:
+                    condition_index = compiled.get(text, NO_NODE)
+                    if condition_index == NO_NODE:
+                        condition = parse_condition(text)
+                        register_aggregates(condition, self.property_ids, slots, self.aggregates, self.windows)
+                        condition_index = compiled[text] = len(self.conditions)
+                        self.conditions.append(compile_tree(condition.tree, slots))
+                        self.condition_texts.append(text)
+                except ConditionError as e:
+                    self.errors[position] = str(e)
+            self.condition_index.append(condition_index)
+            
+            if node.node_type == 'leaf':
+                yes, no = NO_NODE, NO_NODE
+            elif node.yes_child_id is not None or node.no_child_id is not None:
+                yes, no = visit(node.yes_child_id), visit(node.no_child_id)
+            else:
+                # 根节点通过 parent_id 挂接唯一的子节点
+                child_ids = children.get(node.id, [])
+                yes, no = (visit(child_ids[0]) if child_ids else NO_NODE), NO_NODE
+            self.yes_index.append(yes)
+            self.no_index.append(no)
+            position += 1
+    
+    @property
+    def event_identifiers(self):
+        """根节点待决策内容中引用的事件标识符，为空表示任何事件都可触发诊断"""
+        if not self.node_ids or not self.decision_inputs[0]:
+            return frozenset()
+        return frozenset(re.findall(r'\w+', self.decision_inputs[0]))
+    
+    def handles_event(self, identifier):
+        """事件触发时是否需要运行此决策树"""
+        identifiers = self.event_identifiers
+        return not identifiers or identifier in identifiers
+    
+    @property
+    def max_window(self):
+        return max(self.windows.values()) if self.windows else 0
+    
+    def walk(self, values, aggs):
+        """沿决策路径求值，返回 (路径节点下标列表, 错误信息)"""
+        path = []
+        index = 0 if self.node_ids else NO_NODE
+        limit = len(self.node_ids)
+        while index != NO_NODE and len(path) <= limit:
+            path.append(index)
+            error = self.errors.get(index)
+            if error is not None:
+                return path, error
+            condition = self.condition_index[index]
+            if condition == NO_NODE:
+                # 无条件节点：叶子终止，其余节点沿唯一分支继续
+                yes = self.yes_index[index]
+                index = yes if yes != NO_NODE else self.no_index[index]
+                continue
+            try:
+                matched = bool(self.conditions[condition](values, aggs))
+            except ConditionError as e:
+                return path, str(e)
+            except (TypeError, ZeroDivisionError, ValueError, OverflowError) as e:
+                return path, f'表达式求值失败: {e}'
+            index = self.yes_index[index] if matched else self.no_index[index]
+        if len(path) > limit:
+            return path, '决策树存在循环引用'
+        return path, None
+    
+    def describe(self, path, error=None):
+        """将路径转换为结果字典"""
+        leaf = path[-1] if path else NO_NODE
+        reached = leaf != NO_NODE and self.node_types[leaf] == 'leaf' and error is None
+        if not path:
+            error = '决策树没有节点'
+        elif error is None and not reached:
+            error = '决策路径未到达叶子节点'
+        return {
+            'path': [self.node_ids[i] for i in path],
+            'leaf_node_id': self.node_ids[leaf] if reached else None,
+            'leaf_name': self.node_names[leaf] if reached else None,
+            'result': self.results[leaf] if reached else None,
+            'error': error
+        }
+    
+    def evaluate(self, device_id, values, history, now):
+        """对单台设备求值，返回结果字典"""
+        aggs = compute_aggregates(self.aggregates, self.property_ids, history, device_id, now, values)
+        return self.describe(*self.walk(values, aggs))
+
+
+def load_compiled_tree(tree_id):
+    """一次查询读取整棵树的全部节点并编译，树不存在时返回 None"""
+    tree = DecisionTree.query.get(tree_id)
+    if tree is None:
+        return None
+    nodes = db.session.query(
+        DecisionTreeNode.id,
+        DecisionTreeNode.parent_id,
+        DecisionTreeNode.name,
+        DecisionTreeNode.node_type,
+        DecisionTreeNode.condition,
+        DecisionTreeNode.result,
+        DecisionTreeNode.decision_input,
+        DecisionTreeNode.yes_child_id,
+        DecisionTreeNode.no_child_id
+    ).filter(DecisionTreeNode.tree_id == tree_id).all()
+    properties = []
+    if tree.device_type_id is not None:
+        properties = DeviceProperty.query.filter_by(device_type_id=tree.device_type_id).all()
+    return CompiledDecisionTree(tree, nodes, properties)
+
+
+def tree_etag(tree):
+    """
+    决策树内容的 ETag：由树的更新时间和节点数量、最大 id、id 之和、最晚更新时间计算，
+    一次聚合查询即可判断整棵树是否变化，不读取节点内容
+    """
+    count, max_id, id_sum, last_updated = db.session.query(
+        func.count(DecisionTreeNode.id),
+        func.max(DecisionTreeNode.id),
+        func.sum(DecisionTreeNode.id),
+        func.max(DecisionTreeNode.updated_at)
+    ).filter(DecisionTreeNode.tree_id == tree.id).one()
+    text = f'{tree.id}|{tree.updated_at}|{count}|{max_id}|{id_sum}|{last_updated}'
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def load_tree_document(tree):
+    """
+    一次查询读取整棵树的全部节点，在内存中按 yes_child_id / no_child_id / parent_id 链接，
+    返回嵌套结构：决策节点带 yes_child / no_child，根节点带 children；
+    未挂在根节点下的节点放在 detached 中
+    """
+    columns = (
+        DecisionTreeNode.id, DecisionTreeNode.tree_id, DecisionTreeNode.parent_id, DecisionTreeNode.name,
+        DecisionTreeNode.node_type, DecisionTreeNode.condition, DecisionTreeNode.result,
+        DecisionTreeNode.decision_input, DecisionTreeNode.yes_child_id, DecisionTreeNode.no_child_id,
+        DecisionTreeNode.created_at, DecisionTreeNode.updated_at
+    )
+    names = [column.key for column in columns]
+    rows = db.session.query(*columns).filter(DecisionTreeNode.tree_id == tree.id).order_by(DecisionTreeNode.id).all()
+    items = {}
+    for row in rows:
+        item = dict(zip(names, row))
+        item['created_at'] = item['created_at'].isoformat() if item['created_at'] else None
+        item['updated_at'] = item['updated_at'].isoformat() if item['updated_at'] else None
+        items[item['id']] = item
+    children = {}
+    for item in items.values():
+        if item['parent_id'] is not None:
+            children.setdefault(item['parent_id'], []).append(item['id'])
+    
+    placed = set()
+    
+    def build(start):
+        """从 start 开始展开子树（迭代展开，已放置的节点不再重复展开，防止错误数据中的环）"""
+        if start not in items or start in placed:
+            return None
+        placed.add(start)
+        stack = [start]
+        while stack:
+            item = items[stack.pop()]
+            if item['node_type'] == 'decision':
+                links = [('yes_child', item['yes_child_id']), ('no_child', item['no_child_id'])]
+            elif item['node_type'] == 'root':
+                links = [('children', child_id) for child_id in children.get(item['id'], [])]
+                item['children'] = []
+            else:
+                links = []
+            for field, child_id in links:
+                child = None
+                if child_id in items and child_id not in placed:
+                    placed.add(child_id)
+                    stack.append(child_id)
+                    child = items[child_id]
+                if field == 'children':
+                    if child is not None:
+                        item['children'].append(child)
+                else:
+                    item[field] = child
+        return items[start]
+    
+    roots = [item['id'] for item in items.values() if item['node_type'] == 'root']
+    if not roots:
+        roots = [item['id'] for item in items.values() if item['parent_id'] is None]
+    root = build(roots[0]) if roots else None
+    detached = [build(node_id) for node_id in items if node_id not in placed]
+    return {
+        'tree': tree.to_dict(),
+        'node_count': len(items),
+        'root': root,
+        'detached': [item for item in detached if item]
+    }
+
+
+class DecisionEngine:
+    """决策树引擎：缓存编译结果，树、节点或设备类型属性变化时失效"""
+    
+    def __init__(self):
+        self._trees = {}
+        self._lock = threading.Lock()
+        self.listeners = []  # 失效回调 f(tree_id)，多进程部署时通知其他进程
+    
+    def get_tree(self, tree_id):
+        """获取编译后的决策树（需在应用上下文中调用）"""
+        with self._lock:
+            compiled = self._trees.get(tree_id)
+        if compiled is None:
+            compiled = load_compiled_tree(tree_id)
+            if compiled is not None:
+                with self._lock:
+                    self._trees[tree_id] = compiled
+        return compiled
+    
+    def invalidate(self, tree_id=None):
+        """使决策树编译结果失效，None 表示全部失效"""
+        with self._lock:
+            if tree_id is None:
+                self._trees.clear()
+            else:
+                self._trees.pop(tree_id, None)
+        for listener in self.listeners:
+            listener(tree_id)
+    
+    def evaluate_devices(self, tree_id, device_values, at=None):
+        """
+        批量求值多台设备
+        device_values: {device_id: {属性标识符: 值}}，缺失的属性使用 at（默认当前）之前的最新历史值
+        返回 {device_id: 结果字典}，决策树不存在时返回 None
+        """
+        compiled = self.get_tree(tree_id)
+        if compiled is None:
+            return None
+        now = at or datetime.utcnow()
+        device_values = fill_missing_values(device_values, compiled.property_ids, at)
+        history = {}
+        if compiled.windows:
+            history = load_window_history(
+                device_values.keys(),
+                compiled.windows.keys(),
+                now - timedelta(seconds=compiled.max_window),
+                at
+            )
+        return {
+            device_id: compiled.evaluate(device_id, values, history, now)
+            for device_id, values in device_values.items()
+        }
+
+
+# 全局决策树引擎实例
+decision_engine = DecisionEngine()
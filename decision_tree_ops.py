@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+决策树批量保存与子树操作
+- 批量保存：提交的整棵树与数据库中的节点比对，新建、更新、删除在一个事务中用批量语句完成
+  （新建用带 RETURNING 的批量 INSERT，更新用 executemany）
+- 子树复制、移动、删除：子树由递归 CTE 沿 tree_id、parent_id 求出，
+  每个操作都是少量集合语句，不逐节点读写 ORM 对象
+所有函数在调用方的事务中执行，由调用方提交或回滚。
+"""
+
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, delete, bindparam, func, case, literal, text
+
+from models import db, DecisionTree, DecisionTreeNode
+
+
+NODE_TYPES = ('root', 'decision', 'leaf')
+BRANCHES = ('yes', 'no')
+
+# 批量保存时比较和写入的节点字段
+NODE_FIELDS = ('name', 'node_type', 'condition', 'result', 'decision_input')
+LINK_FIELDS = ('parent_id', 'yes_child_id', 'no_child_id')
+
+nodes_table = DecisionTreeNode.__table__
+
+
+class TreeEditError(ValueError):
+    """决策树编辑参数错误"""
+
+
+def subtree_cte(tree_id, node_id):
+    """以 node_id 为根的子树节点 id（沿 (tree_id, parent_id) 索引逐层展开，UNION 去重保证有环数据也能终止）"""
+    subtree = (
+        select(nodes_table.c.id)
+        .where(nodes_table.c.id == node_id)
+        .where(nodes_table.c.tree_id == tree_id)
+        .cte('subtree', recursive=True)
+    )
+    child = nodes_table.alias('child')
+    return subtree.union(
+        select(child.c.id)
+        .join(subtree, child.c.parent_id == subtree.c.id)
+        .where(child.c.tree_id == tree_id)
+    )
+
+
+def _count(subtree):
+    return db.session.execute(select(func.count()).select_from(subtree)).scalar()
+
+
+def _node(node_id):
+    row = db.session.execute(
+        select(nodes_table.c.id, nodes_table.c.tree_id, nodes_table.c.node_type, nodes_table.c.parent_id)
+        .where(nodes_table.c.id == node_id)
+    ).first()
+    if row is None:
+        raise TreeEditError(f'节点 {node_id} 不存在')
+    return row
+
+
+def _clear_dangling(tree_id):
+    """清除树内指向已不存在节点的父节点、分支引用"""
+    existing = select(nodes_table.c.id).where(nodes_table.c.tree_id == tree_id)
+    for column in LINK_FIELDS:
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.tree_id == tree_id)
+            .where(nodes_table.c[column].is_not(None))
+            .where(nodes_table.c[column].not_in(existing))
+            .values({column: None})
+        )
+
+
+def _detach(tree_id, node_id, now):
+    """解除其他节点对 node_id 的是/否分支引用"""
+    for column in ('yes_child_id', 'no_child_id'):
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.tree_id == tree_id)
+            .where(nodes_table.c[column] == node_id)
+            .values({column: None, 'updated_at': now})
+        )
+
+
+def _attach_target(parent_id, branch):
+    """
+    校验挂载位置：决策节点需指定空闲的 yes / no 分支，根节点的子节点不区分分支，叶子节点不能挂载子节点
+    返回目标父节点
+    """
+    parent = _node(parent_id)
+    if parent.node_type == 'leaf':
+        raise TreeEditError('叶子节点不能添加子节点')
+    if parent.node_type == 'decision':
+        if branch not in BRANCHES:
+            raise TreeEditError('挂载到决策节点时需指定分支 yes 或 no')
+        occupied = db.session.execute(
+            select(nodes_table.c[f'{branch}_child_id']).where(nodes_table.c.id == parent_id)
+        ).scalar()
+        if occupied is not None:
+            raise TreeEditError(f'目标节点的{"是" if branch == "yes" else "否"}分支已有子节点')
+    return parent
+
+
+def _link(parent, node_id, branch, now):
+    if parent.node_type == 'decision':
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.id == parent.id)
+            .values({f'{branch}_child_id': node_id, 'updated_at': now})
+        )
+
+
+def delete_subtree(node_id):
+    """删除节点及其全部子孙节点，返回 (树ID, 删除的节点数)"""
+    node = _node(node_id)
+    now = datetime.utcnow()
+    _detach(node.tree_id, node_id, now)
+    subtree = subtree_cte(node.tree_id, node_id)
+    # 带 WITH 的语句在 SQLite 上不返回影响行数，先计数
+    deleted = _count(subtree)
+    db.session.execute(delete(nodes_table).where(nodes_table.c.id.in_(select(subtree.c.id))))
+    _clear_dangling(node.tree_id)
+    return node.tree_id, deleted
+
+
+def move_subtree(node_id, parent_id, branch=None):
+    """
+    把子树挂到新的父节点下（可跨树，子树节点的 tree_id 一并更新），
+    不能移动根节点，也不能移动到自身的子树中
+    """
+    node = _node(node_id)
+    if node.node_type == 'root':
+        raise TreeEditError('不能移动根节点')
+    subtree = subtree_cte(node.tree_id, node_id)
+    inside = db.session.execute(
+        select(func.count()).select_from(subtree).where(subtree.c.id == parent_id)
+    ).scalar()
+    if inside:
+        raise TreeEditError('不能移动到自身的子树中')
+    parent = _attach_target(parent_id, branch)
+    now = datetime.utcnow()
+    _detach(node.tree_id, node_id, now)
+    if parent.tree_id != node.tree_id:
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.id.in_(select(subtree.c.id)))
+            .values(tree_id=parent.tree_id, updated_at=now)
+        )
+    db.session.execute(
+        update(nodes_table).where(nodes_table.c.id == node_id).values(parent_id=parent_id, updated_at=now)
+    )
+    _link(parent, node_id, branch, now)
+    return node.tree_id, parent.tree_id
+
+
+def _id_offset(subtree):
+    """
+    复制时新节点 id 的偏移量：新 id = 原 id + 偏移量，
+    使子树中最小的 id 映射到当前最大 id 和自增序列值之后，id 的增长只取决于子树的 id 跨度
+    """
+    top = db.session.execute(select(func.coalesce(func.max(nodes_table.c.id), 0))).scalar()
+    has_sequence = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'")
+    ).first()
+    if has_sequence:
+        sequence = db.session.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {'name': nodes_table.name}
+        ).scalar()
+        top = max(top, sequence or 0)
+    lowest = db.session.execute(select(func.min(subtree.c.id))).scalar()
+    return top - lowest + 1
+
+
+def copy_subtree(node_id, parent_id, branch=None):
+    """
+    复制子树并挂到 parent_id 下（可跨树），一条 INSERT ... SELECT 完成：
+    新 id = 原 id + 偏移量，子树内部的父节点、分支引用按同一偏移量映射
+    返回 (目标树ID, 新子树根节点ID, 复制的节点数)
+    """
+    node = _node(node_id)
+    if node.node_type == 'root':
+        raise TreeEditError('不能复制根节点')
+    parent = _attach_target(parent_id, branch)
+    subtree = subtree_cte(node.tree_id, node_id)
+    if db.session.execute(select(func.count()).select_from(subtree).where(subtree.c.id == parent_id)).scalar():
+        raise TreeEditError('不能复制到自身的子树中')
+    offset = _id_offset(subtree)
+    now = datetime.utcnow()
+    members = select(subtree.c.id)
+    
+    def mapped(column):
+        return case((column.in_(members), column + offset), else_=None)
+    
+    source = (
+        select(
+            nodes_table.c.id + offset,
+            literal(parent.tree_id),
+            case((nodes_table.c.id == node_id, literal(parent_id)), else_=mapped(nodes_table.c.parent_id)),
+            nodes_table.c.name,
+            nodes_table.c.node_type,
+            nodes_table.c.condition,
+            nodes_table.c.result,
+            nodes_table.c.decision_input,
+            mapped(nodes_table.c.yes_child_id),
+            mapped(nodes_table.c.no_child_id),
+            literal(now),
+            literal(now)
+        )
+        .where(nodes_table.c.id.in_(members))
+    )
+    copied = _count(subtree)
+    db.session.execute(
+        insert(nodes_table).from_select(
+            ['id', 'tree_id', 'parent_id', 'name', 'node_type', 'condition', 'result', 'decision_input',
+             'yes_child_id', 'no_child_id', 'created_at', 'updated_at'],
+            source
+        )
+    )
+    new_root = node_id + offset
+    _link(parent, new_root, branch, now)
+    return parent.tree_id, new_root, copied
+
+
+def delete_tree_nodes(tree_id):
+    """删除决策树的全部节点（先在一条语句中清除节点间引用，再一次删除）"""
+    db.session.execute(
+        update(nodes_table)
+        .where(nodes_table.c.tree_id == tree_id)
+        .values(parent_id=None, yes_child_id=None, no_child_id=None)
+    )
+    return db.session.execute(delete(nodes_table).where(nodes_table.c.tree_id == tree_id)).rowcount
+
+
+def flatten_document(root, detached=None):
+    """
+    /full 返回的嵌套结构展开为节点列表（嵌套的子节点隐含 parent_id 和分支引用）
+    detached 为未挂在根节点下的子树列表，同样展开（否则保存时这些节点会被当作已删除）
+    """
+    if detached is None:
+        detached = []
+    if not isinstance(detached, list):
+        raise TreeEditError('detached 必须为数组')
+    nodes = []
+    stack = [(item, None, None) for item in reversed(detached)]
+    if root is not None:
+        stack.append((root, None, None))
+    while stack:
+        item, parent, field = stack.pop()
+        if not isinstance(item, dict):
+            raise TreeEditError('节点必须为对象')
+        node = {key: value for key, value in item.items() if key not in ('yes_child', 'no_child', 'children')}
+        nodes.append(node)
+        if parent is not None:
+            node['parent_id'] = parent.get('id')
+            if field in ('yes_child', 'no_child'):
+                parent[f'{field}_id'] = node.get('id')
+        for field_name in ('yes_child', 'no_child'):
+            # 嵌套结构优先于节点上的 yes_child_id / no_child_id
+            if field_name in item:
+                node[f'{field_name}_id'] = None
+            if item.get(field_name):
+                stack.append((item[field_name], node, field_name))
+        for child in item.get('children') or []:
+            stack.append((child, node, 'children'))
+    return nodes
+
+
+def _key(value):
+    """节点引用统一为文本键（已有节点 id 与临时 id 共用一个命名空间）"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or isinstance(value, (dict, list)):
+        raise TreeEditError(f'无效的节点引用: {value}')
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def save_tree(tree_id, nodes):
+    """
+    批量保存整棵树：nodes 为提交的全部节点（id 为已有节点 id 或客户端临时 id，
+    parent_id / yes_child_id / no_child_id 可引用临时 id）。
+    提交中没有的已有节点被删除，有变化的已有节点被更新，其余新建。
+    返回统计及临时 id → 节点 id 映射
+    """
+    existing = {
+        str(row.id): row for row in db.session.execute(
+            select(nodes_table).where(nodes_table.c.tree_id == tree_id)
+        )
+    }
+    
+    submitted = {}
+    for index, node in enumerate(nodes):
+        if not isinstance(node, dict):
+            raise TreeEditError(f'第 {index + 1} 个节点必须为对象')
+        key = _key(node.get('id'))
+        if key is None:
+            key = f'#new-{index}'
+        if key in submitted:
+            raise TreeEditError(f'节点 id {key} 重复')
+        if not node.get('name'):
+            raise TreeEditError(f'节点 {key} 缺少名称')
+        if node.get('node_type') not in NODE_TYPES:
+            raise TreeEditError(f'节点 {key} 的类型不合法')
+        submitted[key] = node
+    roots = [key for key, node in submitted.items() if node['node_type'] == 'root']
+    if len(roots) > 1:
+        raise TreeEditError('决策树只能有一个根节点')
+    for key, node in submitted.items():
+        for field in LINK_FIELDS:
+            ref = _key(node.get(field))
+            if ref is not None and ref not in submitted:
+                raise TreeEditError(f'节点 {key} 的 {field} 引用了不存在的节点 {ref}')
+    
+    now = datetime.utcnow()
+    inserts = [key for key in submitted if key not in existing]
+    deletes = [row.id for key, row in existing.items() if key not in submitted]
+    
+    # 新建节点（引用稍后统一写入）
+    created = []
+    if inserts:
+        result = db.session.execute(
+            insert(nodes_table).returning(nodes_table.c.id, sort_by_parameter_order=True),
+            [
+                dict({field: submitted[key].get(field) for field in NODE_FIELDS},
+                     tree_id=tree_id, created_at=now, updated_at=now)
+                for key in inserts
+            ]
+        )
+        created = [row[0] for row in result]
+    ids = {key: row.id for key, row in existing.items() if key in submitted}
+    ids.update(zip(inserts, created))
+    
+    # 删除不再提交的节点（先清除被删除节点之间及指向它们的引用）
+    if deletes:
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.id.in_(deletes))
+            .values(parent_id=None, yes_child_id=None, no_child_id=None)
+        )
+        db.session.execute(delete(nodes_table).where(nodes_table.c.id.in_(deletes)))
+    
+    # 更新字段或引用发生变化的节点，新建节点在此写入引用
+    updates = []
+    for key, node in submitted.items():
+        values = {field: node.get(field) for field in NODE_FIELDS}
+        values.update({field: ids.get(_key(node.get(field))) for field in LINK_FIELDS})
+        row = existing.get(key)
+        if row is not None and all(getattr(row, field) == value for field, value in values.items()):
+            continue
+        if row is None and not any(values[field] is not None for field in LINK_FIELDS):
+            continue
+        updates.append(dict({f'b_{field}': value for field, value in values.items()}, b_id=ids[key], b_updated_at=now))
+    if updates:
+        db.session.execute(
+            update(nodes_table)
+            .where(nodes_table.c.id == bindparam('b_id'))
+            .values({field: bindparam(f'b_{field}') for field in NODE_FIELDS + LINK_FIELDS + ('updated_at',)}),
+            updates
+        )
+    
+    if inserts or deletes or updates:
+        db.session.execute(update(DecisionTree.__table__).where(DecisionTree.id == tree_id).values(updated_at=now))
+    updated_existing = sum(1 for row in updates if str(row['b_id']) in existing)
+    return {
+        'inserted': len(inserts),
+        'updated': updated_existing,
+        'deleted': len(deletes),
+        'unchanged': len(submitted) - len(inserts) - updated_existing,
+        'id_map': {key: ids[key] for key in inserts if not key.startswith('#new-')}
+    }
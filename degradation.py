@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+设备劣化趋势与剩余寿命预测
+对健康指标（属性小时汇总的均值，或特征提取等生成的派生序列）按小时拟合趋势模型：
+- linear: y = a + b·t
+- exponential: ln y = a + b·t（只使用正值）
+- piecewise: 分段线性，先验残差连续 PIECE_RUN 个时段超过 PIECE_SIGMA 倍残差标准差时开始新分段
+三种模型都是两参数的线性回归，用递推最小二乘（RLS）更新：每次刷新只并入新结束的时段，
+拟合状态（参数、协方差矩阵、残差平方和）保存在模型记录中，不需要从头重新拟合。
+刷新时把全部模型的状态装入数组，按时段逐步对整个设备群做一次向量化更新，
+再按属性的最小值 / 最大值（或模型指定的阈值）外推到达阈值的时间。
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from models import db, DegradationModel, DeviceProperty
+from rollups import refresh_rollups, load_rollups, complete_before, bucket_hours, ROLLUP_SECONDS, ROLLUP_STEP_US
+from timeseries import bucket_series
+from features import load_derived_series
+
+
+MODEL_TYPES = ('linear', 'exponential', 'piecewise')
+DIRECTIONS = ('up', 'down')
+
+# 协方差矩阵的初始值（相当于很弱的先验）
+INITIAL_COVARIANCE = 1e6
+# 给出预测所需的最少时段数
+MIN_SAMPLES = 3
+# 分段模型：超差倍数和连续超差时段数
+PIECE_SIGMA = 3.0
+PIECE_RUN = 3
+
+
+def _series_buckets(model, since, until):
+    """派生序列按小时取均值，返回 (时段起始 datetime64[us], 均值)"""
+    start = since + timedelta(seconds=ROLLUP_SECONDS) if since is not None else None
+    times, values = load_derived_series(model.device_id, model.property_id, model.series, start)
+    if times.size == 0:
+        return times, values
+    starts, means = bucket_series(times.astype(np.int64), values, 0, ROLLUP_STEP_US, 'mean')
+    starts = starts.astype('datetime64[us]')
+    keep = starts < np.datetime64(until, 'us')
+    return starts[keep], means[keep]
+
+
+def load_observations(models, until):
+    """
+    读取每个模型在 last_bucket 之后、until 之前结束的时段，返回与 models 对应的 [(时段起始, 均值)]
+    属性指标先增量刷新小时汇总，再用一次查询读取全部点位
+    """
+    points = {(model.device_id, model.property_id) for model in models if not model.series}
+    observations = [None] * len(models)
+    if points:
+        refresh_rollups(points)
+        last_buckets = [model.last_bucket for model in models if not model.series]
+        since = None if any(last is None for last in last_buckets) else min(last_buckets)
+        rollups = load_rollups(points, since, until)
+    empty = (np.empty(0, dtype='datetime64[us]'), np.empty(0))
+    for index, model in enumerate(models):
+        if model.series:
+            observations[index] = _series_buckets(model, model.last_bucket, until)
+            continue
+        starts, means = rollups.get((model.device_id, model.property_id), empty)
+        if model.last_bucket is not None and starts.size:
+            keep = starts > np.datetime64(model.last_bucket, 'us')
+            starts, means = starts[keep], means[keep]
+        observations[index] = (starts, means)
+    return observations
+
+
+class FleetState:
+    """全部模型的拟合状态（每个字段一个数组，下标与模型列表对应）"""
+    
+    def __init__(self, models):
+        count = len(models)
+        self.a = np.array([model.theta_a or 0.0 for model in models], dtype=np.float64)
+        self.b = np.array([model.theta_b or 0.0 for model in models], dtype=np.float64)
+        fresh = np.array([model.p_aa is None or not model.samples for model in models], dtype=bool)
+        self.p_aa = np.array([model.p_aa or 0.0 for model in models], dtype=np.float64)
+        self.p_ab = np.array([model.p_ab or 0.0 for model in models], dtype=np.float64)
+        self.p_bb = np.array([model.p_bb or 0.0 for model in models], dtype=np.float64)
+        self.n = np.array([model.samples or 0 for model in models], dtype=np.float64)
+        self.sse = np.array([model.residual_ss or 0.0 for model in models], dtype=np.float64)
+        self.run = np.array([model.outlier_run or 0 for model in models], dtype=np.float64)
+        self.segment = np.full(count, np.nan)  # 本次刷新中开始的新分段（小时）
+        self.reset(fresh)
+    
+    def reset(self, mask):
+        """把选中的模型恢复为初始状态"""
+        self.a[mask] = 0.0
+        self.b[mask] = 0.0
+        self.p_aa[mask] = INITIAL_COVARIANCE
+        self.p_ab[mask] = 0.0
+        self.p_bb[mask] = INITIAL_COVARIANCE
+        self.n[mask] = 0
+        self.sse[mask] = 0.0
+        self.run[mask] = 0
+    
+    def residual_std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 2, np.sqrt(self.sse / np.maximum(self.n - 2, 1)), np.nan)
+    
+    def step(self, t, y, mask, piecewise):
+        """对 mask 选中的模型并入一个观测 (t, y)，整组向量化计算"""
+        prior = y - (self.a + self.b * t)
+        
+        # 分段模型：连续超差时从当前时段开始新分段
+        sigma = self.residual_std()
+        floor = 1e-6 * np.abs(y) + 1e-12
+        with np.errstate(invalid='ignore'):
+            outlier = mask & piecewise & (self.n >= MIN_SAMPLES) & (np.abs(prior) > PIECE_SIGMA * np.maximum(sigma, floor))
+        self.run = np.where(mask & piecewise, np.where(outlier, self.run + 1, 0), self.run)
+        breaks = self.run >= PIECE_RUN
+        if breaks.any():
+            self.reset(breaks)
+            self.segment[breaks] = t[breaks]
+            prior = np.where(breaks, y, prior)
+        
+        px_a = self.p_aa + self.p_ab * t
+        px_b = self.p_ab + self.p_bb * t
+        denominator = 1.0 + px_a + t * px_b
+        gain_a = px_a / denominator
+        gain_b = px_b / denominator
+        self.a = np.where(mask, self.a + gain_a * prior, self.a)
+        self.b = np.where(mask, self.b + gain_b * prior, self.b)
+        self.p_aa = np.where(mask, self.p_aa - gain_a * px_a, self.p_aa)
+        self.p_ab = np.where(mask, self.p_ab - gain_a * px_b, self.p_ab)
+        self.p_bb = np.where(mask, self.p_bb - gain_b * px_b, self.p_bb)
+        # 先验残差乘后验残差等于最小二乘残差平方和的增量
+        self.sse = np.where(mask, self.sse + prior * prior / denominator, self.sse)
+        self.n = np.where(mask, self.n + 1, self.n)
+
+
+def fit_fleet(models, observations):
+    """
+    把新观测并入全部模型的 RLS 状态，返回 (FleetState, 每个模型最后时段的小时数)
+    观测补齐为 [模型, 时段] 矩阵，按时段列逐步更新
+    """
+    count = len(models)
+    state = FleetState(models)
+    exponential = np.array([model.model_type == 'exponential' for model in models], dtype=bool)
+    piecewise = np.array([model.model_type == 'piecewise' for model in models], dtype=bool)
+    
+    width = max((starts.size for starts, _ in observations), default=0)
+    hours = np.zeros((count, width))
+    targets = np.zeros((count, width))
+    valid = np.zeros((count, width), dtype=bool)
+    last_hours = np.full(count, np.nan)
+    for index, (model, (starts, values)) in enumerate(zip(models, observations)):
+        if model.origin is None and starts.size:
+            model.origin = starts[0].astype('datetime64[us]').item()
+        if model.origin is not None and model.last_bucket is not None:
+            last_hours[index] = bucket_hours(np.array([model.last_bucket], dtype='datetime64[us]'), model.origin)[0]
+        if not starts.size:
+            continue
+        size = starts.size
+        hours[index, :size] = bucket_hours(starts, model.origin)
+        if exponential[index]:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                targets[index, :size] = np.log(values)
+            valid[index, :size] = values > 0
+        else:
+            targets[index, :size] = values
+            valid[index, :size] = np.isfinite(values)
+        last_hours[index] = hours[index, size - 1]
+    
+    for column in range(width):
+        state.step(hours[:, column], targets[:, column], valid[:, column], piecewise)
+    return state, last_hours
+
+
+def predict(models, state, last_hours):
+    """按拟合状态外推到达阈值的时间，返回 {level, slope, limit, rising, rul}（均为数组）"""
+    count = len(models)
+    exponential = np.array([model.model_type == 'exponential' for model in models], dtype=bool)
+    properties = {prop.id: prop for prop in DeviceProperty.query.filter(
+        DeviceProperty.id.in_({model.property_id for model in models})
+    ).all()} if models else {}
+    
+    fitted = state.a + state.b * last_hours
+    with np.errstate(over='ignore', invalid='ignore'):
+        level = np.where(exponential, np.exp(fitted), fitted)
+        slope = np.where(exponential, state.b * level, state.b)
+    
+    limits = np.full(count, np.nan)
+    rising = np.zeros(count, dtype=bool)
+    for index, model in enumerate(models):
+        prop = properties.get(model.property_id)
+        direction = model.direction
+        if model.threshold is not None:
+            limit = model.threshold
+            if direction is None and np.isfinite(level[index]):
+                # 指定阈值但未指定方向：以首次拟合时指标相对阈值的位置确定
+                direction = model.direction = 'up' if limit >= level[index] else 'down'
+        else:
+            if direction is None:
+                direction = 'up' if slope[index] > 0 else 'down'
+            limit = None
+            if prop is not None:
+                limit = prop.max_value if direction == 'up' else prop.min_value
+        rising[index] = direction == 'up'
+        if limit is not None:
+            limits[index] = limit
+    
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        target = np.where(exponential, np.log(np.where(limits > 0, limits, np.nan)), limits)
+        crossed = np.where(rising, level >= limits, level <= limits)
+        approaching = np.where(rising, state.b > 0, state.b < 0)
+        rul = np.where(crossed, 0.0, np.where(approaching, (target - fitted) / state.b, np.nan))
+    ready = (state.n >= MIN_SAMPLES) & np.isfinite(last_hours) & np.isfinite(limits)
+    rul = np.where(ready & np.isfinite(rul), np.maximum(rul, 0.0), np.nan)
+    return {
+        'level': level,
+        'slope': slope,
+        'limit': limits,
+        'rising': rising,
+        'rul': rul
+    }
+
+
+def _number(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def refresh_models(models=None, now=None, progress=None):
+    """
+    增量刷新劣化模型（默认全部模型）：并入新结束的时段并更新剩余寿命预测
+    返回 {'models': 模型数, 'buckets': 并入的时段数}
+    """
+    models = DegradationModel.query.order_by(DegradationModel.id).all() if models is None else list(models)
+    if not models:
+        return {'models': 0, 'buckets': 0}
+    until = complete_before(now)
+    observations = load_observations(models, until)
+    if progress is not None:
+        progress(0.5, message='已读取健康指标')
+    
+    state, last_hours = fit_fleet(models, observations)
+    prediction = predict(models, state, last_hours)
+    
+    buckets = 0
+    for index, (model, (starts, _)) in enumerate(zip(models, observations)):
+        buckets += int(starts.size)
+        if starts.size:
+            model.last_bucket = starts[-1].astype('datetime64[us]').item()
+        if np.isfinite(state.segment[index]):
+            model.segment_start = model.origin + timedelta(hours=float(state.segment[index]))
+        elif model.segment_start is None:
+            model.segment_start = model.origin
+        model.theta_a = float(state.a[index])
+        model.theta_b = float(state.b[index])
+        model.p_aa = float(state.p_aa[index])
+        model.p_ab = float(state.p_ab[index])
+        model.p_bb = float(state.p_bb[index])
+        model.samples = int(state.n[index])
+        model.residual_ss = float(state.sse[index])
+        model.outlier_run = int(state.run[index])
+        model.level = _number(prediction['level'][index]) if model.samples else None
+        model.slope = _number(prediction['slope'][index]) if model.samples else None
+        model.limit = _number(prediction['limit'][index])
+        model.rul_hours = _number(prediction['rul'][index])
+        model.predicted_failure_at = (
+            model.last_bucket + timedelta(hours=model.rul_hours)
+            if model.rul_hours is not None and model.last_bucket is not None else None
+        )
+    db.session.commit()
+    return {'models': len(models), 'buckets': buckets}
+
+
+def reset_model(model):
+    """清除拟合状态，下次刷新时从头拟合"""
+    model.origin = model.last_bucket = model.segment_start = None
+    model.samples = 0
+    model.theta_a = model.theta_b = 0.0
+    model.p_aa = model.p_ab = model.p_bb = None
+    model.residual_ss = 0.0
+    model.outlier_run = 0
+    model.level = model.slope = model.limit = model.rul_hours = None
+    model.predicted_failure_at = None
+
+
+def reset_models_since(starts):
+    """
+    补录历史后重置受影响的属性指标模型：已并入 starts[(device_id, property_id)] 及之后时段的模型
+    无法只撤销部分时段，下次刷新时从头拟合。返回重置的模型数（需由调用方提交）
+    """
+    device_ids = {device_id for device_id, _ in starts}
+    count = 0
+    for model in DegradationModel.query.filter(DegradationModel.device_id.in_(device_ids)).all():
+        start = starts.get((model.device_id, model.property_id))
+        if model.series or start is None or model.last_bucket is None or model.last_bucket < start:
+            continue
+        reset_model(model)
+        count += 1
+    return count
+
+
+def model_curve(model, points=50):
+    """
+    模型的观测值和拟合趋势（当前分段起到预测失效时刻，没有预测时到最后时段），用于绘图
+    返回 {'observed': {'t': [...], 'v': [...]}, 'fitted': {'t': [...], 'v': [...]}, 'limit': 阈值}
+    """
+    until = complete_before()
+    if model.series:
+        starts, values = _series_buckets(model, None, until)
+    else:
+        starts, values = load_rollups([(model.device_id, model.property_id)], None, until).get(
+            (model.device_id, model.property_id), (np.empty(0, dtype='datetime64[us]'), np.empty(0))
+        )
+    curve = {
+        'observed': {'t': [str(start) for start in starts], 'v': [_number(value) for value in values]},
+        'fitted': {'t': [], 'v': []},
+        'limit': model.limit
+    }
+    if not model.samples or model.origin is None or model.last_bucket is None:
+        return curve
+    
+    begin = model.segment_start or model.origin
+    end = model.predicted_failure_at or model.last_bucket
+    grid = np.linspace(
+        bucket_hours(np.array([begin], dtype='datetime64[us]'), model.origin)[0],
+        bucket_hours(np.array([end], dtype='datetime64[us]'), model.origin)[0],
+        points
+    )
+    fitted = model.theta_a + model.theta_b * grid
+    if model.model_type == 'exponential':
+        with np.errstate(over='ignore'):
+            fitted = np.exp(fitted)
+    curve['fitted'] = {
+        't': [(model.origin + timedelta(hours=float(hour))).isoformat() for hour in grid],
+        'v': [_number(value) for value in fitted]
+    }
+    return curve
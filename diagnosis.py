@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+事件触发的决策树自动诊断
+事件跳变为触发状态时，按设备类型找到关联的决策树，用触发时刻的属性值快照和窗口历史求值，
+诊断路径和叶子结果写入诊断记录。任务进入有界队列由固定数量的工作线程处理，
+告警风暴时多余的任务被丢弃并计数，不会阻塞数据采集。
+"""
+
+import json
+import logging
+import queue
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from models import db, Device, DecisionTree, DiagnosisRecord
+from decision_engine import decision_engine
+
+logger = logging.getLogger(__name__)
+
+# 诊断任务：事件在 timestamp 时刻跳变为触发，values 为当时的属性值快照 {属性标识符: 值}
+DiagnosisJob = namedtuple('DiagnosisJob', ['device_type_id', 'device_id', 'event_id', 'event_identifier', 'values', 'timestamp'])
+
+
+class DiagnosisPipeline:
+    """诊断任务队列和工作线程池"""
+    
+    def __init__(self, app, workers=2, max_pending=1000, batch_size=256):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.completed = 0
+        self.running = False
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """启动工作线程"""
+        if self.running:
+            return
+        self.running = True
+        self._threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"诊断工作线程已启动: {self.workers} 个")
+    
+    def stop(self):
+        """停止工作线程（已排队的任务处理完后退出）"""
+        if not self.running:
+            return
+        self.running = False
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        logger.info("诊断工作线程已停止")
+    
+    def submit(self, device_type_id, device_id, event_id, event_identifier, values, timestamp):
+        """提交诊断任务，队列已满时丢弃并返回 False"""
+        job = DiagnosisJob(device_type_id, device_id, event_id, event_identifier, dict(values or {}), timestamp)
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"诊断队列已满，丢弃设备 {device_id} 事件 {event_identifier} 的诊断任务")
+            return False
+    
+    @property
+    def pending(self):
+        return self._queue.qsize()
+    
+    def status(self):
+        with self._lock:
+            return {
+                'running': self.running,
+                'workers': self.workers,
+                'pending': self.pending,
+                'completed': self.completed,
+                'dropped': self.dropped
+            }
+    
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            # 一次取出队列中积压的任务，同一时刻、同一设备类型的任务合并为一次批量求值
+            jobs, stop = [job], False
+            while len(jobs) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            try:
+                self.run_jobs(jobs)
+            except Exception as e:
+                logger.error(f"决策树诊断出错: {e}")
+                import traceback
+                traceback.print_exc()
+            if stop:
+                return
+    
+    def run_jobs(self, jobs):
+        """执行一批诊断任务并写入诊断记录，返回写入的记录列表"""
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job.device_type_id, job.timestamp), []).append(job)
+        
+        with self.app.app_context():
+            try:
+                rows = []
+                tree_ids = {}
+                for (device_type_id, timestamp), group in groups.items():
+                    if device_type_id not in tree_ids:
+                        tree_ids[device_type_id] = [
+                            tree_id for (tree_id,) in db.session.query(DecisionTree.id).filter_by(device_type_id=device_type_id).all()
+                        ]
+                    for tree_id in tree_ids[device_type_id]:
+                        compiled = decision_engine.get_tree(tree_id)
+                        if compiled is None:
+                            continue
+                        matched = [job for job in group if compiled.handles_event(job.event_identifier)]
+                        if not matched:
+                            continue
+                        device_values = {job.device_id: job.values for job in matched}
+                        results = decision_engine.evaluate_devices(tree_id, device_values, timestamp)
+                        for job in matched:
+                            result = results[job.device_id]
+                            rows.append({
+                                'device_id': job.device_id,
+                                'tree_id': tree_id,
+                                'event_id': job.event_id,
+                                'leaf_node_id': result['leaf_node_id'],
+                                'result': result['result'],
+                                'path': json.dumps(result['path']),
+                                'error': result['error'],
+                                'timestamp': timestamp,
+                                'created_at': datetime.utcnow()
+                            })
+                if rows:
+                    db.session.execute(DiagnosisRecord.__table__.insert(), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        with self._lock:
+            self.completed += len(jobs)
+        return rows
+
+
+def evaluate_tree_batch(tree_id, device_values, at=None, save=False, progress=None, chunk_size=500):
+    """
+    分块批量求值决策树（后台任务），save 为真时把结果保存为诊断记录
+    device_values: {device_id: {属性标识符: 值}}；progress(已完成数, 总数, 说明) 用于报告进度
+    """
+    timestamp = at or datetime.utcnow()
+    device_ids = list(device_values)
+    names = dict(db.session.query(Device.id, Device.name).filter(Device.id.in_(device_ids)).all()) if device_ids else {}
+    results = []
+    for offset in range(0, len(device_ids), chunk_size):
+        if progress is not None:
+            progress(offset, len(device_ids), f'已诊断 {offset} / {len(device_ids)} 台设备')
+        chunk = {device_id: device_values[device_id] for device_id in device_ids[offset:offset + chunk_size]}
+        evaluated = decision_engine.evaluate_devices(tree_id, chunk, at)
+        if evaluated is None:
+            raise ValueError('决策树不存在')
+        rows = []
+        for device_id in chunk:
+            result = evaluated[device_id]
+            results.append(dict(device_id=device_id, device_name=names.get(device_id), **result))
+            if save:
+                rows.append({
+                    'device_id': device_id,
+                    'tree_id': tree_id,
+                    'event_id': None,
+                    'leaf_node_id': result['leaf_node_id'],
+                    'result': result['result'],
+                    'path': json.dumps(result['path']),
+                    'error': result['error'],
+                    'timestamp': timestamp,
+                    'created_at': datetime.utcnow()
+                })
+        if rows:
+            db.session.execute(DiagnosisRecord.__table__.insert(), rows)
+            db.session.commit()
+    return {
+        'tree_id': tree_id,
+        'timestamp': timestamp.isoformat(),
+        'results': results
+    }
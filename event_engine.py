@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""
+事件条件引擎
+将事件触发条件解析为语法树并按设备类型共享编译结果，
+同一设备上相同的 (属性, 聚合函数, 时间窗口) 聚合只计算一次，
+被所有引用它的事件条件共享。
+"""
+
+import ast
+import bisect
+import math
+import operator
+import re
+import statistics
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from models import db, DeviceType, DeviceEvent, DeviceProperty, PropertyHistory
+
+
+# 支持的时间聚合函数，与设备监控页面的条件语法保持一致
+AGGREGATE_FUNCTIONS = {
+    'sum': sum,
+    'avg': lambda values: sum(values) / len(values),
+    'max': max,
+    'min': min,
+    'variance': statistics.pvariance,
+    'median': statistics.median,
+}
+
+# 聚合键：(属性标识符, 聚合函数, 时间窗口秒数)
+AggregateKey = namedtuple('AggregateKey', ['property', 'function', 'window'])
+
+_WINDOW_PATTERN = re.compile(r'^T(\d+)$')
+
+# 将 JavaScript 风格的逻辑运算符统一为 Python 语法（字符串字面量保持不变）
+_NORMALIZE_PATTERN = re.compile(
+    r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(&&)|(\|\|)|(===|!==)|(!(?!=))|\b(and|or|not|true|false)\b''',
+    re.IGNORECASE
+)
+
+def _power(base, exponent):
+    # 乘方按浮点数计算：整数乘方没有大小限制，9**9**9 这样的表达式会长时间占用 GIL，
+    # 浮点数溢出时 math.pow 抛出 OverflowError（数组按 NumPy 计算为 inf）
+    if isinstance(base, np.ndarray) or isinstance(exponent, np.ndarray):
+        return np.power(np.asarray(base, dtype=np.float64), exponent)
+    return math.pow(base, exponent)
+
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: _power,
+}
+
+_COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+_UNARY_OPERATORS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+}
+
+
+class ConditionError(ValueError):
+    """条件表达式无法解析或求值"""
+
+
+def _normalize(text):
+    """将条件文本规范化为Python表达式"""
+    def replace(match):
+        literal, and_op, or_op, strict_op, not_op, word = match.groups()
+        if literal:
+            return literal
+        if and_op:
+            return ' and '
+        if or_op:
+            return ' or '
+        if strict_op:
+            return strict_op[:2]
+        if not_op:
+            return ' not '
+        word = word.lower()
+        if word in ('true', 'false'):
+            return word.capitalize()
+        return word
+    return _NORMALIZE_PATTERN.sub(replace, text)
+
+
+def _parse_node(node):
+    """将Python语法树转换为引擎内部的元组语法树（白名单方式）"""
+    if isinstance(node, ast.Expression):
+        return _parse_node(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool)):
+        return ('const', node.value)
+    if isinstance(node, ast.Name):
+        return ('var', node.id)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return ('unary', type(node.op), _parse_node(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        return ('bin', type(node.op), _parse_node(node.left), _parse_node(node.right))
+    if isinstance(node, ast.BoolOp):
+        op = 'and' if isinstance(node.op, ast.And) else 'or'
+        return ('bool', op, tuple(_parse_node(v) for v in node.values))
+    if isinstance(node, ast.Compare):
+        ops = []
+        for op in node.ops:
+            if type(op) not in _COMPARE_OPERATORS:
+                raise ConditionError(f'不支持的比较运算: {type(op).__name__}')
+            ops.append(type(op))
+        operands = (_parse_node(node.left),) + tuple(_parse_node(c) for c in node.comparators)
+        return ('cmp', tuple(ops), operands)
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in AGGREGATE_FUNCTIONS:
+            raise ConditionError('不支持的函数调用')
+        if len(node.args) != 2 or node.keywords:
+            raise ConditionError(f'聚合函数 {node.func.id} 需要两个参数，如 {node.func.id}(x,T60)')
+        prop, window = node.args
+        if not isinstance(prop, ast.Name) or not isinstance(window, ast.Name):
+            raise ConditionError(f'聚合函数 {node.func.id} 的参数格式错误')
+        match = _WINDOW_PATTERN.match(window.id)
+        if not match:
+            raise ConditionError(f'时间窗口格式错误: {window.id}')
+        return ('agg', AggregateKey(prop.id, node.func.id, int(match.group(1))))
+    raise ConditionError(f'表达式包含不支持的语法: {type(node).__name__}')
+
+
+def _collect(tree, variables, aggregates):
+    """收集语法树中引用的属性和聚合"""
+    kind = tree[0]
+    if kind == 'var':
+        variables.add(tree[1])
+    elif kind == 'agg':
+        aggregates.add(tree[1])
+    elif kind == 'unary':
+        _collect(tree[2], variables, aggregates)
+    elif kind == 'bin':
+        _collect(tree[2], variables, aggregates)
+        _collect(tree[3], variables, aggregates)
+    elif kind in ('bool', 'cmp'):
+        for child in tree[2]:
+            _collect(child, variables, aggregates)
+
+
+class Condition:
+    """解析后的条件表达式，相同文本的条件共享同一实例"""
+    
+    __slots__ = ('text', 'tree', 'variables', 'aggregates')
+    
+    def __init__(self, text):
+        self.text = text
+        try:
+            parsed = ast.parse(_normalize(text.strip()), mode='eval')
+        except SyntaxError as e:
+            raise ConditionError(f'表达式语法错误: {e.msg}')
+        self.tree = _parse_node(parsed)
+        variables, aggregates = set(), set()
+        _collect(self.tree, variables, aggregates)
+        self.variables = frozenset(variables)
+        self.aggregates = frozenset(aggregates)
+
+
+_condition_cache = {}
+_condition_cache_lock = threading.Lock()
+
+
+def parse_condition(text):
+    """解析条件表达式（按文本缓存，全局共享语法树）"""
+    with _condition_cache_lock:
+        condition = _condition_cache.get(text)
+    if condition is None:
+        condition = Condition(text)
+        with _condition_cache_lock:
+            condition = _condition_cache.setdefault(text, condition)
+    return condition
+
+
+def compile_tree(tree, slots):
+    """
+    将语法树编译为闭包求值函数 f(values, aggregates)
+    slots 为聚合键到聚合值数组下标的映射
+    """
+    kind = tree[0]
+    if kind == 'const':
+        value = tree[1]
+        return lambda values, aggs: value
+    if kind == 'var':
+        name = tree[1]
+        
+        def load(values, aggs):
+            try:
+                return values[name]
+            except KeyError:
+                raise ConditionError(f'缺少属性值: {name}')
+        return load
+    if kind == 'agg':
+        index = slots[tree[1]]
+        return lambda values, aggs: aggs[index]
+    if kind == 'unary':
+        op = _UNARY_OPERATORS[tree[1]]
+        operand = compile_tree(tree[2], slots)
+        return lambda values, aggs: op(operand(values, aggs))
+    if kind == 'bin':
+        op = _BINARY_OPERATORS[tree[1]]
+        left = compile_tree(tree[2], slots)
+        right = compile_tree(tree[3], slots)
+        return lambda values, aggs: op(left(values, aggs), right(values, aggs))
+    if kind == 'bool':
+        parts = [compile_tree(child, slots) for child in tree[2]]
+        if tree[1] == 'and':
+            return lambda values, aggs: all(part(values, aggs) for part in parts)
+        return lambda values, aggs: any(part(values, aggs) for part in parts)
+    if kind == 'cmp':
+        ops = [_COMPARE_OPERATORS[op] for op in tree[1]]
+        operands = [compile_tree(child, slots) for child in tree[2]]
+        
+        def compare(values, aggs):
+            left = operands[0](values, aggs)
+            for op, operand in zip(ops, operands[1:]):
+                right = operand(values, aggs)
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+        return compare
+    raise ConditionError(f'未知的语法树节点: {kind}')
+
+
+def _truthy(value):
+    """逐元素真值（与 Python 的 bool 一致，NaN 为真）"""
+    value = np.asarray(value)
+    return value if value.dtype == bool else value != 0
+
+
+def compile_vector(tree, slots):
+    """
+    将语法树编译为逐元素求值函数 f(columns, aggregates)，用于按时间批量回测
+    columns 为 {属性标识符: 数值数组}，aggregates 为与槽位对齐的数值数组列表，
+    返回数组或标量（比较、逻辑运算的结果为布尔数组）；不支持字符串常量
+    """
+    kind = tree[0]
+    if kind == 'const':
+        value = tree[1]
+        if isinstance(value, str):
+            raise ConditionError('批量回测不支持字符串比较')
+        return lambda columns, aggs: value
+    if kind == 'var':
+        name = tree[1]
+        
+        def load(columns, aggs):
+            try:
+                return columns[name]
+            except KeyError:
+                raise ConditionError(f'缺少属性值: {name}')
+        return load
+    if kind == 'agg':
+        index = slots[tree[1]]
+        return lambda columns, aggs: aggs[index]
+    if kind == 'unary':
+        operand = compile_vector(tree[2], slots)
+        if tree[1] is ast.Not:
+            return lambda columns, aggs: np.logical_not(_truthy(operand(columns, aggs)))
+        op = _UNARY_OPERATORS[tree[1]]
+        return lambda columns, aggs: op(operand(columns, aggs))
+    if kind == 'bin':
+        op = _BINARY_OPERATORS[tree[1]]
+        left = compile_vector(tree[2], slots)
+        right = compile_vector(tree[3], slots)
+        
+        def binary(columns, aggs):
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                return op(np.asarray(left(columns, aggs), dtype=np.float64), right(columns, aggs))
+        return binary
+    if kind == 'bool':
+        parts = [compile_vector(child, slots) for child in tree[2]]
+        reduce = np.logical_and.reduce if tree[1] == 'and' else np.logical_or.reduce
+        return lambda columns, aggs: reduce(np.broadcast_arrays(*[_truthy(part(columns, aggs)) for part in parts]))
+    if kind == 'cmp':
+        ops = [_COMPARE_OPERATORS[op] for op in tree[1]]
+        operands = [compile_vector(child, slots) for child in tree[2]]
+        
+        def compare(columns, aggs):
+            values = [operand(columns, aggs) for operand in operands]
+            with np.errstate(invalid='ignore'):
+                results = [np.asarray(op(left, right)) for op, left, right in zip(ops, values, values[1:])]
+            return np.logical_and.reduce(np.broadcast_arrays(*results))
+        return compare
+    raise ConditionError(f'未知的语法树节点: {kind}')
+
+
+_expression_cache = {}
+
+
+def evaluate_expression(text, values):
+    """对不含聚合函数的算术表达式求值（用于计算属性）"""
+    evaluate = _expression_cache.get(text)
+    if evaluate is None:
+        condition = parse_condition(text)
+        if condition.aggregates:
+            raise ConditionError('计算表达式不支持聚合函数')
+        evaluate = _expression_cache[text] = compile_tree(condition.tree, {})
+    return evaluate(values, ())
+
+
+def to_number(value):
+    """尽量将属性值转换为数值，与前端 parseFloat 的处理一致"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def load_window_history(device_ids, property_ids, since, until=None):
+    """
+    一次查询读取多个设备、多个属性在时间窗口内的历史数据
+    返回 {(device_id, property_id): (时间戳列表, 数值列表)}，按时间升序
+    """
+    series = {}
+    if not device_ids or not property_ids:
+        return series
+    query = db.session.query(
+        PropertyHistory.device_id,
+        PropertyHistory.property_id,
+        PropertyHistory.timestamp,
+        PropertyHistory.value
+    ).filter(
+        PropertyHistory.device_id.in_(list(device_ids)),
+        PropertyHistory.property_id.in_(list(property_ids)),
+        PropertyHistory.timestamp >= since
+    )
+    if until is not None:
+        query = query.filter(PropertyHistory.timestamp <= until)
+    for device_id, property_id, timestamp, value in query.order_by(PropertyHistory.timestamp).all():
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            continue
+        times, values = series.setdefault((device_id, property_id), ([], []))
+        times.append(timestamp)
+        values.append(number)
+    return series
+
+
+def load_latest_snapshot(device_ids, property_ids, until=None, chunk_size=500):
+    """
+    一次查询读取多台设备各属性在 until（默认当前）之前的最新历史值
+    返回 {device_id: {property_id: value}}，设备数量很多时按批查询
+    """
+    snapshot = {}
+    if not device_ids or not property_ids:
+        return snapshot
+    device_ids = list(device_ids)
+    for start in range(0, len(device_ids), chunk_size):
+        chunk = device_ids[start:start + chunk_size]
+        latest = db.session.query(
+            PropertyHistory.device_id,
+            PropertyHistory.property_id,
+            db.func.max(PropertyHistory.timestamp).label('timestamp')
+        ).filter(
+            PropertyHistory.device_id.in_(chunk),
+            PropertyHistory.property_id.in_(list(property_ids))
+        )
+        if until is not None:
+            latest = latest.filter(PropertyHistory.timestamp <= until)
+        latest = latest.group_by(PropertyHistory.device_id, PropertyHistory.property_id).subquery()
+        rows = db.session.query(
+            PropertyHistory.device_id,
+            PropertyHistory.property_id,
+            PropertyHistory.value
+        ).join(
+            latest,
+            db.and_(
+                PropertyHistory.device_id == latest.c.device_id,
+                PropertyHistory.property_id == latest.c.property_id,
+                PropertyHistory.timestamp == latest.c.timestamp
+            )
+        ).all()
+        for device_id, property_id, value in rows:
+            snapshot.setdefault(device_id, {})[property_id] = value
+    return snapshot
+
+
+def register_aggregates(condition, property_ids, slots, aggregates, windows):
+    """
+    将条件引用的聚合登记到共享槽位表
+    slots: AggregateKey → 槽位下标；aggregates: 槽位列表；windows: property_id → 最长窗口
+    """
+    for key in sorted(condition.aggregates):
+        if key.property not in property_ids:
+            raise ConditionError(f'未找到属性: {key.property}')
+        if key not in slots:
+            slots[key] = len(aggregates)
+            aggregates.append(key)
+            property_id = property_ids[key.property]
+            windows[property_id] = max(windows.get(property_id, 0), key.window)
+
+
+def compute_aggregates(aggregates, property_ids, history, device_id, now, current=None):
+    """计算设备的全部聚合槽位，返回与槽位对齐的数值列表"""
+    results = []
+    slices = {}  # (property_id, window) → 窗口内数值，供不同聚合函数共享
+    for key in aggregates:
+        property_id = property_ids[key.property]
+        window_values = slices.get((property_id, key.window))
+        if window_values is None:
+            times, values = history.get((device_id, property_id), ((), ()))
+            start = bisect.bisect_left(times, now - timedelta(seconds=key.window))
+            window_values = values[start:]
+            # 历史按例外报告存储时窗口内可能没有采样，说明值未超出死区，按当前值保持
+            if not window_values and current is not None and isinstance(current.get(key.property), float):
+                window_values = [current[key.property]]
+            slices[(property_id, key.window)] = window_values
+        # 窗口内无数据时按0处理，与前端行为一致
+        results.append(AGGREGATE_FUNCTIONS[key.function](window_values) if window_values else 0)
+    return results
+
+
+def fill_missing_values(device_values, property_ids, until=None):
+    """
+    将 {device_id: {属性标识符: 值}} 转为数值，缺失的属性一次查询补齐为 until 之前的最新历史值
+    """
+    filled = {
+        device_id: {identifier: to_number(value) for identifier, value in (values or {}).items()}
+        for device_id, values in device_values.items()
+    }
+    incomplete = [
+        device_id for device_id, values in filled.items()
+        if any(identifier not in values for identifier in property_ids)
+    ]
+    if incomplete:
+        identifiers = {pid: identifier for identifier, pid in property_ids.items()}
+        snapshot = load_latest_snapshot(incomplete, identifiers.keys(), until)
+        for device_id in incomplete:
+            values = filled[device_id]
+            for property_id, value in snapshot.get(device_id, {}).items():
+                values.setdefault(identifiers[property_id], to_number(value))
+    return filled
+
+
+class CompiledEvent:
+    """设备类型下单个事件的编译结果"""
+    
+    __slots__ = ('id', 'identifier', 'name', 'level', 'condition', 'evaluate', 'error')
+    
+    def __init__(self, event, condition=None, evaluate=None, error=None):
+        self.id = event.id
+        self.identifier = event.identifier
+        self.name = event.name
+        self.level = event.level
+        self.condition = condition
+        self.evaluate = evaluate
+        self.error = error
+
+
+class DeviceTypeProgram:
+    """
+    设备类型的事件程序
+    所有事件共享一份去重后的聚合槽位表，每个属性只读取一次最长窗口的历史
+    """
+    
+    def __init__(self, device_type_id, events, properties):
+        self.device_type_id = device_type_id
+        self.property_ids = {p.identifier: p.id for p in properties}
+        self.aggregates = []  # 槽位下标 → AggregateKey
+        self.windows = {}  # property_id → 最长时间窗口（秒）
+        self.events = []
+        
+        slots = {}
+        evaluators = {}  # 相同条件文本只编译一次
+        for event in events:
+            if not event.condition or not event.condition.strip():
+                self.events.append(CompiledEvent(event))
+                continue
+            try:
+                condition = parse_condition(event.condition)
+                register_aggregates(condition, self.property_ids, slots, self.aggregates, self.windows)
+                evaluate = evaluators.get(condition.text)
+                if evaluate is None:
+                    evaluate = evaluators[condition.text] = compile_tree(condition.tree, slots)
+                self.events.append(CompiledEvent(event, condition, evaluate))
+            except ConditionError as e:
+                self.events.append(CompiledEvent(event, error=str(e)))
+    
+    @property
+    def max_window(self):
+        return max(self.windows.values()) if self.windows else 0
+    
+    def compute_aggregates(self, history, device_id, now, current=None):
+        """计算设备的全部聚合槽位，返回与槽位对齐的数值列表"""
+        return compute_aggregates(self.aggregates, self.property_ids, history, device_id, now, current)
+    
+    def evaluate(self, device_id, values, history, now):
+        """对单台设备求值所有事件，返回结果字典列表"""
+        aggs = self.compute_aggregates(history, device_id, now, values)
+        results = []
+        for event in self.events:
+            triggered, error = False, event.error
+            if event.evaluate is not None:
+                try:
+                    triggered = bool(event.evaluate(values, aggs))
+                except ConditionError as e:
+                    error = str(e)
+                except (TypeError, ZeroDivisionError, ValueError, OverflowError) as e:
+                    error = f'表达式求值失败: {e}'
+            results.append({
+                'event_id': event.id,
+                'identifier': event.identifier,
+                'name': event.name,
+                'level': event.level,
+                'triggered': triggered,
+                'error': error
+            })
+        return results
+
+
+class EventEngine:
+    """事件引擎：按设备类型缓存事件程序，设备类型的事件或属性变化时失效"""
+    
+    def __init__(self):
+        self._programs = {}
+        self._lock = threading.Lock()
+        self.listeners = []  # 失效回调 f(device_type_id)，多进程部署时通知其他进程
+    
+    def get_program(self, device_type_id):
+        """获取设备类型的事件程序（需在应用上下文中调用）"""
+        with self._lock:
+            program = self._programs.get(device_type_id)
+        if program is None:
+            events = DeviceEvent.query.filter_by(device_type_id=device_type_id).order_by(DeviceEvent.id).all()
+            properties = DeviceProperty.query.filter_by(device_type_id=device_type_id).all()
+            program = DeviceTypeProgram(device_type_id, events, properties)
+            with self._lock:
+                self._programs[device_type_id] = program
+        return program
+    
+    def invalidate(self, device_type_id=None):
+        """使设备类型的事件程序失效，None 表示全部失效"""
+        with self._lock:
+            if device_type_id is None:
+                self._programs.clear()
+            else:
+                self._programs.pop(device_type_id, None)
+        for listener in self.listeners:
+            listener(device_type_id)
+    
+    def evaluate_devices(self, device_type_id, device_values, now=None):
+        """
+        批量求值同一设备类型下的多台设备
+        device_values: {device_id: {属性标识符: 当前值}}，缺失的属性使用最新历史值
+        返回 {device_id: [事件结果]}
+        """
+        program = self.get_program(device_type_id)
+        now = now or datetime.utcnow()
+        history = {}
+        if program.windows:
+            history = load_window_history(
+                device_values.keys(),
+                program.windows.keys(),
+                now - timedelta(seconds=program.max_window)
+            )
+        device_values = fill_missing_values(device_values, program.property_ids)
+        return {
+            device_id: program.evaluate(device_id, values, history, now)
+            for device_id, values in device_values.items()
+        }
+    
+    def evaluate_device(self, device, values=None, now=None):
+        """求值单台设备的所有事件"""
+        device_type = DeviceType.query.filter_by(name=device.type).first()
+        if device_type is None:
+            return []
+        return self.evaluate_devices(device_type.id, {device.id: values or {}}, now)[device.id]
+
+
+# 全局事件引擎实例
+event_engine = EventEngine()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+知识图谱批量导入导出
+支持两种格式：
+- jsonl：每行一个对象，{"type": "node", "id", "name", "node_type", "properties"} 或
+  {"type": "edge", "id", "from", "to", "relation_type", "properties"}
+- columnar：{"nodes": {"id": [...], "name": [...], ...}, "edges": {"id": [...], "from": [...], ...}}
+节点 id 为图谱中已有节点的 id 时更新该节点，否则视为客户端临时 id 并新建节点；
+边的 from / to 先按本次导入的临时 id 解析，再按图谱中已有节点 id 解析。
+全部写入在一个事务中按批执行（新建用带 RETURNING 的批量 INSERT 取回真实 id，更新用 executemany），
+属性索引行同步写入。导出按同样的格式流式输出，导出结果可直接导入到其他图谱中复制整张图谱。
+"""
+
+import json
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, delete, bindparam
+
+from models import db, KnowledgeGraphNode, KnowledgeGraphEdge, KnowledgeGraphPropertyIndex
+from graph_properties import property_rows, unindex_entities, unindex_graph
+
+
+FORMATS = ('jsonl', 'columnar')
+
+NODE_COLUMNS = ('id', 'name', 'node_type', 'properties')
+EDGE_COLUMNS = ('id', 'from', 'to', 'relation_type', 'properties')
+
+# 导出时每次从数据库读取的行数
+EXPORT_BATCH = 2000
+
+
+class BulkImportError(ValueError):
+    """批量导入数据错误"""
+
+
+def _properties_text(value, where):
+    """导入的属性：对象序列化为 JSON 文本，文本原样保存"""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    raise BulkImportError(f'{where}: properties 必须为对象或 JSON 文本')
+
+
+def _properties_value(text):
+    """导出的属性：可解析的 JSON 对象输出为对象，其他文本原样输出"""
+    if not text:
+        return text
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return text
+    return value if isinstance(value, (dict, list)) else text
+
+
+def _ref(value, where, field):
+    """临时 id / 节点 id 统一为可哈希的键（数值与数值文本视为相同）"""
+    if value is None or isinstance(value, bool) or isinstance(value, (dict, list)):
+        raise BulkImportError(f'{where}: {field} 无效')
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def parse_jsonl(lines):
+    """解析 JSON Lines，返回 (节点列表, 边列表)"""
+    nodes, edges = [], []
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise BulkImportError(f'第 {number} 行: JSON 格式错误: {e}')
+        if not isinstance(item, dict):
+            raise BulkImportError(f'第 {number} 行: 必须为对象')
+        item_type = item.get('type')
+        if item_type == 'node':
+            nodes.append((f'第 {number} 行', item))
+        elif item_type == 'edge':
+            edges.append((f'第 {number} 行', item))
+        else:
+            raise BulkImportError(f'第 {number} 行: type 必须为 node 或 edge')
+    return nodes, edges
+
+
+def parse_columnar(data):
+    """解析列式 JSON，返回 (节点列表, 边列表)"""
+    if not isinstance(data, dict):
+        raise BulkImportError('列式数据必须为对象')
+    
+    def rows(section, columns, label):
+        table = data.get(section) or {}
+        if not isinstance(table, dict):
+            raise BulkImportError(f'{section} 必须为列对象')
+        lengths = {len(values) for values in table.values() if isinstance(values, list)}
+        if any(not isinstance(values, list) for values in table.values()) or len(lengths) > 1:
+            raise BulkImportError(f'{section} 的各列必须为等长数组')
+        count = lengths.pop() if lengths else 0
+        present = [column for column in columns if column in table]
+        return [
+            (f'{label} {i}', {column: table[column][i] for column in present})
+            for i in range(count)
+        ]
+    
+    return rows('nodes', NODE_COLUMNS, '节点'), rows('edges', EDGE_COLUMNS, '边')
+
+
+def _existing(model, graph_id):
+    return {
+        str(entity_id): entity_id
+        for entity_id, in db.session.execute(select(model.id).where(model.graph_id == graph_id))
+    }
+
+
+def _insert_returning(model, rows):
+    """批量插入并按参数顺序取回新建行的 id"""
+    if not rows:
+        return []
+    table = model.__table__
+    result = db.session.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+    return [row[0] for row in result]
+
+
+def _update(model, rows, columns):
+    """按 id 批量更新（executemany）"""
+    if rows:
+        statement = (
+            update(model.__table__)
+            .where(model.__table__.c.id == bindparam('b_id'))
+            .values({column: bindparam(f'b_{column}') for column in columns})
+        )
+        db.session.execute(statement, [{f'b_{key}': value for key, value in row.items()} for row in rows])
+
+
+def import_graph(graph_id, nodes, edges, replace=False):
+    """
+    在当前事务中批量导入节点和边（由调用方提交或回滚）
+    replace 为 True 时先删除图谱中原有的全部节点和边
+    返回统计及临时 id → 节点 id 映射
+    """
+    now = datetime.utcnow()
+    if replace:
+        unindex_graph(graph_id)
+        db.session.execute(delete(KnowledgeGraphEdge).where(KnowledgeGraphEdge.graph_id == graph_id))
+        db.session.execute(delete(KnowledgeGraphNode).where(KnowledgeGraphNode.graph_id == graph_id))
+        existing_nodes, existing_edges = {}, {}
+    else:
+        existing_nodes = _existing(KnowledgeGraphNode, graph_id)
+        existing_edges = _existing(KnowledgeGraphEdge, graph_id)
+    
+    # 节点：已有 id 更新，其余新建
+    node_inserts, node_insert_refs, node_updates = [], [], []
+    seen = set()
+    for where, item in nodes:
+        name, node_type = item.get('name'), item.get('node_type')
+        if not name or not node_type:
+            raise BulkImportError(f'{where}: 节点缺少 name 或 node_type')
+        values = {
+            'name': str(name),
+            'node_type': str(node_type),
+            'properties': _properties_text(item.get('properties'), where),
+            'updated_at': now
+        }
+        ref = _ref(item['id'], where, 'id') if item.get('id') is not None else None
+        if ref is not None:
+            if ref in seen:
+                raise BulkImportError(f'{where}: 节点 id {ref} 重复')
+            seen.add(ref)
+        if ref is not None and ref in existing_nodes:
+            node_updates.append(dict(values, id=existing_nodes[ref]))
+        else:
+            node_inserts.append(dict(values, graph_id=graph_id, created_at=now))
+            node_insert_refs.append(ref)
+    
+    created_ids = _insert_returning(KnowledgeGraphNode, node_inserts)
+    _update(KnowledgeGraphNode, node_updates, ('name', 'node_type', 'properties', 'updated_at'))
+    id_map = {ref: node_id for ref, node_id in zip(node_insert_refs, created_ids) if ref is not None}
+    
+    def resolve(value, where, field):
+        ref = _ref(value, where, field)
+        node_id = id_map.get(ref, existing_nodes.get(ref))
+        if node_id is None:
+            raise BulkImportError(f'{where}: {field} 引用的节点 {value} 不存在')
+        return node_id
+    
+    # 边：端点解析为真实节点 id
+    edge_inserts, edge_updates = [], []
+    for where, item in edges:
+        relation_type = item.get('relation_type')
+        if not relation_type:
+            raise BulkImportError(f'{where}: 边缺少 relation_type')
+        values = {
+            'from_node_id': resolve(item.get('from'), where, 'from'),
+            'to_node_id': resolve(item.get('to'), where, 'to'),
+            'relation_type': str(relation_type),
+            'properties': _properties_text(item.get('properties'), where),
+            'updated_at': now
+        }
+        ref = _ref(item['id'], where, 'id') if item.get('id') is not None else None
+        if ref is not None and ref in existing_edges:
+            edge_updates.append(dict(values, id=existing_edges[ref]))
+        else:
+            edge_inserts.append(dict(values, graph_id=graph_id, created_at=now))
+    
+    # 边的新 id 只用于写属性索引，没有属性时直接 executemany
+    if any(row['properties'] for row in edge_inserts):
+        created_edge_ids = _insert_returning(KnowledgeGraphEdge, edge_inserts)
+    else:
+        if edge_inserts:
+            db.session.execute(insert(KnowledgeGraphEdge.__table__), edge_inserts)
+        created_edge_ids = []
+    _update(KnowledgeGraphEdge, edge_updates, ('from_node_id', 'to_node_id', 'relation_type', 'properties', 'updated_at'))
+    
+    # 属性索引：更新的实体先删除旧索引行，新建和更新的实体统一写入
+    unindex_entities('node', [row['id'] for row in node_updates])
+    unindex_entities('edge', [row['id'] for row in edge_updates])
+    index_rows = []
+    for node_id, row in zip(created_ids, node_inserts):
+        index_rows.extend(property_rows(graph_id, 'node', node_id, row['properties']))
+    for row in node_updates:
+        index_rows.extend(property_rows(graph_id, 'node', row['id'], row['properties']))
+    for edge_id, row in zip(created_edge_ids, edge_inserts):
+        index_rows.extend(property_rows(graph_id, 'edge', edge_id, row['properties']))
+    for row in edge_updates:
+        index_rows.extend(property_rows(graph_id, 'edge', row['id'], row['properties']))
+    if index_rows:
+        db.session.execute(KnowledgeGraphPropertyIndex.__table__.insert(), index_rows)
+    
+    return {
+        'nodes_created': len(node_inserts),
+        'nodes_updated': len(node_updates),
+        'edges_created': len(edge_inserts),
+        'edges_updated': len(edge_updates),
+        'id_map': id_map
+    }
+
+
+def _rows(statement):
+    """分批读取查询结果"""
+    result = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH))
+    for partition in result.partitions():
+        yield from partition
+
+
+def _node_query(graph_id, *columns):
+    return select(*columns).where(KnowledgeGraphNode.graph_id == graph_id).order_by(KnowledgeGraphNode.id)
+
+
+def _edge_query(graph_id, *columns):
+    return select(*columns).where(KnowledgeGraphEdge.graph_id == graph_id).order_by(KnowledgeGraphEdge.id)
+
+
+def export_jsonl(graph_id):
+    """流式导出 JSON Lines：先输出全部节点，再输出全部边"""
+    node = KnowledgeGraphNode
+    for node_id, name, node_type, properties in _rows(
+        _node_query(graph_id, node.id, node.name, node.node_type, node.properties)
+    ):
+        yield json.dumps({
+            'type': 'node', 'id': node_id, 'name': name, 'node_type': node_type,
+            'properties': _properties_value(properties)
+        }, ensure_ascii=False) + '\n'
+    edge = KnowledgeGraphEdge
+    for edge_id, from_node_id, to_node_id, relation_type, properties in _rows(
+        _edge_query(graph_id, edge.id, edge.from_node_id, edge.to_node_id, edge.relation_type, edge.properties)
+    ):
+        yield json.dumps({
+            'type': 'edge', 'id': edge_id, 'from': from_node_id, 'to': to_node_id,
+            'relation_type': relation_type, 'properties': _properties_value(properties)
+        }, ensure_ascii=False) + '\n'
+
+
+def export_columnar(graph_id):
+    """
+    导出列式 JSON：每个部分一次查询，按列收集为普通列表（保证各列行对齐），
+    再分块输出，不创建 ORM 对象
+    """
+    node, edge = KnowledgeGraphNode, KnowledgeGraphEdge
+    sections = (
+        ('nodes', NODE_COLUMNS, _node_query(graph_id, node.id, node.name, node.node_type, node.properties)),
+        ('edges', EDGE_COLUMNS, _edge_query(
+            graph_id, edge.id, edge.from_node_id, edge.to_node_id, edge.relation_type, edge.properties
+        )),
+    )
+    yield '{'
+    for section_index, (section, names, query) in enumerate(sections):
+        columns = tuple([] for _ in names)
+        for row in _rows(query):
+            for values, value in zip(columns, row):
+                values.append(value)
+        columns[-1][:] = [_properties_value(value) for value in columns[-1]]
+        yield ('' if section_index == 0 else ',') + json.dumps(section) + ':{'
+        for column_index, (name, values) in enumerate(zip(names, columns)):
+            yield ('' if column_index == 0 else ',') + json.dumps(name) + ':['
+            for offset in range(0, len(values), EXPORT_BATCH):
+                chunk = json.dumps(values[offset:offset + EXPORT_BATCH], ensure_ascii=False)[1:-1]
+                yield ('' if offset == 0 else ',') + chunk
+            yield ']'
+        yield '}'
+    yield '}'
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+知识图谱内存邻接索引
+按图谱在首次访问时一次性读取节点和边，构建以节点下标为键的压缩稀疏行（CSR）邻接数组
+（出边、入边各一份，按关系类型分段的子索引按需构建），节点或边写入后失效。
+遍历按层展开：整层前沿节点的邻接区间用 NumPy 一次收集，不逐节点循环，
+10 万条边的图谱上故障传播查询在毫秒级完成。
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import select
+
+from models import db, KnowledgeGraph, KnowledgeGraphNode, KnowledgeGraphEdge
+from graph_properties import property_text, load_properties
+
+
+DIRECTIONS = ('out', 'in', 'both')
+
+# 单次查询返回的节点数上限
+MAX_RESULT_NODES = 10000
+
+
+class GraphQueryError(ValueError):
+    """图谱查询参数错误"""
+
+
+def build_csr(sources, targets, edge_index, node_count):
+    """
+    按起点构建 CSR：ptr[i]:ptr[i+1] 为节点 i 的邻接区间，
+    返回 (ptr, 邻接节点下标, 边在边数组中的下标)
+    """
+    order = np.argsort(sources, kind='stable')
+    ptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=ptr[1:])
+    return ptr, targets[order], edge_index[order]
+
+
+def gather(csr, frontier):
+    """收集前沿节点的全部邻接项，返回 (来源节点下标, 邻接节点下标, 边下标)"""
+    ptr, neighbors, edges = csr
+    starts = ptr[frontier]
+    counts = ptr[frontier + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    # 每个邻接项在 CSR 中的位置 = 所属区间起点 + 区间内偏移
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+    return np.repeat(frontier, counts), neighbors[offsets], edges[offsets]
+
+
+class GraphIndex:
+    """
+    单个知识图谱的邻接索引
+    节点按 id 升序映射为 0..n-1 的下标；边的端点、关系编码保存在并行数组中，
+    引用已删除节点的边在构建时丢弃
+    """
+    
+    def __init__(self, graph_id, nodes, edges, properties=()):
+        self.graph_id = graph_id
+        nodes = sorted(nodes, key=lambda row: row[0])
+        self.node_ids = np.array([row[0] for row in nodes], dtype=np.int64)
+        self.node_names = [row[1] for row in nodes]
+        self.node_types = [row[2] for row in nodes]
+        self.node_properties = properties  # [(节点ID, 属性键, 值文本)]，来自属性索引表
+        node_count = len(nodes)
+        
+        edge_ids = np.array([row[0] for row in edges], dtype=np.int64)
+        sources = self.lookup(np.array([row[1] for row in edges], dtype=np.int64))
+        targets = self.lookup(np.array([row[2] for row in edges], dtype=np.int64))
+        self.relations = sorted({row[3] for row in edges})
+        codes = {relation: code for code, relation in enumerate(self.relations)}
+        relation_codes = np.array([codes[row[3]] for row in edges], dtype=np.int64)
+        
+        valid = (sources >= 0) & (targets >= 0)
+        self.edge_ids = edge_ids[valid]
+        self.edge_sources = sources[valid]
+        self.edge_targets = targets[valid]
+        self.edge_relations = relation_codes[valid]
+        positions = np.arange(self.edge_ids.size, dtype=np.int64)
+        self.node_count = node_count
+        self.out_csr = build_csr(self.edge_sources, self.edge_targets, positions, node_count)
+        self.in_csr = build_csr(self.edge_targets, self.edge_sources, positions, node_count)
+        self._relation_csr = {}
+        self._relation_lock = threading.Lock()
+        self._property_lookup = None
+    
+    def lookup(self, ids):
+        """节点 id → 下标，不存在的 id 返回 -1"""
+        if not self.node_ids.size:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        index = np.searchsorted(self.node_ids, ids)
+        index = np.minimum(index, self.node_ids.size - 1)
+        return np.where(self.node_ids[index] == ids, index, -1)
+    
+    def node_index(self, node_id):
+        """单个节点 id → 下标"""
+        try:
+            node_id = int(node_id)
+        except (TypeError, ValueError):
+            raise GraphQueryError(f'无效的节点ID: {node_id}')
+        index = int(self.lookup(np.array([node_id], dtype=np.int64))[0])
+        if index < 0:
+            raise GraphQueryError(f'节点 {node_id} 不属于该知识图谱')
+        return index
+    
+    def property_lookup(self):
+        """节点属性的反查表 {键: {值文本: 节点下标数组}}，首次使用时由属性索引行构建"""
+        lookup = self._property_lookup
+        if lookup is None:
+            collected = {}
+            if self.node_properties:
+                positions = self.lookup(np.array([row[0] for row in self.node_properties], dtype=np.int64))
+                for position, (_, key, value) in zip(positions.tolist(), self.node_properties):
+                    if position >= 0:
+                        collected.setdefault(key, {}).setdefault(value, []).append(position)
+            lookup = {
+                key: {value: np.array(indexes, dtype=np.int64) for value, indexes in values.items()}
+                for key, values in collected.items()
+            }
+            self._property_lookup = lookup
+        return lookup
+    
+    def nodes_with_property(self, key, value):
+        """属性 key 等于 value 的节点下标数组"""
+        value = property_text(value)
+        empty = np.empty(0, dtype=np.int64)
+        if value is None:
+            return empty
+        return self.property_lookup().get(key, {}).get(value, empty)
+    
+    def has_property(self, keys):
+        """布尔数组：节点是否具有 keys 中任一属性"""
+        mask = np.zeros(self.node_count, dtype=bool)
+        lookup = self.property_lookup()
+        for key in keys:
+            for indexes in lookup.get(key, {}).values():
+                mask[indexes] = True
+        return mask
+    
+    def relation_codes(self, relations):
+        """关系类型列表 → 编码列表，None 表示不过滤；图谱中不存在的关系类型被忽略"""
+        if relations is None:
+            return None
+        codes = {relation: code for code, relation in enumerate(self.relations)}
+        return sorted({codes[relation] for relation in relations if relation in codes})
+    
+    def csr(self, direction, code=None):
+        """方向为 'out' / 'in' 的邻接索引，指定关系编码时返回该关系的子索引（按需构建并缓存）"""
+        full = self.out_csr if direction == 'out' else self.in_csr
+        if code is None:
+            return full
+        key = (direction, code)
+        with self._relation_lock:
+            cached = self._relation_csr.get(key)
+        if cached is None:
+            mask = self.edge_relations == code
+            positions = np.flatnonzero(mask)
+            sources, targets = self.edge_sources[mask], self.edge_targets[mask]
+            if direction == 'in':
+                sources, targets = targets, sources
+            cached = build_csr(sources, targets, positions, self.node_count)
+            with self._relation_lock:
+                self._relation_csr[key] = cached
+        return cached
+    
+    def adjacency(self, direction, codes):
+        """查询要展开的邻接索引列表"""
+        if direction not in DIRECTIONS:
+            raise GraphQueryError(f'无效的方向: {direction}，可选 out、in、both')
+        directions = ('out', 'in') if direction == 'both' else (direction,)
+        if codes is None:
+            return [self.csr(d) for d in directions]
+        return [self.csr(d, code) for d in directions for code in codes]
+    
+    def expand(self, indexes, frontier):
+        """展开一层前沿，返回 (来源下标, 邻接下标, 边下标)"""
+        parts = [gather(csr, frontier) for csr in indexes]
+        if len(parts) == 1:
+            return parts[0]
+        return tuple(np.concatenate(column) for column in zip(*parts))
+    
+    def bfs(self, sources, direction='out', relations=None, max_depth=None, target=None):
+        """
+        广度优先遍历
+        返回 (depth, parent_edge)：depth[i] 为节点 i 的层数（未到达为 -1），
+        parent_edge[i] 为到达节点 i 的边下标（起点为 -1）；指定 target 时到达即停止
+        """
+        indexes = self.adjacency(direction, self.relation_codes(relations))
+        depth = np.full(self.node_count, -1, dtype=np.int64)
+        parent_edge = np.full(self.node_count, -1, dtype=np.int64)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        depth[frontier] = 0
+        level = 0
+        while frontier.size and (max_depth is None or level < max_depth):
+            if target is not None and depth[target] >= 0:
+                break
+            _, neighbors, edges = self.expand(indexes, frontier)
+            fresh = depth[neighbors] < 0
+            neighbors, edges = neighbors[fresh], edges[fresh]
+            # 同一节点被多条边到达时保留第一条
+            frontier, first = np.unique(neighbors, return_index=True)
+            level += 1
+            depth[frontier] = level
+            parent_edge[frontier] = edges[first]
+        return depth, parent_edge
+    
+    def node_dicts(self, indexes, depth=None):
+        """节点下标数组 → 节点字典列表（depth 为全图层数数组时附带层数）"""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        names, types = self.node_names, self.node_types
+        nodes = [
+            {'id': node_id, 'name': names[i], 'node_type': types[i]}
+            for i, node_id in zip(indexes.tolist(), self.node_ids[indexes].tolist())
+        ]
+        if depth is not None:
+            for node, d in zip(nodes, depth[indexes].tolist()):
+                node['depth'] = d
+        return nodes
+    
+    def edge_dicts(self, positions):
+        """边下标数组 → 边字典列表"""
+        positions = np.asarray(positions, dtype=np.int64)
+        relations = self.relations
+        return [
+            {'id': edge_id, 'from_node_id': source, 'to_node_id': target, 'relation_type': relations[code]}
+            for edge_id, source, target, code in zip(
+                self.edge_ids[positions].tolist(),
+                self.node_ids[self.edge_sources[positions]].tolist(),
+                self.node_ids[self.edge_targets[positions]].tolist(),
+                self.edge_relations[positions].tolist()
+            )
+        ]
+    
+    def _visited(self, depth, limit):
+        """按层数、节点 id 排序的已到达节点下标，最多 limit 个"""
+        reached = np.flatnonzero(depth >= 0)
+        order = np.lexsort((reached, depth[reached]))
+        reached = reached[order]
+        return reached[:limit], reached.size > limit
+    
+    def neighborhood(self, node_id, hops=1, direction='both', relations=None, limit=MAX_RESULT_NODES):
+        """节点的 k 跳邻域：返回邻域内节点（含层数）及节点之间满足关系过滤的边"""
+        if hops < 0:
+            raise GraphQueryError('跳数不能为负数')
+        start = self.node_index(node_id)
+        depth, _ = self.bfs([start], direction, relations, max_depth=hops)
+        visited, truncated = self._visited(depth, limit)
+        inside = np.zeros(self.node_count, dtype=bool)
+        inside[visited] = True
+        mask = inside[self.edge_sources] & inside[self.edge_targets]
+        codes = self.relation_codes(relations)
+        if codes is not None:
+            mask &= np.isin(self.edge_relations, codes)
+        return {
+            'node_id': int(node_id),
+            'hops': hops,
+            'nodes': self.node_dicts(visited, depth),
+            'edges': self.edge_dicts(np.flatnonzero(mask)),
+            'truncated': bool(truncated)
+        }
+    
+    def shortest_path(self, from_node_id, to_node_id, direction='out', relations=None, max_depth=None):
+        """两节点间的最短路径（边数最少），不可达时 found 为 False"""
+        start = self.node_index(from_node_id)
+        target = self.node_index(to_node_id)
+        depth, parent_edge = self.bfs([start], direction, relations, max_depth, target=target)
+        if depth[target] < 0:
+            return {'found': False, 'length': None, 'nodes': [], 'edges': []}
+        nodes, edges = [target], []
+        current = target
+        while current != start:
+            position = int(parent_edge[current])
+            edges.append(position)
+            # both 方向下父边可能是反向走过的入边
+            source = int(self.edge_sources[position])
+            current = source if source != current else int(self.edge_targets[position])
+            nodes.append(current)
+        nodes.reverse()
+        edges.reverse()
+        return {
+            'found': True,
+            'length': len(edges),
+            'nodes': self.node_dicts(nodes, depth),
+            'edges': self.edge_dicts(edges)
+        }
+    
+    def reachable(self, node_ids, relations=None, direction='out', max_depth=None, limit=MAX_RESULT_NODES):
+        """
+        沿指定关系类型可到达的节点（如故障沿“导致”关系的传播范围），
+        node_ids 可为多个起点，返回节点及层数、到达该节点的边
+        """
+        starts = [self.node_index(node_id) for node_id in node_ids]
+        if not starts:
+            raise GraphQueryError('缺少起始节点')
+        depth, parent_edge = self.bfs(starts, direction, relations, max_depth)
+        visited, truncated = self._visited(depth, limit)
+        reached = visited[depth[visited] > 0]
+        return {
+            'node_ids': [int(node_id) for node_id in node_ids],
+            'relations': relations,
+            'count': int((depth > 0).sum()),
+            'nodes': self.node_dicts(visited, depth),
+            'edges': self.edge_dicts(parent_edge[reached]),
+            'truncated': bool(truncated)
+        }
+    
+    def stats(self):
+        return {
+            'graph_id': self.graph_id,
+            'nodes': self.node_count,
+            'edges': int(self.edge_ids.size),
+            'relations': self.relations
+        }
+
+
+def load_graph_index(graph_id):
+    """从数据库构建图谱索引，图谱不存在时返回 None"""
+    if db.session.get(KnowledgeGraph, graph_id) is None:
+        return None
+    nodes = db.session.execute(
+        select(KnowledgeGraphNode.id, KnowledgeGraphNode.name, KnowledgeGraphNode.node_type)
+        .where(KnowledgeGraphNode.graph_id == graph_id)
+    ).all()
+    edges = db.session.execute(
+        select(KnowledgeGraphEdge.id, KnowledgeGraphEdge.from_node_id,
+               KnowledgeGraphEdge.to_node_id, KnowledgeGraphEdge.relation_type)
+        .where(KnowledgeGraphEdge.graph_id == graph_id)
+    ).all()
+    return GraphIndex(
+        graph_id, [tuple(row) for row in nodes], [tuple(row) for row in edges],
+        load_properties(graph_id, 'node')
+    )
+
+
+class GraphIndexRegistry:
+    """图谱索引缓存：首次访问时构建，节点或边写入后失效；最多保留 max_graphs 个图谱"""
+    
+    def __init__(self, max_graphs=32):
+        self.max_graphs = max_graphs
+        self._indexes = OrderedDict()
+        self._versions = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.listeners = []  # 失效回调 f(graph_id)，多进程部署时通知其他进程
+    
+    def get(self, graph_id):
+        """获取图谱索引（需在应用上下文中调用），图谱不存在时返回 None"""
+        with self._lock:
+            index = self._indexes.get(graph_id)
+            if index is not None:
+                self._indexes.move_to_end(graph_id)
+                return index
+            version = (self._generation, self._versions.get(graph_id, 0))
+        index = load_graph_index(graph_id)
+        if index is not None:
+            with self._lock:
+                # 构建期间发生写入时不缓存，下次访问重新构建
+                if (self._generation, self._versions.get(graph_id, 0)) == version:
+                    self._indexes[graph_id] = index
+                    while len(self._indexes) > self.max_graphs:
+                        self._indexes.popitem(last=False)
+        return index
+    
+    def invalidate(self, graph_id=None):
+        """使图谱索引失效，None 表示全部失效"""
+        with self._lock:
+            if graph_id is None:
+                self._generation += 1
+                self._indexes.clear()
+            else:
+                self._versions[graph_id] = self._versions.get(graph_id, 0) + 1
+                self._indexes.pop(graph_id, None)
+        for listener in self.listeners:
+            listener(graph_id)
+
+
+# 全局图谱索引实例
+graph_index = GraphIndexRegistry()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+知识图谱属性二级索引
+节点、边的 properties 为 JSON 文本，写入时展开为 (graph_id, 实体类型, 键, 值) → 实体ID 的索引行，
+按属性查找节点或边时走索引检索，不再读取并解析整张图谱。
+嵌套对象的键以点号连接（{"location": {"site": "A"}} → location.site = A），列表不建索引。
+"""
+
+import json
+
+from sqlalchemy import select, delete
+
+from models import db, KnowledgeGraphPropertyIndex
+
+
+ENTITY_TYPES = ('node', 'edge')
+
+# 请求参数中属性过滤条件的前缀：?prop.device_code=P-001
+FILTER_PREFIX = 'prop.'
+
+# 超过该长度的属性值不建索引
+MAX_VALUE_LENGTH = 500
+
+
+def property_text(value):
+    """属性值 → 索引文本，非标量返回 None；数值统一为文本（3 与 3.0 视为相同）"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, (int, float, str)):
+        return str(value).strip()
+    return None
+
+
+def flatten_properties(text):
+    """解析属性 JSON 文本，返回 [(键, 值文本)]，无法解析或不是对象时返回空列表"""
+    if not text:
+        return []
+    try:
+        properties = json.loads(text) if isinstance(text, str) else text
+    except ValueError:
+        return []
+    if not isinstance(properties, dict):
+        return []
+    items = []
+    stack = [('', properties)]
+    while stack:
+        prefix, current = stack.pop()
+        for key, value in current.items():
+            key = f'{prefix}{key}'
+            if isinstance(value, dict):
+                stack.append((f'{key}.', value))
+                continue
+            value = property_text(value)
+            if value is not None and len(value) <= MAX_VALUE_LENGTH and len(key) <= 200:
+                items.append((key, value))
+    return items
+
+
+def property_rows(graph_id, entity_type, entity_id, text):
+    """实体的索引行（用于批量插入）"""
+    return [
+        {'graph_id': graph_id, 'entity_type': entity_type, 'entity_id': entity_id, 'key': key, 'value': value}
+        for key, value in flatten_properties(text)
+    ]
+
+
+def index_entity(graph_id, entity_type, entity_id, text):
+    """重建单个节点或边的索引行（在调用方的事务中执行，由调用方提交）"""
+    unindex_entities(entity_type, [entity_id])
+    rows = property_rows(graph_id, entity_type, entity_id, text)
+    if rows:
+        db.session.execute(KnowledgeGraphPropertyIndex.__table__.insert(), rows)
+
+
+def unindex_entities(entity_type, entity_ids):
+    """删除节点或边的索引行"""
+    entity_ids = list(entity_ids)
+    if entity_ids:
+        db.session.execute(
+            delete(KnowledgeGraphPropertyIndex)
+            .where(KnowledgeGraphPropertyIndex.entity_type == entity_type)
+            .where(KnowledgeGraphPropertyIndex.entity_id.in_(entity_ids))
+        )
+
+
+def unindex_graph(graph_id):
+    """删除知识图谱的全部索引行"""
+    db.session.execute(
+        delete(KnowledgeGraphPropertyIndex).where(KnowledgeGraphPropertyIndex.graph_id == graph_id)
+    )
+
+
+def property_filters(args):
+    """从请求参数中提取属性过滤条件 [(键, 值文本)]"""
+    return [
+        (name[len(FILTER_PREFIX):], value.strip())
+        for name, value in args.items(multi=True)
+        if name.startswith(FILTER_PREFIX) and len(name) > len(FILTER_PREFIX)
+    ]
+
+
+def matching_ids(graph_id, entity_type, filters):
+    """满足全部属性条件的实体ID子查询（各条件在索引上分别检索后取交集）"""
+    index = KnowledgeGraphPropertyIndex
+    queries = [
+        select(index.entity_id)
+        .where(index.graph_id == graph_id)
+        .where(index.entity_type == entity_type)
+        .where(index.key == key)
+        .where(index.value == value)
+        for key, value in filters
+    ]
+    if len(queries) == 1:
+        return queries[0]
+    query = queries[0].intersect(*queries[1:]).subquery()
+    return select(query.c.entity_id)
+
+
+def load_properties(graph_id, entity_type):
+    """读取知识图谱的全部索引行 [(实体ID, 键, 值文本)]"""
+    index = KnowledgeGraphPropertyIndex
+    return [
+        tuple(row) for row in db.session.execute(
+            select(index.entity_id, index.key, index.value)
+            .where(index.graph_id == graph_id)
+            .where(index.entity_type == entity_type)
+        )
+    ]
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Excel 历史数据导入
+读取上传的 Excel 工作簿（第一个工作表，首行为表头），按设备ID、属性ID、属性值、时间戳四列
+批量写入属性历史表。以只读模式逐行读取，每批一次 executemany 写入并提交，内存占用与文件大小无关。
+"""
+
+from datetime import datetime
+
+from openpyxl import load_workbook
+
+from models import db, Device, DeviceProperty, PropertyHistory
+from timeseries import parse_utc_time
+
+
+# 表头名称 → 字段
+HEADER_ALIASES = {
+    'device_id': 'device_id', '设备ID': 'device_id', '设备id': 'device_id',
+    'property_id': 'property_id', '属性ID': 'property_id', '属性id': 'property_id',
+    'value': 'value', '值': 'value', '属性值': 'value',
+    'timestamp': 'timestamp', '时间': 'timestamp', '时间戳': 'timestamp'
+}
+REQUIRED_COLUMNS = ('device_id', 'property_id', 'value', 'timestamp')
+
+
+class HistoryImportError(ValueError):
+    """导入文件格式不正确"""
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    if value is None or value == '':
+        return None
+    return parse_utc_time(value)
+
+
+def import_history_workbook(path, progress=None, batch_size=5000, earliest=None):
+    """
+    导入 Excel 文件中的历史数据，返回 {'imported': 导入行数, 'skipped': 跳过行数, 'errors': 前若干条错误说明}
+    progress(已处理行数, 总行数, 说明) 用于报告进度；设备或属性不存在、数值或时间无法解析的行被跳过
+    earliest 为字典时记录每个点位导入的最早时刻 {(device_id, property_id): datetime}，用于重算汇总
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise HistoryImportError('文件为空')
+        columns = {}
+        for position, name in enumerate(header):
+            field = HEADER_ALIASES.get(str(name).strip()) if name is not None else None
+            if field is not None:
+                columns[field] = position
+        missing = [field for field in REQUIRED_COLUMNS if field not in columns]
+        if missing:
+            raise HistoryImportError(f"缺少必要的列: {', '.join(missing)}")
+        
+        device_ids = {device_id for (device_id,) in db.session.query(Device.id).all()}
+        property_ids = {property_id for (property_id,) in db.session.query(DeviceProperty.id).all()}
+        total = max((sheet.max_row or 1) - 1, 1)
+        insert = PropertyHistory.__table__.insert()
+        imported, skipped, errors, batch = 0, 0, [], []
+        
+        for line, row in enumerate(rows, start=2):
+            try:
+                device_id = int(row[columns['device_id']])
+                property_id = int(row[columns['property_id']])
+                value = row[columns['value']]
+                timestamp = _parse_timestamp(row[columns['timestamp']])
+                if device_id not in device_ids or property_id not in property_ids:
+                    raise ValueError('设备或属性不存在')
+                if value is None or timestamp is None:
+                    raise ValueError('属性值或时间为空')
+            except (TypeError, ValueError, IndexError) as e:
+                skipped += 1
+                if len(errors) < 20:
+                    errors.append(f'第 {line} 行: {e}')
+                continue
+            batch.append({'device_id': device_id, 'property_id': property_id, 'value': str(value), 'timestamp': timestamp})
+            if earliest is not None:
+                key = (device_id, property_id)
+                if key not in earliest or timestamp < earliest[key]:
+                    earliest[key] = timestamp
+            if len(batch) >= batch_size:
+                db.session.execute(insert, batch)
+                db.session.commit()
+                imported += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(line - 1, total, f'已导入 {imported} 行')
+        if batch:
+            db.session.execute(insert, batch)
+            db.session.commit()
+            imported += len(batch)
+    finally:
+        workbook.close()
+    return {'imported': imported, 'skipped': skipped, 'errors': errors}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+采样例外报告过滤
+按属性的死区配置决定哪些采样写入历史数据：
+- absolute: 与上次存储值的差超过绝对阈值才存储
+- percent: 差值超过量程（或上次存储值）的百分比才存储
+- swinging_door: 旋转门压缩，只存储趋势转折点
+max_silence 为最长静默时间（秒），超过后即使值未变化也存储一次（心跳）。
+"""
+
+import threading
+from collections import namedtuple
+
+
+DEADBAND_MODES = ('absolute', 'percent', 'swinging_door')
+
+DeadbandConfig = namedtuple('DeadbandConfig', ['mode', 'value', 'max_silence', 'span'])
+
+
+def deadband_config(prop):
+    """从设备属性读取死区配置，未配置时返回 None（每个采样都存储）"""
+    mode = getattr(prop, 'deadband_mode', None)
+    max_silence = getattr(prop, 'max_silence', None)
+    if mode not in DEADBAND_MODES and not max_silence:
+        return None
+    span = None
+    if prop.min_value is not None and prop.max_value is not None and prop.max_value > prop.min_value:
+        span = prop.max_value - prop.min_value
+    return DeadbandConfig(
+        mode if mode in DEADBAND_MODES else None,
+        prop.deadband_value or 0.0,
+        max_silence or None,
+        span
+    )
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _SeriesState:
+    """单个序列的过滤状态"""
+    
+    __slots__ = ('stored_time', 'stored_value', 'held_time', 'held_value', 'upper', 'lower')
+    
+    def __init__(self, timestamp, value):
+        self.stored_time = timestamp
+        self.stored_value = value
+        self.held_time = None  # 旋转门：最近收到但尚未存储的采样
+        self.held_value = None
+        self.upper = None  # 旋转门：上门斜率
+        self.lower = None  # 旋转门：下门斜率
+
+
+class ExceptionFilter:
+    """例外报告过滤器，状态按 (device_id, property_id) 保存在内存中"""
+    
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+    
+    def reset(self, device_id=None, property_id=None):
+        """清除过滤状态（属性配置变化时调用）"""
+        with self._lock:
+            if device_id is None and property_id is None:
+                self._states.clear()
+                return
+            for key in [k for k in self._states
+                        if (device_id is None or k[0] == device_id) and (property_id is None or k[1] == property_id)]:
+                del self._states[key]
+    
+    def offer(self, device_id, property_id, config, value, timestamp):
+        """
+        提交一个采样，返回需要写入历史的 (timestamp, value) 列表
+        旋转门模式下返回的可能是之前暂存的转折点
+        """
+        if config is None:
+            return [(timestamp, value)]
+        key = (device_id, property_id)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                self._states[key] = _SeriesState(timestamp, value)
+                return [(timestamp, value)]
+            
+            number, stored = _to_float(value), _to_float(state.stored_value)
+            silent = config.max_silence and (timestamp - state.stored_time).total_seconds() >= config.max_silence
+            
+            # 非数值或未配置死区：值变化或心跳时存储
+            if number is None or stored is None or config.mode is None:
+                if silent or value != state.stored_value:
+                    self._store(state, timestamp, value)
+                    return [(timestamp, value)]
+                return []
+            
+            if config.mode == 'swinging_door':
+                return self._swinging_door(state, config, number, value, timestamp, silent)
+            
+            threshold = config.value
+            if config.mode == 'percent':
+                base = config.span if config.span else abs(stored)
+                threshold = base * config.value / 100.0
+            if silent or abs(number - stored) > threshold:
+                self._store(state, timestamp, value)
+                return [(timestamp, value)]
+            return []
+    
+    @staticmethod
+    def _store(state, timestamp, value):
+        state.stored_time = timestamp
+        state.stored_value = value
+        state.held_time = state.held_value = None
+        state.upper = state.lower = None
+    
+    def _swinging_door(self, state, config, number, value, timestamp, silent):
+        """旋转门压缩：新采样超出门限时存储上一个暂存点并以其为新的起点"""
+        rows = []
+        if silent:
+            if state.held_time is not None:
+                rows.append((state.held_time, state.held_value))
+            self._store(state, timestamp, value)
+            rows.append((timestamp, value))
+            return rows
+        
+        elapsed = (timestamp - state.stored_time).total_seconds()
+        if elapsed <= 0:
+            return rows
+        stored = float(state.stored_value)
+        upper = (number + config.value - stored) / elapsed
+        lower = (number - config.value - stored) / elapsed
+        new_upper = upper if state.upper is None else min(state.upper, upper)
+        new_lower = lower if state.lower is None else max(state.lower, lower)
+        
+        if new_lower > new_upper and state.held_time is not None:
+            # 门已打开：暂存点成为新的存储点，从它重新开始计算门限
+            rows.append((state.held_time, state.held_value))
+            held_time, held_value = state.held_time, state.held_value
+            self._store(state, held_time, held_value)
+            elapsed = (timestamp - held_time).total_seconds()
+            if elapsed > 0:
+                base = float(held_value)
+                state.upper = (number + config.value - base) / elapsed
+                state.lower = (number - config.value - base) / elapsed
+        else:
+            state.upper, state.lower = new_upper, new_lower
+        state.held_time, state.held_value = timestamp, value
+        return rows
+
+
+# 全局过滤器实例，采集服务和历史数据写入接口共用
+exception_filter = ExceptionFilter()
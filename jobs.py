@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+后台任务
+耗时的计算（数据分析、历史数据导入、批量诊断等）作为任务写入任务表，在独立的进程池中执行，
+不占用 Web 请求线程，NumPy 计算可以利用多个 CPU 核心。工作进程以较低的调度优先级运行，
+并保留一个核心给 Web 服务。任务的状态、进度和结果都写在任务表中，
+工作进程在报告进度时检查取消标记，请求取消的任务在下一次报告进度时终止。
+多进程部署时进程池只在运行时服务进程中运行，Web 工作进程经运行时 IPC 提交和取消任务（RemoteJobManager）。
+"""
+
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, Job
+from analysis_cache import run_project_analysis
+from history_import import import_history_workbook
+from diagnosis import evaluate_tree_batch
+from decision_backtest import MAX_INTERVALS, backtest_tree
+from features import extract_point_features
+from rollups import refresh_rollups, refresh_event_rollups, refresh_backdated
+from degradation import refresh_models, reset_models_since
+from kpi import clear_cache
+from correlation import run_correlation, limit_result
+from timeseries import parse_utc_time
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+# 工作进程的调度优先级增量（nice 值），让 Web 进程优先获得 CPU
+WORKER_NICENESS = 5
+
+# 进度写入数据库的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+# 任务类型 → 处理函数 handler(params, context)
+JOB_HANDLERS = {}
+
+# 可通过通用接口 POST /api/jobs 直接提交的任务类型 → 必填参数
+# history_import 等读取服务器文件的任务只能由各自的接口在校验路径后提交
+GENERIC_JOB_PARAMS = {
+    'analysis_run': ('project_id',),
+    'decision_tree_batch': ('tree_id', 'device_values'),
+    'decision_tree_backtest': ('tree_id', 'device_ids', 'start_time'),
+    'feature_extraction': ('device_id', 'property_id'),
+    'rollup_backfill': (),
+    'degradation_refresh': (),
+    'fleet_correlation': ('points',),
+}
+
+
+class JobCancelled(Exception):
+    """任务被取消"""
+
+
+class JobParamsError(ValueError):
+    """任务类型不允许通用提交或参数不完整"""
+
+
+def check_generic_job(job_type, params):
+    """校验通过通用接口提交的任务类型和参数"""
+    if job_type not in GENERIC_JOB_PARAMS:
+        raise JobParamsError(f'不支持通过此接口提交的任务类型: {job_type}')
+    if not isinstance(params, dict):
+        raise JobParamsError('params 必须是对象')
+    missing = [name for name in GENERIC_JOB_PARAMS[job_type] if params.get(name) in (None, '')]
+    if missing:
+        raise JobParamsError(f'缺少任务参数: {", ".join(missing)}')
+
+
+def job_handler(job_type):
+    """注册任务处理函数的装饰器"""
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+
+class JobContext:
+    """传给任务处理函数的上下文，用于报告进度和检查取消"""
+    
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._last_report = 0.0
+    
+    def _update(self, **values):
+        db.session.execute(db.update(Job).where(Job.id == self.job_id).values(**values))
+        db.session.commit()
+    
+    def check_cancelled(self):
+        cancelled = db.session.execute(
+            db.select(Job.cancel_requested).where(Job.id == self.job_id)
+        ).scalar()
+        if cancelled:
+            raise JobCancelled()
+    
+    def progress(self, done, total=None, message=None, force=False):
+        """
+        报告进度（done / total，或直接给出 0~1 的比例），按最小间隔节流写入；
+        任务已被请求取消时抛出 JobCancelled。处理函数应按批次而不是逐条记录调用
+        """
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            fraction = done / total if total else done
+            values = {'progress': max(0.0, min(1.0, float(fraction)))}
+            if message is not None:
+                values['message'] = message[:500]
+            self._update(**values)
+        self.check_cancelled()
+
+
+# 工作进程中的 Flask 应用
+_worker_app = None
+
+
+def _init_worker(app_import):
+    """工作进程初始化：导入 Flask 应用并降低调度优先级"""
+    global _worker_app
+    # 运行时服务进程中的任务工作进程像 Web 工作进程一样连接服务进程，不再创建运行时
+    if os.environ.get('RUNTIME_MODE') == 'service':
+        os.environ['RUNTIME_MODE'] = 'remote'
+    module_name, _, attribute = app_import.partition(':')
+    _worker_app = getattr(importlib.import_module(module_name), attribute)
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(WORKER_NICENESS)
+        except OSError:
+            pass
+
+
+def _finish(job_id, status, **values):
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(
+        status=status, finished_at=datetime.utcnow(), **values
+    ))
+    db.session.commit()
+
+
+def execute_job(job_id, job_type, params, app=None):
+    """在工作进程（或指定应用的当前进程）中执行任务，状态和结果写入任务表"""
+    app = app or _worker_app
+    with app.app_context():
+        try:
+            job = db.session.get(Job, job_id)
+            if job is None or job.status != PENDING:
+                return
+            if job.cancel_requested:
+                _finish(job_id, CANCELLED, message='任务已取消')
+                return
+            job.status = RUNNING
+            job.started_at = datetime.utcnow()
+            db.session.commit()
+            
+            handler = JOB_HANDLERS.get(job_type)
+            if handler is None:
+                _finish(job_id, FAILED, error=f'未知的任务类型: {job_type}')
+                return
+            context = JobContext(job_id)
+            try:
+                result = handler(params, context)
+            except JobCancelled:
+                db.session.rollback()
+                _finish(job_id, CANCELLED, message='任务已取消')
+                return
+            except Exception as e:
+                db.session.rollback()
+                logger.exception(f"任务 {job_id} ({job_type}) 执行失败")
+                _finish(job_id, FAILED, error=str(e))
+                return
+            _finish(job_id, SUCCEEDED, progress=1.0, result=json.dumps(result, ensure_ascii=False, default=str))
+        finally:
+            db.session.remove()
+
+
+class JobManager:
+    """任务提交、取消和进程池管理（单进程部署时在 Web 进程中，多进程部署时在运行时服务进程中）"""
+    
+    def __init__(self, app, max_workers=None, app_import='app:app'):
+        self.app = app
+        self.app_import = app_import
+        # 保留一个核心给 Web 服务
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.started = False
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """创建进程池，并把上次服务退出时未完成的任务标记为失败"""
+        with self._lock:
+            if self.started:
+                return
+            with self.app.app_context():
+                db.session.execute(db.update(Job).where(Job.status.in_([PENDING, RUNNING])).values(
+                    status=FAILED, error='服务重启，任务中断', finished_at=datetime.utcnow()
+                ))
+                db.session.commit()
+            # spawn 方式启动工作进程，不继承 Web 进程中的线程和数据库连接
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.app_import,)
+            )
+            self.started = True
+        logger.info(f"后台任务进程池已启动: {self.max_workers} 个工作进程")
+    
+    def stop(self, wait=True):
+        """关闭进程池，未开始的任务被取消"""
+        with self._lock:
+            if not self.started:
+                return
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+            self.started = False
+    
+    def submit(self, job_type, params=None):
+        """创建任务记录并提交到进程池，返回任务记录（需在应用上下文中调用）"""
+        if job_type not in JOB_HANDLERS:
+            raise ValueError(f'未知的任务类型: {job_type}')
+        if not self.started:
+            self.start()
+        params = params or {}
+        job = Job(job_type=job_type, status=PENDING, params=json.dumps(params, ensure_ascii=False, default=str))
+        db.session.add(job)
+        db.session.commit()
+        
+        future = self._executor.submit(execute_job, job.id, job_type, params)
+        with self._lock:
+            self._futures[job.id] = future
+        future.add_done_callback(lambda f, job_id=job.id: self._on_done(job_id, f))
+        return job
+    
+    def _on_done(self, job_id, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            return
+        # 工作进程异常退出等情况，任务自身没有机会写入状态
+        logger.error(f"任务 {job_id} 执行异常: {error}")
+        with self.app.app_context():
+            try:
+                db.session.execute(db.update(Job).where(
+                    Job.id == job_id, Job.status.in_([PENDING, RUNNING])
+                ).values(status=FAILED, error=str(error) or type(error).__name__, finished_at=datetime.utcnow()))
+                db.session.commit()
+            finally:
+                db.session.remove()
+    
+    def cancel(self, job_id):
+        """
+        取消任务（需在应用上下文中调用）：尚未开始的任务直接取消，
+        运行中的任务设置取消标记，在下一次报告进度时终止。返回任务记录，不存在时返回 None
+        """
+        job = db.session.get(Job, job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            return job
+        with self._lock:
+            future = self._futures.get(job_id)
+        job.cancel_requested = True
+        if future is not None and future.cancel():
+            job.status = CANCELLED
+            job.message = '任务已取消'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return job
+    
+    def status(self):
+        with self._lock:
+            return {
+                'running': self.started,
+                'workers': self.max_workers,
+                'active': len(self._futures)
+            }
+
+
+class RemoteJobManager:
+    """
+    多进程部署时 Web 工作进程中的任务管理：提交和取消经运行时 IPC 转发到服务进程中的 JobManager，
+    各工作进程不创建自己的进程池，也不会在启动时把其他进程的任务当作中断的任务
+    """
+    
+    started = True
+    
+    def __init__(self, runtime):
+        self.runtime = runtime
+    
+    def start(self):
+        """进程池由服务进程启动"""
+    
+    def stop(self, wait=True):
+        """进程池由服务进程关闭"""
+    
+    def submit(self, job_type, params=None):
+        """提交任务，返回任务记录（需在应用上下文中调用）"""
+        if job_type not in JOB_HANDLERS:
+            raise ValueError(f'未知的任务类型: {job_type}')
+        job_id = self.runtime.submit_job(job_type, params or {})
+        return db.session.get(Job, job_id)
+    
+    def cancel(self, job_id):
+        """取消任务，返回任务记录，不存在时返回 None（需在应用上下文中调用）"""
+        self.runtime.cancel_job(job_id)
+        return db.session.get(Job, job_id, populate_existing=True)
+    
+    def status(self):
+        return self.runtime.job_pool_status()
+
+
+def apply_backfilled_history(earliest):
+    """
+    补录历史（导入文件、迟到或带历史时间戳的写入）后：从补录的最早时段起重算受影响点位的汇总，
+    清除此后结束的 KPI 周期缓存，已并入这些时段的劣化模型从头重新拟合
+    earliest: {(device_id, property_id): 补录的最早时刻}，返回 {'points', 'cleared', 'models_reset'}
+    """
+    affected = refresh_backdated(earliest)
+    summary = {'points': len(affected), 'cleared': 0, 'models_reset': 0}
+    if affected:
+        summary['models_reset'] = reset_models_since(affected)
+    db.session.commit()
+    if affected:
+        summary['cleared'] = clear_cache(since=min(affected.values()))
+    return summary
+
+
+# 任务处理函数
+
+
+@job_handler('analysis_run')
+def run_analysis_job(params, context):
+    """执行数据分析项目的分析实例"""
+    return run_project_analysis(params['project_id'], params.get('options') or {}, context.progress)
+
+
+@job_handler('history_import')
+def run_history_import_job(params, context):
+    """从上传的 Excel 文件导入历史数据（文件必须位于上传目录中）"""
+    folder = os.path.realpath(current_app.config['UPLOAD_FOLDER'])
+    path = os.path.realpath(params['filepath'])
+    if os.path.commonpath([folder, path]) != folder:
+        raise ValueError('导入文件必须位于上传目录中')
+    earliest = {}
+    result = import_history_workbook(path, context.progress, earliest=earliest)
+    result['backfill'] = apply_backfilled_history(earliest)
+    return result
+
+
+@job_handler('decision_tree_batch')
+def run_decision_tree_batch_job(params, context):
+    """对一批设备求值决策树，可选保存为诊断记录"""
+    at = parse_utc_time(params.get('timestamp'))
+    device_values = {int(device_id): values for device_id, values in params['device_values'].items()}
+    return evaluate_tree_batch(params['tree_id'], device_values, at, params.get('save', False), context.progress)
+
+
+@job_handler('decision_tree_backtest')
+def run_decision_tree_backtest_job(params, context):
+    """在历史数据上回测决策树，统计各设备的叶子命中次数和时间段"""
+    start = parse_utc_time(params['start_time'])
+    end = parse_utc_time(params.get('end_time'))
+    result = backtest_tree(
+        params['tree_id'], params['device_ids'], start, end, params.get('step'),
+        params.get('max_intervals', MAX_INTERVALS), context.progress
+    )
+    if result is None:
+        raise ValueError('决策树不存在')
+    return result
+
+
+@job_handler('feature_extraction')
+def run_feature_extraction_job(params, context):
+    """提取点位的状态监测特征并保存为派生序列"""
+    start = parse_utc_time(params.get('start_time'))
+    end = parse_utc_time(params.get('end_time'))
+    return extract_point_features(
+        params['device_id'], params['property_id'], params.get('config') or {}, start, end, context.progress
+    )
+
+
+@job_handler('rollup_backfill')
+def run_rollup_backfill_job(params, context):
+    """回填（或增量刷新）属性和事件历史的小时汇总，重算全部历史后清除 KPI 周期结果缓存"""
+    points = [tuple(point) for point in params['points']] if params.get('points') else None
+    full = params.get('full', False)
+    summary = refresh_rollups(points, full, context.progress)
+    if points is None:
+        events = refresh_event_rollups(None, full, context.progress)
+        summary['events'] = events['events']
+        summary['buckets'] += events['buckets']
+    if full:
+        summary['cleared'] = clear_cache()
+    return summary
+
+
+@job_handler('degradation_refresh')
+def run_degradation_refresh_job(params, context):
+    """增量刷新全部劣化模型和剩余寿命预测"""
+    return refresh_models(progress=context.progress)
+
+
+@job_handler('fleet_correlation')
+def run_fleet_correlation_job(params, context):
+    """计算大规模相关系数矩阵和滞后相关，结果写入缓存"""
+    start = parse_utc_time(params.get('start_time'))
+    end = parse_utc_time(params.get('end_time'))
+    result, status, correlation = run_correlation(
+        params['points'], start, end, params.get('step'), params.get('max_lag'), params.get('target'),
+        params.get('refresh', False), context.progress
+    )
+    result = limit_result(result, correlation, params.get('top_k', 20))
+    result['cache_status'] = status
+    return result
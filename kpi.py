@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+KPI 引擎
+KPI 以声明方式定义：输入是属性（sum、count、avg、min、max）或事件（triggered_time、transitions）
+在统计周期内的聚合，表达式对输入别名和 period（统计秒数）做算术运算，例如可用率 1 - fault / period、
+单位产量能耗 energy / output。表达式使用事件条件引擎的语法树，按设备数组整体求值。
+输入从汇总表按点位分组查询得到（整日部分读取日汇总，首尾不足一日的部分读取小时汇总）；设备类型和全部设备的 KPI 先合并各设备的输入
+（总和与秒数相加、均值按计数加权、最值取最值）再代入表达式，得到的是合并后的比值而不是设备 KPI 的平均。
+统计周期按整点对齐，已结束周期的结果按定义哈希缓存，月度报表直接读取缓存。
+"""
+
+import ast
+import hashlib
+import json
+import keyword
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from models import db, Device, DeviceType, DeviceProperty, DeviceEvent, KpiPeriodCache
+from models import PropertyRollup, PropertyDailyRollup, EventRollup, EventDailyRollup
+from event_engine import ConditionError, parse_condition, compile_tree
+from rollups import ROLLUP_SECONDS, floor_bucket, floor_day, complete_before, refresh_rollups, refresh_event_rollups
+
+
+# 输入来源及其支持的周期聚合
+PROPERTY_AGGREGATES = ('sum', 'count', 'avg', 'min', 'max')
+EVENT_AGGREGATES = ('triggered_time', 'transitions')
+SOURCES = {'property': PROPERTY_AGGREGATES, 'event': EVENT_AGGREGATES}
+
+# 表达式中表示统计秒数的变量（合并时为各设备统计秒数之和）
+PERIOD_VARIABLE = 'period'
+
+
+class KpiError(ValueError):
+    """KPI 定义不合法"""
+
+
+class KpiInput:
+    """KPI 的一个输入：某个属性或事件标识符在统计周期内的聚合"""
+    
+    __slots__ = ('alias', 'source', 'identifier', 'aggregate')
+    
+    def __init__(self, alias, source, identifier, aggregate):
+        self.alias = alias
+        self.source = source
+        self.identifier = identifier
+        self.aggregate = aggregate
+    
+    def to_dict(self):
+        return {'source': self.source, 'identifier': self.identifier, 'aggregate': self.aggregate}
+
+
+def parse_inputs(inputs):
+    """解析输入定义 {别名: {source, identifier, aggregate}}（JSON 文本或字典），返回 [KpiInput]"""
+    if isinstance(inputs, str):
+        try:
+            inputs = json.loads(inputs) if inputs.strip() else {}
+        except ValueError:
+            raise KpiError('输入定义不是合法的 JSON')
+    if not isinstance(inputs, dict) or not inputs:
+        raise KpiError('请至少定义一个输入')
+    
+    parsed = []
+    for alias, spec in inputs.items():
+        if not alias.isidentifier() or keyword.iskeyword(alias) or alias == PERIOD_VARIABLE:
+            raise KpiError(f'输入别名不合法: {alias}')
+        if not isinstance(spec, dict):
+            raise KpiError(f'输入 {alias} 的定义格式错误')
+        source = spec.get('source')
+        identifier = (spec.get('identifier') or '').strip()
+        aggregate = spec.get('aggregate')
+        if source not in SOURCES:
+            raise KpiError(f'输入 {alias} 的来源必须是 property 或 event')
+        if not identifier:
+            raise KpiError(f'输入 {alias} 缺少标识符')
+        if aggregate not in SOURCES[source]:
+            raise KpiError(f"输入 {alias} 的聚合必须是 {', '.join(SOURCES[source])} 之一")
+        parsed.append(KpiInput(alias, source, identifier, aggregate))
+    return parsed
+
+
+def _check_arithmetic(tree):
+    """KPI 表达式只允许数值常量、变量和算术运算"""
+    kind = tree[0]
+    if kind == 'const':
+        if isinstance(tree[1], (bool, str)):
+            raise KpiError('KPI 表达式只能包含数值常量')
+    elif kind == 'unary':
+        if tree[1] is ast.Not:
+            raise KpiError('KPI 表达式不支持逻辑运算')
+        _check_arithmetic(tree[2])
+    elif kind == 'bin':
+        _check_arithmetic(tree[2])
+        _check_arithmetic(tree[3])
+    elif kind == 'agg':
+        raise KpiError('KPI 表达式不支持时间窗口聚合，请在输入中定义周期聚合')
+    elif kind != 'var':
+        raise KpiError('KPI 表达式只支持算术运算')
+
+
+class CompiledKpi:
+    """编译后的 KPI 定义"""
+    
+    __slots__ = ('definition', 'inputs', 'evaluate', 'hash')
+    
+    def __init__(self, definition):
+        self.definition = definition
+        self.inputs = parse_inputs(definition.inputs)
+        expression = (definition.expression or '').strip()
+        if not expression:
+            raise KpiError('请填写 KPI 表达式')
+        try:
+            condition = parse_condition(expression)
+        except ConditionError as e:
+            raise KpiError(str(e))
+        _check_arithmetic(condition.tree)
+        unknown = condition.variables - {item.alias for item in self.inputs} - {PERIOD_VARIABLE}
+        if unknown:
+            raise KpiError(f"表达式引用了未定义的输入: {', '.join(sorted(unknown))}")
+        self.evaluate = compile_tree(condition.tree, {})
+        content = json.dumps([
+            {item.alias: item.to_dict() for item in self.inputs}, expression, definition.device_type_id
+        ], sort_keys=True)
+        self.hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def compile_kpi(definition):
+    """校验并编译 KPI 定义，定义不合法时抛出 KpiError"""
+    return CompiledKpi(definition)
+
+
+class KpiScope:
+    """KPI 适用的设备类型 [(ID, 名称)]、设备 [(ID, 名称)] 及每台设备上各输入对应的属性或事件ID"""
+    
+    def __init__(self, kpi):
+        if kpi.definition.device_type_id:
+            device_type = DeviceType.query.get(kpi.definition.device_type_id)
+            if not device_type:
+                raise KpiError('KPI 的设备类型不存在')
+            device_types = [device_type]
+        else:
+            device_types = DeviceType.query.order_by(DeviceType.id).all()
+        
+        self.types = []
+        # 每个输入在各设备类型下对应的属性或事件ID
+        point_ids = {item.alias: {} for item in kpi.inputs}
+        for device_type in device_types:
+            properties = {prop.identifier: prop.id for prop in DeviceProperty.query.filter_by(device_type_id=device_type.id)}
+            events = {event.identifier: event.id for event in DeviceEvent.query.filter_by(device_type_id=device_type.id)}
+            lookup = {'property': properties, 'event': events}
+            missing = [item.identifier for item in kpi.inputs if item.identifier not in lookup[item.source]]
+            if missing:
+                if kpi.definition.device_type_id:
+                    raise KpiError(f"设备类型 {device_type.name} 缺少输入: {', '.join(missing)}")
+                continue
+            for item in kpi.inputs:
+                point_ids[item.alias][device_type.id] = lookup[item.source][item.identifier]
+            self.types.append((device_type.id, device_type.name))
+        
+        # 只保留ID和名称（不持有 ORM 对象，提交缓存结果后不必重新加载）
+        type_index = {name: index for index, (_, name) in enumerate(self.types)}
+        devices = db.session.execute(
+            db.select(Device.id, Device.name, Device.type).where(Device.type.in_(list(type_index))).order_by(Device.id)
+        ).all() if self.types else []
+        self.devices = [(device_id, name) for device_id, name, _ in devices]
+        # 每台设备所属设备类型在 self.types 中的下标
+        self.groups = np.array([type_index[type_name] for _, _, type_name in devices], dtype=np.int64)
+        self.rows = {device_id: row for row, (device_id, _) in enumerate(self.devices)}
+        self.points = {}
+        for item in kpi.inputs:
+            by_type = point_ids[item.alias]
+            self.points[item.alias] = np.array([
+                by_type[self.types[group][0]] for group in self.groups
+            ], dtype=np.int64)
+    
+    def point_pairs(self, source, inputs):
+        """该来源的输入涉及的全部 (设备ID, 属性或事件ID)"""
+        pairs = set()
+        for item in inputs:
+            if item.source == source:
+                pairs.update(zip([device_id for device_id, _ in self.devices], self.points[item.alias].tolist()))
+        return sorted(pairs)
+
+
+def _point_rows(scope, alias, device_ids, point_ids):
+    """查询结果行对应的设备下标，点位不属于该输入时为 -1"""
+    rows = np.array([scope.rows.get(device_id, -1) for device_id in device_ids], dtype=np.int64)
+    valid = rows >= 0
+    valid[valid] = scope.points[alias][rows[valid]] == np.asarray(point_ids)[valid]
+    return np.where(valid, rows, -1)
+
+
+def period_segments(start, end):
+    """把整点对齐的周期拆为日汇总覆盖的整日区间和首尾不足一日的小时区间 [(粒度, 起始, 结束)]"""
+    first_day = floor_day(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = floor_day(end)
+    if first_day >= last_day:
+        return [('hourly', start, end)]
+    segments = [('daily', first_day, last_day)]
+    if start < first_day:
+        segments.append(('hourly', start, first_day))
+    if last_day < end:
+        segments.append(('hourly', last_day, end))
+    return segments
+
+
+# 各输入来源在两种粒度下的汇总表、点位列和统计列
+ROLLUP_TABLES = {
+    'property': ({'hourly': PropertyRollup, 'daily': PropertyDailyRollup}, 'property_id', ('count', 'sum', 'min', 'max')),
+    'event': ({'hourly': EventRollup, 'daily': EventDailyRollup}, 'event_id', ('triggered_seconds', 'transitions'))
+}
+COLUMN_AGGREGATES = {'min': db.func.min, 'max': db.func.max}
+# 统计列合并到设备数组时的方式，及在输入统计量中的名称
+COLUMN_MERGE = {
+    'count': ('count', np.add),
+    'sum': ('sum', np.add),
+    'min': ('min', np.fmin),
+    'max': ('max', np.fmax),
+    'triggered_seconds': ('seconds', np.add),
+    'transitions': ('transitions', np.add)
+}
+
+
+def collect_inputs(kpi, scope, start, end):
+    """
+    从汇总表读取各设备在 [start, end) 内的输入统计量，整日部分读取日汇总，首尾不足一日的部分读取小时汇总
+    返回 {别名: {统计量: 设备数组}}，属性为 count/sum/min/max，事件为 seconds/transitions
+    """
+    size = len(scope.devices)
+    segments = period_segments(start, end)
+    stats = {}
+    for source, (tables, point_column, columns) in ROLLUP_TABLES.items():
+        items = [item for item in kpi.inputs if item.source == source]
+        if not items:
+            continue
+        point_ids = {int(point) for item in items for point in scope.points[item.alias]}
+        results = []
+        for granularity, begin, finish in segments:
+            table = tables[granularity].__table__
+            rows = db.session.execute(db.select(
+                table.c.device_id, table.c[point_column],
+                *[COLUMN_AGGREGATES.get(column, db.func.sum)(table.c[column]) for column in columns]
+            ).where(
+                table.c[point_column].in_(point_ids),
+                table.c.bucket_start >= begin,
+                table.c.bucket_start < finish
+            ).group_by(table.c.device_id, table.c[point_column])).all()
+            results.append(np.array([tuple(row) for row in rows], dtype=np.float64).reshape(-1, 2 + len(columns)))
+        
+        for item in items:
+            entry = {}
+            for column in columns:
+                name, _ = COLUMN_MERGE[column]
+                entry[name] = np.full(size, np.nan) if column in ('min', 'max') else np.zeros(size)
+            for result in results:
+                rows = _point_rows(scope, item.alias, result[:, 0].astype(np.int64), result[:, 1].astype(np.int64))
+                found = rows >= 0
+                for index, column in enumerate(columns):
+                    name, merge = COLUMN_MERGE[column]
+                    merge.at(entry[name], rows[found], result[found, 2 + index])
+            stats[item.alias] = entry
+    return stats
+
+
+def pool_inputs(stats, period, groups, size):
+    """按分组合并各设备的输入统计量：计数、总和和秒数相加，最值取最值"""
+    pooled = {}
+    for alias, entry in stats.items():
+        merged = {}
+        for name, values in entry.items():
+            if name in ('min', 'max'):
+                fill = np.inf if name == 'min' else -np.inf
+                result = np.full(size, fill)
+                (np.minimum if name == 'min' else np.maximum).at(result, groups, np.where(np.isnan(values), fill, values))
+                merged[name] = np.where(np.isinf(result), np.nan, result)
+            else:
+                merged[name] = np.bincount(groups, weights=values, minlength=size)
+        pooled[alias] = merged
+    return pooled, np.bincount(groups, weights=period, minlength=size)
+
+
+def input_values(kpi, stats, period):
+    """由统计量得到各输入的聚合值 {别名: 数组}，没有采样的属性聚合为 NaN"""
+    values = {PERIOD_VARIABLE: period}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for item in kpi.inputs:
+            entry = stats[item.alias]
+            if item.source == 'event':
+                values[item.alias] = entry['seconds'] if item.aggregate == 'triggered_time' else entry['transitions']
+            elif item.aggregate == 'count':
+                values[item.alias] = entry['count']
+            elif item.aggregate == 'avg':
+                values[item.alias] = np.where(entry['count'] > 0, entry['sum'] / entry['count'], np.nan)
+            elif item.aggregate == 'sum':
+                values[item.alias] = np.where(entry['count'] > 0, entry['sum'], np.nan)
+            else:
+                values[item.alias] = entry[item.aggregate]
+    return values
+
+
+def evaluate_kpi(kpi, values, size):
+    """按数组对表达式求值，除零等无意义的结果为 NaN"""
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        result = kpi.evaluate(values, ())
+    return np.broadcast_to(np.asarray(result, dtype=np.float64), (size,))
+
+
+def _number(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def _entries(kpi, values, results, rows):
+    return [
+        (_number(results[row]), {item.alias: _number(values[item.alias][row]) for item in kpi.inputs})
+        for row in rows
+    ]
+
+
+def align_period(start, end):
+    """统计周期对齐到整点：起点向下取整，终点向上取整"""
+    start = floor_bucket(start)
+    aligned_end = floor_bucket(end)
+    if aligned_end < end:
+        aligned_end += timedelta(seconds=ROLLUP_SECONDS)
+    if aligned_end <= start:
+        raise KpiError('统计周期的结束时间必须晚于开始时间')
+    return start, aligned_end
+
+
+def compute_period(kpi, scope, start, end, now=None):
+    """计算 [start, end) 内各设备、各设备类型和全部设备的 KPI"""
+    now = now or datetime.utcnow()
+    size = len(scope.devices)
+    stats = collect_inputs(kpi, scope, start, end)
+    # 统计秒数截止到当前时刻（未结束的周期只统计已经过去的部分）
+    seconds = max(0.0, (min(end, now) - start).total_seconds())
+    period = np.full(size, seconds)
+    
+    device_values = input_values(kpi, stats, period)
+    device_results = evaluate_kpi(kpi, device_values, size)
+    pooled, pooled_period = pool_inputs(stats, period, scope.groups, len(scope.types))
+    type_values = input_values(kpi, pooled, pooled_period)
+    type_results = evaluate_kpi(kpi, type_values, len(scope.types))
+    fleet, fleet_period = pool_inputs(stats, period, np.zeros(size, dtype=np.int64), 1)
+    fleet_values = input_values(kpi, fleet, fleet_period)
+    fleet_result = evaluate_kpi(kpi, fleet_values, 1)
+    type_counts = np.bincount(scope.groups, minlength=len(scope.types))
+    
+    fleet_value, fleet_inputs = _entries(kpi, fleet_values, fleet_result, [0])[0]
+    return {
+        'kpi_id': kpi.definition.id,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'fleet': {
+            'value': fleet_value,
+            'devices': size,
+            'inputs': fleet_inputs
+        },
+        'types': [
+            {
+                'device_type_id': type_id,
+                'device_type_name': type_name,
+                'devices': int(type_counts[index]),
+                'value': value,
+                'inputs': inputs
+            }
+            for index, ((type_id, type_name), (value, inputs)) in enumerate(zip(
+                scope.types, _entries(kpi, type_values, type_results, range(len(scope.types)))
+            ))
+        ],
+        'devices': [
+            {
+                'device_id': device_id,
+                'device_name': device_name,
+                'device_type_id': scope.types[scope.groups[row]][0],
+                'value': value,
+                'inputs': inputs
+            }
+            for row, ((device_id, device_name), (value, inputs)) in enumerate(zip(
+                scope.devices, _entries(kpi, device_values, device_results, range(size))
+            ))
+        ]
+    }
+
+
+def refresh_inputs(kpi, scope):
+    """增量刷新 KPI 输入涉及的属性和事件小时汇总"""
+    refresh_rollups(scope.point_pairs('property', kpi.inputs))
+    refresh_event_rollups(scope.point_pairs('event', kpi.inputs))
+
+
+def _cached(kpi, start, end):
+    entry = KpiPeriodCache.query.filter_by(
+        kpi_id=kpi.definition.id, definition_hash=kpi.hash, period_start=start, period_end=end
+    ).first()
+    return json.loads(entry.result) if entry else None
+
+
+def _store(kpi, start, end, result):
+    db.session.add(KpiPeriodCache(
+        kpi_id=kpi.definition.id,
+        definition_hash=kpi.hash,
+        period_start=start,
+        period_end=end,
+        result=json.dumps(result, ensure_ascii=False)
+    ))
+    db.session.commit()
+
+
+def period_result(definition, start, end, now=None, scope=None, refresh=True):
+    """
+    计算一个统计周期的 KPI（周期先对齐到整点）
+    已结束的周期先查缓存，未命中时刷新输入汇总（refresh 为假时直接读取汇总表）、计算并写入缓存；
+    未结束的周期每次重新计算
+    """
+    kpi = compile_kpi(definition)
+    now = now or datetime.utcnow()
+    start, end = align_period(start, end)
+    closed = end <= complete_before(now)
+    if closed:
+        result = _cached(kpi, start, end)
+        if result is not None:
+            result['cached'] = True
+            return result
+    
+    scope = scope or KpiScope(kpi)
+    if refresh:
+        refresh_inputs(kpi, scope)
+    result = compute_period(kpi, scope, start, end, now)
+    if closed:
+        _store(kpi, start, end, result)
+    result['cached'] = False
+    return result
+
+
+def month_periods(month, months):
+    """从 month（'YYYY-MM'）起连续 months 个自然月 [(标签, 起始, 结束)]"""
+    try:
+        year, number = (int(part) for part in month.split('-')[:2])
+        current = datetime(year, number, 1)
+    except (AttributeError, ValueError):
+        raise KpiError(f'月份格式错误: {month}，应为 YYYY-MM')
+    if months < 1:
+        raise KpiError('月数至少为 1')
+    periods = []
+    for _ in range(months):
+        following = datetime(current.year + current.month // 12, current.month % 12 + 1, 1)
+        periods.append((current.strftime('%Y-%m'), current, following))
+        current = following
+    return periods
+
+
+def _change(current, previous):
+    if current is None or previous is None:
+        return None, None
+    ratio = (current - previous) / abs(previous) if previous else None
+    return current - previous, ratio
+
+
+def monthly_report(definition, month, months, now=None, refresh=True):
+    """
+    月度报表：各月全部设备和各设备类型的 KPI 及相对上月的变化
+    已结束的月份读取缓存；只要有未缓存的月份，就先刷新一次输入汇总（refresh 为假时直接读取汇总表）再逐月计算
+    """
+    kpi = compile_kpi(definition)
+    now = now or datetime.utcnow()
+    periods = [(label, start, end) for label, start, end in month_periods(month, months) if start < now]
+    
+    results = {}
+    for label, start, end in periods:
+        if end <= complete_before(now):
+            cached = _cached(kpi, start, end)
+            if cached is not None:
+                results[label] = cached
+    scope = None
+    if len(results) < len(periods):
+        scope = KpiScope(kpi)
+        if refresh:
+            refresh_inputs(kpi, scope)
+    
+    rows = []
+    previous = None
+    for label, start, end in periods:
+        result = results.get(label)
+        cached = result is not None
+        if not cached:
+            result = period_result(definition, start, end, now, scope, refresh=False)
+        fleet_value = result['fleet']['value']
+        change, ratio = _change(fleet_value, previous)
+        rows.append({
+            'month': label,
+            'start': result['start'],
+            'end': result['end'],
+            'cached': cached,
+            'fleet': result['fleet'],
+            'types': result['types'],
+            'change': change,
+            'change_ratio': ratio
+        })
+        previous = fleet_value
+    return {
+        'kpi_id': definition.id,
+        'months': rows
+    }
+
+
+def clear_cache(kpi_id=None, since=None):
+    """
+    清除 KPI 周期结果缓存（定义修改、历史数据补录或汇总重算后调用），返回删除的行数
+    since 指定时只清除在该时刻之后结束的周期（补录的历史不影响更早结束的周期）
+    """
+    query = KpiPeriodCache.query
+    if kpi_id is not None:
+        query = query.filter_by(kpi_id=kpi_id)
+    if since is not None:
+        query = query.filter(KpiPeriodCache.period_end > since)
+    deleted = query.delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,42 @@
+"""为设备属性添加死区（例外报告）配置字段的迁移脚本"""
+
+def upgrade():
+    """添加 deadband_mode、deadband_value、max_silence 字段到 device_properties 表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    columns = [
+        ('deadband_mode', 'VARCHAR(20)'),
+        ('deadband_value', 'FLOAT'),
+        ('max_silence', 'INTEGER')
+    ]
+    
+    try:
+        for name, column_type in columns:
+            try:
+                cursor.execute(f"ALTER TABLE device_properties ADD COLUMN {name} {column_type}")
+                print(f"成功添加 {name} 字段到 device_properties 表")
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" in str(e):
+                    print(f"字段 {name} 已存在，无需添加")
+                else:
+                    print(f"添加字段时出错: {e}")
+        conn.commit()
+    finally:
+        conn.close()
+
+def downgrade():
+    """降级操作 - 注意：SQLite 不支持直接删除列"""
+    print("注意：SQLite 不支持直接删除列操作")
+    print("如需降级，请手动重建表结构")
+
+if __name__ == '__main__':
+    upgrade()
@@ -0,0 +1,77 @@
+"""创建决策树诊断记录表的迁移脚本"""
+
+def upgrade():
+    """创建决策树诊断记录表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建决策树诊断记录表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS diagnosis_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                tree_id INTEGER NOT NULL,
+                event_id INTEGER,
+                leaf_node_id INTEGER,
+                result TEXT,
+                path TEXT,
+                error TEXT,
+                timestamp DATETIME NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (tree_id) REFERENCES decision_trees (id),
+                FOREIGN KEY (event_id) REFERENCES device_events (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_diagnosis_records_device_id ON diagnosis_records (device_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_diagnosis_records_tree_id ON diagnosis_records (tree_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_diagnosis_records_timestamp ON diagnosis_records (timestamp)")
+        conn.commit()
+        print("决策树诊断记录表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建决策树诊断记录表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除决策树诊断记录表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除决策树诊断记录表
+        cursor.execute("DROP TABLE IF EXISTS diagnosis_records")
+        conn.commit()
+        print("决策树诊断记录表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除决策树诊断记录表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""创建数据分析结果缓存表的迁移脚本"""
+
+def upgrade():
+    """创建数据分析结果缓存表，并为历史数据添加按点位和时间的复合索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建数据分析结果缓存表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_result_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cache_key VARCHAR(64) NOT NULL UNIQUE,
+                project_id INTEGER,
+                instance_id VARCHAR(100),
+                as_of DATETIME NOT NULL,
+                fingerprint TEXT NOT NULL,
+                state TEXT NOT NULL,
+                result TEXT NOT NULL,
+                result_id INTEGER,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (project_id) REFERENCES data_analysis_projects (id),
+                FOREIGN KEY (result_id) REFERENCES data_analysis_results (id)
+            )
+        ''')
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_analysis_result_cache_cache_key ON analysis_result_cache (cache_key)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_analysis_result_cache_project_id ON analysis_result_cache (project_id)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_property_histories_point_time "
+            "ON property_histories (device_id, property_id, timestamp)"
+        )
+        conn.commit()
+        print("数据分析结果缓存表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建数据分析结果缓存表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除数据分析结果缓存表和复合索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除数据分析结果缓存表
+        cursor.execute("DROP TABLE IF EXISTS analysis_result_cache")
+        cursor.execute("DROP INDEX IF EXISTS ix_property_histories_point_time")
+        conn.commit()
+        print("数据分析结果缓存表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除数据分析结果缓存表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -0,0 +1,75 @@
+"""创建后台任务表的迁移脚本"""
+
+def upgrade():
+    """创建后台任务表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建后台任务表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type VARCHAR(50) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                params TEXT,
+                progress FLOAT NOT NULL DEFAULT 0,
+                message VARCHAR(500),
+                result TEXT,
+                error TEXT,
+                cancel_requested BOOLEAN NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                started_at DATETIME,
+                finished_at DATETIME
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_jobs_job_type ON jobs (job_type)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status)")
+        conn.commit()
+        print("后台任务表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建后台任务表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除后台任务表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除后台任务表
+        cursor.execute("DROP TABLE IF EXISTS jobs")
+        conn.commit()
+        print("后台任务表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除后台任务表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -0,0 +1,73 @@
+"""创建派生序列表的迁移脚本"""
+
+def upgrade():
+    """创建派生序列表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建派生序列表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS derived_series_points (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                property_id INTEGER NOT NULL,
+                name VARCHAR(100) NOT NULL,
+                timestamp DATETIME NOT NULL,
+                value FLOAT NOT NULL,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (property_id) REFERENCES device_properties (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_derived_series_points_series_time "
+            "ON derived_series_points (device_id, property_id, name, timestamp)"
+        )
+        conn.commit()
+        print("派生序列表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建派生序列表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除派生序列表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除派生序列表
+        cursor.execute("DROP TABLE IF EXISTS derived_series_points")
+        conn.commit()
+        print("派生序列表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除派生序列表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -0,0 +1,110 @@
+"""创建属性小时汇总表和劣化模型表的迁移脚本"""
+
+def upgrade():
+    """创建属性小时汇总表和劣化模型表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建属性小时汇总表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS property_rollups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                property_id INTEGER NOT NULL,
+                bucket_start DATETIME NOT NULL,
+                count INTEGER NOT NULL,
+                sum FLOAT NOT NULL,
+                min FLOAT NOT NULL,
+                max FLOAT NOT NULL,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (property_id) REFERENCES device_properties (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_property_rollups_point_bucket "
+            "ON property_rollups (device_id, property_id, bucket_start)"
+        )
+        
+        # 创建劣化模型表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS degradation_models (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                property_id INTEGER NOT NULL,
+                series VARCHAR(100),
+                model_type VARCHAR(20) NOT NULL DEFAULT 'linear',
+                threshold FLOAT,
+                direction VARCHAR(10),
+                origin DATETIME,
+                last_bucket DATETIME,
+                segment_start DATETIME,
+                samples INTEGER NOT NULL DEFAULT 0,
+                theta_a FLOAT NOT NULL DEFAULT 0,
+                theta_b FLOAT NOT NULL DEFAULT 0,
+                p_aa FLOAT,
+                p_ab FLOAT,
+                p_bb FLOAT,
+                residual_ss FLOAT NOT NULL DEFAULT 0,
+                outlier_run INTEGER NOT NULL DEFAULT 0,
+                level FLOAT,
+                slope FLOAT,
+                "limit" FLOAT,
+                rul_hours FLOAT,
+                predicted_failure_at DATETIME,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (property_id) REFERENCES device_properties (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_degradation_models_device_id ON degradation_models (device_id)")
+        conn.commit()
+        print("属性小时汇总表和劣化模型表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建属性小时汇总表和劣化模型表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除属性小时汇总表和劣化模型表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除属性小时汇总表和劣化模型表
+        cursor.execute("DROP TABLE IF EXISTS degradation_models")
+        cursor.execute("DROP TABLE IF EXISTS property_rollups")
+        conn.commit()
+        print("属性小时汇总表和劣化模型表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除属性小时汇总表和劣化模型表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -0,0 +1,176 @@
+"""创建事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表的迁移脚本"""
+
+def upgrade():
+    """创建事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建事件小时汇总表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_rollups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                event_id INTEGER NOT NULL,
+                bucket_start DATETIME NOT NULL,
+                triggered_seconds FLOAT NOT NULL,
+                transitions INTEGER NOT NULL,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (event_id) REFERENCES device_events (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_event_rollups_point_bucket "
+            "ON event_rollups (device_id, event_id, bucket_start)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_event_rollups_event_bucket "
+            "ON event_rollups (event_id, bucket_start)"
+        )
+        
+        # 按属性和时段查询属性小时汇总（KPI 统计不限定设备）
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_property_rollups_property_bucket "
+            "ON property_rollups (property_id, bucket_start)"
+        )
+        
+        # 创建属性日汇总表，并由已有的小时汇总合并
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS property_daily_rollups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                property_id INTEGER NOT NULL,
+                bucket_start DATETIME NOT NULL,
+                count INTEGER NOT NULL,
+                sum FLOAT NOT NULL,
+                min FLOAT NOT NULL,
+                max FLOAT NOT NULL,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (property_id) REFERENCES device_properties (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_property_daily_rollups_point_bucket "
+            "ON property_daily_rollups (device_id, property_id, bucket_start)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_property_daily_rollups_property_bucket "
+            "ON property_daily_rollups (property_id, bucket_start)"
+        )
+        cursor.execute('''
+            INSERT OR IGNORE INTO property_daily_rollups (device_id, property_id, bucket_start, count, sum, min, max)
+            SELECT device_id, property_id, strftime('%Y-%m-%d 00:00:00.000000', bucket_start) AS day,
+                   SUM(count), SUM(sum), MIN(min), MAX(max)
+            FROM property_rollups
+            GROUP BY device_id, property_id, day
+        ''')
+        
+        # 创建事件日汇总表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_daily_rollups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id INTEGER NOT NULL,
+                event_id INTEGER NOT NULL,
+                bucket_start DATETIME NOT NULL,
+                triggered_seconds FLOAT NOT NULL,
+                transitions INTEGER NOT NULL,
+                FOREIGN KEY (device_id) REFERENCES devices (id),
+                FOREIGN KEY (event_id) REFERENCES device_events (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_event_daily_rollups_point_bucket "
+            "ON event_daily_rollups (device_id, event_id, bucket_start)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_event_daily_rollups_event_bucket "
+            "ON event_daily_rollups (event_id, bucket_start)"
+        )
+        
+        # 创建 KPI 定义表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kpi_definitions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(100) NOT NULL,
+                identifier VARCHAR(100) NOT NULL UNIQUE,
+                description TEXT,
+                unit VARCHAR(50),
+                device_type_id INTEGER,
+                inputs TEXT NOT NULL,
+                expression VARCHAR(500) NOT NULL,
+                created_at DATETIME,
+                updated_at DATETIME,
+                FOREIGN KEY (device_type_id) REFERENCES device_types (id)
+            )
+        ''')
+        
+        # 创建 KPI 周期结果缓存表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kpi_period_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kpi_id INTEGER NOT NULL,
+                definition_hash VARCHAR(64) NOT NULL,
+                period_start DATETIME NOT NULL,
+                period_end DATETIME NOT NULL,
+                result TEXT NOT NULL,
+                created_at DATETIME NOT NULL,
+                FOREIGN KEY (kpi_id) REFERENCES kpi_definitions (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_kpi_period_cache_period "
+            "ON kpi_period_cache (kpi_id, definition_hash, period_start, period_end)"
+        )
+        conn.commit()
+        print("事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 删除 KPI 周期结果缓存表、KPI 定义表、日汇总表和事件小时汇总表
+        cursor.execute("DROP TABLE IF EXISTS kpi_period_cache")
+        cursor.execute("DROP TABLE IF EXISTS kpi_definitions")
+        cursor.execute("DROP TABLE IF EXISTS event_daily_rollups")
+        cursor.execute("DROP TABLE IF EXISTS property_daily_rollups")
+        cursor.execute("DROP TABLE IF EXISTS event_rollups")
+        cursor.execute("DROP INDEX IF EXISTS ix_property_rollups_property_bucket")
+        conn.commit()
+        print("事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除事件汇总表、日汇总表、KPI 定义表和 KPI 周期结果缓存表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -0,0 +1,95 @@
+"""创建知识图谱属性索引表的迁移脚本"""
+
+def upgrade():
+    """创建知识图谱属性索引表，并由已有节点和边的属性生成索引行"""
+    import sqlite3
+    import os
+    import sys
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    sys.path.append(project_dir)
+    from graph_properties import flatten_properties
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 创建知识图谱属性索引表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS knowledge_graph_property_index (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                graph_id INTEGER NOT NULL,
+                entity_type VARCHAR(10) NOT NULL,
+                entity_id INTEGER NOT NULL,
+                key VARCHAR(200) NOT NULL,
+                value VARCHAR(500) NOT NULL,
+                FOREIGN KEY (graph_id) REFERENCES knowledge_graphs (id)
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_kg_property_index_lookup "
+            "ON knowledge_graph_property_index (graph_id, entity_type, key, value, entity_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_kg_property_index_entity "
+            "ON knowledge_graph_property_index (entity_type, entity_id)"
+        )
+        
+        # 重建已有节点和边的索引行
+        cursor.execute("DELETE FROM knowledge_graph_property_index")
+        for entity_type, table in (('node', 'knowledge_graph_nodes'), ('edge', 'knowledge_graph_edges')):
+            rows = cursor.execute(
+                f"SELECT id, graph_id, properties FROM {table} WHERE properties IS NOT NULL AND properties != ''"
+            ).fetchall()
+            cursor.executemany(
+                "INSERT INTO knowledge_graph_property_index (graph_id, entity_type, entity_id, key, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (graph_id, entity_type, entity_id, key, value)
+                    for entity_id, graph_id, properties in rows
+                    for key, value in flatten_properties(properties)
+                ]
+            )
+        
+        conn.commit()
+        print("知识图谱属性索引表创建成功")
+    except sqlite3.Error as e:
+        print(f"创建知识图谱属性索引表时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除知识图谱属性索引表"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DROP TABLE IF EXISTS knowledge_graph_property_index")
+        conn.commit()
+        print("知识图谱属性索引表删除成功")
+    except sqlite3.Error as e:
+        print(f"删除知识图谱属性索引表时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
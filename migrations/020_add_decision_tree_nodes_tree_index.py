@@ -0,0 +1,60 @@
+"""为决策树节点表添加按决策树检索的索引的迁移脚本"""
+
+def upgrade():
+    """添加 decision_tree_nodes (tree_id, id, updated_at) 索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 整棵树读取和 ETag 计算都按 tree_id 检索，索引包含 id、updated_at 使 ETag 聚合只读索引
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_decision_tree_nodes_tree "
+            "ON decision_tree_nodes (tree_id, id, updated_at)"
+        )
+        conn.commit()
+        print("决策树节点索引创建成功")
+    except sqlite3.Error as e:
+        print(f"创建决策树节点索引时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除 decision_tree_nodes (tree_id, id, updated_at) 索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DROP INDEX IF EXISTS ix_decision_tree_nodes_tree")
+        conn.commit()
+        print("决策树节点索引删除成功")
+    except sqlite3.Error as e:
+        print(f"删除决策树节点索引时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
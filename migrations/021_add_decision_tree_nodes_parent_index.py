@@ -0,0 +1,60 @@
+"""为决策树节点表添加按父节点检索的索引的迁移脚本"""
+
+def upgrade():
+    """添加 decision_tree_nodes (tree_id, parent_id) 索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        # 子树的复制、移动、删除由递归查询沿 parent_id 逐层展开，每层按父节点检索子节点
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_decision_tree_nodes_parent "
+            "ON decision_tree_nodes (tree_id, parent_id)"
+        )
+        conn.commit()
+        print("决策树节点父节点索引创建成功")
+    except sqlite3.Error as e:
+        print(f"创建决策树节点父节点索引时出错: {e}")
+    finally:
+        conn.close()
+
+
+def downgrade():
+    """删除 decision_tree_nodes (tree_id, parent_id) 索引"""
+    import sqlite3
+    import os
+    
+    # 获取项目根目录
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(project_dir, 'device_models.db')
+    
+    # 连接数据库
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DROP INDEX IF EXISTS ix_decision_tree_nodes_parent")
+        conn.commit()
+        print("决策树节点父节点索引删除成功")
+    except sqlite3.Error as e:
+        print(f"删除决策树节点父节点索引时出错: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    action = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    
+    if action == 'downgrade':
+        downgrade()
+    else:
+        upgrade()
@@ -79,8 +79,9 @@ class DatabaseModbusServer:
     从数据库读取点位配置并动态更新数据
     """
 
-    def __init__(self, db_session_func, host="localhost", port=5020):
+    def __init__(self, db_session_func, host="localhost", port=5020, on_update=None):
         self.db_session_func = db_session_func  # 数据库会话函数
+        self.on_update = on_update  # 点位值更新后的回调函数，参数为 get_point_values() 的结果
         self.host = host
         self.port = port
         self.running = False
@@ -189,6 +190,11 @@ class DatabaseModbusServer:
         """数据模拟工作线程"""
         while self.running:
             self.update_modbus_registers()
+            if self.on_update is not None:
+                try:
+                    self.on_update(self.get_point_values())
+                except Exception as e:
+                    logger.error(f"点位更新回调出错: {e}")
             time.sleep(self.update_interval)  # 使用可配置的更新间隔
 
     def _get_update_interval(self):
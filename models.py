@@ -46,6 +46,9 @@ class DeviceProperty(db.Model):
     read_write_flag = db.Column(db.String(10), default='rw')  # 读写标志 (r:只读, w:只写, rw:读写)
     min_value = db.Column(db.Float)  # 最小值
     max_value = db.Column(db.Float)  # 最大值
+    deadband_mode = db.Column(db.String(20))  # 例外报告模式 (absolute, percent, swinging_door)，为空时每个采样都存储
+    deadband_value = db.Column(db.Float)  # 死区阈值（绝对值或百分比，旋转门模式下为压缩偏差）
+    max_silence = db.Column(db.Integer)  # 最长静默时间（秒），超过后即使值未变化也存储一次
     device_type_id = db.Column(db.Integer, db.ForeignKey('device_types.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -64,6 +67,9 @@ class DeviceProperty(db.Model):
             'read_write_flag': self.read_write_flag,
             'min_value': self.min_value,
             'max_value': self.max_value,
+            'deadband_mode': self.deadband_mode,
+            'deadband_value': self.deadband_value,
+            'max_silence': self.max_silence,
             'device_type_id': self.device_type_id,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
@@ -259,6 +265,11 @@ class PropertyHistory(db.Model):
     value = db.Column(db.String(100), nullable=False)  # 属性值
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)  # 时间戳
     
+    # 按点位和时间的范围查询（序列加载、缓存指纹）使用复合索引
+    __table_args__ = (
+        db.Index('ix_property_histories_point_time', 'device_id', 'property_id', 'timestamp'),
+    )
+    
     # 关系
     device = db.relationship('Device', backref='property_histories')
     property = db.relationship('DeviceProperty', backref='histories')
@@ -314,6 +325,8 @@ class DataAnalysisProject(db.Model):
     analysis_type = db.Column(db.String(50), nullable=True)  # 分析类型 (descriptive, diagnostic, predictive, prescriptive)
     selected_points = db.Column(db.Text, nullable=True)  # 选中的数据点信息 (JSON格式)
     analysis_instances = db.Column(db.Text, nullable=True)  # 分析实例信息 (JSON格式)
+    data_cleaning_instances = db.Column(db.Text, nullable=True)  # 数据清洗实例信息 (JSON格式)
+    feature_extraction_instances = db.Column(db.Text, nullable=True)  # 特征提取实例信息 (JSON格式)
     conclusion = db.Column(db.Text, nullable=True)  # 结论说明
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 创建时间
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)  # 更新时间
@@ -329,6 +342,8 @@ class DataAnalysisProject(db.Model):
             'analysis_type': self.analysis_type if self.analysis_type is not None else '',
             'selected_points': self.selected_points,
             'analysis_instances': self.analysis_instances,
+            'data_cleaning_instances': self.data_cleaning_instances,
+            'feature_extraction_instances': self.feature_extraction_instances,
             'conclusion': self.conclusion,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
@@ -390,6 +405,11 @@ class DecisionTreeNode(db.Model):
     yes_child = db.relationship('DecisionTreeNode', foreign_keys=[yes_child_id])
     no_child = db.relationship('DecisionTreeNode', foreign_keys=[no_child_id])
     
+    __table_args__ = (
+        db.Index('ix_decision_tree_nodes_tree', 'tree_id', 'id', 'updated_at'),
+        db.Index('ix_decision_tree_nodes_parent', 'tree_id', 'parent_id'),
+    )
+    
     def __repr__(self):
         return f'<DecisionTreeNode {self.name}>'
     
@@ -438,6 +458,392 @@ class DecisionTree(db.Model):
         }
 
 
+class DerivedSeriesPoint(db.Model):
+    """派生序列数据模型（特征提取、异常检测等由历史数据计算得到的序列）"""
+    __tablename__ = 'derived_series_points'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)  # 设备ID
+    property_id = db.Column(db.Integer, db.ForeignKey('device_properties.id'), nullable=False)  # 源属性ID
+    name = db.Column(db.String(100), nullable=False)  # 序列名称（如 rms、kurtosis、band_energy_0_10）
+    timestamp = db.Column(db.DateTime, nullable=False)  # 时间戳（窗口结束时刻）
+    value = db.Column(db.Float, nullable=False)  # 数值
+    
+    __table_args__ = (
+        db.Index('ix_derived_series_points_series_time', 'device_id', 'property_id', 'name', 'timestamp'),
+    )
+    
+    def __repr__(self):
+        return f'<DerivedSeriesPoint Device:{self.device_id} Property:{self.property_id} {self.name}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'property_id': self.property_id,
+            'name': self.name,
+            'value': self.value,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None
+        }
+
+
+class PropertyRollup(db.Model):
+    """属性历史的小时汇总（按点位和整点时段聚合的计数、总和、最小值和最大值）"""
+    __tablename__ = 'property_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)  # 设备ID
+    property_id = db.Column(db.Integer, db.ForeignKey('device_properties.id'), nullable=False)  # 属性ID
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 时段起始时刻（UTC 整点）
+    count = db.Column(db.Integer, nullable=False)  # 采样数
+    sum = db.Column(db.Float, nullable=False)  # 数值总和
+    min = db.Column(db.Float, nullable=False)  # 最小值
+    max = db.Column(db.Float, nullable=False)  # 最大值
+    
+    __table_args__ = (
+        db.Index('ix_property_rollups_point_bucket', 'device_id', 'property_id', 'bucket_start', unique=True),
+        db.Index('ix_property_rollups_property_bucket', 'property_id', 'bucket_start'),
+    )
+    
+    def __repr__(self):
+        return f'<PropertyRollup Device:{self.device_id} Property:{self.property_id} {self.bucket_start}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'property_id': self.property_id,
+            'bucket_start': self.bucket_start.isoformat() if self.bucket_start else None,
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max
+        }
+
+
+class PropertyDailyRollup(db.Model):
+    """属性历史的日汇总（由小时汇总按 UTC 自然日合并，供长周期统计使用）"""
+    __tablename__ = 'property_daily_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)  # 设备ID
+    property_id = db.Column(db.Integer, db.ForeignKey('device_properties.id'), nullable=False)  # 属性ID
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 日起始时刻（UTC 零点）
+    count = db.Column(db.Integer, nullable=False)  # 采样数
+    sum = db.Column(db.Float, nullable=False)  # 数值总和
+    min = db.Column(db.Float, nullable=False)  # 最小值
+    max = db.Column(db.Float, nullable=False)  # 最大值
+    
+    __table_args__ = (
+        db.Index('ix_property_daily_rollups_point_bucket', 'device_id', 'property_id', 'bucket_start', unique=True),
+        db.Index('ix_property_daily_rollups_property_bucket', 'property_id', 'bucket_start'),
+    )
+    
+    def __repr__(self):
+        return f'<PropertyDailyRollup Device:{self.device_id} Property:{self.property_id} {self.bucket_start}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'property_id': self.property_id,
+            'bucket_start': self.bucket_start.isoformat() if self.bucket_start else None,
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max
+        }
+
+
+class EventRollup(db.Model):
+    """事件历史的小时汇总（按设备事件和整点时段统计的触发时长和触发次数）"""
+    __tablename__ = 'event_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)  # 设备ID
+    event_id = db.Column(db.Integer, db.ForeignKey('device_events.id'), nullable=False)  # 事件ID
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 时段起始时刻（UTC 整点）
+    triggered_seconds = db.Column(db.Float, nullable=False)  # 时段内处于触发状态的秒数
+    transitions = db.Column(db.Integer, nullable=False)  # 时段内进入触发状态的次数
+    
+    __table_args__ = (
+        db.Index('ix_event_rollups_point_bucket', 'device_id', 'event_id', 'bucket_start', unique=True),
+        db.Index('ix_event_rollups_event_bucket', 'event_id', 'bucket_start'),
+    )
+    
+    def __repr__(self):
+        return f'<EventRollup Device:{self.device_id} Event:{self.event_id} {self.bucket_start}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'event_id': self.event_id,
+            'bucket_start': self.bucket_start.isoformat() if self.bucket_start else None,
+            'triggered_seconds': self.triggered_seconds,
+            'transitions': self.transitions
+        }
+
+
+class EventDailyRollup(db.Model):
+    """事件历史的日汇总（由小时汇总按 UTC 自然日合并，供长周期统计使用）"""
+    __tablename__ = 'event_daily_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)  # 设备ID
+    event_id = db.Column(db.Integer, db.ForeignKey('device_events.id'), nullable=False)  # 事件ID
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 日起始时刻（UTC 零点）
+    triggered_seconds = db.Column(db.Float, nullable=False)  # 当日处于触发状态的秒数
+    transitions = db.Column(db.Integer, nullable=False)  # 当日进入触发状态的次数
+    
+    __table_args__ = (
+        db.Index('ix_event_daily_rollups_point_bucket', 'device_id', 'event_id', 'bucket_start', unique=True),
+        db.Index('ix_event_daily_rollups_event_bucket', 'event_id', 'bucket_start'),
+    )
+    
+    def __repr__(self):
+        return f'<EventDailyRollup Device:{self.device_id} Event:{self.event_id} {self.bucket_start}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'event_id': self.event_id,
+            'bucket_start': self.bucket_start.isoformat() if self.bucket_start else None,
+            'triggered_seconds': self.triggered_seconds,
+            'transitions': self.transitions
+        }
+
+
+class DegradationModel(db.Model):
+    """设备劣化趋势模型（健康指标的递推最小二乘拟合状态和剩余寿命预测）"""
+    __tablename__ = 'degradation_models'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False, index=True)  # 设备ID
+    property_id = db.Column(db.Integer, db.ForeignKey('device_properties.id'), nullable=False)  # 健康指标所属属性ID
+    series = db.Column(db.String(100), nullable=True)  # 派生序列名称，为空时使用属性小时汇总的均值
+    model_type = db.Column(db.String(20), nullable=False, default='linear')  # 趋势模型：linear、exponential、piecewise
+    threshold = db.Column(db.Float, nullable=True)  # 失效阈值，为空时按趋势方向取属性的最小值或最大值
+    direction = db.Column(db.String(10), nullable=True)  # 失效方向：up（升高越限）、down（降低越限），为空时按趋势方向
+    origin = db.Column(db.DateTime, nullable=True)  # 拟合时间原点（第一个时段）
+    last_bucket = db.Column(db.DateTime, nullable=True)  # 已并入拟合的最后一个时段
+    segment_start = db.Column(db.DateTime, nullable=True)  # 分段模型当前分段的起始时段
+    samples = db.Column(db.Integer, default=0, nullable=False)  # 当前拟合的时段数
+    theta_a = db.Column(db.Float, default=0.0, nullable=False)  # 截距（指数模型为对数空间）
+    theta_b = db.Column(db.Float, default=0.0, nullable=False)  # 斜率（每小时）
+    p_aa = db.Column(db.Float, nullable=True)  # 递推最小二乘的协方差矩阵
+    p_ab = db.Column(db.Float, nullable=True)
+    p_bb = db.Column(db.Float, nullable=True)
+    residual_ss = db.Column(db.Float, default=0.0, nullable=False)  # 残差平方和
+    outlier_run = db.Column(db.Integer, default=0, nullable=False)  # 分段模型连续超差的时段数
+    level = db.Column(db.Float, nullable=True)  # 最后时段的拟合值
+    slope = db.Column(db.Float, nullable=True)  # 最后时段的变化率（每小时，原始单位）
+    limit = db.Column(db.Float, nullable=True)  # 实际使用的失效阈值
+    rul_hours = db.Column(db.Float, nullable=True)  # 剩余寿命（小时），趋势不会到达阈值时为空
+    predicted_failure_at = db.Column(db.DateTime, nullable=True)  # 预测到达阈值的时刻
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 创建时间
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)  # 更新时间
+    
+    def __repr__(self):
+        return f'<DegradationModel Device:{self.device_id} Property:{self.property_id} {self.model_type}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'property_id': self.property_id,
+            'series': self.series,
+            'model_type': self.model_type,
+            'threshold': self.threshold,
+            'direction': self.direction,
+            'origin': self.origin.isoformat() if self.origin else None,
+            'last_bucket': self.last_bucket.isoformat() if self.last_bucket else None,
+            'segment_start': self.segment_start.isoformat() if self.segment_start else None,
+            'samples': self.samples,
+            'level': self.level,
+            'slope': self.slope,
+            'limit': self.limit,
+            'rul_hours': self.rul_hours,
+            'predicted_failure_at': self.predicted_failure_at.isoformat() if self.predicted_failure_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class KpiDefinition(db.Model):
+    """KPI 定义（输入为属性或事件在统计周期内的聚合，表达式对输入做算术运算）"""
+    __tablename__ = 'kpi_definitions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # KPI 名称
+    identifier = db.Column(db.String(100), nullable=False, unique=True)  # KPI 标识符
+    description = db.Column(db.Text)  # 描述
+    unit = db.Column(db.String(50))  # 单位
+    device_type_id = db.Column(db.Integer, db.ForeignKey('device_types.id'), nullable=True)  # 适用的设备类型，为空时适用于具备全部输入的设备类型
+    inputs = db.Column(db.Text, nullable=False)  # 输入定义 {别名: {source, identifier, aggregate}} (JSON格式)
+    expression = db.Column(db.String(500), nullable=False)  # 计算表达式，可引用输入别名和 period（统计秒数）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<KpiDefinition {self.identifier}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'identifier': self.identifier,
+            'description': self.description,
+            'unit': self.unit,
+            'device_type_id': self.device_type_id,
+            'inputs': self.inputs,
+            'expression': self.expression,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class KpiPeriodCache(db.Model):
+    """已结束统计周期的 KPI 结果缓存（按 KPI 定义哈希和周期寻址）"""
+    __tablename__ = 'kpi_period_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kpi_id = db.Column(db.Integer, db.ForeignKey('kpi_definitions.id'), nullable=False)  # KPI ID
+    definition_hash = db.Column(db.String(64), nullable=False)  # 输入、表达式和设备类型的哈希
+    period_start = db.Column(db.DateTime, nullable=False)  # 周期起始时刻（含）
+    period_end = db.Column(db.DateTime, nullable=False)  # 周期结束时刻（不含）
+    result = db.Column(db.Text, nullable=False)  # 设备、设备类型和全部设备的 KPI 结果 (JSON格式)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 计算时间
+    
+    __table_args__ = (
+        db.Index('ix_kpi_period_cache_period', 'kpi_id', 'definition_hash', 'period_start', 'period_end', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<KpiPeriodCache KPI:{self.kpi_id} {self.period_start}~{self.period_end}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kpi_id': self.kpi_id,
+            'definition_hash': self.definition_hash,
+            'period_start': self.period_start.isoformat() if self.period_start else None,
+            'period_end': self.period_end.isoformat() if self.period_end else None,
+            'result': self.result,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class AnalysisResultCache(db.Model):
+    """数据分析结果缓存（按点位、时间范围、清洗配置和算法版本的内容哈希寻址）"""
+    __tablename__ = 'analysis_result_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False, unique=True, index=True)  # 内容哈希
+    project_id = db.Column(db.Integer, db.ForeignKey('data_analysis_projects.id'), nullable=True, index=True)  # 项目ID
+    instance_id = db.Column(db.String(100), nullable=True)  # 分析实例ID
+    as_of = db.Column(db.DateTime, nullable=False)  # 结果覆盖的数据截止时间
+    fingerprint = db.Column(db.Text, nullable=False)  # 截止时间前各点位历史数据的行数和最大ID (JSON格式)
+    state = db.Column(db.Text, nullable=False)  # 可合并的中间统计量 (JSON格式)
+    result = db.Column(db.Text, nullable=False)  # 分析结果 (JSON格式)
+    result_id = db.Column(db.Integer, db.ForeignKey('data_analysis_results.id'), nullable=True)  # 对应的分析结果记录
+    hits = db.Column(db.Integer, default=0, nullable=False)  # 命中次数
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 创建时间
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)  # 更新时间
+    
+    def __repr__(self):
+        return f'<AnalysisResultCache {self.cache_key[:12]}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'cache_key': self.cache_key,
+            'project_id': self.project_id,
+            'instance_id': self.instance_id,
+            'as_of': self.as_of.isoformat() if self.as_of else None,
+            'result_id': self.result_id,
+            'hits': self.hits,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class Job(db.Model):
+    """后台任务模型（在进程池中执行的耗时计算）"""
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False, index=True)  # 任务类型
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # 状态 (pending, running, succeeded, failed, cancelled)
+    params = db.Column(db.Text, nullable=True)  # 任务参数 (JSON格式)
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # 进度 0~1
+    message = db.Column(db.String(500), nullable=True)  # 进度说明
+    result = db.Column(db.Text, nullable=True)  # 任务结果 (JSON格式)
+    error = db.Column(db.Text, nullable=True)  # 错误信息
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)  # 是否已请求取消
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 创建时间
+    started_at = db.Column(db.DateTime, nullable=True)  # 开始执行时间
+    finished_at = db.Column(db.DateTime, nullable=True)  # 结束时间
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.job_type} {self.status}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'params': self.params,
+            'progress': self.progress,
+            'message': self.message,
+            'result': self.result,
+            'error': self.error,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class DiagnosisRecord(db.Model):
+    """决策树诊断记录模型（事件触发时自动诊断的结果）"""
+    __tablename__ = 'diagnosis_records'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False, index=True)  # 设备ID
+    tree_id = db.Column(db.Integer, db.ForeignKey('decision_trees.id'), nullable=False, index=True)  # 决策树ID
+    event_id = db.Column(db.Integer, db.ForeignKey('device_events.id'), nullable=True)  # 触发诊断的事件ID
+    leaf_node_id = db.Column(db.Integer, nullable=True)  # 到达的叶子节点ID
+    result = db.Column(db.Text, nullable=True)  # 叶子节点结果
+    path = db.Column(db.Text, nullable=True)  # 决策路径节点ID列表 (JSON格式)
+    error = db.Column(db.Text, nullable=True)  # 求值错误信息
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)  # 事件触发时间
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 诊断完成时间
+    
+    # 关系
+    device = db.relationship('Device', backref='diagnosis_records')
+    tree = db.relationship('DecisionTree', backref='diagnosis_records')
+    event = db.relationship('DeviceEvent', backref='diagnosis_records')
+    
+    def __repr__(self):
+        return f'<DiagnosisRecord Device:{self.device_id} Tree:{self.tree_id}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'tree_id': self.tree_id,
+            'event_id': self.event_id,
+            'leaf_node_id': self.leaf_node_id,
+            'result': self.result,
+            'path': self.path,
+            'error': self.error,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
 class KnowledgeGraph(db.Model):
     """知识图谱模型"""
     __tablename__ = 'knowledge_graphs'
@@ -522,4 +928,34 @@ class KnowledgeGraphEdge(db.Model):
             'properties': self.properties,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class KnowledgeGraphPropertyIndex(db.Model):
+    """知识图谱节点和边属性的二级索引（每个标量属性一行，嵌套对象的键以点号连接）"""
+    __tablename__ = 'knowledge_graph_property_index'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    graph_id = db.Column(db.Integer, db.ForeignKey('knowledge_graphs.id'), nullable=False)  # 所属知识图谱ID
+    entity_type = db.Column(db.String(10), nullable=False)  # 实体类型 (node, edge)
+    entity_id = db.Column(db.Integer, nullable=False)  # 节点或边ID
+    key = db.Column(db.String(200), nullable=False)  # 属性键
+    value = db.Column(db.String(500), nullable=False)  # 属性值文本
+    
+    __table_args__ = (
+        db.Index('ix_kg_property_index_lookup', 'graph_id', 'entity_type', 'key', 'value', 'entity_id'),
+        db.Index('ix_kg_property_index_entity', 'entity_type', 'entity_id'),
+    )
+    
+    def __repr__(self):
+        return f'<KnowledgeGraphPropertyIndex {self.entity_type}:{self.entity_id} {self.key}={self.value}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'graph_id': self.graph_id,
+            'entity_type': self.entity_type,
+            'entity_id': self.entity_id,
+            'key': self.key,
+            'value': self.value
         }
\ No newline at end of file
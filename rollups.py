@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+属性和事件历史小时汇总
+按点位把历史数据聚合为 UTC 整点时段的计数、总和、最小值和最大值，按设备事件把状态变化聚合为
+每个时段的触发时长和触发次数。小时汇总再按 UTC 自然日合并为日汇总，长周期统计读取日汇总。
+趋势模型和 KPI 统计读取汇总表，不必每次扫描原始历史。
+刷新时只重算最后一个（可能不完整的）时段之后的数据，补录早于该时段的历史时从补录的最早时段起重算，
+回填整个历史作为后台任务执行。
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from models import db, PropertyHistory, PropertyRollup, PropertyDailyRollup, EventHistory, EventRollup, EventDailyRollup
+from timeseries import load_point_series, bucket_series
+
+
+# 汇总时段长度（秒）
+ROLLUP_SECONDS = 3600
+ROLLUP_STEP_US = ROLLUP_SECONDS * 1000000
+
+# 汇总每批写入的行数
+INSERT_BATCH = 10000
+
+# 小时汇总合并为日汇总时各列的聚合方式
+PROPERTY_DAILY_AGGREGATES = (
+    ('count', db.func.sum), ('sum', db.func.sum), ('min', db.func.min), ('max', db.func.max)
+)
+EVENT_DAILY_AGGREGATES = (
+    ('triggered_seconds', db.func.sum), ('transitions', db.func.sum)
+)
+
+
+def floor_bucket(moment):
+    """时刻所在时段的起始时刻"""
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(moment):
+    """时刻所在 UTC 日的零点"""
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _derive_daily(hourly, daily, point_column, device_id, point_id, since, aggregates):
+    """由小时汇总重新合并一个点位 since 所在日及之后（since 为空时为全部）的日汇总"""
+    delete = daily.delete().where(daily.c.device_id == device_id, daily.c[point_column] == point_id)
+    conditions = [hourly.c.device_id == device_id, hourly.c[point_column] == point_id]
+    if since is not None:
+        day = floor_day(since)
+        delete = delete.where(daily.c.bucket_start >= day)
+        conditions.append(hourly.c.bucket_start >= day)
+    db.session.execute(delete)
+    # 与 DateTime 列的存储格式保持一致，便于按时刻比较
+    day_column = db.func.strftime('%Y-%m-%d 00:00:00.000000', hourly.c.bucket_start)
+    select = db.select(
+        hourly.c.device_id, hourly.c[point_column], day_column, *[function(hourly.c[name]) for name, function in aggregates]
+    ).where(*conditions).group_by(day_column)
+    db.session.execute(daily.insert().from_select(
+        ['device_id', point_column, 'bucket_start'] + [name for name, _ in aggregates], select
+    ))
+
+
+def _last_bucket(device_id, property_id):
+    table = PropertyRollup.__table__
+    return db.session.execute(db.select(db.func.max(table.c.bucket_start)).where(
+        table.c.device_id == device_id,
+        table.c.property_id == property_id
+    )).scalar()
+
+
+def refresh_point_rollups(device_id, property_id, full=False, since=None):
+    """
+    刷新一个点位的小时汇总，返回写入的时段数
+    默认从已有的最后一个时段起重算（该时段可能在上次刷新后又收到采样），full 时重算全部历史；
+    指定 since 时从 since 所在时段和最后一个时段中较早的一个起重算（补录历史后使用）
+    """
+    table = PropertyRollup.__table__
+    last = None if full else _last_bucket(device_id, property_id)
+    if isinstance(last, str):
+        last = datetime.fromisoformat(last)
+    if last is not None and since is not None:
+        last = min(last, floor_bucket(since))
+    since = last
+    
+    delete = table.delete().where(table.c.device_id == device_id, table.c.property_id == property_id)
+    if since is not None:
+        delete = delete.where(table.c.bucket_start >= since)
+    db.session.execute(delete)
+    
+    times, values = load_point_series(device_id, property_id, since)
+    if times.size == 0:
+        _derive_daily(table, PropertyDailyRollup.__table__, 'property_id', device_id, property_id, since, PROPERTY_DAILY_AGGREGATES)
+        return 0
+    micros = times.astype(np.int64)
+    bucket_times, counts = bucket_series(micros, values, 0, ROLLUP_STEP_US, 'count')
+    _, sums = bucket_series(micros, values, 0, ROLLUP_STEP_US, 'sum')
+    _, minimums = bucket_series(micros, values, 0, ROLLUP_STEP_US, 'min')
+    _, maximums = bucket_series(micros, values, 0, ROLLUP_STEP_US, 'max')
+    
+    starts = bucket_times.astype('datetime64[us]').astype(datetime).tolist()
+    rows = [
+        {
+            'device_id': device_id,
+            'property_id': property_id,
+            'bucket_start': start,
+            'count': int(count),
+            'sum': total,
+            'min': low,
+            'max': high
+        }
+        for start, count, total, low, high in zip(starts, counts.tolist(), sums.tolist(), minimums.tolist(), maximums.tolist())
+    ]
+    for offset in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(table.insert(), rows[offset:offset + INSERT_BATCH])
+    _derive_daily(table, PropertyDailyRollup.__table__, 'property_id', device_id, property_id, since, PROPERTY_DAILY_AGGREGATES)
+    return len(rows)
+
+
+def refresh_backdated(earliest):
+    """
+    补录历史后刷新受影响点位的小时和日汇总
+    earliest: {(device_id, property_id): 补录的最早时刻}；未汇总过的点位和落在最后时段及之后的补录由常规增量刷新处理
+    返回需要重算的点位 {(device_id, property_id): 重算起始时段}
+    """
+    affected = {}
+    for (device_id, property_id), moment in earliest.items():
+        last = _last_bucket(device_id, property_id)
+        if isinstance(last, str):
+            last = datetime.fromisoformat(last)
+        if last is None or moment >= last:
+            continue
+        start = floor_bucket(moment)
+        refresh_point_rollups(device_id, property_id, since=start)
+        affected[(device_id, property_id)] = start
+    return affected
+
+
+def history_points():
+    """历史数据中出现过的全部点位 [(device_id, property_id)]"""
+    table = PropertyHistory.__table__
+    return [tuple(row) for row in db.session.execute(
+        db.select(table.c.device_id, table.c.property_id).distinct()
+    ).all()]
+
+
+def refresh_rollups(points=None, full=False, progress=None):
+    """刷新多个点位（默认全部点位）的小时汇总，每个点位提交一次，返回 {'points': 点位数, 'buckets': 写入时段数}"""
+    points = history_points() if points is None else list(points)
+    buckets = 0
+    for index, (device_id, property_id) in enumerate(points):
+        buckets += refresh_point_rollups(device_id, property_id, full)
+        db.session.commit()
+        if progress is not None:
+            progress(index + 1, len(points), f'已汇总 {index + 1} / {len(points)} 个点位')
+    return {'points': len(points), 'buckets': buckets}
+
+
+def load_rollups(points, since=None, until=None):
+    """
+    一次查询读取多个点位的小时汇总
+    since（不含）和 until（不含）限定时段起始时刻，返回 {(device_id, property_id): (时段起始 datetime64[us], 均值数组)}
+    """
+    points = set(points)
+    if not points:
+        return {}
+    table = PropertyRollup.__table__
+    query = db.select(
+        table.c.device_id, table.c.property_id, db.cast(table.c.bucket_start, db.String), table.c.sum, table.c.count
+    ).where(
+        table.c.device_id.in_({device_id for device_id, _ in points}),
+        table.c.property_id.in_({property_id for _, property_id in points})
+    )
+    if since is not None:
+        query = query.where(table.c.bucket_start > since)
+    if until is not None:
+        query = query.where(table.c.bucket_start < until)
+    rows = db.session.execute(query.order_by(table.c.device_id, table.c.property_id, table.c.bucket_start)).all()
+    if not rows:
+        return {}
+    
+    device_ids, property_ids, starts, sums, counts = zip(*rows)
+    device_ids = np.array(device_ids)
+    property_ids = np.array(property_ids)
+    starts = np.array(starts, dtype='datetime64[us]')
+    means = np.array(sums, dtype=np.float64) / np.array(counts, dtype=np.float64)
+    # 行按点位排序，每个点位是连续的一段
+    boundaries = np.flatnonzero((device_ids[1:] != device_ids[:-1]) | (property_ids[1:] != property_ids[:-1])) + 1
+    result = {}
+    for begin, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(rows)]):
+        key = (int(device_ids[begin]), int(property_ids[begin]))
+        if key in points:
+            result[key] = (starts[begin:end], means[begin:end])
+    return result
+
+
+def _last_event_bucket(device_id, event_id):
+    table = EventRollup.__table__
+    return db.session.execute(db.select(db.func.max(table.c.bucket_start)).where(
+        table.c.device_id == device_id,
+        table.c.event_id == event_id
+    )).scalar()
+
+
+def triggered_seconds(times, states, edges):
+    """
+    状态序列在各时段内处于触发状态的秒数
+    times 为状态变化时刻（微秒，升序），states 为变化后的状态（是否触发），edges 为时段边界（微秒，升序），
+    状态在 times[0] 之前视为未触发。返回长度为 len(edges) - 1 的数组
+    """
+    # 到每个状态变化时刻为止的累计触发时长，边界处的累计值由所在区间线性外推
+    cumulative = np.r_[0, np.cumsum(states[:-1] * np.diff(times))]
+    index = np.searchsorted(times, edges, side='right') - 1
+    inside = index >= 0
+    index = np.maximum(index, 0)
+    totals = np.where(inside, cumulative[index] + states[index] * (edges - times[index]), 0)
+    return np.diff(totals) / 1e6
+
+
+def refresh_event_rollups_for(device_id, event_id, full=False, now=None):
+    """
+    刷新一个设备事件的小时汇总，返回写入的时段数
+    触发时长统计到 now 为止，当前时段在下次刷新时重算。只保存有触发的时段和最后一个时段（作为刷新起点）
+    """
+    table = EventRollup.__table__
+    history = EventHistory.__table__
+    since = None if full else _last_event_bucket(device_id, event_id)
+    if isinstance(since, str):
+        since = datetime.fromisoformat(since)
+    
+    delete = table.delete().where(table.c.device_id == device_id, table.c.event_id == event_id)
+    if since is not None:
+        delete = delete.where(table.c.bucket_start >= since)
+    db.session.execute(delete)
+    
+    query = db.select(db.cast(history.c.timestamp, db.String), history.c.status).where(
+        history.c.device_id == device_id,
+        history.c.event_id == event_id
+    )
+    initial = False
+    if since is not None:
+        # 起点之前最后一次状态变化决定起点时的状态
+        previous = db.session.execute(
+            db.select(history.c.status).where(
+                history.c.device_id == device_id,
+                history.c.event_id == event_id,
+                history.c.timestamp < since
+            ).order_by(history.c.timestamp.desc(), history.c.id.desc()).limit(1)
+        ).scalar()
+        initial = previous == 'triggered'
+        query = query.where(history.c.timestamp >= since)
+    rows = db.session.execute(query.order_by(history.c.timestamp, history.c.id)).all()
+    if not rows and since is None:
+        _derive_daily(table, EventDailyRollup.__table__, 'event_id', device_id, event_id, since, EVENT_DAILY_AGGREGATES)
+        return 0
+    
+    timestamps, statuses = zip(*rows) if rows else ((), ())
+    micros = np.array(timestamps, dtype='datetime64[us]').astype(np.int64)
+    changes = np.array([status == 'triggered' for status in statuses], dtype=bool)
+    start = since if since is not None else floor_bucket(datetime.fromisoformat(str(timestamps[0])))
+    start_us = np.datetime64(start, 'us').astype(np.int64)
+    now_us = np.datetime64(now or datetime.utcnow(), 'us').astype(np.int64)
+    end_us = max(now_us, int(micros[-1]) if micros.size else start_us, start_us + 1)
+    
+    times = np.r_[start_us, micros]
+    states = np.r_[initial, changes].astype(np.float64)
+    edges = np.r_[np.arange(start_us, end_us, ROLLUP_STEP_US, dtype=np.int64), end_us]
+    seconds = triggered_seconds(times, states, edges)
+    # 进入触发状态的时刻（前一个状态未触发）
+    onsets = micros[changes & ~np.r_[initial, changes[:-1]].astype(bool)]
+    transitions = np.bincount((onsets - start_us) // ROLLUP_STEP_US, minlength=seconds.size)[:seconds.size]
+    
+    keep = (seconds > 0) | (transitions > 0)
+    keep[-1] = True
+    starts = edges[:-1][keep].astype('datetime64[us]').astype(datetime).tolist()
+    rows = [
+        {
+            'device_id': device_id,
+            'event_id': event_id,
+            'bucket_start': bucket_start,
+            'triggered_seconds': total,
+            'transitions': int(count)
+        }
+        for bucket_start, total, count in zip(starts, seconds[keep].tolist(), transitions[keep].tolist())
+    ]
+    for offset in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(table.insert(), rows[offset:offset + INSERT_BATCH])
+    _derive_daily(table, EventDailyRollup.__table__, 'event_id', device_id, event_id, since, EVENT_DAILY_AGGREGATES)
+    return len(rows)
+
+
+def history_events():
+    """事件历史中出现过的全部设备事件 [(device_id, event_id)]"""
+    table = EventHistory.__table__
+    return [tuple(row) for row in db.session.execute(
+        db.select(table.c.device_id, table.c.event_id).distinct()
+    ).all()]
+
+
+def refresh_event_rollups(events=None, full=False, progress=None, now=None):
+    """刷新多个设备事件（默认全部）的小时汇总，每个设备事件提交一次，返回 {'events': 设备事件数, 'buckets': 写入时段数}"""
+    events = history_events() if events is None else list(events)
+    now = now or datetime.utcnow()
+    buckets = 0
+    for index, (device_id, event_id) in enumerate(events):
+        buckets += refresh_event_rollups_for(device_id, event_id, full, now)
+        db.session.commit()
+        if progress is not None:
+            progress(index + 1, len(events), f'已汇总 {index + 1} / {len(events)} 个设备事件')
+    return {'events': len(events), 'buckets': buckets}
+
+
+def complete_before(now=None):
+    """已经结束的时段都在该时刻之前（当前时段尚未结束）"""
+    return floor_bucket(now or datetime.utcnow())
+
+
+def bucket_hours(starts, origin):
+    """时段起始时刻相对原点的小时数"""
+    return (starts - np.datetime64(origin, 'us')).astype(np.int64) / (ROLLUP_SECONDS * 1e6)
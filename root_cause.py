@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+基于知识图谱的根因排序
+当前触发的事件（或指定设备）通过节点属性映射到知识图谱节点，作为个性化 PageRank 的重启分布，
+随机游走默认沿边的反方向（从现象走向原因）传播，稳态概率即候选根因得分。
+每轮迭代是一次稀疏矩阵-向量乘（按边 bincount 累加），稳态向量按图谱缓存并作为下一次计算的初值，
+告警集合变化不大时几轮迭代即可收敛，可在每次告警跳变后刷新排序。
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import select, func
+
+from models import db, Device, DeviceEvent, EventHistory
+from graph_index import GraphQueryError
+
+
+# 节点属性中引用设备、事件的键
+DEVICE_KEYS = {'device_id': 'device_id', 'device': 'device_name', 'device_name': 'device_name', 'device_code': 'device_code'}
+EVENT_KEYS = {'event_id': 'event_id', 'event': 'identifier', 'event_identifier': 'identifier'}
+
+# 事件级别 → 重启权重
+LEVEL_WEIGHTS = {'info': 1.0, 'warning': 2.0, 'error': 3.0, 'critical': 4.0}
+
+DEFAULT_DAMPING = 0.85
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 200
+
+
+class RootCauseError(GraphQueryError):
+    """根因分析参数错误"""
+
+
+def latest_event_states():
+    """每个设备事件最后一条状态记录的查询 (device_id, event_id, status, timestamp)"""
+    latest = (
+        select(func.max(EventHistory.id).label('id'))
+        .group_by(EventHistory.device_id, EventHistory.event_id)
+        .subquery()
+    )
+    return (
+        select(EventHistory.device_id, EventHistory.event_id, EventHistory.status, EventHistory.timestamp)
+        .join(latest, EventHistory.id == latest.c.id)
+    )
+
+
+def load_active_alarms():
+    """从事件历史读取当前处于触发状态的事件（每个设备事件取最后一条状态记录）"""
+    rows = db.session.execute(
+        latest_event_states().with_only_columns(EventHistory.device_id, EventHistory.event_id)
+        .where(EventHistory.status == 'triggered')
+    ).all()
+    return [{'device_id': device_id, 'event_id': event_id} for device_id, event_id in rows]
+
+
+def resolve_alarms(alarms):
+    """
+    补全告警的设备名称、编码和事件标识符、级别
+    alarms: [{'device_id': ..., 'event_id': 可选}]，event_id 缺省表示设备级告警
+    """
+    resolved = []
+    for alarm in alarms:
+        if not isinstance(alarm, dict) or alarm.get('device_id') is None:
+            raise RootCauseError('告警需包含 device_id')
+        try:
+            device_id = int(alarm['device_id'])
+            event_id = int(alarm['event_id']) if alarm.get('event_id') is not None else None
+        except (TypeError, ValueError):
+            raise RootCauseError(f'无效的告警: {alarm}')
+        resolved.append({'device_id': device_id, 'event_id': event_id})
+    device_ids = {alarm['device_id'] for alarm in resolved}
+    event_ids = {alarm['event_id'] for alarm in resolved if alarm['event_id'] is not None}
+    devices = {
+        row.id: row for row in db.session.execute(
+            select(Device.id, Device.name, Device.code).where(Device.id.in_(device_ids))
+        )
+    } if device_ids else {}
+    events = {
+        row.id: row for row in db.session.execute(
+            select(DeviceEvent.id, DeviceEvent.identifier, DeviceEvent.name, DeviceEvent.level)
+            .where(DeviceEvent.id.in_(event_ids))
+        )
+    } if event_ids else {}
+    for alarm in resolved:
+        device = devices.get(alarm['device_id'])
+        event = events.get(alarm['event_id'])
+        alarm['device_name'] = device.name if device else None
+        alarm['device_code'] = device.code if device else None
+        alarm['identifier'] = event.identifier if event else None
+        alarm['event_name'] = event.name if event else None
+        alarm['level'] = event.level if event else None
+    return resolved
+
+
+def _union(index, keys, alarm):
+    """节点属性引用了告警中对应字段的节点下标"""
+    parts = [
+        index.nodes_with_property(key, alarm.get(field))
+        for key, field in keys.items() if alarm.get(field) is not None
+    ]
+    parts = [part for part in parts if part.size]
+    return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+
+def alarm_seeds(index, alarms):
+    """
+    告警 → 重启分布
+    事件告警匹配引用该事件、且未引用其他设备的节点；没有事件节点时退回到只引用该设备的节点。
+    每条告警按事件级别分配权重，在其匹配节点间平均分配。
+    返回 (重启分布, 每条告警匹配的节点下标列表)
+    """
+    has_device = index.has_property(DEVICE_KEYS)
+    has_event = index.has_property(EVENT_KEYS)
+    seeds = np.zeros(index.node_count)
+    matches = []
+    for alarm in alarms:
+        device_nodes = _union(index, DEVICE_KEYS, alarm)
+        on_device = np.zeros(index.node_count, dtype=bool)
+        on_device[device_nodes] = True
+        matched = np.empty(0, dtype=np.int64)
+        if alarm.get('event_id') is not None:
+            event_nodes = _union(index, EVENT_KEYS, alarm)
+            matched = event_nodes[on_device[event_nodes] | ~has_device[event_nodes]]
+        if not matched.size:
+            matched = device_nodes[~has_event[device_nodes]]
+        matches.append(matched)
+        if matched.size:
+            weight = LEVEL_WEIGHTS.get(alarm.get('level') or 'info', 1.0)
+            np.add.at(seeds, matched, weight / matched.size)
+    return seeds, matches
+
+
+class WalkOperator:
+    """
+    随机游走转移算子：游走者沿 direction 方向的邻接边等概率走向邻居，
+    以边数组（起点、终点、权重）表示，step 为一次稀疏矩阵-向量乘
+    """
+    
+    def __init__(self, index, direction, relations):
+        indexes = index.adjacency(direction, index.relation_codes(relations))
+        sources, targets = [], []
+        for ptr, neighbors, _ in indexes:
+            sources.append(np.repeat(np.arange(index.node_count), np.diff(ptr)))
+            targets.append(neighbors)
+        self.sources = np.concatenate(sources) if sources else np.empty(0, dtype=np.int64)
+        self.targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int64)
+        degree = np.bincount(self.sources, minlength=index.node_count).astype(float)
+        self.dangling = degree == 0
+        self.weights = 1.0 / degree[self.sources] if self.sources.size else np.empty(0)
+        self.node_count = index.node_count
+    
+    def step(self, rank):
+        """返回 (转移后的分布, 无出边节点上滞留的概率质量)"""
+        moved = np.bincount(self.targets, weights=rank[self.sources] * self.weights, minlength=self.node_count)
+        return moved, float(rank[self.dangling].sum())
+
+
+def personalized_pagerank(operator, seeds, damping=DEFAULT_DAMPING, initial=None,
+                          tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    """
+    幂迭代求个性化 PageRank：r = d·(P r + 滞留质量·s) + (1 - d)·s
+    seeds 为归一化的重启分布，initial 为初值（通常为上一次的稳态向量）
+    返回 (稳态向量, 迭代次数, 最后一次的 L1 残差)
+    """
+    rank = seeds if initial is None else initial
+    residual = 0.0
+    for iteration in range(1, max_iterations + 1):
+        moved, dangling = operator.step(rank)
+        updated = damping * (moved + dangling * seeds) + (1.0 - damping) * seeds
+        residual = float(np.abs(updated - rank).sum())
+        rank = updated
+        if residual < tolerance:
+            return rank, iteration, residual
+    return rank, max_iterations, residual
+
+
+class RootCauseRanker:
+    """根因排序器：缓存转移算子和上一次的稳态向量（按图谱、方向、关系、阻尼系数区分）"""
+    
+    def __init__(self, max_states=64):
+        self.max_states = max_states
+        self._operators = OrderedDict()
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _operator(self, index, direction, relations):
+        key = (index.graph_id, direction, tuple(relations) if relations is not None else None)
+        with self._lock:
+            cached = self._operators.get(key)
+        if cached is not None and cached[0] is index:
+            return cached[1]
+        operator = WalkOperator(index, direction, relations)
+        with self._lock:
+            self._operators[key] = (index, operator)
+            self._operators.move_to_end(key)
+            while len(self._operators) > self.max_states:
+                self._operators.popitem(last=False)
+        return operator
+    
+    def _initial(self, key, index):
+        """上一次的稳态向量，图谱索引重建后按节点 id 重新对齐"""
+        with self._lock:
+            state = self._states.get(key)
+        if state is None:
+            return None
+        node_ids, rank = state
+        if node_ids is index.node_ids:
+            initial = rank
+        else:
+            initial = np.zeros(index.node_count)
+            positions = index.lookup(node_ids)
+            kept = positions >= 0
+            initial[positions[kept]] = rank[kept]
+        total = initial.sum()
+        return initial / total if total > 0 else None
+    
+    def rank(self, index, alarms, direction='in', relations=None, damping=DEFAULT_DAMPING,
+             top_k=20, node_types=None, exclude_alarm_nodes=True, warm_start=True):
+        """
+        对候选根因排序
+        alarms 为 resolve_alarms 补全后的告警列表；
+        node_types 限定候选节点类型，exclude_alarm_nodes 为 True 时告警映射到的节点本身不作为候选
+        """
+        if not 0 < damping < 1:
+            raise RootCauseError('阻尼系数需在 0 与 1 之间')
+        relations = sorted(set(relations)) if relations is not None else None
+        seeds, matches = alarm_seeds(index, alarms)
+        total = seeds.sum()
+        result = {
+            'graph_id': index.graph_id,
+            'alarms': len(alarms),
+            'matched_alarms': sum(1 for m in matches if m.size),
+            'unmatched_alarms': [alarm for alarm, m in zip(alarms, matches) if not m.size],
+            'seed_nodes': int(np.count_nonzero(seeds)),
+            'iterations': 0,
+            'residual': None,
+            'warm_start': False,
+            'candidates': []
+        }
+        if total <= 0:
+            return result
+        seeds = seeds / total
+        operator = self._operator(index, direction, relations)
+        key = (index.graph_id, direction, tuple(relations) if relations is not None else None, damping)
+        initial = self._initial(key, index) if warm_start else None
+        rank, iterations, residual = personalized_pagerank(operator, seeds, damping, initial)
+        with self._lock:
+            self._states[key] = (index.node_ids, rank)
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+        
+        candidates = rank > 0
+        if exclude_alarm_nodes:
+            candidates &= seeds == 0
+        if node_types:
+            allowed = set(node_types)
+            candidates &= np.array([t in allowed for t in index.node_types], dtype=bool)
+        positions = np.flatnonzero(candidates)
+        order = positions[np.lexsort((positions, -rank[positions]))][:top_k]
+        nodes = index.node_dicts(order)
+        for position, (node, score) in enumerate(zip(nodes, rank[order].tolist()), start=1):
+            node['rank'] = position
+            node['score'] = round(score, 8)
+            node['alarm_node'] = bool(seeds[order[position - 1]] > 0)
+        result.update({
+            'iterations': iterations,
+            'residual': residual,
+            'warm_start': initial is not None,
+            'candidates': nodes
+        })
+        return result
+
+
+# 全局根因排序器实例
+root_cause_ranker = RootCauseRanker()
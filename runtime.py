@@ -0,0 +1,610 @@
+#!/usr/bin/env python3
+"""
+运行时状态：Modbus 模拟器、设备数据采集、事件状态、异常检测和诊断队列
+单进程部署时运行在 Web 进程的线程中（LocalRuntime）。
+多进程部署时由独立的运行时服务进程持有（python runtime_service.py），
+任意数量的无状态 Web 工作进程经本地 IPC（Unix 套接字，Windows 上为本机 TCP）调用同一组方法（RemoteRuntime），
+实时推送消息和缓存失效通知经同一通道转发到每个工作进程，
+点位最新值写入共享内存值表（value_table），工作进程直接映射读取。
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from models import ModbusPoint, ServerConfig, db
+from modbus_server_db import DatabaseModbusServer
+from acquisition import AcquisitionService
+from ingest_filter import exception_filter
+from anomaly import anomaly_detector
+from event_engine import event_engine
+from decision_engine import decision_engine
+from graph_index import graph_index
+from stream_hub import StreamSubscriber
+from value_table import ValueTable
+
+logger = logging.getLogger(__name__)
+
+# local：单进程；remote：Web 工作进程，运行时在服务进程中；service：运行时服务进程本身
+RUNTIME_MODES = ('local', 'remote', 'service')
+
+MODBUS_HOST = 'localhost'
+MODBUS_PORT = 5020
+
+# Web 工作进程可以远程调用的运行时方法
+RUNTIME_METHODS = frozenset({
+    'modbus_status', 'modbus_interval', 'start_modbus', 'stop_modbus', 'set_modbus_interval',
+    'reload_modbus_points', 'modbus_point_values', 'modbus_snapshot',
+    'ensure_acquisition', 'current_values', 'active_alarms', 'alarm_snapshot', 'device_snapshot',
+    'filter_sample', 'reset_exception_filter', 'anomaly_scores', 'anomaly_active', 'anomaly_status',
+    'invalidate', 'submit_job', 'cancel_job', 'job_pool_status', 'submit_diagnosis', 'diagnosis_status'
+})
+
+# 在各进程间同步失效的缓存
+CACHES = {'events': event_engine, 'decisions': decision_engine, 'graphs': graph_index}
+
+# 每个工作进程转发队列的容量（同键更新合并，溢出时通知工作进程重新同步）
+RELAY_QUEUE_SIZE = 4096
+
+RELAY_HEARTBEAT = 15.0
+RECONNECT_DELAY = 2.0
+
+AUTHKEY_BYTES = 32
+
+
+class RuntimeUnavailable(RuntimeError):
+    """运行时服务进程不可用"""
+
+
+def default_address(basedir):
+    """默认 IPC 地址：POSIX 上为项目目录下的 Unix 套接字，其他平台为本机 TCP 端口"""
+    if os.name == 'posix':
+        return os.path.join(basedir, 'runtime.sock')
+    return ('127.0.0.1', 5021)
+
+
+def default_key_path(address, basedir):
+    """默认 IPC 认证密钥文件：Unix 套接字旁的同名 .key 文件，TCP 地址时为项目目录下的 runtime.key"""
+    if isinstance(address, str):
+        return os.path.splitext(address)[0] + '.key'
+    return os.path.join(basedir, 'runtime.key')
+
+
+def load_authkey(path, create=False):
+    """
+    读取 IPC 认证密钥文件（连接收发的消息会被反序列化，密钥不能是公开的默认值）
+    create 时（服务进程）文件不存在则生成随机密钥，权限为 0600；权限过宽的密钥文件拒绝使用
+    """
+    if create:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(AUTHKEY_BYTES).hex().encode())
+    with open(path, 'rb') as f:
+        if os.name == 'posix' and os.fstat(f.fileno()).st_mode & 0o077:
+            raise PermissionError(f'认证密钥文件 {path} 的权限过宽，应为 0600')
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f'认证密钥文件 {path} 为空')
+    return key
+
+
+def parse_address(text):
+    """'host:port' 解析为 TCP 地址，其余视为 Unix 套接字路径"""
+    if isinstance(text, str) and ':' in text and not text.startswith(('/', '.', '\\')):
+        host, port = text.rsplit(':', 1)
+        return (host, int(port))
+    return text
+
+
+def modbus_db_session(get_config=False, save_config=None):
+    """为Modbus服务器提供数据库会话的函数"""
+    if get_config:
+        # 获取配置
+        return ServerConfig.query.all()
+    elif save_config:
+        # 保存配置
+        config = ServerConfig.query.filter_by(key=save_config['key']).first()
+        if config:
+            config.value = save_config['value']
+            config.updated_at = datetime.utcnow()
+        else:
+            config = ServerConfig(
+                key=save_config['key'],
+                value=save_config['value'],
+                description='Modbus服务器更新间隔（秒）'
+            )
+            db.session.add(config)
+        db.session.commit()
+        return True
+    else:
+        # 获取激活的Modbus点位
+        return ModbusPoint.query.filter_by(is_active=True).all()
+
+
+class LocalRuntime:
+    """
+    进程内运行时（单进程部署，或运行时服务进程内部）
+    read_point_value(address) 在模拟器不在本进程中运行时通过 Modbus TCP 读取点位值
+    """
+    
+    remote = False
+    
+    def __init__(self, app, hub, diagnosis, read_point_value, values):
+        self.app = app
+        self.hub = hub
+        self.diagnosis = diagnosis
+        self.read_point_value = read_point_value
+        self.values = values  # 点位最新值表，由模拟线程写入
+        self.modbus_server = None
+        self.modbus_thread = None
+        self.acquisition = None
+        self.jobs = None  # 后台任务管理（JobManager），由应用设置
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """本地运行时的服务按需启动"""
+    
+    def stop(self):
+        """停止采集、诊断和模拟器"""
+        if self.acquisition is not None:
+            self.acquisition.stop()
+        if self.modbus_server is not None and self.modbus_server.running:
+            self.modbus_server.stop_simulation()
+        if self.diagnosis.running:
+            self.diagnosis.stop()
+        self.values.close()
+    
+    def value_table(self):
+        """点位最新值表"""
+        return self.values
+    
+    # 后台任务（多进程部署时 Web 工作进程提交的任务在服务进程的进程池中执行）
+    
+    def submit_job(self, job_type, params):
+        """提交后台任务，返回任务 id"""
+        return self.jobs.submit(job_type, params).id
+    
+    def cancel_job(self, job_id):
+        """取消后台任务，任务不存在时返回 False"""
+        return self.jobs.cancel(job_id) is not None
+    
+    def job_pool_status(self):
+        """进程池状态"""
+        return self.jobs.status()
+    
+    # 决策树诊断（多进程部署时 Web 工作进程提交的诊断在服务进程的诊断队列中执行）
+    
+    def submit_diagnosis(self, device_type_id, device_id, event_id, event_identifier, values, timestamp):
+        """提交诊断任务（必要时启动诊断工作线程），队列已满时返回 False"""
+        with self._lock:
+            if not self.diagnosis.running:
+                self.diagnosis.start()
+        return self.diagnosis.submit(device_type_id, device_id, event_id, event_identifier, values, timestamp)
+    
+    def diagnosis_status(self):
+        """诊断队列状态"""
+        return self.diagnosis.status()
+    
+    # Modbus 模拟器
+    
+    def modbus_status(self):
+        """获取Modbus服务器运行状态"""
+        running = self.modbus_server is not None and self.modbus_server.running
+        return {
+            'running': running,
+            'host': MODBUS_HOST,
+            'port': MODBUS_PORT
+        }
+    
+    def modbus_interval(self):
+        """获取Modbus服务器更新间隔"""
+        server = self.modbus_server
+        if server:
+            return server.update_interval
+        # 从数据库获取
+        with self.app.app_context():
+            config = ServerConfig.query.filter_by(key='modbus_update_interval').first()
+            return float(config.value) if config else 2.0  # 默认值
+    
+    def start_modbus(self):
+        """启动Modbus服务器，已在运行时返回 False"""
+        with self._lock:
+            if self.modbus_server is not None and self.modbus_server.running:
+                return False
+            
+            # 创建服务器实例，传递数据库会话函数和点位更新推送函数
+            self.modbus_server = DatabaseModbusServer(
+                modbus_db_session, MODBUS_HOST, MODBUS_PORT, on_update=self._modbus_updated
+            )
+            
+            # 新服务器重新加载点位配置，值表随第一轮模拟重新布局
+            self.values.set_points(())
+            
+            # 在单独线程中启动服务器
+            self.modbus_thread = threading.Thread(target=self.modbus_server.start_server)
+            self.modbus_thread.daemon = True
+            self.modbus_thread.start()
+        
+        time.sleep(1)  # 等待服务器启动
+        
+        self.publish_modbus_status()
+        self.ensure_acquisition()
+        return True
+    
+    def stop_modbus(self):
+        """停止Modbus服务器，未在运行时返回 False"""
+        with self._lock:
+            if self.modbus_server is None or not self.modbus_server.running:
+                return False
+            self.modbus_server.stop_simulation()
+            self.modbus_server = None
+            self.modbus_thread = None
+            self.values.set_active(False)
+        
+        self.publish_modbus_status()
+        return True
+    
+    def set_modbus_interval(self, interval):
+        """服务器正在运行时更新其间隔（配置已由调用方保存）"""
+        server = self.modbus_server
+        if server:
+            server.set_update_interval(interval)
+        self.publish_modbus_status()
+    
+    def reload_modbus_points(self):
+        """点位配置变化后，服务器正在运行时重新加载点位"""
+        server = self.modbus_server
+        if server:
+            server.load_points_from_db()
+            self.values.set_points([point.id for point in server.points])
+    
+    def modbus_point_values(self):
+        """所有点位的当前值 {point_id: {value, name}}，服务器未运行时返回 None"""
+        server = self.modbus_server
+        return server.get_point_values() if server is not None else None
+    
+    def modbus_snapshot(self):
+        """Modbus管理页面订阅的状态快照 [(键, 事件名, 数据)]"""
+        status = self.modbus_status()
+        status['interval'] = self.modbus_interval()
+        messages = [('server', 'status', status)]
+        for point_id, item in (self.modbus_point_values() or {}).items():
+            messages.append((f'point:{point_id}', 'point', {
+                'id': point_id,
+                'name': item['name'],
+                'value': item['value']
+            }))
+        return messages
+    
+    def publish_modbus_status(self):
+        """推送Modbus服务器状态和更新间隔"""
+        status = self.modbus_status()
+        status['interval'] = self.modbus_interval()
+        self.hub.publish('modbus', 'server', 'status', status)
+    
+    def _modbus_updated(self, values):
+        """模拟线程每轮更新后写入值表并推送"""
+        self.values.update({point_id: item['value'] for point_id, item in values.items()})
+        self.publish_modbus_points(values)
+    
+    def publish_modbus_points(self, values):
+        """模拟线程更新点位值后推送到Modbus管理页面"""
+        for point_id, item in values.items():
+            self.hub.publish('modbus', f'point:{point_id}', 'point', {
+                'id': point_id,
+                'name': item['name'],
+                'value': item['value']
+            })
+    
+    # 设备数据采集
+    
+    def read_point_values(self):
+        """读取所有Modbus点位的当前值，供采集服务使用"""
+        server = self.modbus_server
+        if server is not None and server.running:
+            return {point_id: item['value'] for point_id, item in server.get_point_values().items()}
+        
+        # 服务器不在本进程中运行时，通过Modbus TCP读取
+        values = {}
+        for point in ModbusPoint.query.filter_by(is_active=True).all():
+            values[point.id] = self.read_point_value(point.address)
+        return values
+    
+    def ensure_acquisition(self):
+        """获取（必要时启动）设备数据采集服务和决策树诊断工作线程"""
+        with self._lock:
+            if self.acquisition is None:
+                if not self.diagnosis.running:
+                    self.diagnosis.start()
+                interval = 10.0
+                with self.app.app_context():
+                    config = ServerConfig.query.filter_by(key='acquisition_interval').first()
+                    if config:
+                        interval = float(config.value)
+                self.acquisition = AcquisitionService(
+                    self.app, self.read_point_values, self.hub, interval, diagnosis=self.diagnosis
+                )
+                self.acquisition.start()
+        return self.acquisition
+    
+    def _running_acquisition(self):
+        service = self.acquisition
+        return service if service is not None and service.running else None
+    
+    def current_values(self, device_ids):
+        """设备最近一轮采集的属性值 {device_id: {属性标识符: 值}}，采集服务未运行时为空"""
+        service = self._running_acquisition()
+        return service.current_values(device_ids) if service else {}
+    
+    def active_alarms(self):
+        """当前处于触发状态的事件，采集服务未运行时返回 None"""
+        service = self._running_acquisition()
+        return service.active_alarms() if service else None
+    
+    def alarm_snapshot(self):
+        return self.ensure_acquisition().alarm_snapshot()
+    
+    def device_snapshot(self, device_id):
+        return self.ensure_acquisition().device_snapshot(device_id)
+    
+    def filter_sample(self, device_id, property_id, config, value, timestamp):
+        """按死区配置过滤一个采样，返回需要存储的 [(时间戳, 值)]（例外报告的状态与采集服务共享）"""
+        return exception_filter.offer(device_id, property_id, config, value, timestamp)
+    
+    def reset_exception_filter(self, device_id=None, property_id=None):
+        exception_filter.reset(device_id=device_id, property_id=property_id)
+    
+    def anomaly_scores(self, device_id):
+        return anomaly_detector.device_scores(device_id)
+    
+    def anomaly_active(self):
+        return anomaly_detector.active()
+    
+    def anomaly_status(self):
+        return anomaly_detector.status()
+    
+    def invalidate(self, cache, key=None):
+        """使缓存失效（其他进程中的写入通知）"""
+        CACHES[cache].invalidate(key)
+
+
+class RuntimeServer:
+    """
+    运行时服务：在 IPC 地址上接受 Web 工作进程的连接
+    普通连接为请求/响应：(方法名, 参数) → ('ok', 结果) 或 ('error', 说明)；
+    发送 ('subscribe', ()) 的连接转为推送通道，持续接收推送消息和缓存失效通知
+    """
+    
+    def __init__(self, runtime, address, authkey):
+        self.runtime = runtime
+        self.address = address
+        self.authkey = authkey
+        self._relays = set()
+        self._lock = threading.Lock()
+        runtime.hub.taps.append(self._forward)
+        for name, cache in CACHES.items():
+            cache.listeners.append(functools.partial(self._broadcast_invalidation, name))
+    
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # 上次异常退出遗留的套接字文件
+            os.unlink(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            logger.info(f"运行时服务已启动: {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError) as e:
+                    # 认证失败或连接中途断开，不影响其他连接
+                    logger.warning(f"拒绝运行时连接: {e}")
+                    continue
+                thread = threading.Thread(target=self._handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+    
+    def _handle(self, conn):
+        try:
+            while True:
+                method, args = conn.recv()
+                if method == 'subscribe':
+                    self._relay(conn)
+                    return
+                if method not in RUNTIME_METHODS:
+                    conn.send(('error', f'未知的运行时方法: {method}'))
+                    continue
+                try:
+                    with self.runtime.app.app_context():
+                        result = getattr(self.runtime, method)(*args)
+                    conn.send(('ok', result))
+                except Exception as e:
+                    logger.error(f"运行时方法 {method} 出错: {e}")
+                    conn.send(('error', str(e)))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+    
+    def _relay(self, conn):
+        """推送通道：更新按 (主题, 键) 合并后依次发送，工作进程处理不及时只会丢失中间值"""
+        queue = StreamSubscriber((), RELAY_QUEUE_SIZE)
+        with self._lock:
+            self._relays.add(queue)
+        try:
+            while True:
+                message = queue.pop(RELAY_HEARTBEAT)
+                if message is None:
+                    conn.send(('ping',))
+                    continue
+                event, data = message
+                conn.send(('resync',) if event == 'resync' else data)
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._relays.discard(queue)
+            queue.close()
+    
+    def _push(self, key, event, message):
+        with self._lock:
+            relays = list(self._relays)
+        for queue in relays:
+            queue.push(key, event, message)
+    
+    def _forward(self, topic, key, event, data):
+        self._push((topic, key), event, ('publish', topic, key, event, data))
+    
+    def _broadcast_invalidation(self, name, key):
+        self._push(('invalidate', name, key), 'invalidate', ('invalidate', name, key))
+
+
+class RemoteRuntime:
+    """
+    Web 工作进程中的运行时代理：方法调用经 IPC 转发到运行时服务进程（每个线程一个连接），
+    后台转发线程把服务进程的推送消息发布到本进程的推送中心，并应用其他进程的缓存失效通知
+    """
+    
+    remote = True
+    
+    def __init__(self, hub, address, authkey, table_name, key_file=None):
+        self.hub = hub
+        self.address = address
+        self.authkey = authkey
+        self.key_file = key_file
+        self.table_name = table_name
+        self._values = None
+        self._local = threading.local()
+        self._relay_thread = None
+        self._lock = threading.Lock()
+    
+    def __getattr__(self, name):
+        if name in RUNTIME_METHODS:
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+    
+    def _authkey(self):
+        # 未配置密钥时每次连接读取服务进程生成的密钥文件（服务进程可能晚于工作进程启动或已重新生成密钥）
+        return self.authkey or load_authkey(self.key_file)
+    
+    def _connect(self):
+        try:
+            return Client(self.address, authkey=self._authkey())
+        except (OSError, EOFError, ValueError, AuthenticationError) as e:
+            raise RuntimeUnavailable(f'运行时服务不可用: {e}')
+    
+    def call(self, method, *args):
+        """调用服务进程中的运行时方法，连接断开时重连一次"""
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            try:
+                conn.send((method, args))
+                status, result = conn.recv()
+                break
+            except (EOFError, OSError) as e:
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise RuntimeUnavailable(f'运行时服务不可用: {e}')
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+    
+    def start(self):
+        """启动推送转发线程并登记缓存失效回调（在工作进程中首次处理请求时调用）"""
+        if self._relay_thread is not None:
+            return
+        with self._lock:
+            if self._relay_thread is not None:
+                return
+            for name, cache in CACHES.items():
+                cache.listeners.append(functools.partial(self._forward_invalidation, name))
+            self._relay_thread = threading.Thread(target=self._relay_worker)
+            self._relay_thread.daemon = True
+            self._relay_thread.start()
+    
+    def stop(self):
+        """运行时由服务进程管理"""
+        self._drop_values()
+    
+    def value_table(self):
+        """映射服务进程的点位最新值表，服务进程未启动或已关闭值表时返回 None"""
+        table = self._values
+        if table is not None and not table.valid:
+            self._drop_values()
+            table = None
+        if table is None:
+            table = self._values = ValueTable.attach(self.table_name)
+        return table
+    
+    def _drop_values(self):
+        table, self._values = self._values, None
+        if table is not None:
+            table.close()
+    
+    def _forward_invalidation(self, name, key):
+        # 转发线程应用的是其他进程的通知，不再回传
+        if threading.current_thread() is self._relay_thread:
+            return
+        try:
+            self.call('invalidate', name, key)
+        except RuntimeUnavailable as e:
+            logger.warning(f"缓存失效通知未能发送到运行时服务: {e}")
+    
+    def _invalidate_all(self):
+        for cache in CACHES.values():
+            cache.invalidate()
+    
+    def _relay_worker(self):
+        while True:
+            try:
+                conn = Client(self.address, authkey=self._authkey())
+            except (OSError, EOFError, ValueError, AuthenticationError):
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                conn.send(('subscribe', ()))
+                # 连接（重新）建立：断开期间的推送和失效通知可能已丢失，服务进程重启后值表也已重建
+                self._drop_values()
+                self._invalidate_all()
+                self.hub.resync()
+                while True:
+                    message = conn.recv()
+                    kind = message[0]
+                    if kind == 'publish':
+                        self.hub.publish(*message[1:])
+                    elif kind == 'invalidate':
+                        CACHES[message[1]].invalidate(message[2])
+                    elif kind == 'resync':
+                        self._invalidate_all()
+                        self.hub.resync()
+            except (EOFError, OSError) as e:
+                logger.warning(f"与运行时服务的推送连接断开: {e}")
+            finally:
+                conn.close()
+            time.sleep(RECONNECT_DELAY)
+
+
+def create_runtime(app, hub, diagnosis, read_point_value):
+    """按 app.config['RUNTIME_MODE'] 创建运行时"""
+    mode = app.config.get('RUNTIME_MODE', 'local')
+    if mode not in RUNTIME_MODES:
+        raise ValueError(f'不支持的运行时模式: {mode}')
+    if mode == 'remote':
+        return RemoteRuntime(
+            hub, app.config['RUNTIME_ADDRESS'], app.config['RUNTIME_AUTHKEY'], app.config['RUNTIME_VALUE_TABLE'],
+            app.config['RUNTIME_AUTHKEY_FILE']
+        )
+    # 服务进程把值表放在共享内存中供工作进程映射，单进程部署使用进程内存
+    name = app.config['RUNTIME_VALUE_TABLE'] if mode == 'service' else None
+    values = ValueTable.create(app.config['RUNTIME_VALUE_CAPACITY'], name)
+    return LocalRuntime(app, hub, diagnosis, read_point_value, values)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+运行时服务进程（多进程部署）
+Modbus模拟器、设备数据采集、事件计算、决策树诊断和后台任务进程池在本进程中运行，
+最新属性值、告警状态和实时推送经本地 IPC 提供给任意数量的无状态 Web 工作进程。
+
+用法：
+    python runtime_service.py [--modbus]
+    RUNTIME_MODE=remote gunicorn -k gthread --threads 16 -w 4 app:app
+
+两端的 RUNTIME_ADDRESS（Unix 套接字路径或 host:port，默认为项目目录下的 runtime.sock）需一致。
+连接以 RUNTIME_AUTHKEY 认证；未设置时本进程在 RUNTIME_AUTHKEY_FILE（默认为套接字旁的 runtime.key）
+生成随机密钥（权限 0600），工作进程读取同一文件，两端需以同一用户运行。
+"""
+
+import argparse
+import logging
+import os
+import signal
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='运行时服务进程')
+    parser.add_argument('--modbus', action='store_true', help='启动时同时启动Modbus模拟器')
+    args = parser.parse_args()
+    
+    # 导入 app 前设置：本进程持有运行时，不连接其他服务进程。
+    # 在 main 中导入：后台任务工作进程（spawn）会重新导入本模块，不能在其中再创建运行时
+    os.environ['RUNTIME_MODE'] = 'service'
+    from value_table import ValueTableInUse
+    try:
+        from app import app, runtime, get_job_manager
+    except ValueTableInUse as e:
+        sys.exit(f'运行时服务未启动: {e}')
+    from runtime import RuntimeServer, load_authkey
+    
+    authkey = app.config['RUNTIME_AUTHKEY'] or load_authkey(app.config['RUNTIME_AUTHKEY_FILE'], create=True)
+    server = RuntimeServer(runtime, app.config['RUNTIME_ADDRESS'], authkey)
+    # 按 SIGTERM 停止时同样执行清理（删除共享内存值表）
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    runtime.ensure_acquisition()
+    if args.modbus:
+        runtime.start_modbus()
+    # 进程池只在本进程中运行，启动时把上次服务退出时未完成的任务标记为失败
+    job_manager = get_job_manager()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("运行时服务正在停止")
+    finally:
+        job_manager.stop(wait=False)
+        runtime.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+大结果集的快速序列化
+查询只选取需要的列，按元组取出（不构造 ORM 对象），时间戳以文本取出后批量格式化为 ISO 字符串或 Unix 毫秒，
+安装了 orjson 时用其编码，否则退回标准库 json。
+时间序列支持列式结构 {"t": [...], "v": [...]}，比逐行字典小数倍。
+"""
+
+import json
+import math
+
+import numpy as np
+from flask import Response
+
+from models import db
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SHAPES = ('rows', 'columns')
+TIME_FORMATS = ('iso', 'ms')
+
+
+class SerializationError(ValueError):
+    """序列化参数无效"""
+
+
+def request_options(args):
+    """从查询参数读取 (结构, 时间格式)：format=rows|columns，time=iso|ms"""
+    shape = args.get('format', 'rows')
+    time_format = args.get('time', 'iso')
+    if shape not in SHAPES:
+        raise SerializationError(f'不支持的返回结构: {shape}，可选 {", ".join(SHAPES)}')
+    if time_format not in TIME_FORMATS:
+        raise SerializationError(f'不支持的时间格式: {time_format}，可选 {", ".join(TIME_FORMATS)}')
+    return shape, time_format
+
+
+def dumps(payload):
+    """编码为 UTF-8 JSON 字节串（NaN、正负无穷编码为 null）"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_finite_only(payload), ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _finite_only(payload):
+    # 标准库 json 会输出非法的 NaN / Infinity，只在退回路径上逐层替换，与 orjson 的输出一致
+    if isinstance(payload, float):
+        return payload if math.isfinite(payload) else None
+    if isinstance(payload, dict):
+        return {key: _finite_only(value) for key, value in payload.items()}
+    if isinstance(payload, (list, tuple)):
+        return [_finite_only(value) for value in payload]
+    if isinstance(payload, np.ndarray):
+        return _finite_only(payload.tolist())
+    return payload
+
+
+def json_response(payload, status=200):
+    """与 jsonify 相同用途的响应，使用快速编码器"""
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def time_text(column):
+    """以文本选取时间戳列，由 format_times 批量格式化"""
+    return db.cast(column, db.String)
+
+
+def format_times(texts, time_format='iso'):
+    """
+    数据库时间戳文本（'YYYY-MM-DD HH:MM:SS[.ffffff]'）批量格式化
+    iso 与 datetime.isoformat() 结果一致，ms 为 Unix 毫秒（时间戳按 UTC 存储）
+    """
+    if time_format == 'ms':
+        if not texts:
+            return []
+        present = [text for text in texts if text is not None]
+        if len(present) == len(texts):
+            return np.array(texts, dtype='datetime64[ms]').astype(np.int64).tolist()
+        millis = iter(np.array(present, dtype='datetime64[ms]').astype(np.int64).tolist())
+        return [next(millis) if text is not None else None for text in texts]
+    result = []
+    for text in texts:
+        if text is None:
+            result.append(None)
+            continue
+        text = text.replace(' ', 'T', 1)
+        # isoformat() 在微秒为 0 时省略小数部分
+        if text.endswith('.000000'):
+            text = text[:-7]
+        result.append(text)
+    return result
+
+
+def format_epoch(seconds, time_format='iso'):
+    """Unix 秒（float64 数组，NaN 表示无时间戳）批量格式化，与 format_times 的输出格式相同"""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    present = ~np.isnan(seconds)
+    micros = np.round(np.where(present, seconds, 0.0) * 1e6).astype(np.int64)
+    if time_format == 'ms':
+        formatted = (micros // 1000).tolist()
+    else:
+        formatted = [
+            text[:-7] if text.endswith('.000000') else text
+            for text in np.datetime_as_string(micros.astype('datetime64[us]'), unit='us').tolist()
+        ]
+    if present.all():
+        return formatted
+    return [text if flag else None for text, flag in zip(formatted, present.tolist())]
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def numeric_column(values):
+    """值列转为数值列表，无法转换的值（如状态文本）保持原值"""
+    try:
+        return np.array(values, dtype=np.float64).tolist()
+    except (TypeError, ValueError):
+        return [_to_number(value) for value in values]
+
+
+def rows_payload(names, rows, time_field, time_format='iso'):
+    """
+    逐行字典结构：rows 为按 names 顺序选取的元组，time_field 列为时间戳文本
+    返回 [{列名: 值}]
+    """
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    index = names.index(time_field)
+    columns[index] = format_times(columns[index], time_format)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def columns_payload(names, rows, time_field, value_field, time_format='iso', numeric=True):
+    """
+    列式结构 {"t": [...], "v": [...]}，其余列以列名为键（如 id）
+    numeric 为 True 时值列尽量转为数值
+    """
+    columns = dict(zip(names, zip(*rows))) if rows else {name: () for name in names}
+    payload = {
+        't': format_times(list(columns.pop(time_field)), time_format),
+        'v': numeric_column(columns[value_field]) if numeric else list(columns[value_field])
+    }
+    del columns[value_field]
+    for name, column in columns.items():
+        payload[name] = list(column)
+    return payload
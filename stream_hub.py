@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+实时推送中心（Server-Sent Events）
+每个客户端持有一个有界队列，同一键的未发送更新会被新值合并覆盖，
+慢速客户端只会收到最新状态而不会无限堆积。
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+
+# 队列溢出时放入的重新同步标记键
+RESYNC_KEY = '__resync__'
+
+
+class StreamSubscriber:
+    """单个客户端的订阅，按键合并未发送的更新"""
+    
+    def __init__(self, topics, maxsize=256):
+        self.topics = frozenset(topics)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pending = OrderedDict()  # 键 → (事件名, 数据)
+        self._condition = threading.Condition()
+        self._closed = False
+    
+    def push(self, key, event, data):
+        """放入一条更新；同键的旧更新直接被替换"""
+        with self._condition:
+            if self._closed:
+                return
+            if key not in self._pending and len(self._pending) >= self.maxsize:
+                # 队列已满：丢弃积压内容，改为通知客户端重新同步当前状态
+                self.dropped += len(self._pending)
+                self._pending.clear()
+                self._pending[RESYNC_KEY] = ('resync', {'dropped': self.dropped})
+            else:
+                self._pending[key] = (event, data)
+            self._condition.notify()
+    
+    def pop(self, timeout):
+        """取出最早的一条更新，超时返回 None（用于发送心跳）"""
+        with self._condition:
+            if not self._pending and not self._closed:
+                self._condition.wait(timeout)
+            if not self._pending:
+                return None
+            _, message = self._pending.popitem(last=False)
+            return message
+    
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+    
+    @property
+    def closed(self):
+        return self._closed
+
+
+class StreamHub:
+    """按主题分发更新到所有订阅者"""
+    
+    def __init__(self):
+        self._topics = {}  # 主题 → 订阅者集合
+        self._lock = threading.Lock()
+        self.taps = []  # 接收全部主题更新的回调 f(主题, 键, 事件名, 数据)，用于转发到其他进程
+    
+    def subscribe(self, topics, maxsize=256):
+        subscriber = StreamSubscriber(topics, maxsize)
+        with self._lock:
+            for topic in subscriber.topics:
+                self._topics.setdefault(topic, set()).add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            for topic in subscriber.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._topics[topic]
+    
+    def has_subscribers(self, topic):
+        with self._lock:
+            return bool(self._topics.get(topic))
+    
+    def publish(self, topic, key, event, data):
+        """向主题的所有订阅者推送一条更新"""
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        for subscriber in subscribers:
+            subscriber.push(key, event, data)
+        for tap in self.taps:
+            tap(topic, key, event, data)
+    
+    def resync(self):
+        """通知全部订阅者重新同步当前状态（上游连接中断或丢失更新后）"""
+        with self._lock:
+            subscribers = {subscriber for subscribers in self._topics.values() for subscriber in subscribers}
+        for subscriber in subscribers:
+            subscriber.push(RESYNC_KEY, 'resync', {'dropped': subscriber.dropped})
+
+
+def format_sse(event, data):
+    """格式化为SSE消息"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f'event: {event}\ndata: {payload}\n\n'
+
+
+def sse_stream(hub, subscriber, prime=None, heartbeat=15.0):
+    """
+    SSE响应生成器
+    prime(subscriber) 用于连接建立和队列溢出后推送当前状态快照
+    """
+    try:
+        if prime is not None:
+            prime(subscriber)
+        yield 'retry: 3000\n\n'
+        while True:
+            message = subscriber.pop(heartbeat)
+            if message is None:
+                if subscriber.closed:
+                    break
+                yield ': heartbeat\n\n'
+                continue
+            event, data = message
+            if event == 'resync' and prime is not None:
+                prime(subscriber)
+            yield format_sse(event, data)
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+# 全局推送中心实例
+stream_hub = StreamHub()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+时间序列加载与对齐
+每条序列用一次范围查询读取，再对齐到公共时间网格上，得到 [序列, 时刻] 的二维矩阵。
+支持最近值 / 线性 / 前值保持三种插值方式、最大间隔屏蔽以及按时间桶聚合。
+时间统一用 int64 微秒表示，所有运算都在 NumPy 数组上完成。
+"""
+
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from models import db, PropertyHistory
+
+
+INTERPOLATION_METHODS = ('nearest', 'linear', 'previous')
+BUCKET_AGGREGATES = ('mean', 'min', 'max', 'sum', 'count', 'first', 'last')
+
+# 对齐结果：grid 为网格时刻（datetime64[us]），values 为 [序列, 时刻] 矩阵（被屏蔽处为 NaN），
+# mask 为有效值标记
+AlignedSeries = namedtuple('AlignedSeries', ['grid', 'values', 'mask'])
+
+
+def parse_utc_time(text):
+    """
+    ISO 8601 时间文本解析为 naive UTC datetime（历史数据按 UTC 存储）
+    带时区偏移的先换算到 UTC，不带时区的视为 UTC，空值返回 None
+    """
+    if not text:
+        return None
+    value = datetime.fromisoformat(str(text).strip().replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _point_query(device_id, property_id, start=None, end=None):
+    """点位历史的范围查询，时间戳按文本取出，由 NumPy 批量解析，避免逐行构造 ORM 对象和 datetime"""
+    table = PropertyHistory.__table__
+    query = db.select(db.cast(table.c.timestamp, db.String), table.c.value).where(
+        table.c.device_id == device_id,
+        table.c.property_id == property_id
+    )
+    if start is not None:
+        query = query.where(table.c.timestamp >= start)
+    if end is not None:
+        query = query.where(table.c.timestamp <= end)
+    return query.order_by(table.c.timestamp)
+
+
+def _rows_to_arrays(rows):
+    """(时间戳文本, 值) 行转换为 (datetime64[us] 数组, float64 数组)，丢弃非数值采样"""
+    if not rows:
+        return np.empty(0, dtype='datetime64[us]'), np.empty(0, dtype=np.float64)
+    
+    timestamps, values = zip(*rows)
+    times = np.array(timestamps, dtype='datetime64[us]')
+    try:
+        numbers = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        # 存在非数值采样时逐个转换
+        numbers = np.fromiter((_to_float(value) for value in values), dtype=np.float64, count=len(values))
+    mask = np.isfinite(numbers)
+    if not mask.all():
+        times, numbers = times[mask], numbers[mask]
+    return times, numbers
+
+
+def load_point_series(device_id, property_id, start=None, end=None):
+    """
+    加载一个点位的全部历史数据
+    返回 (时间戳数组 datetime64[us], 数值数组 float64)，按时间升序，非数值采样被丢弃
+    """
+    return _rows_to_arrays(db.session.execute(_point_query(device_id, property_id, start, end)).all())
+
+
+def iter_point_chunks(device_id, property_id, start=None, end=None, chunk_size=65536):
+    """按固定大小分块流式读取一个点位的历史数据，逐块产出 (times, values)，内存占用与序列长度无关"""
+    result = db.session.execute(
+        _point_query(device_id, property_id, start, end).execution_options(yield_per=chunk_size)
+    )
+    for rows in result.partitions(chunk_size):
+        times, values = _rows_to_arrays(rows)
+        if times.size:
+            yield times, values
+
+
+def point_fingerprint(device_id, property_id, start=None, end=None):
+    """
+    点位在时间范围内历史数据的指纹 (行数, 最大ID, 最新时间戳)
+    范围内的数据被插入、补录或删除时行数或最大ID会变化，用于判断缓存的分析结果是否仍然有效
+    """
+    table = PropertyHistory.__table__
+    query = db.select(db.func.count(table.c.id), db.func.max(table.c.id), db.func.max(table.c.timestamp)).where(
+        table.c.device_id == device_id,
+        table.c.property_id == property_id
+    )
+    if start is not None:
+        query = query.where(table.c.timestamp >= start)
+    if end is not None:
+        query = query.where(table.c.timestamp <= end)
+    return tuple(db.session.execute(query).one())
+
+
+def _micros(times):
+    """datetime64 转为 int64 微秒"""
+    return np.asarray(times, dtype='datetime64[us]').astype(np.int64)
+
+
+def bucket_series(times, values, origin, step, aggregate='mean'):
+    """
+    按固定步长分桶聚合，times 为升序 int64 微秒
+    返回 (桶起始时刻, 聚合值)，只包含有采样的桶；采样有序，因此每个桶是连续区间，整体 O(n)
+    """
+    if aggregate not in BUCKET_AGGREGATES:
+        raise ValueError(f'不支持的聚合方式: {aggregate}')
+    if times.size == 0:
+        return times, values
+    buckets = (times - origin) // step
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    bucket_times = origin + buckets[starts] * step
+    if aggregate == 'first':
+        result = values[starts]
+    elif aggregate == 'last':
+        result = values[np.r_[starts[1:] - 1, values.size - 1]]
+    elif aggregate == 'min':
+        result = np.minimum.reduceat(values, starts)
+    elif aggregate == 'max':
+        result = np.maximum.reduceat(values, starts)
+    else:
+        sums = np.add.reduceat(values, starts)
+        counts = np.diff(np.r_[starts, values.size]).astype(np.float64)
+        result = {'sum': sums, 'count': counts, 'mean': sums / counts}[aggregate]
+    return bucket_times, result
+
+
+def resample(times, values, grid, method='linear', max_gap=None):
+    """
+    将一条升序序列插值到网格上（times 与 grid 均为 int64 微秒）
+    max_gap（微秒）：线性插值时两侧采样间隔、最近值/前值方式下与所取采样的距离超过它时屏蔽
+    返回 (数值数组, 有效值标记)
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError(f'不支持的插值方式: {method}')
+    result = np.full(grid.size, np.nan)
+    if times.size == 0:
+        return result, np.zeros(grid.size, dtype=bool)
+    
+    right = np.searchsorted(times, grid, side='left')  # 第一个 >= 网格时刻的采样
+    exact = (right < times.size) & (times[np.minimum(right, times.size - 1)] == grid)
+    previous = np.where(exact, right, right - 1)  # 最后一个 <= 网格时刻的采样
+    has_previous = previous >= 0
+    has_next = right < times.size
+    prev_index = np.maximum(previous, 0)
+    next_index = np.minimum(right, times.size - 1)
+    
+    if method == 'previous':
+        valid = has_previous
+        result[valid] = values[prev_index[valid]]
+        distance = grid - times[prev_index]
+    elif method == 'nearest':
+        use_next = has_next & (~has_previous | ((times[next_index] - grid) < (grid - times[prev_index])))
+        index = np.where(use_next, next_index, prev_index)
+        valid = has_previous | has_next
+        result[valid] = values[index[valid]]
+        distance = np.abs(times[index] - grid)
+    else:
+        # 只在采样覆盖范围内插值，不外推
+        valid = has_previous & (exact | has_next)
+        x0, x1 = times[prev_index], times[next_index]
+        y0, y1 = values[prev_index], values[next_index]
+        span = (x1 - x0).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(span > 0, (grid - x0) / span, 0.0)
+        interpolated = y0 + (y1 - y0) * weight
+        result[valid] = interpolated[valid]
+        distance = np.where(exact, 0, x1 - x0)
+    
+    if max_gap is not None:
+        valid &= distance <= max_gap
+        result[~valid] = np.nan
+    return result, valid
+
+
+def make_grid(series, start=None, end=None, step=None):
+    """
+    生成公共时间网格（int64 微秒）
+    指定 step 时为 [start, end] 上的等间隔网格（未指定范围时取各序列的公共时间段），
+    否则为各序列时间戳的并集
+    """
+    non_empty = [times for times in series if times.size]
+    if not non_empty:
+        return np.empty(0, dtype=np.int64)
+    if step is None:
+        # 各序列本身有序，稳定排序会识别已排序的区段并归并，接近线性时间
+        merged = np.sort(np.concatenate(non_empty), kind='stable')
+        grid = merged[np.r_[True, merged[1:] != merged[:-1]]]
+        if start is not None:
+            grid = grid[grid >= start]
+        if end is not None:
+            grid = grid[grid <= end]
+        return grid
+    if start is None:
+        start = max(times[0] for times in non_empty)
+    if end is None:
+        end = min(times[-1] for times in non_empty)
+    if end < start:
+        return np.empty(0, dtype=np.int64)
+    return np.arange(start, end + 1, step, dtype=np.int64)
+
+
+def align_series(series, start=None, end=None, step=None, method='linear', max_gap=None, aggregate=None):
+    """
+    将已加载的多条序列 [(times, values), ...] 对齐到公共网格
+    step、max_gap 单位为秒；指定 aggregate 时先按 step 分桶聚合，再把空桶按 method 填补
+    """
+    step_us = int(step * 1e6) if step else None
+    max_gap_us = int(max_gap * 1e6) if max_gap is not None else None
+    start_us = int(_micros(np.datetime64(start, 'us'))) if start is not None else None
+    end_us = int(_micros(np.datetime64(end, 'us'))) if end is not None else None
+    
+    prepared = [(_micros(times), np.asarray(values, dtype=np.float64)) for times, values in series]
+    if aggregate is not None:
+        if not step_us:
+            raise ValueError('按时间桶聚合需要指定步长')
+        non_empty = [times for times, _ in prepared if times.size]
+        origin = start_us
+        if origin is None and non_empty:
+            origin = min(int(times[0]) for times in non_empty)
+            origin -= origin % step_us
+        prepared = [bucket_series(times, values, origin, step_us, aggregate) for times, values in prepared]
+    
+    grid = make_grid([times for times, _ in prepared], start_us, end_us, step_us)
+    matrix = np.full((len(prepared), grid.size), np.nan)
+    mask = np.zeros((len(prepared), grid.size), dtype=bool)
+    for i, (times, values) in enumerate(prepared):
+        matrix[i], mask[i] = resample(times, values, grid, method, max_gap_us)
+    return AlignedSeries(grid.astype('datetime64[us]'), matrix, mask)
+
+
+def load_aligned(points, start=None, end=None, step=None, method='linear', max_gap=None, aggregate=None,
+                 loader=load_point_series):
+    """
+    加载多个 (device_id, property_id) 点位并对齐到公共网格，每个点位一次范围查询
+    返回 AlignedSeries，values 的第 i 行对应 points[i]
+    """
+    series = [loader(device_id, property_id, start, end) for device_id, property_id in points]
+    return align_series(series, start, end, step, method, max_gap, aggregate)
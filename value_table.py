@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+点位最新值表（共享内存）
+固定布局的结构数组：64 字节表头之后依次为点位 id（int64，升序）、值（float64）、时间戳（float64，Unix 秒）、质量（uint8），
+由运行时进程中的唯一写入方更新，Web 工作进程映射同一段共享内存直接读取，不经过进程间调用。
+并发控制采用顺序锁：写入前后各把序号加一（奇数表示正在写），
+读取方复制数据后检查序号未变，否则重试，读取方永远不会阻塞写入方。
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x4F4D56414C554553  # 表头标识，段关闭时清零
+DEFAULT_CAPACITY = 65536
+HEADER_SIZE = 64
+
+# 表头字段下标（uint64）
+_MAGIC, _CAPACITY, _COUNT, _SEQUENCE, _LAYOUT, _ACTIVE, _INSTANCE, _OWNER = range(8)
+_ONE = np.uint64(1)
+
+QUALITY_BAD = 0  # 尚无有效值
+QUALITY_GOOD = 1
+
+# 读取方连续遇到写入的最大重试次数
+MAX_READ_RETRIES = 1000
+
+ValueSnapshot = namedtuple('ValueSnapshot', 'instance layout active ids values timestamps quality')
+
+
+class ValueTableBusy(RuntimeError):
+    """读取方多次重试仍未取得一致的快照"""
+
+
+class ValueTableInUse(RuntimeError):
+    """同名的共享内存段仍由运行中的写入进程持有"""
+
+
+def default_table_name(basedir):
+    """共享内存段名称：按项目目录区分，同一部署的服务进程和工作进程得到相同的名称"""
+    return 'om_values_' + hashlib.sha1(os.path.abspath(basedir).encode('utf-8')).hexdigest()[:12]
+
+
+def table_size(capacity):
+    return HEADER_SIZE + capacity * (8 + 8 + 8 + 1)
+
+
+def _process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 进程存在但属于其他用户
+        return True
+    return True
+
+
+def _live_owner(name):
+    """已存在的同名共享内存段的写入进程 pid，段已关闭或写入进程已退出（遗留段）时返回 None"""
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+    if os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        if shm.size < HEADER_SIZE:
+            return None
+        header = np.ndarray((8,), dtype=np.uint64, buffer=shm.buf)
+        magic, owner = int(header[_MAGIC]), int(header[_OWNER])
+        del header
+    finally:
+        shm.close()
+    if magic == MAGIC and _process_alive(owner):
+        return owner
+    return None
+
+
+class ValueTable:
+    """
+    点位最新值表
+    ValueTable.create(capacity, name) 由写入方创建（name 为 None 时使用进程内存，用于单进程部署），
+    ValueTable.attach(name) 由读取方映射已存在的共享内存段
+    """
+    
+    def __init__(self, buffer, shm=None, owner=False):
+        self._shm = shm
+        self._owner = owner
+        header = np.ndarray((8,), dtype=np.uint64, buffer=buffer)
+        capacity = int(header[_CAPACITY])
+        offset = HEADER_SIZE
+        ids = np.ndarray((capacity,), dtype=np.int64, buffer=buffer, offset=offset)
+        offset += capacity * 8
+        values = np.ndarray((capacity,), dtype=np.float64, buffer=buffer, offset=offset)
+        offset += capacity * 8
+        timestamps = np.ndarray((capacity,), dtype=np.float64, buffer=buffer, offset=offset)
+        offset += capacity * 8
+        quality = np.ndarray((capacity,), dtype=np.uint8, buffer=buffer, offset=offset)
+        self._arrays = (header, ids, values, timestamps, quality)
+        self.capacity = capacity
+        self._slots = {}  # 写入方：点位 id → 槽位
+        self._write_lock = threading.Lock()
+    
+    @classmethod
+    def create(cls, capacity=DEFAULT_CAPACITY, name=None):
+        """
+        创建并初始化值表；同名的遗留共享内存段（上次异常退出）会被替换，
+        仍由运行中的写入进程持有时抛出 ValueTableInUse
+        """
+        size = table_size(capacity)
+        shm = None
+        if name is None:
+            buffer = bytearray(size)
+        else:
+            try:
+                shm = SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                owner = _live_owner(name)
+                if owner is not None:
+                    raise ValueTableInUse(f'值表 {name} 正由进程 {owner} 使用，同一部署只能运行一个运行时服务进程')
+                logger.warning(f"替换遗留的值表共享内存段 {name}")
+                stale = SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                shm = SharedMemory(name=name, create=True, size=size)
+            buffer = shm.buf
+        header = np.ndarray((8,), dtype=np.uint64, buffer=buffer)
+        header[:] = 0
+        header[_CAPACITY] = capacity
+        header[_INSTANCE] = int.from_bytes(os.urandom(8), 'little') >> 1
+        header[_OWNER] = os.getpid()
+        header[_MAGIC] = MAGIC
+        del header
+        return cls(buffer, shm, owner=True)
+    
+    @classmethod
+    def attach(cls, name):
+        """映射已存在的值表，不存在或已关闭时返回 None"""
+        try:
+            shm = SharedMemory(name=name)
+        except (FileNotFoundError, ValueError):
+            return None
+        # 读取方不拥有共享内存段，避免进程退出时被资源跟踪进程删除
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        if shm.size < HEADER_SIZE:
+            shm.close()
+            return None
+        table = cls(shm.buf, shm)
+        if not table.valid:
+            table.close()
+            return None
+        return table
+    
+    @property
+    def valid(self):
+        """值表未被写入方关闭"""
+        arrays = self._arrays
+        return arrays is not None and int(arrays[0][_MAGIC]) == MAGIC
+    
+    # 写入方
+    
+    def _begin(self, header):
+        header[_SEQUENCE] += _ONE
+    
+    def _end(self, header):
+        header[_SEQUENCE] += _ONE
+    
+    def set_points(self, point_ids):
+        """重新布局：点位配置变化后调用，全部值复位为无效"""
+        with self._write_lock:
+            self._layout(point_ids)
+    
+    def _layout(self, point_ids):
+        point_ids = sorted(set(int(point_id) for point_id in point_ids))
+        if len(point_ids) > self.capacity:
+            logger.warning(f"点位数量 {len(point_ids)} 超出值表容量 {self.capacity}，多余点位不写入值表")
+            point_ids = point_ids[:self.capacity]
+        header, ids, values, timestamps, quality = self._arrays
+        count = len(point_ids)
+        self._begin(header)
+        ids[:count] = point_ids
+        values[:count] = np.nan
+        timestamps[:count] = 0.0
+        quality[:count] = QUALITY_BAD
+        header[_COUNT] = count
+        header[_LAYOUT] += _ONE
+        self._end(header)
+        self._slots = {point_id: slot for slot, point_id in enumerate(point_ids)}
+    
+    def update(self, values, timestamp=None):
+        """
+        写入一批点位值 {point_id: 值}，值为 None 表示无效；
+        出现未布局的点位时先重新布局，写入后值表标记为活动
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        point_ids, numbers = [], []
+        for point_id, value in values.items():
+            point_ids.append(int(point_id))
+            try:
+                numbers.append(float(value) if value is not None else np.nan)
+            except (TypeError, ValueError):
+                numbers.append(np.nan)
+        numbers = np.array(numbers, dtype=np.float64)
+        flags = np.where(np.isnan(numbers), QUALITY_BAD, QUALITY_GOOD).astype(np.uint8)
+        with self._write_lock:
+            if any(point_id not in self._slots for point_id in point_ids):
+                self._layout(list(self._slots) + point_ids)
+            slots = [self._slots.get(point_id, -1) for point_id in point_ids]
+            header, _, column, timestamps, quality = self._arrays
+            self._begin(header)
+            if slots:
+                slots = np.array(slots, dtype=np.int64)
+                placed = slots >= 0
+                column[slots[placed]] = numbers[placed]
+                timestamps[slots[placed]] = timestamp
+                quality[slots[placed]] = flags[placed]
+            header[_ACTIVE] = 1
+            self._end(header)
+    
+    def set_active(self, active):
+        """数据源启停时设置活动标记（非活动时读取方不使用表中的值）"""
+        with self._write_lock:
+            header = self._arrays[0]
+            self._begin(header)
+            header[_ACTIVE] = 1 if active else 0
+            self._end(header)
+    
+    # 读取方
+    
+    def snapshot(self):
+        """复制一份一致的快照（已布局部分的 NumPy 数组），写入进行中时重试"""
+        arrays = self._arrays
+        if arrays is None:
+            raise ValueTableBusy('值表已关闭')
+        header, ids, values, timestamps, quality = arrays
+        for _ in range(MAX_READ_RETRIES):
+            sequence = int(header[_SEQUENCE])
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            count = min(int(header[_COUNT]), self.capacity)
+            snapshot = ValueSnapshot(
+                int(header[_INSTANCE]),
+                int(header[_LAYOUT]),
+                bool(header[_ACTIVE]),
+                ids[:count].copy(),
+                values[:count].copy(),
+                timestamps[:count].copy(),
+                quality[:count].copy()
+            )
+            if int(header[_SEQUENCE]) == sequence:
+                return snapshot
+        raise ValueTableBusy('值表持续写入中，未能读取一致的快照')
+    
+    def lookup(self, point_ids):
+        """批量读取指定点位，返回 (值, 时间戳, 质量) 三个数组，未布局的点位质量为 QUALITY_BAD"""
+        snapshot = self.snapshot()
+        point_ids = np.asarray(point_ids, dtype=np.int64)
+        values = np.full(len(point_ids), np.nan)
+        timestamps = np.zeros(len(point_ids))
+        quality = np.full(len(point_ids), QUALITY_BAD, dtype=np.uint8)
+        if len(snapshot.ids):
+            positions = np.minimum(np.searchsorted(snapshot.ids, point_ids), len(snapshot.ids) - 1)
+            found = snapshot.ids[positions] == point_ids
+            values[found] = snapshot.values[positions[found]]
+            timestamps[found] = snapshot.timestamps[positions[found]]
+            quality[found] = snapshot.quality[positions[found]]
+        return values, timestamps, quality
+    
+    def close(self):
+        """解除映射；写入方同时标记值表已关闭并删除共享内存段"""
+        arrays, self._arrays = self._arrays, None
+        if arrays is None:
+            return
+        if self._owner:
+            arrays[0][_MAGIC] = 0
+        del arrays
+        if self._shm is None:
+            return
+        try:
+            self._shm.close()
+        except BufferError:
+            # 其他线程仍持有数组引用，由垃圾回收释放映射
+            pass
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass